@@ -67,9 +67,6 @@ CREATE TABLE user_keys (
         ON DELETE CASCADE
 );
 
-CREATE INDEX idx_user_keys_user
-    ON user_keys(user_id);
-
 -- Only one primary key per user
 CREATE UNIQUE INDEX ux_user_keys_primary
     ON user_keys(user_id)
@@ -118,6 +115,40 @@ CREATE TABLE conversation_participants (
 );
 
 
+-- ============================================================
+-- MESSAGE SEGMENTS (cold storage)
+-- Old ciphertext packed into checksummed files under VAULT_ARCHIVE_DIR;
+-- archived messages keep their row with an empty ciphertext.
+-- ============================================================
+
+CREATE TABLE message_segments (
+
+    segment_id UUID PRIMARY KEY
+        DEFAULT gen_random_uuid(),
+
+    conversation_id UUID NOT NULL,
+
+    first_created_at TIMESTAMP NOT NULL,
+    last_created_at TIMESTAMP NOT NULL,
+    message_count INTEGER NOT NULL,
+
+    -- File size and SHA-256 as written by the archiver
+    bytes BIGINT NOT NULL,
+    sha256 BYTEA NOT NULL,
+
+    created_at TIMESTAMP NOT NULL
+        DEFAULT CURRENT_TIMESTAMP,
+
+    CONSTRAINT fk_segment_conversation
+        FOREIGN KEY (conversation_id)
+        REFERENCES conversations(conversation_id)
+        ON DELETE RESTRICT
+);
+
+CREATE INDEX idx_message_segments_conversation
+    ON message_segments(conversation_id, first_created_at);
+
+
 -- ============================================================
 -- MESSAGES
 -- Append-only, immutable, end-to-end encrypted
@@ -158,6 +189,9 @@ CREATE TABLE messages (
     created_at TIMESTAMP NOT NULL
         DEFAULT CURRENT_TIMESTAMP,
 
+    -- Set once by the archiver; ciphertext then lives in the segment file
+    segment_id UUID,
+
     CONSTRAINT fk_message_conversation
         FOREIGN KEY (conversation_id)
         REFERENCES conversations(conversation_id)
@@ -166,6 +200,11 @@ CREATE TABLE messages (
     CONSTRAINT fk_message_sender
         FOREIGN KEY (sender_id)
         REFERENCES users(user_id)
+        ON DELETE RESTRICT,
+
+    CONSTRAINT fk_message_segment
+        FOREIGN KEY (segment_id)
+        REFERENCES message_segments(segment_id)
         ON DELETE RESTRICT
 );
 
@@ -194,9 +233,6 @@ CREATE TABLE message_status (
         ON DELETE CASCADE
 );
 
-CREATE INDEX idx_ms_message
-    ON message_status(message_id);
-
 CREATE INDEX idx_ms_user
     ON message_status(user_id);
 
@@ -250,14 +286,151 @@ CREATE INDEX idx_attachments_uploader
 
 
 -- ============================================================
--- INDEXES
+-- IDEMPOTENCY KEYS
+-- Safe retries for append-only inserts (messages / attachments)
+-- ============================================================
+
+CREATE TABLE idempotency_keys (
+
+    -- sender_id / uploader_id that owns the key
+    owner_id UUID NOT NULL,
+
+    -- "message" | "attachment"
+    scope TEXT NOT NULL,
+
+    -- Client-supplied Idempotency-Key header
+    idempotency_key TEXT NOT NULL,
+
+    -- content_hash of the original request (detects key reuse)
+    request_hash BYTEA NOT NULL,
+
+    -- conversation_id (message) / message_id (attachment) the key was used for
+    target_id UUID,
+
+    resource_id UUID,
+    resource_created_at TIMESTAMP,
+
+    created_at TIMESTAMP NOT NULL
+        DEFAULT CURRENT_TIMESTAMP,
+
+    expires_at TIMESTAMP NOT NULL,
+
+    PRIMARY KEY (owner_id, scope, idempotency_key)
+);
+
+CREATE INDEX idx_idempotency_keys_expires
+    ON idempotency_keys(expires_at);
+
+
+-- ============================================================
+-- CONVERSATION PLACEMENTS (sharding directory)
+-- Conversations living outside their consistent-hash shard
+-- (server/rebalance.py); only read on the directory database
 -- ============================================================
 
-CREATE INDEX idx_messages_conversation
-    ON messages(conversation_id);
+CREATE TABLE conversation_placements (
+
+    conversation_id UUID PRIMARY KEY,
+
+    shard TEXT NOT NULL,
+
+    -- 'moving': writes paused while the last delta is copied
+    state TEXT NOT NULL DEFAULT 'active'
+        CHECK (state IN ('active', 'moving')),
+
+    updated_at TIMESTAMP NOT NULL
+        DEFAULT CURRENT_TIMESTAMP
+);
+
+
+-- ============================================================
+-- MERKLE TREES (per-conversation transparency log)
+-- RFC 6962 tree over messages.content_hash (server/merkle.py):
+-- leaves in sequencing order plus every complete internal node,
+-- so inclusion and consistency proofs read O(log n) rows.
+-- ============================================================
+
+CREATE TABLE merkle_heads (
+
+    conversation_id UUID PRIMARY KEY,
+
+    tree_size BIGINT NOT NULL,
+    root_hash BYTEA NOT NULL,
+
+    -- Newest created_at already sequenced, compared on every head update;
+    -- imports of older messages reset it to NULL
+    sequenced_until TIMESTAMP,
+
+    updated_at TIMESTAMP NOT NULL
+        DEFAULT CURRENT_TIMESTAMP,
+
+    CONSTRAINT fk_merkle_head_conversation
+        FOREIGN KEY (conversation_id)
+        REFERENCES conversations(conversation_id)
+        ON DELETE RESTRICT
+);
+
+CREATE TABLE merkle_leaves (
+
+    conversation_id UUID NOT NULL,
+    leaf_index BIGINT NOT NULL,
+
+    message_id UUID NOT NULL,
 
-CREATE INDEX idx_messages_created_at
-    ON messages(created_at);
+    -- SHA-256(0x00 || content_hash)
+    hash BYTEA NOT NULL,
+
+    created_at TIMESTAMP NOT NULL
+        DEFAULT CURRENT_TIMESTAMP,
+
+    PRIMARY KEY (conversation_id, leaf_index),
+
+    CONSTRAINT ux_merkle_leaves_message
+        UNIQUE (message_id),
+
+    CONSTRAINT fk_merkle_leaf_conversation
+        FOREIGN KEY (conversation_id)
+        REFERENCES conversations(conversation_id)
+        ON DELETE RESTRICT,
+
+    CONSTRAINT fk_merkle_leaf_message
+        FOREIGN KEY (message_id)
+        REFERENCES messages(message_id)
+        ON DELETE RESTRICT
+);
+
+CREATE TABLE merkle_nodes (
+
+    conversation_id UUID NOT NULL,
+
+    -- Covers leaves [node_index << level, (node_index + 1) << level)
+    level SMALLINT NOT NULL
+        CHECK (level > 0),
+    node_index BIGINT NOT NULL,
+
+    -- SHA-256(0x01 || left || right)
+    hash BYTEA NOT NULL,
+
+    created_at TIMESTAMP NOT NULL
+        DEFAULT CURRENT_TIMESTAMP,
+
+    PRIMARY KEY (conversation_id, level, node_index),
+
+    CONSTRAINT fk_merkle_node_conversation
+        FOREIGN KEY (conversation_id)
+        REFERENCES conversations(conversation_id)
+        ON DELETE RESTRICT
+);
+
+
+-- ============================================================
+-- INDEXES
+-- ============================================================
+
+-- Append-only: heap order follows created_at, BRIN is enough for time ranges
+CREATE INDEX idx_messages_created_at_brin
+    ON messages USING brin (created_at)
+    WITH (pages_per_range = 32, autosummarize = on);
 
 CREATE INDEX idx_messages_conversation_created
     ON messages(conversation_id, created_at);
@@ -281,17 +454,58 @@ CREATE INDEX idx_cp_user
 -- Messages are INSERT-only
 REVOKE UPDATE, DELETE, TRUNCATE ON messages FROM PUBLIC;
 
+-- The only role allowed to DELETE them (server/rebalance.py, on the source
+-- shard of a finished move). NOLOGIN: grant it to the rebalancer's own
+-- login, never to the API's
+DO $$
+BEGIN
+    IF to_regrole('vault_rebalancer') IS NULL THEN
+        CREATE ROLE vault_rebalancer NOLOGIN;
+    END IF;
+END;
+$$;
+
+GRANT SELECT, DELETE ON conversations, messages, message_segments TO vault_rebalancer;
+
+-- The only role allowed to UPDATE them, and only to stub the ciphertext of
+-- archived rows (server/archive.py). NOLOGIN as well: grant it to the
+-- archiver's own login
+DO $$
+BEGIN
+    IF to_regrole('vault_archiver') IS NULL THEN
+        CREATE ROLE vault_archiver NOLOGIN;
+    END IF;
+END;
+$$;
+
+GRANT SELECT, UPDATE ON messages TO vault_archiver;
+GRANT SELECT, INSERT ON message_segments TO vault_archiver;
+
+-- ...and so is the Merkle tree built over them
+REVOKE UPDATE, DELETE, TRUNCATE ON merkle_leaves, merkle_nodes FROM PUBLIC;
+
+GRANT SELECT, DELETE ON merkle_heads, merkle_leaves, merkle_nodes TO vault_rebalancer;
+
 
 -- ============================================================
 -- STRONG IMMUTABILITY (Defense in Depth)
 -- ============================================================
 
+-- search_path is pinned so a session cannot shadow pg_has_role
 CREATE OR REPLACE FUNCTION prevent_message_mutation()
 RETURNS trigger
 LANGUAGE plpgsql
-SECURITY DEFINER
+SET search_path = pg_catalog
 AS $$
 BEGIN
+    -- Only members of vault_archiver UPDATE (the archiver's stubs)...
+    IF TG_OP = 'UPDATE' AND pg_has_role(current_user, 'vault_archiver', 'MEMBER') THEN
+        RETURN NULL;
+    END IF;
+    -- ...and only members of vault_rebalancer DELETE
+    IF TG_OP = 'DELETE' AND pg_has_role(current_user, 'vault_rebalancer', 'MEMBER') THEN
+        RETURN NULL;
+    END IF;
     RAISE EXCEPTION
         'Messages are immutable (append-only log)';
 END;
@@ -303,5 +517,61 @@ ON messages
 FOR EACH STATEMENT
 EXECUTE FUNCTION prevent_message_mutation();
 
+-- ...and even then only to stub the ciphertext of a not yet archived row
+CREATE OR REPLACE FUNCTION restrict_message_archival()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF OLD.segment_id IS NOT NULL
+       OR NEW.segment_id IS NULL
+       OR NEW.ciphertext <> ''::bytea
+       OR (NEW.message_id, NEW.conversation_id, NEW.sender_id, NEW.content_hash,
+           NEW.prev_hash, NEW.signature, NEW.client_timestamp, NEW.key_id, NEW.created_at)
+          IS DISTINCT FROM
+          (OLD.message_id, OLD.conversation_id, OLD.sender_id, OLD.content_hash,
+           OLD.prev_hash, OLD.signature, OLD.client_timestamp, OLD.key_id, OLD.created_at)
+    THEN
+        RAISE EXCEPTION
+            'Only archival stubbing of message ciphertext is allowed';
+    END IF;
+    RETURN NEW;
+END;
+$$;
+
+CREATE TRIGGER message_archival_stub_only
+BEFORE UPDATE
+ON messages
+FOR EACH ROW
+EXECUTE FUNCTION restrict_message_archival();
+
+-- Signed tree heads commit to these hashes: only vault_rebalancer may
+-- DELETE them (source shard of a finished move), nobody may UPDATE
+CREATE OR REPLACE FUNCTION prevent_merkle_mutation()
+RETURNS trigger
+LANGUAGE plpgsql
+SET search_path = pg_catalog
+AS $$
+BEGIN
+    IF TG_OP = 'DELETE' AND pg_has_role(current_user, 'vault_rebalancer', 'MEMBER') THEN
+        RETURN NULL;
+    END IF;
+    RAISE EXCEPTION
+        'Merkle tree nodes are immutable';
+END;
+$$;
+
+CREATE TRIGGER no_merkle_leaf_update_or_delete
+BEFORE UPDATE OR DELETE OR TRUNCATE
+ON merkle_leaves
+FOR EACH STATEMENT
+EXECUTE FUNCTION prevent_merkle_mutation();
+
+CREATE TRIGGER no_merkle_node_update_or_delete
+BEFORE UPDATE OR DELETE OR TRUNCATE
+ON merkle_nodes
+FOR EACH STATEMENT
+EXECUTE FUNCTION prevent_merkle_mutation();
+
 
 COMMIT;
@@ -0,0 +1,285 @@
+-- ============================================================
+-- Secure Messaging Vault
+-- SQLite Schema (embedded engine, VAULT_STORAGE=sqlite)
+-- ============================================================
+--
+-- Same tables and rules as schema.sql. Types map as follows:
+--   UUID      -> TEXT (canonical lowercase form, generated by server/sqlite_db.py)
+--   BYTEA     -> BLOB
+--   TIMESTAMP -> TEXT 'YYYY-MM-DD HH:MM:SS.ffffff' (UTC, sorts lexically)
+--   BOOLEAN   -> INTEGER 0/1
+-- Applied by server/sqlite_db.py (PRAGMA user_version); statements after a
+-- "-- schema-version: N" line are only run on databases older than N.
+
+-- ============================================================
+-- USERS
+-- Cryptographic identities only (no personal data)
+-- ============================================================
+
+CREATE TABLE users (
+    user_id TEXT PRIMARY KEY,
+    public_key TEXT NOT NULL,
+    fingerprint BLOB NOT NULL UNIQUE,
+    created_at TIMESTAMP NOT NULL
+);
+
+-- ============================================================
+-- USER KEYS
+-- Rotatable keys per user (multi-device / key rotation)
+-- ============================================================
+
+CREATE TABLE user_keys (
+    user_id TEXT NOT NULL
+        REFERENCES users(user_id) ON DELETE CASCADE,
+    key_id TEXT NOT NULL,
+    public_key TEXT NOT NULL,
+    fingerprint BLOB NOT NULL UNIQUE,
+    is_primary BOOLEAN NOT NULL DEFAULT 0,
+    created_at TIMESTAMP NOT NULL,
+    revoked_at TIMESTAMP,
+    PRIMARY KEY (user_id, key_id)
+);
+
+-- Only one primary key per user
+CREATE UNIQUE INDEX ux_user_keys_primary
+    ON user_keys(user_id)
+    WHERE is_primary;
+
+-- ============================================================
+-- CONVERSATIONS
+-- ============================================================
+
+CREATE TABLE conversations (
+    conversation_id TEXT PRIMARY KEY,
+    created_at TIMESTAMP NOT NULL
+);
+
+CREATE TABLE conversation_participants (
+    conversation_id TEXT NOT NULL
+        REFERENCES conversations(conversation_id) ON DELETE CASCADE,
+    user_id TEXT NOT NULL
+        REFERENCES users(user_id) ON DELETE CASCADE,
+    joined_at TIMESTAMP NOT NULL,
+    PRIMARY KEY (conversation_id, user_id)
+);
+
+CREATE INDEX idx_cp_user
+    ON conversation_participants(user_id);
+
+-- ============================================================
+-- MESSAGE SEGMENTS (cold storage)
+-- ============================================================
+
+CREATE TABLE message_segments (
+    segment_id TEXT PRIMARY KEY,
+    conversation_id TEXT NOT NULL
+        REFERENCES conversations(conversation_id) ON DELETE RESTRICT,
+    first_created_at TIMESTAMP NOT NULL,
+    last_created_at TIMESTAMP NOT NULL,
+    message_count INTEGER NOT NULL,
+    bytes INTEGER NOT NULL,
+    sha256 BLOB NOT NULL,
+    created_at TIMESTAMP NOT NULL
+);
+
+CREATE INDEX idx_message_segments_conversation
+    ON message_segments(conversation_id, first_created_at);
+
+-- ============================================================
+-- MESSAGES
+-- Append-only, immutable, end-to-end encrypted
+-- ============================================================
+
+CREATE TABLE messages (
+    message_id TEXT PRIMARY KEY,
+    conversation_id TEXT NOT NULL
+        REFERENCES conversations(conversation_id) ON DELETE RESTRICT,
+    sender_id TEXT NOT NULL
+        REFERENCES users(user_id) ON DELETE RESTRICT,
+    ciphertext BLOB NOT NULL,
+    content_hash BLOB NOT NULL,
+    prev_hash BLOB,
+    signature BLOB NOT NULL,
+    client_timestamp TIMESTAMP,
+    key_id TEXT,
+    created_at TIMESTAMP NOT NULL,
+    segment_id TEXT
+        REFERENCES message_segments(segment_id) ON DELETE RESTRICT
+);
+
+CREATE INDEX idx_messages_conversation_created
+    ON messages(conversation_id, created_at);
+
+CREATE INDEX idx_messages_sender
+    ON messages(sender_id);
+
+-- ============================================================
+-- MESSAGE STATUS (Delivery / Read Receipts)
+-- ============================================================
+
+CREATE TABLE message_status (
+    message_id TEXT NOT NULL
+        REFERENCES messages(message_id) ON DELETE CASCADE,
+    user_id TEXT NOT NULL
+        REFERENCES users(user_id) ON DELETE CASCADE,
+    delivered_at TIMESTAMP,
+    read_at TIMESTAMP,
+    PRIMARY KEY (message_id, user_id)
+);
+
+CREATE INDEX idx_ms_user
+    ON message_status(user_id);
+
+-- ============================================================
+-- ATTACHMENTS (E2EE)
+-- ============================================================
+
+CREATE TABLE attachments (
+    attachment_id TEXT PRIMARY KEY,
+    message_id TEXT NOT NULL
+        REFERENCES messages(message_id) ON DELETE CASCADE,
+    uploader_id TEXT NOT NULL
+        REFERENCES users(user_id) ON DELETE RESTRICT,
+    ciphertext BLOB NOT NULL,
+    content_hash BLOB NOT NULL,
+    signature BLOB NOT NULL,
+    meta_ciphertext BLOB,
+    meta_hash BLOB,
+    meta_signature BLOB,
+    created_at TIMESTAMP NOT NULL
+);
+
+CREATE INDEX idx_attachments_message
+    ON attachments(message_id);
+
+-- ============================================================
+-- IDEMPOTENCY KEYS
+-- ============================================================
+
+CREATE TABLE idempotency_keys (
+    owner_id TEXT NOT NULL,
+    scope TEXT NOT NULL,
+    idempotency_key TEXT NOT NULL,
+    request_hash BLOB NOT NULL,
+    resource_id TEXT,
+    resource_created_at TIMESTAMP,
+    created_at TIMESTAMP NOT NULL,
+    expires_at TIMESTAMP NOT NULL,
+    PRIMARY KEY (owner_id, scope, idempotency_key)
+);
+
+CREATE INDEX idx_idempotency_keys_expires
+    ON idempotency_keys(expires_at);
+
+-- ============================================================
+-- STRONG IMMUTABILITY
+-- SQLite has no session settings: the archiver inserts 'archiving' into
+-- vault_flags inside its own write transaction (writers are serialized,
+-- nobody else can see it) and deletes it before committing.
+-- ============================================================
+
+CREATE TABLE vault_flags (
+    flag TEXT PRIMARY KEY
+);
+
+CREATE TRIGGER no_message_update
+BEFORE UPDATE ON messages
+WHEN NOT EXISTS (SELECT 1 FROM vault_flags WHERE flag = 'archiving')
+BEGIN
+    SELECT RAISE(ABORT, 'Messages are immutable (append-only log)');
+END;
+
+CREATE TRIGGER no_message_delete
+BEFORE DELETE ON messages
+BEGIN
+    SELECT RAISE(ABORT, 'Messages are immutable (append-only log)');
+END;
+
+-- ...and even then only to stub the ciphertext of a not yet archived row
+CREATE TRIGGER message_archival_stub_only
+BEFORE UPDATE ON messages
+WHEN OLD.segment_id IS NOT NULL
+  OR NEW.segment_id IS NULL
+  OR NEW.ciphertext <> X''
+  OR NEW.message_id IS NOT OLD.message_id
+  OR NEW.conversation_id IS NOT OLD.conversation_id
+  OR NEW.sender_id IS NOT OLD.sender_id
+  OR NEW.content_hash IS NOT OLD.content_hash
+  OR NEW.prev_hash IS NOT OLD.prev_hash
+  OR NEW.signature IS NOT OLD.signature
+  OR NEW.client_timestamp IS NOT OLD.client_timestamp
+  OR NEW.key_id IS NOT OLD.key_id
+  OR NEW.created_at IS NOT OLD.created_at
+BEGIN
+    SELECT RAISE(ABORT, 'Only archival stubbing of message ciphertext is allowed');
+END;
+
+
+-- schema-version: 2
+-- ============================================================
+-- MERKLE TREES (per-conversation transparency log, server/merkle.py)
+-- Leaves in sequencing order and every complete internal node;
+-- never updated once written.
+-- ============================================================
+
+CREATE TABLE merkle_heads (
+    conversation_id TEXT PRIMARY KEY
+        REFERENCES conversations(conversation_id) ON DELETE RESTRICT,
+    tree_size INTEGER NOT NULL,
+    root_hash BLOB NOT NULL,
+    -- Newest created_at already sequenced; NULL = rescan the whole conversation
+    sequenced_until TIMESTAMP,
+    updated_at TIMESTAMP NOT NULL
+);
+
+CREATE TABLE merkle_leaves (
+    conversation_id TEXT NOT NULL
+        REFERENCES conversations(conversation_id) ON DELETE RESTRICT,
+    leaf_index INTEGER NOT NULL,
+    message_id TEXT NOT NULL UNIQUE
+        REFERENCES messages(message_id) ON DELETE RESTRICT,
+    hash BLOB NOT NULL,
+    PRIMARY KEY (conversation_id, leaf_index)
+);
+
+CREATE TABLE merkle_nodes (
+    conversation_id TEXT NOT NULL
+        REFERENCES conversations(conversation_id) ON DELETE RESTRICT,
+    level INTEGER NOT NULL CHECK (level > 0),
+    node_index INTEGER NOT NULL,
+    hash BLOB NOT NULL,
+    PRIMARY KEY (conversation_id, level, node_index)
+);
+
+CREATE TRIGGER no_merkle_leaf_update
+BEFORE UPDATE ON merkle_leaves
+BEGIN
+    SELECT RAISE(ABORT, 'Merkle tree nodes are immutable');
+END;
+
+CREATE TRIGGER no_merkle_leaf_delete
+BEFORE DELETE ON merkle_leaves
+BEGIN
+    SELECT RAISE(ABORT, 'Merkle tree nodes are immutable');
+END;
+
+CREATE TRIGGER no_merkle_node_update
+BEFORE UPDATE ON merkle_nodes
+BEGIN
+    SELECT RAISE(ABORT, 'Merkle tree nodes are immutable');
+END;
+
+CREATE TRIGGER no_merkle_node_delete
+BEFORE DELETE ON merkle_nodes
+BEGIN
+    SELECT RAISE(ABORT, 'Merkle tree nodes are immutable');
+END;
+
+
+-- schema-version: 3
+-- ============================================================
+-- IDEMPOTENCY KEY TARGETS
+-- conversation_id (message) / message_id (attachment) the key was used for
+-- ============================================================
+
+ALTER TABLE idempotency_keys ADD COLUMN target_id TEXT;
@@ -2,12 +2,15 @@ import argparse
 import base64
 import hashlib
 import json
+import os
+import sys
+import time
 from pathlib import Path
 from typing import Optional
 
 import httpx
 
-from client import crypto, identity
+from client import crypto, identity, receive, transfer
 
 
 STATE_FILE = Path("client/state.json")
@@ -64,7 +67,8 @@ def cmd_register(args: argparse.Namespace) -> None:
 
 def cmd_create_conversation(args: argparse.Namespace) -> None:
     with api_client(args.api) as client:
-        resp = client.post("/conversations")
+        payload = {"participants": args.participant} if args.participant else None
+        resp = client.post("/conversations", json=payload)
         resp.raise_for_status()
         data = resp.json()
     print(f"[+] conversation_id={data['conversation_id']}")
@@ -90,6 +94,17 @@ def cmd_last_hash(args: argparse.Namespace) -> Optional[bytes]:
     return b64d(data["content_hash"])
 
 
+def fetch_primary_key(base_url: str, user_id: str):
+    with api_client(base_url) as client:
+        resp = client.get(f"/users/{user_id}/keys")
+        resp.raise_for_status()
+        keys = resp.json()
+    for k in keys:
+        if k["is_primary"] and not k["revoked_at"]:
+            return crypto.load_public_key_pem(k["public_key"])
+    raise SystemExit(f"El usuario {user_id} no tiene clave primaria activa.")
+
+
 def cmd_send_message(args: argparse.Namespace) -> None:
     ensure_keys()
     state = load_state()
@@ -98,15 +113,19 @@ def cmd_send_message(args: argparse.Namespace) -> None:
         raise SystemExit("Falta user_id. Usa --user-id o ejecuta register.")
 
     prev_hash = cmd_last_hash(args)
-    encrypted = crypto.encrypt_message(args.message.encode())
+    if args.to:
+        recipients = [crypto.load_public_key()]
+        recipients += [fetch_primary_key(args.api, rid) for rid in args.to]
+        encrypted = crypto.encrypt_group_message(
+            args.message.encode(), recipients, compress=args.compress
+        )
+    else:
+        encrypted = crypto.encrypt_message(args.message.encode(), compress=args.compress)
     ciphertext = encrypted["ciphertext"]
 
-    content_hash = hashlib.sha256(
-        ciphertext
-        + user_id.encode()
-        + args.conversation_id.encode()
-        + (prev_hash or b"")
-    ).digest()
+    content_hash = crypto.calculate_message_hash(
+        ciphertext, user_id, args.conversation_id, prev_hash
+    )
     signature = crypto.sign_hash(content_hash)
 
     payload = {
@@ -127,13 +146,15 @@ def cmd_send_message(args: argparse.Namespace) -> None:
         resp.raise_for_status()
         data = resp.json()
 
-    # Store local key/nonce for demo decryption (same device)
-    state.setdefault("message_keys", {})
-    state["message_keys"][data["message_id"]] = {
-        "key": b64e(encrypted["key"]),
-        "nonce": b64e(encrypted["nonce"]),
-    }
-    save_state(state)
+    # Store local key/nonce for demo decryption (same device).
+    # Group envelopes carry their wrapped keys, nothing to keep locally.
+    if not args.to:
+        state.setdefault("message_keys", {})
+        state["message_keys"][data["message_id"]] = {
+            "key": b64e(encrypted["key"]),
+            "nonce": b64e(encrypted["nonce"]),
+        }
+        save_state(state)
     print(f"[+] mensaje enviado: {data['message_id']}")
 
 
@@ -152,7 +173,21 @@ def cmd_list_messages(args: argparse.Namespace) -> None:
         resp.raise_for_status()
         data = resp.json()
 
-    print(json.dumps(data, indent=2))
+        if not args.verify:
+            print(json.dumps(data, indent=2))
+            return
+
+        results = receive.receive_many(
+            args.conversation_id,
+            data,
+            receive.api_key_resolver(client),
+            message_keys=load_state().get("message_keys"),
+            private_key=crypto.load_private_key() if crypto.PRIVATE_KEY_FILE.exists() else None,
+        )
+
+    for r in results:
+        text = r["plaintext"].decode(errors="replace") if r["plaintext"] else ""
+        print(f"{r['message_id']} [{r['status']}] {text}")
 
 
 def cmd_mark_delivered(args: argparse.Namespace) -> None:
@@ -224,6 +259,126 @@ def cmd_get_attachment(args: argparse.Namespace) -> None:
     print(json.dumps(data, indent=2))
 
 
+class Progress:
+    def __init__(self, label: str, total: Optional[int] = None):
+        self.label = label
+        self.total = total
+        self.done = 0
+        self.started = time.monotonic()
+        self._shown = 0.0
+
+    def add(self, n: int, final: bool = False) -> None:
+        self.done += n
+        now = time.monotonic()
+        if not final and now - self._shown < 0.5:
+            return
+        self._shown = now
+        rate = self.done / max(now - self.started, 1e-6) / 1e6
+        total = f"/{self.total / 1e6:.1f}" if self.total else ""
+        end = "\n" if final else ""
+        print(f"\r[{self.label}] {self.done / 1e6:.1f}{total} MB  {rate:.1f} MB/s", end=end,
+              file=sys.stderr, flush=True)
+
+
+def cmd_export(args: argparse.Namespace) -> None:
+    user_id = args.user_id or load_state().get("user_id")
+    if not user_id:
+        raise SystemExit("Falta user_id. Usa --user-id o ejecuta register.")
+    path = Path(args.file)
+    params = {"user_id": user_id, "format": args.format, "attachments": args.attachments}
+
+    # Reanudación: se descarta el registro a medias y se pide desde el último mensaje
+    offset = 0
+    if path.exists() and path.stat().st_size:
+        with open(path, "rb") as fh:
+            state = transfer.resume_point(fh)
+            fmt = transfer.detect_format(fh)
+        if state["complete"]:
+            print(f"[=] {path} ya está completo")
+            return
+        if state["header"] and state["last_message_id"]:
+            offset = state["valid_until"]
+            params.update(format=fmt, after=state["last_message_id"])
+            print(f"[~] reanudando tras {state['last_message_id']} (byte {offset})")
+
+    with open(path, "r+b" if offset else "wb") as fh:
+        fh.truncate(offset)
+        fh.seek(offset)
+        progress = Progress("export")
+        with api_client(args.api) as client:
+            with client.stream(
+                "GET", f"/conversations/{args.conversation_id}/export",
+                params=params, timeout=None,
+            ) as resp:
+                resp.raise_for_status()
+                for chunk in resp.iter_bytes():
+                    fh.write(chunk)
+                    progress.add(len(chunk))
+        progress.add(0, final=True)
+
+    with open(path, "rb") as fh:
+        state = transfer.resume_point(fh)
+    if not state["complete"]:
+        raise SystemExit("[!] exportación incompleta; vuelve a ejecutar para reanudar")
+    print(f"[+] exportado en {path}")
+
+
+def cmd_import(args: argparse.Namespace) -> None:
+    token = args.admin_token or os.getenv("VAULT_ADMIN_TOKEN")
+    if not token:
+        raise SystemExit("Falta el token de admin. Usa --admin-token o VAULT_ADMIN_TOKEN.")
+    path = Path(args.file)
+    with open(path, "rb") as fh:
+        state = transfer.resume_point(fh)
+    if not state["header"]:
+        raise SystemExit(f"{path} no empieza con un header de exportación")
+    _, header_end, header = state["header"]
+    conversation_id = args.conversation_id or header["conversation_id"]
+
+    # Reanudación: lo que ya está en el servidor termina en su último hash
+    offset = header_end
+    with api_client(args.api) as client:
+        resp = client.get(f"/conversations/{conversation_id}/messages/last-hash")
+        last_hash = resp.json().get("content_hash") if resp.status_code == 200 else None
+    if last_hash:
+        with open(path, "rb") as fh:
+            found = transfer.find_message_end(fh, last_hash)
+        if found:
+            offset = found
+            print(f"[~] reanudando desde el byte {offset}")
+        else:
+            print("[!] el último mensaje del servidor no está en el fichero; se reenvía todo")
+
+    size = path.stat().st_size
+    progress = Progress("import", header_end + size - offset)
+
+    def body():
+        with open(path, "rb") as fh:
+            # header (y MAGIC en binary) siempre, luego el resto desde `offset`
+            head = fh.read(header_end)
+            progress.add(len(head))
+            yield head
+            fh.seek(offset)
+            while True:
+                chunk = fh.read(1024 * 1024)
+                if not chunk:
+                    break
+                progress.add(len(chunk))
+                yield chunk
+
+    with api_client(args.api) as client:
+        resp = client.post(
+            f"/conversations/{conversation_id}/import",
+            content=body(),
+            headers={"X-Admin-Token": token, "Content-Type": "application/octet-stream"},
+            timeout=None,
+        )
+    progress.add(0, final=True)
+    if resp.status_code >= 400:
+        raise SystemExit(f"[!] importación rechazada ({resp.status_code}): {resp.text}")
+    print(json.dumps(resp.json(), indent=2))
+
+
 def main() -> None:
     parser = argparse.ArgumentParser(description="Secure Vault CLI")
     parser.add_argument("--api", default="http://localhost:8000")
@@ -233,6 +388,7 @@ def main() -> None:
     sub.add_parser("register")
 
     c1 = sub.add_parser("create-conversation")
+    c1.add_argument("--participant", action="append", metavar="USER_ID")
 
     c2 = sub.add_parser("add-participant")
     c2.add_argument("conversation_id")
@@ -244,11 +400,14 @@ def main() -> None:
     c3.add_argument("--user-id")
     c3.add_argument("--key-id")
     c3.add_argument("--client-timestamp", default=None)
+    c3.add_argument("--compress", action="store_true")
+    c3.add_argument("--to", action="append", metavar="USER_ID")
 
     c4 = sub.add_parser("list-messages")
     c4.add_argument("conversation_id")
     c4.add_argument("--after")
     c4.add_argument("--limit", type=int, default=50)
+    c4.add_argument("--verify", action="store_true")
 
     c5 = sub.add_parser("delivered")
     c5.add_argument("message_id")
@@ -279,6 +438,18 @@ def main() -> None:
     c10.add_argument("attachment_id")
     c10.add_argument("user_id")
 
+    c11 = sub.add_parser("export")
+    c11.add_argument("conversation_id")
+    c11.add_argument("file")
+    c11.add_argument("--user-id")
+    c11.add_argument("--format", choices=("ndjson", "binary"), default="ndjson")
+    c11.add_argument("--attachments", choices=("ref", "full"), default="ref")
+
+    c12 = sub.add_parser("import")
+    c12.add_argument("file")
+    c12.add_argument("--conversation-id")
+    c12.add_argument("--admin-token")
+
     args = parser.parse_args()
 
     if args.cmd == "register":
@@ -303,6 +474,10 @@ def main() -> None:
         cmd_list_attachments(args)
     elif args.cmd == "get-attachment":
         cmd_get_attachment(args)
+    elif args.cmd == "export":
+        cmd_export(args)
+    elif args.cmd == "import":
+        cmd_import(args)
 
 
 if __name__ == "__main__":
@@ -1,13 +1,23 @@
 import os
 import hashlib
+import struct
+import threading
 from pathlib import Path
+from typing import Optional
 
+from cryptography.exceptions import InvalidTag
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
-from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric.ed25519 import (
     Ed25519PrivateKey,
     Ed25519PublicKey
 )
+from cryptography.hazmat.primitives.asymmetric.x25519 import (
+    X25519PrivateKey,
+    X25519PublicKey
+)
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.keywrap import aes_key_wrap, aes_key_unwrap
 
 
 # ============================================================
@@ -36,11 +46,121 @@ def load_public_key() -> Ed25519PublicKey:
     )
 
 
+def load_public_key_pem(public_key: str) -> Ed25519PublicKey:
+    """
+    Clave pública tal como la devuelve GET /users/{user_id}/keys (PEM)
+    """
+    return serialization.load_pem_public_key(public_key.encode())
+
+
+# ============================================================
+# COMPRESSION (dentro del sobre cifrado)
+# ============================================================
+
+try:
+    import zstandard
+except ImportError:  # dependencia opcional: sin ella no se comprime
+    zstandard = None
+
+# El sobre va autenticado con este AAD; el primer byte del texto
+# descifrado indica cómo está codificado el cuerpo.
+ENVELOPE_AAD = b"sv-envelope-v1"
+
+FLAG_RAW = 0x00
+FLAG_ZSTD = 0x01
+FLAG_ZSTD_DICT = 0x02
+
+# Por debajo de este tamaño la cabecera de zstd no compensa
+COMPRESS_MIN_SIZE = 128
+# Con diccionario entrenado los mensajes cortos de chat sí encogen (es
+# para lo que existe); igualmente solo se guarda si sale más pequeño
+COMPRESS_DICT_MIN_SIZE = 16
+COMPRESS_LEVEL = 3
+
+# Un ZstdCompressor / ZstdDecompressor no admite dos hilos a la vez y
+# receive_many descifra en un ThreadPoolExecutor: uno por hilo y diccionario
+_local = threading.local()
+
+
+def train_dictionary(samples: list, dict_size: int = 16 * 1024) -> bytes:
+    """
+    Entrena un diccionario zstd con mensajes cortos de ejemplo.
+    El mismo diccionario debe estar disponible al descifrar.
+    """
+    if zstandard is None:
+        raise RuntimeError("zstandard no está instalado")
+    return zstandard.train_dictionary(dict_size, samples).as_bytes()
+
+
+def _zstd_dict(zstd_dict: Optional[bytes]):
+    if zstd_dict is None:
+        return None
+    return zstandard.ZstdCompressionDict(zstd_dict)
+
+
+def _compressor(zstd_dict: Optional[bytes]):
+    compressors = _local.__dict__.setdefault("compressors", {})
+    compressor = compressors.get(zstd_dict)
+    if compressor is None:
+        compressor = zstandard.ZstdCompressor(
+            level=COMPRESS_LEVEL,
+            dict_data=_zstd_dict(zstd_dict),
+        )
+        compressors[zstd_dict] = compressor
+    return compressor
+
+
+def _decompressor(zstd_dict: Optional[bytes]):
+    decompressors = _local.__dict__.setdefault("decompressors", {})
+    decompressor = decompressors.get(zstd_dict)
+    if decompressor is None:
+        decompressor = zstandard.ZstdDecompressor(dict_data=_zstd_dict(zstd_dict))
+        decompressors[zstd_dict] = decompressor
+    return decompressor
+
+
+def encode_body(
+    plaintext: bytes,
+    compress: bool = False,
+    zstd_dict: Optional[bytes] = None,
+) -> bytes:
+    """
+    Cuerpo del sobre: 1 byte de flags + contenido (comprimido o no).
+    Solo se comprime si hay zstandard, el texto supera COMPRESS_MIN_SIZE
+    (COMPRESS_DICT_MIN_SIZE con diccionario) y el resultado es realmente
+    más pequeño.
+    """
+    min_size = COMPRESS_DICT_MIN_SIZE if zstd_dict is not None else COMPRESS_MIN_SIZE
+    if compress and zstandard is not None and len(plaintext) >= min_size:
+        compressed = _compressor(zstd_dict).compress(plaintext)
+        if len(compressed) < len(plaintext):
+            flag = FLAG_ZSTD_DICT if zstd_dict is not None else FLAG_ZSTD
+            return bytes([flag]) + compressed
+    return bytes([FLAG_RAW]) + plaintext
+
+
+def decode_body(body: bytes, zstd_dict: Optional[bytes] = None) -> bytes:
+    flag, payload = body[0], body[1:]
+    if flag == FLAG_RAW:
+        return payload
+    if flag not in (FLAG_ZSTD, FLAG_ZSTD_DICT):
+        raise ValueError(f"Flag de sobre desconocido: {flag}")
+    if zstandard is None:
+        raise RuntimeError("Mensaje comprimido con zstd y zstandard no está instalado")
+    if flag == FLAG_ZSTD_DICT and zstd_dict is None:
+        raise ValueError("Mensaje comprimido con diccionario: falta zstd_dict")
+    return _decompressor(zstd_dict if flag == FLAG_ZSTD_DICT else None).decompress(payload)
+
+
 # ============================================================
 # AES-GCM ENCRYPTION
 # ============================================================
 
-def encrypt_message(plaintext: bytes) -> dict:
+def encrypt_message(
+    plaintext: bytes,
+    compress: bool = False,
+    zstd_dict: Optional[bytes] = None,
+) -> dict:
     """
     Retorna un dict explícito (contrato estable)
     """
@@ -48,7 +168,8 @@ def encrypt_message(plaintext: bytes) -> dict:
     nonce = os.urandom(12)
 
     aesgcm = AESGCM(key)
-    ciphertext = aesgcm.encrypt(nonce, plaintext, None)
+    body = encode_body(plaintext, compress, zstd_dict)
+    ciphertext = aesgcm.encrypt(nonce, body, ENVELOPE_AAD)
 
     return {
         "ciphertext": ciphertext,
@@ -57,9 +178,164 @@ def encrypt_message(plaintext: bytes) -> dict:
     }
 
 
-def decrypt_message(ciphertext: bytes, nonce: bytes, key: bytes) -> bytes:
+def decrypt_message(
+    ciphertext: bytes,
+    nonce: bytes,
+    key: bytes,
+    zstd_dict: Optional[bytes] = None,
+) -> bytes:
     aesgcm = AESGCM(key)
-    return aesgcm.decrypt(nonce, ciphertext, None)
+    try:
+        body = aesgcm.decrypt(nonce, ciphertext, ENVELOPE_AAD)
+    except InvalidTag:
+        # Mensajes anteriores al sobre versionado: texto plano sin AAD
+        return aesgcm.decrypt(nonce, ciphertext, None)
+    return decode_body(body, zstd_dict)
+
+
+# ============================================================
+# GROUP ENVELOPES (cifrar una vez, envolver la clave por destinatario)
+# ============================================================
+
+# magic(4) | ephemeral_pub(32) | nonce(12) | count(u16) |
+# count x [recipient_id(8) | wrapped_key(40)] | cuerpo AES-GCM
+GROUP_MAGIC = b"SVG1"
+GROUP_RECIPIENT_ID_SIZE = 8
+GROUP_WRAPPED_KEY_SIZE = 40
+GROUP_ENTRY_SIZE = GROUP_RECIPIENT_ID_SIZE + GROUP_WRAPPED_KEY_SIZE
+_GROUP_HEADER = struct.Struct(">4s32s12sH")
+_GROUP_WRAP_INFO = b"sv-group-wrap-v1"
+
+# Curve25519: p = 2^255 - 19
+_P25519 = 2 ** 255 - 19
+
+
+def ed25519_public_to_x25519(public_key: Ed25519PublicKey) -> X25519PublicKey:
+    """
+    Mapa birracional Edwards -> Montgomery: u = (1 + y) / (1 - y) mod p.
+    Permite cifrar hacia las claves Ed25519 ya registradas en user_keys.
+    """
+    raw = public_key.public_bytes(
+        encoding=serialization.Encoding.Raw,
+        format=serialization.PublicFormat.Raw,
+    )
+    y = int.from_bytes(raw, "little") & ((1 << 255) - 1)
+    u = (1 + y) * pow(1 - y, _P25519 - 2, _P25519) % _P25519
+    return X25519PublicKey.from_public_bytes(u.to_bytes(32, "little"))
+
+
+def ed25519_private_to_x25519(private_key: Ed25519PrivateKey) -> X25519PrivateKey:
+    seed = private_key.private_bytes(
+        encoding=serialization.Encoding.Raw,
+        format=serialization.PrivateFormat.Raw,
+        encryption_algorithm=serialization.NoEncryption(),
+    )
+    # X25519PrivateKey aplica el clamping sobre el escalar
+    return X25519PrivateKey.from_private_bytes(hashlib.sha512(seed).digest()[:32])
+
+
+def _x25519_raw(public_key: X25519PublicKey) -> bytes:
+    return public_key.public_bytes(
+        encoding=serialization.Encoding.Raw,
+        format=serialization.PublicFormat.Raw,
+    )
+
+
+def _group_recipient_id(recipient_raw: bytes) -> bytes:
+    return calculate_hash(recipient_raw)[:GROUP_RECIPIENT_ID_SIZE]
+
+
+def _group_kek(shared: bytes, ephemeral_raw: bytes, recipient_raw: bytes) -> bytes:
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=_GROUP_WRAP_INFO + ephemeral_raw + recipient_raw,
+    ).derive(shared)
+
+
+def is_group_envelope(ciphertext: bytes) -> bool:
+    return ciphertext[:len(GROUP_MAGIC)] == GROUP_MAGIC
+
+
+def encrypt_group_message(
+    plaintext: bytes,
+    recipients: list,
+    compress: bool = False,
+    zstd_dict: Optional[bytes] = None,
+) -> dict:
+    """
+    Cifra el cuerpo una sola vez y envuelve la clave AES por destinatario
+    (X25519 efímero + HKDF + AES key wrap). Cada destinatario añade
+    GROUP_ENTRY_SIZE bytes al ciphertext.
+
+    `recipients` son claves públicas Ed25519; el emisor debe incluirse
+    si quiere poder releer sus propios mensajes.
+    """
+    if not recipients:
+        raise ValueError("Se necesita al menos un destinatario")
+
+    content_key = AESGCM.generate_key(bit_length=256)
+    nonce = os.urandom(12)
+    ephemeral = X25519PrivateKey.generate()
+    ephemeral_raw = _x25519_raw(ephemeral.public_key())
+
+    entries = {}
+    for recipient in recipients:
+        recipient_x = ed25519_public_to_x25519(recipient)
+        recipient_raw = _x25519_raw(recipient_x)
+        kek = _group_kek(ephemeral.exchange(recipient_x), ephemeral_raw, recipient_raw)
+        entries[_group_recipient_id(recipient_raw)] = aes_key_wrap(kek, content_key)
+
+    header = _GROUP_HEADER.pack(GROUP_MAGIC, ephemeral_raw, nonce, len(entries))
+    header += b"".join(rid + wrapped for rid, wrapped in entries.items())
+
+    body = encode_body(plaintext, compress, zstd_dict)
+    ciphertext = header + AESGCM(content_key).encrypt(nonce, body, header)
+
+    return {
+        "ciphertext": ciphertext,
+        "recipients": len(entries),
+    }
+
+
+def decrypt_group_message(
+    ciphertext: bytes,
+    private_key: Optional[Ed25519PrivateKey] = None,
+    zstd_dict: Optional[bytes] = None,
+) -> bytes:
+    """
+    Desenvuelve solo la entrada del lector y descifra el cuerpo.
+    La cabecera completa (incluida la lista de destinatarios) es el AAD.
+    """
+    if not is_group_envelope(ciphertext):
+        raise ValueError("No es un sobre de grupo")
+    if private_key is None:
+        private_key = load_private_key()
+
+    _, ephemeral_raw, nonce, count = _GROUP_HEADER.unpack_from(ciphertext)
+    body_offset = _GROUP_HEADER.size + count * GROUP_ENTRY_SIZE
+    if len(ciphertext) < body_offset:
+        raise ValueError("Sobre de grupo truncado")
+
+    own_x = ed25519_private_to_x25519(private_key)
+    own_raw = _x25519_raw(own_x.public_key())
+    own_id = _group_recipient_id(own_raw)
+
+    wrapped = None
+    for offset in range(_GROUP_HEADER.size, body_offset, GROUP_ENTRY_SIZE):
+        if ciphertext[offset:offset + GROUP_RECIPIENT_ID_SIZE] == own_id:
+            wrapped = ciphertext[offset + GROUP_RECIPIENT_ID_SIZE:offset + GROUP_ENTRY_SIZE]
+            break
+    if wrapped is None:
+        raise ValueError("La clave local no es destinataria del mensaje")
+
+    shared = own_x.exchange(X25519PublicKey.from_public_bytes(ephemeral_raw))
+    content_key = aes_key_unwrap(_group_kek(shared, ephemeral_raw, own_raw), wrapped)
+
+    header = ciphertext[:body_offset]
+    body = AESGCM(content_key).decrypt(nonce, ciphertext[body_offset:], header)
+    return decode_body(body, zstd_dict)
 
 
 # ============================================================
@@ -74,6 +350,23 @@ def calculate_hash(data: bytes) -> bytes:
     return hashlib.sha256(data).digest()
 
 
+def calculate_message_hash(
+    ciphertext: bytes,
+    sender_id: str,
+    conversation_id: str,
+    prev_hash: Optional[bytes],
+) -> bytes:
+    """
+    content_hash = SHA-256(ciphertext + sender_id + conversation_id + prev_hash)
+    """
+    return calculate_hash(
+        ciphertext
+        + sender_id.encode()
+        + conversation_id.encode()
+        + (prev_hash or b"")
+    )
+
+
 def sign_hash(content_hash: bytes) -> bytes:
     private_key = load_private_key()
     return private_key.sign(content_hash)
@@ -95,8 +388,12 @@ def verify_signature(
 # HIGH-LEVEL OPERATION
 # ============================================================
 
-def encrypt_and_sign(plaintext: bytes) -> dict:
-    encrypted = encrypt_message(plaintext)
+def encrypt_and_sign(
+    plaintext: bytes,
+    compress: bool = False,
+    zstd_dict: Optional[bytes] = None,
+) -> dict:
+    encrypted = encrypt_message(plaintext, compress, zstd_dict)
 
     content_hash = calculate_hash(encrypted["ciphertext"])
     signature = sign_hash(content_hash)
@@ -1,11 +1,37 @@
+import base64
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from cryptography.hazmat.primitives.asymmetric.ed25519 import (
+    Ed25519PrivateKey,
+    Ed25519PublicKey,
+)
+
 from client.crypto import (
     decrypt_message,
+    decrypt_group_message,
+    is_group_envelope,
     verify_signature,
     load_public_key,
-    calculate_hash
+    load_public_key_pem,
+    calculate_hash,
+    calculate_message_hash,
 )
 
 
+# ============================================================
+# RESULT STATUS (receive_many)
+# ============================================================
+
+STATUS_OK = "ok"
+STATUS_BAD_HASH = "bad-hash"
+STATUS_BAD_SIGNATURE = "bad-signature"
+STATUS_UNKNOWN_KEY = "unknown-key"
+STATUS_DECRYPT_FAILED = "decrypt-failed"
+
+KeyResolver = Callable[[str, str], Optional[Ed25519PublicKey]]
+
+
 def receive(payload: dict):
     print("\n[📥] Mensaje recibido")
 
@@ -60,6 +86,139 @@ def receive(payload: dict):
     return plaintext
 
 
+# ============================================================
+# BATCH RECEIVE (páginas de GET /conversations/{id}/messages)
+# ============================================================
+
+def api_key_resolver(client) -> KeyResolver:
+    """
+    Resuelve (sender_id, key_id) con GET /users/{user_id}/keys.
+    Una sola petición por emisor; las claves parseadas se reutilizan.
+    """
+    cache: Dict[str, Dict[str, Ed25519PublicKey]] = {}
+
+    def resolve(sender_id: str, key_id: str) -> Optional[Ed25519PublicKey]:
+        if sender_id not in cache:
+            resp = client.get(f"/users/{sender_id}/keys")
+            keys = {}
+            if resp.status_code == 200:
+                for k in resp.json():
+                    try:
+                        keys[k["key_id"]] = load_public_key_pem(k["public_key"])
+                    except ValueError:
+                        continue
+            cache[sender_id] = keys
+        return cache[sender_id].get(key_id)
+
+    return resolve
+
+
+def _b64(value: Optional[str]) -> Optional[bytes]:
+    if value is None:
+        return None
+    return base64.b64decode(value)
+
+
+def _process_one(
+    conversation_id: str,
+    message: dict,
+    public_key: Optional[Ed25519PublicKey],
+    message_key: Optional[dict],
+    private_key: Optional[Ed25519PrivateKey] = None,
+    zstd_dict: Optional[bytes] = None,
+) -> dict:
+    result = {
+        "message_id": message["message_id"],
+        "sender_id": message["sender_id"],
+        "status": STATUS_OK,
+        "plaintext": None,
+    }
+
+    if public_key is None:
+        result["status"] = STATUS_UNKNOWN_KEY
+        return result
+
+    ciphertext = _b64(message["ciphertext"])
+    received_hash = _b64(message["content_hash"])
+    calculated_hash = calculate_message_hash(
+        ciphertext,
+        message["sender_id"],
+        conversation_id,
+        _b64(message.get("prev_hash")),
+    )
+    if calculated_hash != received_hash:
+        result["status"] = STATUS_BAD_HASH
+        return result
+
+    if not verify_signature(received_hash, _b64(message["signature"]), public_key):
+        result["status"] = STATUS_BAD_SIGNATURE
+        return result
+
+    try:
+        if message_key:
+            result["plaintext"] = decrypt_message(
+                ciphertext,
+                _b64(message_key["nonce"]),
+                _b64(message_key["key"]),
+                zstd_dict,
+            )
+        elif private_key is not None and is_group_envelope(ciphertext):
+            result["plaintext"] = decrypt_group_message(ciphertext, private_key, zstd_dict)
+    except Exception:
+        result["status"] = STATUS_DECRYPT_FAILED
+
+    return result
+
+
+def receive_many(
+    conversation_id: str,
+    messages: Iterable[dict],
+    resolve_key: KeyResolver,
+    message_keys: Optional[Dict[str, dict]] = None,
+    max_workers: Optional[int] = None,
+    private_key: Optional[Ed25519PrivateKey] = None,
+    zstd_dict: Optional[bytes] = None,
+) -> List[dict]:
+    """
+    Verifica y descifra una página de mensajes tal como la devuelve el API
+    (campos binarios en base64). No imprime nada: devuelve un dict por
+    mensaje, en el mismo orden, con `status` en:
+    ok / bad-hash / bad-signature / unknown-key / decrypt-failed.
+
+    `message_keys` tiene el formato de state.json:
+    {message_id: {"key": base64, "nonce": base64}}. Los sobres de grupo se
+    abren con `private_key`. Sin clave el mensaje se verifica igual y
+    `plaintext` queda en None.
+    """
+    messages = list(messages)
+    message_keys = message_keys or {}
+
+    # Resolución de claves: una vez por (sender_id, key_id), en serie
+    # porque normalmente implica red.
+    public_keys: Dict[Tuple[str, str], Optional[Ed25519PublicKey]] = {}
+    for m in messages:
+        ref = (m["sender_id"], m.get("key_id") or "primary")
+        if ref not in public_keys:
+            public_keys[ref] = resolve_key(*ref)
+
+    def work(m: dict) -> dict:
+        ref = (m["sender_id"], m.get("key_id") or "primary")
+        return _process_one(
+            conversation_id,
+            m,
+            public_keys[ref],
+            message_keys.get(m["message_id"]),
+            private_key,
+            zstd_dict,
+        )
+
+    if len(messages) <= 1:
+        return [work(m) for m in messages]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(work, messages))
+
+
 def main():
     print(
         "[!] Este módulo no se ejecuta solo.\n"
@@ -0,0 +1,80 @@
+import json
+import struct
+from typing import BinaryIO, Iterator, Tuple
+
+
+# Mismo formato que server/transfer.py
+MAGIC = b"SVEXP\x00\x01\n"
+_FRAME = struct.Struct(">cII")
+
+
+def detect_format(fh: BinaryIO) -> str:
+    fh.seek(0)
+    start = fh.read(len(MAGIC))
+    fh.seek(0)
+    return "binary" if start == MAGIC else "ndjson"
+
+
+def iter_records(fh: BinaryIO) -> Iterator[Tuple[int, int, dict]]:
+    """
+    (inicio, fin, registro) de cada registro completo del fichero; un
+    registro truncado al final (exportación interrumpida) no se devuelve.
+    En binary el ciphertext (blob) no se lee.
+    """
+    if detect_format(fh) == "ndjson":
+        pos = 0
+        for line in fh:
+            end = pos + len(line)
+            if not line.endswith(b"\n"):
+                return
+            if line.strip():
+                try:
+                    yield pos, end, json.loads(line)
+                except ValueError:
+                    return
+            pos = end
+        return
+
+    size = fh.seek(0, 2)
+    pos = len(MAGIC)
+    while pos + _FRAME.size <= size:
+        fh.seek(pos)
+        _, body_len, blob_len = _FRAME.unpack(fh.read(_FRAME.size))
+        end = pos + _FRAME.size + body_len + blob_len
+        if end > size:
+            return
+        body = fh.read(body_len)
+        try:
+            record = json.loads(body)
+        except ValueError:
+            return
+        yield pos, end, record
+        pos = end
+
+
+def resume_point(fh: BinaryIO) -> dict:
+    """
+    Estado de una exportación en disco: si está completa, hasta qué byte
+    es válida y el último message_id escrito.
+    """
+    state = {"complete": False, "header": None, "valid_until": 0, "last_message_id": None}
+    for start, end, record in iter_records(fh):
+        kind = record.get("type")
+        if kind == "header":
+            state["header"] = (start, end, record)
+        elif kind == "message":
+            state["last_message_id"] = record["message_id"]
+        elif kind == "end":
+            state["complete"] = True
+        state["valid_until"] = end
+    return state
+
+
+def find_message_end(fh: BinaryIO, content_hash_b64: str) -> int:
+    """
+    Byte donde termina el mensaje con ese content_hash (0 si no está).
+    """
+    for _, end, record in iter_records(fh):
+        if record.get("type") == "message" and record.get("content_hash") == content_hash_b64:
+            return end
+    return 0
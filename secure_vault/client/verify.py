@@ -1,9 +1,349 @@
-from client.crypto import verify_signature, load_public_key
+import argparse
+import base64
+import hashlib
+import json
+import struct
+import sys
+import uuid
+from pathlib import Path
+from typing import Iterable, Optional
 
+import httpx
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PublicKey
 
-def main():
-    print("[!] verify.py se usará para auditoría e integridad histórica")
-    print("Verificación de cadenas de mensajes (prev_hash)")
+from client.crypto import calculate_message_hash
+
+
+# ============================================================
+# CONFIG
+#
+# Auditoría de conversaciones sin confiar en el servidor:
+#   chain  recorre los mensajes y comprueba content_hash y prev_hash
+#   proof  verifica la cabecera firmada del árbol de Merkle, que el árbol
+#          solo crece respecto a la última vista (prueba de consistencia)
+#          y, si se piden, que ciertos mensajes están dentro (inclusión)
+# ============================================================
+
+# Clave del registro fijada la primera vez y última cabecera verificada
+# de cada conversación
+TREE_HEADS_FILE = Path("client/tree_heads.json")
+
+# Mismo dominio que server/merkle.py
+TREE_HEAD_CONTEXT = b"secure-vault/tree-head/v1\x00"
+
+
+class VerificationError(Exception):
+    pass
+
+
+def b64e(data: bytes) -> str:
+    return base64.b64encode(data).decode()
+
+
+def b64d(text: Optional[str]) -> Optional[bytes]:
+    return base64.b64decode(text) if text is not None else None
+
+
+# ============================================================
+# MERKLE (RFC 6962 / RFC 9162)
+# ============================================================
+
+EMPTY_ROOT = hashlib.sha256(b"").digest()
+
+
+def leaf_hash(content_hash: bytes) -> bytes:
+    return hashlib.sha256(b"\x00" + content_hash).digest()
+
+
+def node_hash(left: bytes, right: bytes) -> bytes:
+    return hashlib.sha256(b"\x01" + left + right).digest()
+
+
+def verify_inclusion(
+    leaf_index: int,
+    tree_size: int,
+    leaf: bytes,
+    path: Iterable[bytes],
+    root: bytes,
+) -> bool:
+    """
+    RFC 9162 §2.1.3.2: `leaf` (hash de hoja) está en la posición
+    `leaf_index` del árbol de `tree_size` hojas con raíz `root`.
+    """
+    if leaf_index >= tree_size:
+        return False
+    fn, sn, r = leaf_index, tree_size - 1, leaf
+    for p in path:
+        if sn == 0:
+            return False
+        if fn & 1 or fn == sn:
+            r = node_hash(p, r)
+            while not fn & 1 and fn != 0:
+                fn >>= 1
+                sn >>= 1
+        else:
+            r = node_hash(r, p)
+        fn >>= 1
+        sn >>= 1
+    return sn == 0 and r == root
+
+
+def verify_consistency(
+    first: int,
+    second: int,
+    first_root: bytes,
+    second_root: bytes,
+    path: Iterable[bytes],
+) -> bool:
+    """
+    RFC 9162 §2.1.4.2: el árbol de `first` hojas es prefijo del de `second`.
+    """
+    path = list(path)
+    if first > second:
+        return False
+    if first == second:
+        return not path and first_root == second_root
+    if first == 0:
+        return not path
+    if not path:
+        return False
+    if first & (first - 1) == 0:
+        path.insert(0, first_root)
+
+    fn, sn = first - 1, second - 1
+    while fn & 1:
+        fn >>= 1
+        sn >>= 1
+    fr = sr = path[0]
+    for c in path[1:]:
+        if sn == 0:
+            return False
+        if fn & 1 or fn == sn:
+            fr = node_hash(c, fr)
+            sr = node_hash(c, sr)
+            while not fn & 1 and fn != 0:
+                fn >>= 1
+                sn >>= 1
+        else:
+            sr = node_hash(sr, c)
+        fn >>= 1
+        sn >>= 1
+    return sn == 0 and fr == first_root and sr == second_root
+
+
+def tree_head_message(conversation_id: str, tree_size: int, timestamp: int, root_hash: bytes) -> bytes:
+    return (
+        TREE_HEAD_CONTEXT
+        + uuid.UUID(conversation_id).bytes
+        + struct.pack(">QQ", tree_size, timestamp)
+        + root_hash
+    )
+
+
+def verify_tree_head(public_key: Ed25519PublicKey, conversation_id: str, head: dict) -> bool:
+    message = tree_head_message(
+        conversation_id, head["tree_size"], head["timestamp"], b64d(head["root_hash"])
+    )
+    try:
+        public_key.verify(b64d(head["signature"]), message)
+        return True
+    except InvalidSignature:
+        return False
+
+
+# ============================================================
+# ESTADO DE CONFIANZA
+# ============================================================
+
+def load_trusted(path: Path = TREE_HEADS_FILE) -> dict:
+    if path.exists():
+        return json.loads(path.read_text(encoding="utf-8"))
+    return {"public_key": None, "conversations": {}}
+
+
+def save_trusted(trusted: dict, path: Path = TREE_HEADS_FILE) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(trusted, indent=2), encoding="utf-8")
+
+
+def log_public_key(client, trusted: dict) -> Ed25519PublicKey:
+    """
+    La clave fijada en `trusted`; si no hay, se pide al servidor y se fija
+    (confianza en el primer uso: compárala por otro canal).
+    """
+    if not trusted.get("public_key"):
+        resp = client.get("/log/public-key")
+        resp.raise_for_status()
+        trusted["public_key"] = resp.json()["public_key"]
+        print("[!] clave del registro fijada por primera vez", file=sys.stderr)
+    return serialization.load_pem_public_key(trusted["public_key"].encode())
+
+
+# ============================================================
+# AUDITORÍA
+# ============================================================
+
+def check_tree_head(client, conversation_id: str, trusted: dict) -> dict:
+    """
+    Cabecera actual firmada y consistente con la última verificada (que
+    pasa a ser esta).
+    """
+    public_key = log_public_key(client, trusted)
+    resp = client.get(f"/conversations/{conversation_id}/tree-head")
+    resp.raise_for_status()
+    head = resp.json()
+    if not verify_tree_head(public_key, conversation_id, head):
+        raise VerificationError("firma de la cabecera inválida")
+
+    previous = trusted["conversations"].get(conversation_id)
+    if previous:
+        if head["tree_size"] < previous["tree_size"]:
+            raise VerificationError(
+                f"el árbol ha encogido: {previous['tree_size']} -> {head['tree_size']}"
+            )
+        resp = client.get(
+            f"/conversations/{conversation_id}/proofs/consistency",
+            params={"first": previous["tree_size"], "second": head["tree_size"]},
+        )
+        resp.raise_for_status()
+        path = [b64d(h) for h in resp.json()["consistency_path"]]
+        if not verify_consistency(
+            previous["tree_size"], head["tree_size"],
+            b64d(previous["root_hash"]), b64d(head["root_hash"]), path,
+        ):
+            raise VerificationError(
+                f"el árbol de {head['tree_size']} no extiende el de {previous['tree_size']}"
+            )
+
+    trusted["conversations"][conversation_id] = head
+    return head
+
+
+def check_inclusion(client, conversation_id: str, head: dict, message: dict) -> int:
+    """
+    Recalcula el content_hash del mensaje tal como lo devuelve la API y
+    verifica su prueba de inclusión contra `head`. Devuelve su índice de hoja.
+    """
+    content_hash = calculate_message_hash(
+        b64d(message["ciphertext"]),
+        message["sender_id"],
+        conversation_id,
+        b64d(message["prev_hash"]),
+    )
+    if content_hash != b64d(message["content_hash"]):
+        raise VerificationError(f"{message['message_id']}: content_hash no coincide")
+
+    resp = client.get(
+        f"/conversations/{conversation_id}/proofs/inclusion",
+        params={"message_id": message["message_id"], "tree_size": head["tree_size"]},
+    )
+    resp.raise_for_status()
+    proof = resp.json()
+    path = [b64d(h) for h in proof["inclusion_path"]]
+    if not verify_inclusion(
+        proof["leaf_index"], head["tree_size"], leaf_hash(content_hash), path,
+        b64d(head["root_hash"]),
+    ):
+        raise VerificationError(f"{message['message_id']}: prueba de inclusión inválida")
+    return proof["leaf_index"]
+
+
+def audit_proofs(
+    client,
+    conversation_id: str,
+    trusted: dict,
+    message_ids: Iterable[str] = (),
+    user_id: Optional[str] = None,
+) -> dict:
+    head = check_tree_head(client, conversation_id, trusted)
+    included = {}
+    message_ids = list(message_ids)
+    if message_ids:
+        resp = client.post("/messages:batchGet", json={"user_id": user_id, "message_ids": message_ids})
+        resp.raise_for_status()
+        data = resp.json()
+        if data["missing"] or data["forbidden"]:
+            raise VerificationError(
+                f"mensajes no disponibles: {', '.join(data['missing'] + data['forbidden'])}"
+            )
+        for message in data["messages"]:
+            included[message["message_id"]] = check_inclusion(client, conversation_id, head, message)
+    return {"tree_size": head["tree_size"], "root_hash": head["root_hash"], "included": included}
+
+
+def audit_chain(client, conversation_id: str, page_size: int = 200) -> dict:
+    """
+    Recorre la conversación página a página: cada content_hash se recalcula
+    y cada prev_hash debe ser el content_hash de un mensaje anterior.
+    """
+    seen, checked, after = set(), 0, None
+    while True:
+        params = {"limit": page_size, **({"after": after} if after else {})}
+        resp = client.get(f"/conversations/{conversation_id}/messages", params=params)
+        resp.raise_for_status()
+        page = resp.json()
+        for m in page:
+            prev_hash = b64d(m["prev_hash"])
+            content_hash = calculate_message_hash(
+                b64d(m["ciphertext"]), m["sender_id"], conversation_id, prev_hash
+            )
+            if content_hash != b64d(m["content_hash"]):
+                raise VerificationError(f"{m['message_id']}: content_hash no coincide")
+            if prev_hash is not None and prev_hash not in seen:
+                raise VerificationError(f"{m['message_id']}: prev_hash no enlaza con ningún mensaje anterior")
+            seen.add(content_hash)
+            checked += 1
+        if len(page) < page_size:
+            return {"messages": checked}
+        after = page[-1]["message_id"]
+
+
+# ============================================================
+# CLI
+# ============================================================
+
+def main(argv: Optional[list] = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m client.verify")
+    parser.add_argument("--api", default="http://localhost:8000")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p_chain = sub.add_parser("chain", help="hashes y enlaces prev_hash de toda la conversación")
+    p_chain.add_argument("conversation_id")
+
+    p_proof = sub.add_parser("proof", help="cabecera firmada, consistencia e inclusión")
+    p_proof.add_argument("conversation_id")
+    p_proof.add_argument("--message-id", action="append", default=[], metavar="MESSAGE_ID")
+    p_proof.add_argument("--user-id", help="participante con el que leer los mensajes")
+    p_proof.add_argument("--log-key", type=Path, help="PEM de la clave del registro (en lugar de fijarla)")
+    p_proof.add_argument("--state", type=Path, default=TREE_HEADS_FILE)
+
+    args = parser.parse_args(argv)
+    if args.cmd == "proof" and args.message_id and not args.user_id:
+        parser.error("--message-id requiere --user-id")
+
+    with httpx.Client(base_url=args.api, timeout=30) as client:
+        try:
+            if args.cmd == "chain":
+                report = audit_chain(client, args.conversation_id)
+                print(f"[+] {report['messages']} mensajes, cadena íntegra")
+                return
+
+            trusted = load_trusted(args.state)
+            if args.log_key:
+                trusted["public_key"] = args.log_key.read_text(encoding="utf-8")
+            report = audit_proofs(
+                client, args.conversation_id, trusted, args.message_id, args.user_id
+            )
+        except VerificationError as exc:
+            print(f"[✗] {exc}")
+            sys.exit(1)
+
+    save_trusted(trusted, args.state)
+    print(f"[+] cabecera verificada: {report['tree_size']} mensajes, raíz {report['root_hash']}")
+    for message_id, index in report["included"].items():
+        print(f"[+] {message_id} incluido (hoja {index})")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,120 @@
+"""
+Benchmark del group commit (server/coalescer.py) contra PostgreSQL.
+
+Lanza N hilos que insertan mensajes en paralelo, primero con un commit por
+mensaje (db.insert_message) y luego con el WriteCoalescer para cada
+combinación de ventana / tamaño de lote. Reporta commits/s, mensajes/s y
+latencia p50/p99 por llamada.
+
+Uso (con la DB del docker compose levantada, desde la raíz del proyecto):
+    python scripts/bench_coalescer.py [--threads 64] [--messages 50]
+"""
+
+import argparse
+import hashlib
+import os
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from server import db  # noqa: E402
+from server.coalescer import WriteCoalescer  # noqa: E402
+
+
+CONFIGS = [
+    # (window_ms, max_batch)
+    (1, 16),
+    (2, 64),
+    (5, 128),
+    (10, 256),
+]
+
+
+def setup() -> tuple:
+    public_key = f"bench-{os.urandom(8).hex()}"
+    user_id = db.create_user(public_key, hashlib.sha256(public_key.encode()).digest())
+    conversation_id = db.create_conversation()
+    db.add_participant(conversation_id, user_id)
+    return str(conversation_id), str(user_id)
+
+
+def row(conversation_id: str, user_id: str) -> dict:
+    ciphertext = os.urandom(256)
+    return {
+        "conversation_id": conversation_id,
+        "sender_id": user_id,
+        "ciphertext": ciphertext,
+        "content_hash": hashlib.sha256(ciphertext).digest(),
+        "signature": os.urandom(64),
+        "key_id": "primary",
+    }
+
+
+def run(label: str, insert, commits, threads: int, messages: int, ids: tuple) -> None:
+    latencies = []
+    lock = threading.Lock()
+
+    def worker():
+        local = []
+        for _ in range(messages):
+            r = row(*ids)
+            started = time.perf_counter()
+            insert(r)
+            local.append(time.perf_counter() - started)
+        with lock:
+            latencies.extend(local)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        for _ in range(threads):
+            pool.submit(worker)
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    p50 = statistics.median(latencies) * 1000
+    p99 = latencies[int(len(latencies) * 0.99) - 1] * 1000
+    print(
+        f"{label:<22} msgs/s={len(latencies) / elapsed:8.0f}  "
+        f"commits/s={commits() / elapsed:8.0f}  p50={p50:7.2f} ms  p99={p99:7.2f} ms"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=64)
+    parser.add_argument("--messages", type=int, default=50)
+    args = parser.parse_args()
+
+    ids = setup()
+    total = args.threads * args.messages
+    print(f"{args.threads} hilos x {args.messages} mensajes = {total} inserts\n")
+
+    run("commit por mensaje", lambda r: db.insert_message(**r), lambda: total,
+        args.threads, args.messages, ids)
+
+    for window_ms, max_batch in CONFIGS:
+        flushes = {"n": 0}
+
+        def flush(rows):
+            flushes["n"] += 1
+            return db.insert_messages_batch(rows)
+
+        writer = WriteCoalescer(flush, window_ms=window_ms, max_batch=max_batch)
+        run(
+            f"window={window_ms}ms batch={max_batch}",
+            lambda r: writer.submit(r).result(),
+            lambda: flushes["n"],
+            args.threads,
+            args.messages,
+            ids,
+        )
+        writer.close()
+
+
+if __name__ == "__main__":
+    main()
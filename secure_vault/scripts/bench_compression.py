@@ -0,0 +1,113 @@
+"""
+Benchmark de compresión dentro del sobre cifrado (client/crypto.py).
+
+Mide, sobre un corpus sintético de chat, el tamaño total de ciphertext y el
+coste de CPU de encrypt_message/decrypt_message sin compresión, con zstd y
+con zstd + diccionario entrenado, sobre todo el corpus y solo sobre los
+mensajes cortos (por debajo de COMPRESS_MIN_SIZE, que solo se comprimen con
+diccionario).
+
+Uso (desde la raíz del proyecto):
+    python scripts/bench_compression.py [--messages 20000] [--seed 7]
+"""
+
+import argparse
+import json
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from client import crypto  # noqa: E402
+
+
+WORDS = (
+    "hola que tal bien gracias nos vemos mañana reunión a las diez "
+    "ok perfecto te envío el archivo ahora revisa el documento por favor "
+    "the deploy is done can you check the logs when you have a minute "
+    "sounds good thanks see you later lunch at noon? meeting moved to three "
+    "estoy en camino llego en cinco minutos listo hecho genial jaja"
+).split()
+
+
+def chat_line(rng: random.Random) -> bytes:
+    n = rng.choice((2, 3, 5, 8, 12, 20, 40))
+    return " ".join(rng.choice(WORDS) for _ in range(n)).encode()
+
+
+def json_payload(rng: random.Random) -> bytes:
+    # Mensajes estructurados (reacciones, respuestas, enlaces)
+    return json.dumps({
+        "type": rng.choice(("text", "reply", "reaction", "link")),
+        "body": chat_line(rng).decode(),
+        "reply_to": f"{rng.getrandbits(128):032x}",
+        "mentions": [f"user-{rng.randint(1, 500)}" for _ in range(rng.randint(0, 3))],
+    }).encode()
+
+
+def build_corpus(count: int, seed: int) -> list:
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(count):
+        corpus.append(json_payload(rng) if rng.random() < 0.3 else chat_line(rng))
+    return corpus
+
+
+def run(label: str, corpus: list, compress: bool, zstd_dict=None) -> None:
+    encrypted = []
+    start = time.perf_counter()
+    for text in corpus:
+        encrypted.append(crypto.encrypt_message(text, compress, zstd_dict))
+    enc_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for e in encrypted:
+        crypto.decrypt_message(e["ciphertext"], e["nonce"], e["key"], zstd_dict)
+    dec_time = time.perf_counter() - start
+
+    plain = sum(len(t) for t in corpus)
+    stored = sum(len(e["ciphertext"]) for e in encrypted)
+    n = len(corpus)
+    compressed = sum(
+        1 for t in corpus if crypto.encode_body(t, compress, zstd_dict)[0] != crypto.FLAG_RAW
+    )
+    print(
+        f"{label:<20} ciphertext={stored:>10} B  ratio={stored / plain:5.3f}  "
+        f"comprimidos={compressed / n:6.1%}  "
+        f"encrypt={enc_time / n * 1e6:6.1f} µs/msg  decrypt={dec_time / n * 1e6:6.1f} µs/msg"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    if crypto.zstandard is None:
+        raise SystemExit("zstandard no está instalado")
+
+    corpus = build_corpus(args.messages, args.seed)
+    training = build_corpus(2000, args.seed + 1)
+    zstd_dict = crypto.train_dictionary(training)
+
+    short = [t for t in corpus if len(t) < crypto.COMPRESS_MIN_SIZE]
+    plain = sum(len(t) for t in corpus)
+    print(f"corpus: {len(corpus)} mensajes ({len(short)} cortos), {plain} B en claro, "
+          f"umbral={crypto.COMPRESS_MIN_SIZE} B ({crypto.COMPRESS_DICT_MIN_SIZE} B con "
+          f"diccionario), diccionario={len(zstd_dict)} B\n")
+
+    run("raw", corpus, compress=False)
+    run("zstd", corpus, compress=True)
+    run("zstd+dict", corpus, compress=True, zstd_dict=zstd_dict)
+    if short:
+        print()
+        run("cortos raw", short, compress=False)
+        run("cortos zstd", short, compress=True)
+        run("cortos zstd+dict", short, compress=True, zstd_dict=zstd_dict)
+
+
+if __name__ == "__main__":
+    main()
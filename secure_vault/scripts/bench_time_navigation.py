@@ -0,0 +1,195 @@
+"""
+Benchmark de navegación temporal: BRIN vs btree sobre created_at.
+
+Carga N filas sintéticas con la forma de `messages` en una tabla UNLOGGED
+aparte (messages es append-only: no se pueden borrar las filas de prueba),
+con created_at creciente como en producción. Después, para cada tipo de
+índice sobre created_at, mide tamaño, tiempo de creación y EXPLAIN ANALYZE
+de los rangos de tiempo que hace el archivador. El salto `around=` por
+conversación se mide aparte: usa siempre (conversation_id, created_at).
+
+Uso (con la DB del docker compose levantada, desde la raíz del proyecto):
+    python scripts/bench_time_navigation.py [--rows 50000000] [--conversations 100000]
+"""
+
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import psycopg2  # noqa: E402
+
+from server import db  # noqa: E402
+
+
+TABLE = "bench_time_messages"
+START = "2024-01-01 00:00:00"
+
+INDEXES = [
+    ("btree", "CREATE INDEX {name} ON {table} (created_at);"),
+    (
+        "brin",
+        "CREATE INDEX {name} ON {table} USING brin (created_at) "
+        "WITH (pages_per_range = 32, autosummarize = on);",
+    ),
+]
+
+# (etiqueta, consulta); %(cutoff)s y %(window)s se calculan sobre el rango cargado
+RANGE_QUERIES = [
+    (
+        "archivables (1%)",
+        f"SELECT conversation_id, count(*) FROM {TABLE} "
+        "WHERE created_at < %(cutoff)s AND segment_id IS NULL GROUP BY conversation_id;",
+    ),
+    (
+        "ventana 1 h",
+        f"SELECT count(*) FROM {TABLE} "
+        "WHERE created_at >= %(window)s AND created_at < %(window)s + interval '1 hour';",
+    ),
+]
+
+AROUND_QUERY = f"""
+    SELECT * FROM (
+        (SELECT message_id, created_at FROM {TABLE}
+         WHERE conversation_id = %(cid)s AND created_at < %(at)s
+         ORDER BY created_at DESC LIMIT 26)
+        UNION ALL
+        (SELECT message_id, created_at FROM {TABLE}
+         WHERE conversation_id = %(cid)s AND created_at >= %(at)s
+         ORDER BY created_at ASC LIMIT 51)
+    ) w ORDER BY created_at;
+"""
+
+
+def conversation_uuid(expr: str) -> str:
+    return f"('00000000-0000-0000-0000-' || lpad(to_hex({expr}), 12, '0'))::uuid"
+
+
+def load(conn, rows: int, conversations: int, payload: int, chunk: int) -> None:
+    with conn.cursor() as cur:
+        cur.execute(f"DROP TABLE IF EXISTS {TABLE};")
+        cur.execute(
+            f"CREATE UNLOGGED TABLE {TABLE} "
+            "(LIKE messages INCLUDING DEFAULTS, PRIMARY KEY (message_id));"
+        )
+    conn.commit()
+
+    started = time.perf_counter()
+    for first in range(0, rows, chunk):
+        last = min(first + chunk, rows)
+        with conn.cursor() as cur:
+            # Un mensaje cada 10 ms: created_at sigue el orden físico
+            cur.execute(
+                f"""
+                INSERT INTO {TABLE} (message_id, conversation_id, sender_id, ciphertext,
+                                     content_hash, signature, created_at)
+                SELECT md5(i::text)::uuid,
+                       {conversation_uuid(f"i % {conversations}")},
+                       '00000000-0000-0000-0000-000000000001',
+                       convert_to(repeat('x', %s), 'UTF8'),
+                       decode(md5(i::text), 'hex'),
+                       decode(md5((-i)::text), 'hex'),
+                       %s::timestamp + i * interval '10 milliseconds'
+                FROM generate_series(%s, %s) AS i;
+                """,
+                (payload, START, first, last - 1),
+            )
+        conn.commit()
+        elapsed = time.perf_counter() - started
+        print(f"  {last:>12,} filas  {last / elapsed:10,.0f} filas/s", end="\r", flush=True)
+    print()
+
+    with conn.cursor() as cur:
+        cur.execute(f"CREATE INDEX {TABLE}_conversation ON {TABLE} (conversation_id, created_at);")
+        cur.execute(f"VACUUM ANALYZE {TABLE};")
+
+
+def explain(conn, query: str, params: dict) -> tuple:
+    with conn.cursor() as cur:
+        cur.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + query, params)
+        plan = cur.fetchone()[0][0]
+    conn.rollback()
+    root = plan["Plan"]
+    buffers = root.get("Shared Hit Blocks", 0) + root.get("Shared Read Blocks", 0)
+    return plan["Execution Time"], buffers
+
+
+def best_of(conn, query: str, params: dict, runs: int) -> tuple:
+    return min(explain(conn, query, params) for _ in range(runs))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--conversations", type=int, default=10_000)
+    parser.add_argument("--payload", type=int, default=256, help="bytes de ciphertext por fila")
+    parser.add_argument("--chunk", type=int, default=1_000_000)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--reuse", action="store_true", help="no recargar la tabla de prueba")
+    parser.add_argument("--keep", action="store_true", help="no borrar la tabla al terminar")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(**db.DB_CONFIG)
+    conn.autocommit = False
+    try:
+        if not args.reuse:
+            print(f"cargando {args.rows:,} filas en {args.conversations:,} conversaciones")
+            conn.autocommit = True
+            load(conn, args.rows, args.conversations, args.payload, args.chunk)
+            conn.autocommit = False
+
+        with conn.cursor() as cur:
+            cur.execute(f"SELECT min(created_at), max(created_at), count(*) FROM {TABLE};")
+            first, last, count = cur.fetchone()
+            cur.execute(f"SELECT pg_size_pretty(pg_relation_size('{TABLE}'));")
+            heap = cur.fetchone()[0]
+        conn.rollback()
+        span = last - first
+        params = {"cutoff": first + span / 100, "window": first + span / 2}
+        print(f"{count:,} filas, heap {heap}\n")
+
+        results = {}
+        for kind, ddl in INDEXES:
+            name = f"{TABLE}_created_{kind}"
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                started = time.perf_counter()
+                cur.execute(ddl.format(name=name, table=TABLE))
+                built = time.perf_counter() - started
+                cur.execute(f"ANALYZE {TABLE};")
+                cur.execute("SELECT pg_relation_size(%s);", (name,))
+                size = cur.fetchone()[0]
+            conn.autocommit = False
+
+            results[kind] = {"size_bytes": size, "build_s": round(built, 2)}
+            print(f"{kind:<6} tamaño={size / 2**20:10.2f} MiB  creación={built:7.2f} s")
+            for label, query in RANGE_QUERIES:
+                ms, buffers = best_of(conn, query, params, args.runs)
+                results[kind][label] = {"ms": round(ms, 3), "buffers": buffers}
+                print(f"       {label:<18} {ms:10.2f} ms  buffers={buffers}")
+
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute(f"DROP INDEX {name};")
+            conn.autocommit = False
+
+        # around= por conversación: salto sobre (conversation_id, created_at)
+        around = {"cid": "00000000-0000-0000-0000-000000000007", "at": params["window"]}
+        ms, buffers = best_of(conn, AROUND_QUERY, around, args.runs)
+        results["around"] = {"ms": round(ms, 3), "buffers": buffers}
+        print(f"\naround (25 + 50 mensajes)  {ms:10.2f} ms  buffers={buffers}")
+        print(json.dumps(results, indent=2))
+    finally:
+        if not args.keep:
+            conn.rollback()
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute(f"DROP TABLE IF EXISTS {TABLE};")
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+-- Sharding directory: conversations living outside their consistent-hash
+-- shard (moved by server/rebalance.py). Only read on the directory
+-- database (DB_CONFIG); created everywhere so every node has one schema.
+
+CREATE TABLE IF NOT EXISTS conversation_placements (
+    conversation_id UUID PRIMARY KEY,
+    shard TEXT NOT NULL,
+    -- 'moving': writes paused while the last delta is copied
+    state TEXT NOT NULL DEFAULT 'active'
+        CHECK (state IN ('active', 'moving')),
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- DELETE on messages is reserved to this role (the rebalancer, on the source
+-- shard of a finished move). NOLOGIN: grant it to the rebalancer's own
+-- login, never to the API's
+DO $$
+BEGIN
+    IF to_regrole('vault_rebalancer') IS NULL THEN
+        CREATE ROLE vault_rebalancer NOLOGIN;
+    END IF;
+END;
+$$;
+
+GRANT SELECT, DELETE ON conversations, messages, message_segments TO vault_rebalancer;
+
+-- UPDATE is only allowed for members of vault_archiver (migration 0007),
+-- DELETE only for members of vault_rebalancer. search_path is pinned so a
+-- session cannot shadow pg_has_role
+CREATE OR REPLACE FUNCTION prevent_message_mutation()
+RETURNS trigger
+LANGUAGE plpgsql
+SET search_path = pg_catalog
+AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' AND pg_has_role(current_user, 'vault_archiver', 'MEMBER') THEN
+        RETURN NULL;
+    END IF;
+    IF TG_OP = 'DELETE' AND pg_has_role(current_user, 'vault_rebalancer', 'MEMBER') THEN
+        RETURN NULL;
+    END IF;
+    RAISE EXCEPTION
+        'Messages are immutable (append-only log)';
+END;
+$$;
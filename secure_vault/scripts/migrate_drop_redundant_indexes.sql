@@ -0,0 +1,13 @@
+-- migrate: no-transaction
+-- Drop indexes whose columns are a prefix of another index on the same table
+-- (reported by `python -m server.migrate audit`). CONCURRENTLY avoids taking
+-- an exclusive lock on the hot tables.
+
+-- messages(conversation_id) is served by idx_messages_conversation_created
+DROP INDEX CONCURRENTLY IF EXISTS idx_messages_conversation;
+
+-- message_status(message_id) is served by the (message_id, user_id) primary key
+DROP INDEX CONCURRENTLY IF EXISTS idx_ms_message;
+
+-- user_keys(user_id) is served by the (user_id, key_id) primary key
+DROP INDEX CONCURRENTLY IF EXISTS idx_user_keys_user;
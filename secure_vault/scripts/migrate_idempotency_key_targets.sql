@@ -0,0 +1,7 @@
+-- Bind each idempotency key to the conversation (messages) or message
+-- (attachments) it was first used for. A retry against another target is a
+-- conflict, not a replay. Keys claimed before this column existed have no
+-- target and conflict until they expire.
+
+ALTER TABLE idempotency_keys
+    ADD COLUMN IF NOT EXISTS target_id UUID;
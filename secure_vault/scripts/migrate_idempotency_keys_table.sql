@@ -0,0 +1,16 @@
+-- Create idempotency_keys table for safe message/attachment retries if missing
+
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    owner_id UUID NOT NULL,
+    scope TEXT NOT NULL,
+    idempotency_key TEXT NOT NULL,
+    request_hash BYTEA NOT NULL,
+    resource_id UUID,
+    resource_created_at TIMESTAMP,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    expires_at TIMESTAMP NOT NULL,
+    PRIMARY KEY (owner_id, scope, idempotency_key)
+);
+
+CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires
+    ON idempotency_keys(expires_at);
@@ -0,0 +1,86 @@
+-- Per-conversation Merkle trees (transparency log over messages.content_hash).
+-- New tables only: existing conversations get their tree built lazily by
+-- server/merkle.py the first time a tree head or proof is requested.
+
+CREATE TABLE IF NOT EXISTS merkle_heads (
+    conversation_id UUID PRIMARY KEY,
+    tree_size BIGINT NOT NULL,
+    root_hash BYTEA NOT NULL,
+    -- Newest created_at already sequenced; NULL = rescan the whole conversation
+    sequenced_until TIMESTAMP,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    CONSTRAINT fk_merkle_head_conversation
+        FOREIGN KEY (conversation_id)
+        REFERENCES conversations(conversation_id)
+        ON DELETE RESTRICT
+);
+
+CREATE TABLE IF NOT EXISTS merkle_leaves (
+    conversation_id UUID NOT NULL,
+    leaf_index BIGINT NOT NULL,
+    message_id UUID NOT NULL,
+    hash BYTEA NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (conversation_id, leaf_index),
+    CONSTRAINT ux_merkle_leaves_message
+        UNIQUE (message_id),
+    CONSTRAINT fk_merkle_leaf_conversation
+        FOREIGN KEY (conversation_id)
+        REFERENCES conversations(conversation_id)
+        ON DELETE RESTRICT,
+    CONSTRAINT fk_merkle_leaf_message
+        FOREIGN KEY (message_id)
+        REFERENCES messages(message_id)
+        ON DELETE RESTRICT
+);
+
+CREATE TABLE IF NOT EXISTS merkle_nodes (
+    conversation_id UUID NOT NULL,
+    level SMALLINT NOT NULL CHECK (level > 0),
+    node_index BIGINT NOT NULL,
+    hash BYTEA NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (conversation_id, level, node_index),
+    CONSTRAINT fk_merkle_node_conversation
+        FOREIGN KEY (conversation_id)
+        REFERENCES conversations(conversation_id)
+        ON DELETE RESTRICT
+);
+
+REVOKE UPDATE, DELETE, TRUNCATE ON merkle_leaves, merkle_nodes FROM PUBLIC;
+
+-- vault_rebalancer comes from migration 0008
+GRANT SELECT, DELETE ON merkle_heads, merkle_leaves, merkle_nodes TO vault_rebalancer;
+
+-- Signed tree heads commit to these hashes: only members of vault_rebalancer
+-- may DELETE them (source shard of a finished move). search_path is pinned
+-- so a session cannot shadow pg_has_role
+CREATE OR REPLACE FUNCTION prevent_merkle_mutation()
+RETURNS trigger
+LANGUAGE plpgsql
+SET search_path = pg_catalog
+AS $$
+BEGIN
+    IF TG_OP = 'DELETE' AND pg_has_role(current_user, 'vault_rebalancer', 'MEMBER') THEN
+        RETURN NULL;
+    END IF;
+    RAISE EXCEPTION
+        'Merkle tree nodes are immutable';
+END;
+$$;
+
+DROP TRIGGER IF EXISTS no_merkle_leaf_update_or_delete ON merkle_leaves;
+
+CREATE TRIGGER no_merkle_leaf_update_or_delete
+BEFORE UPDATE OR DELETE OR TRUNCATE
+ON merkle_leaves
+FOR EACH STATEMENT
+EXECUTE FUNCTION prevent_merkle_mutation();
+
+DROP TRIGGER IF EXISTS no_merkle_node_update_or_delete ON merkle_nodes;
+
+CREATE TRIGGER no_merkle_node_update_or_delete
+BEFORE UPDATE OR DELETE OR TRUNCATE
+ON merkle_nodes
+FOR EACH STATEMENT
+EXECUTE FUNCTION prevent_merkle_mutation();
@@ -0,0 +1,85 @@
+-- Cold-storage segment map and archival stubs for messages.
+-- Archived rows keep every column except ciphertext, which is replaced by an
+-- empty bytea and read back from the segment file referenced by segment_id.
+
+CREATE TABLE IF NOT EXISTS message_segments (
+    segment_id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    conversation_id UUID NOT NULL,
+    first_created_at TIMESTAMP NOT NULL,
+    last_created_at TIMESTAMP NOT NULL,
+    message_count INTEGER NOT NULL,
+    bytes BIGINT NOT NULL,
+    sha256 BYTEA NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    CONSTRAINT fk_segment_conversation
+        FOREIGN KEY (conversation_id)
+        REFERENCES conversations(conversation_id)
+        ON DELETE RESTRICT
+);
+
+CREATE INDEX IF NOT EXISTS idx_message_segments_conversation
+    ON message_segments(conversation_id, first_created_at);
+
+ALTER TABLE messages
+    ADD COLUMN IF NOT EXISTS segment_id UUID
+        REFERENCES message_segments(segment_id)
+        ON DELETE RESTRICT;
+
+-- UPDATE on messages is reserved to this role (server/archive.py). NOLOGIN:
+-- grant it to the archiver's own login, never to the API's
+DO $$
+BEGIN
+    IF to_regrole('vault_archiver') IS NULL THEN
+        CREATE ROLE vault_archiver NOLOGIN;
+    END IF;
+END;
+$$;
+
+GRANT SELECT, UPDATE ON messages TO vault_archiver;
+GRANT SELECT, INSERT ON message_segments TO vault_archiver;
+
+-- UPDATE is only allowed for members of vault_archiver. search_path is
+-- pinned so a session cannot shadow pg_has_role
+CREATE OR REPLACE FUNCTION prevent_message_mutation()
+RETURNS trigger
+LANGUAGE plpgsql
+SET search_path = pg_catalog
+AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' AND pg_has_role(current_user, 'vault_archiver', 'MEMBER') THEN
+        RETURN NULL;
+    END IF;
+    RAISE EXCEPTION
+        'Messages are immutable (append-only log)';
+END;
+$$;
+
+-- ...and even then only to stub the ciphertext of a not yet archived row
+CREATE OR REPLACE FUNCTION restrict_message_archival()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF OLD.segment_id IS NOT NULL
+       OR NEW.segment_id IS NULL
+       OR NEW.ciphertext <> ''::bytea
+       OR (NEW.message_id, NEW.conversation_id, NEW.sender_id, NEW.content_hash,
+           NEW.prev_hash, NEW.signature, NEW.client_timestamp, NEW.key_id, NEW.created_at)
+          IS DISTINCT FROM
+          (OLD.message_id, OLD.conversation_id, OLD.sender_id, OLD.content_hash,
+           OLD.prev_hash, OLD.signature, OLD.client_timestamp, OLD.key_id, OLD.created_at)
+    THEN
+        RAISE EXCEPTION
+            'Only archival stubbing of message ciphertext is allowed';
+    END IF;
+    RETURN NEW;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS message_archival_stub_only ON messages;
+
+CREATE TRIGGER message_archival_stub_only
+BEFORE UPDATE
+ON messages
+FOR EACH ROW
+EXECUTE FUNCTION restrict_message_archival();
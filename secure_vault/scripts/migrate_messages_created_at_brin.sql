@@ -0,0 +1,12 @@
+-- migrate: no-transaction
+-- messages is append-only and created_at only grows, so heap order follows
+-- created_at: a BRIN index (min/max per block range) serves the time-range
+-- scans of the archiver at a tiny fraction of the btree's size. Per
+-- conversation seeks (`around=`, `after=`) keep using
+-- idx_messages_conversation_created.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_messages_created_at_brin
+    ON messages USING brin (created_at)
+    WITH (pages_per_range = 32, autosummarize = on);
+
+DROP INDEX CONCURRENTLY IF EXISTS idx_messages_created_at;
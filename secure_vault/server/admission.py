@@ -0,0 +1,200 @@
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Optional
+
+from server import metrics
+
+
+# ============================================================
+# CONFIG
+# ============================================================
+
+ENABLED = os.getenv("VAULT_ADMISSION", "0") == "1"
+
+# Peticiones simultáneas que tocan la DB; debe coincidir con la capacidad
+# de conexiones de Postgres reservada para este worker.
+DB_MAX_CONNECTIONS = int(os.getenv("VAULT_DB_MAX_CONNECTIONS", 20))
+# Parte de las ranuras reservada a escrituras; el resto es para lecturas.
+WRITE_SHARE = float(os.getenv("VAULT_ADMISSION_WRITE_SHARE", 0.3))
+
+# Presupuesto máximo de espera por una ranura antes de responder 503
+READ_QUEUE_BUDGET_MS = float(os.getenv("VAULT_ADMISSION_READ_BUDGET_MS", 100))
+WRITE_QUEUE_BUDGET_MS = float(os.getenv("VAULT_ADMISSION_WRITE_BUDGET_MS", 250))
+
+# Token buckets: tasa sostenida por segundo y ráfaga
+USER_WRITE_RATE = float(os.getenv("VAULT_RATE_USER_WRITE", 10))
+USER_WRITE_BURST = float(os.getenv("VAULT_RATE_USER_WRITE_BURST", 30))
+USER_READ_RATE = float(os.getenv("VAULT_RATE_USER_READ", 20))
+USER_READ_BURST = float(os.getenv("VAULT_RATE_USER_READ_BURST", 60))
+CONVERSATION_WRITE_RATE = float(os.getenv("VAULT_RATE_CONVERSATION_WRITE", 50))
+CONVERSATION_WRITE_BURST = float(os.getenv("VAULT_RATE_CONVERSATION_WRITE_BURST", 100))
+CONVERSATION_READ_RATE = float(os.getenv("VAULT_RATE_CONVERSATION_READ", 200))
+CONVERSATION_READ_BURST = float(os.getenv("VAULT_RATE_CONVERSATION_READ_BURST", 400))
+
+MAX_BUCKETS = 100_000
+
+
+ADMISSIONS = metrics.Counter(
+    "vault_admission_total",
+    "Admission decisions by traffic class and outcome.",
+    ("kind", "outcome"),
+)
+ADMISSION_WAIT = metrics.Histogram(
+    "vault_admission_wait_seconds",
+    "Time spent waiting for a DB slot.",
+    ("kind",),
+)
+ADMISSION_IN_FLIGHT = metrics.Gauge(
+    "vault_admission_in_flight",
+    "Admitted requests currently holding a DB slot.",
+    ("kind",),
+)
+
+
+class Rejected(Exception):
+    """
+    429 = límite por usuario/conversación, 503 = sobrecarga global.
+    """
+
+    def __init__(self, status_code: int, retry_after: float, reason: str):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.retry_after = max(1, math.ceil(retry_after))
+        self.reason = reason
+
+
+# ============================================================
+# TOKEN BUCKETS
+# ============================================================
+
+class TokenBuckets:
+    def __init__(self, rate: float, burst: float, max_keys: int = MAX_BUCKETS):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key: str, now: Optional[float] = None) -> float:
+        """
+        Consume un token. Devuelve 0 si hay token o los segundos que faltan.
+        """
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = [self.burst, now]
+                self._buckets[key] = bucket
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0.0
+            return (1 - bucket[0]) / self.rate
+
+    def refund(self, key: str) -> None:
+        """
+        Devuelve un token consumido por una petición que al final se rechazó.
+        """
+        if self.rate <= 0:
+            return
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket[0] = min(self.burst, bucket[0] + 1)
+
+
+# ============================================================
+# DB SLOTS (lecturas y escrituras por separado)
+# ============================================================
+
+class Slots:
+    def __init__(self, kind: str, size: int, budget_ms: float):
+        self.kind = kind
+        self.size = max(1, size)
+        self.budget = budget_ms / 1000
+        self._semaphore = threading.BoundedSemaphore(self.size)
+        self._waiting = 0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        with self._lock:
+            # Cola más larga que lo que cabe en el presupuesto: rechazo inmediato
+            if self._waiting >= self.size * 2:
+                raise Rejected(503, self.budget, f"{self.kind} queue full")
+            self._waiting += 1
+        started = time.perf_counter()
+        try:
+            acquired = self._semaphore.acquire(timeout=self.budget)
+        finally:
+            with self._lock:
+                self._waiting -= 1
+        ADMISSION_WAIT.observe(time.perf_counter() - started, self.kind)
+        if not acquired:
+            raise Rejected(503, self.budget, f"{self.kind} latency budget exceeded")
+
+    def release(self) -> None:
+        self._semaphore.release()
+
+
+_write_size = max(1, round(DB_MAX_CONNECTIONS * WRITE_SHARE))
+_SLOTS = {
+    "read": Slots("read", DB_MAX_CONNECTIONS - _write_size, READ_QUEUE_BUDGET_MS),
+    "write": Slots("write", _write_size, WRITE_QUEUE_BUDGET_MS),
+}
+_BUCKETS = {
+    ("read", "user"): TokenBuckets(USER_READ_RATE, USER_READ_BURST),
+    ("read", "conversation"): TokenBuckets(CONVERSATION_READ_RATE, CONVERSATION_READ_BURST),
+    ("write", "user"): TokenBuckets(USER_WRITE_RATE, USER_WRITE_BURST),
+    ("write", "conversation"): TokenBuckets(CONVERSATION_WRITE_RATE, CONVERSATION_WRITE_BURST),
+}
+
+
+@contextmanager
+def admit(kind: str, user: Optional[str] = None, conversation: Optional[str] = None):
+    """
+    kind = "read" | "write". Primero los token buckets (429 inmediato),
+    después una ranura de DB dentro del presupuesto de espera (503).
+    """
+    if not ENABLED:
+        yield
+        return
+
+    taken = []
+    for scope, key in (("user", user), ("conversation", conversation)):
+        if key is None:
+            continue
+        buckets = _BUCKETS[(kind, scope)]
+        wait = buckets.take(key)
+        if wait:
+            # Un 429 no gasta tokens: se devuelven los ya consumidos
+            for prev, prev_key in taken:
+                prev.refund(prev_key)
+            ADMISSIONS.inc(kind, f"rate_limited_{scope}")
+            raise Rejected(429, wait, f"{scope} rate limit exceeded")
+        taken.append((buckets, key))
+
+    slots = _SLOTS[kind]
+    try:
+        slots.acquire()
+    except Rejected:
+        ADMISSIONS.inc(kind, "overloaded")
+        raise
+
+    ADMISSIONS.inc(kind, "admitted")
+    ADMISSION_IN_FLIGHT.inc(kind)
+    try:
+        yield
+    finally:
+        ADMISSION_IN_FLIGHT.dec(kind)
+        slots.release()
@@ -1,13 +1,72 @@
 import base64
+import hashlib
+import hmac
+import json
+import os
+import time
 import uuid
-from typing import Optional
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from typing import List, Optional
+from urllib.parse import urlencode
 
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request, Response
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
 
-from server import db
+from server import (
+    admission, coalescer, db, merkle, metrics, profiling, receipts, segments, signals,
+    signatures, slowlog, tailcache, transfer,
+)
 
-app = FastAPI(title="Secure Messaging Vault")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Sin clave de firma de cabeceras no se arranca (ver server/merkle.py)
+    merkle.signing_key()
+    yield
+    # Vaciar escrituras agrupadas y recibos pendientes antes de salir
+    coalescer.shutdown()
+    receipts.shutdown()
+    tailcache.shutdown()
+    # Cierra los streams de señales abiertos
+    signals.shutdown()
+
+
+app = FastAPI(title="Secure Messaging Vault", lifespan=lifespan)
+app.router.route_class = profiling.ProfiledRoute
+
+# Token compartido para endpoints /admin (sin token: deshabilitados)
+ADMIN_TOKEN = os.getenv("VAULT_ADMIN_TOKEN")
+
+app.add_middleware(profiling.ProfilingMiddleware, token=lambda: ADMIN_TOKEN)
+app.add_middleware(metrics.MetricsMiddleware)
+
+
+@app.exception_handler(admission.Rejected)
+def admission_rejected(request: Request, exc: admission.Rejected):
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={"detail": exc.reason},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+
+@app.exception_handler(segments.SegmentError)
+def segment_unavailable(request: Request, exc: segments.SegmentError):
+    # Mensaje archivado cuyo segmento falta o está corrupto: no se sirve un stub
+    return JSONResponse(status_code=503, content={"detail": "Archived segment unavailable"})
+
+
+@app.exception_handler(db.ConversationMoving)
+def conversation_moving(request: Request, exc: db.ConversationMoving):
+    # Escrituras en pausa mientras se copia el último delta a otro shard
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Conversation is being moved, retry shortly"},
+        headers={"Retry-After": str(max(1, round(db.PLACEMENT_TTL_S)))},
+    )
 
 
 # ======== MODELOS ========
@@ -16,6 +75,30 @@ class ParticipantIn(BaseModel):
     user_id: str
 
 
+class ParticipantsIn(BaseModel):
+    user_ids: List[str]
+
+
+class ConversationIn(BaseModel):
+    participants: Optional[List[str]] = None
+
+
+class BatchGetIn(BaseModel):
+    user_id: str
+    message_ids: List[str]
+
+
+class KeyRef(BaseModel):
+    user_id: str
+    key_id: str
+
+
+class KeyLookupIn(BaseModel):
+    keys: List[KeyRef] = []
+    user_ids: List[str] = []
+    since: Optional[datetime] = None
+
+
 class UserIn(BaseModel):
     public_key: str
     fingerprint: str
@@ -42,6 +125,13 @@ class AttachmentIn(BaseModel):
     meta_signature: Optional[str] = None
 
 
+class SignalIn(BaseModel):
+    user_id: str
+    type: str
+    state: Optional[str] = None
+    ttl_s: Optional[float] = None
+
+
 class MessageIn(BaseModel):
     sender_id: str
     ciphertext: str
@@ -75,6 +165,87 @@ def _require_uuid(value: str, label: str):
         raise HTTPException(status_code=400, detail=f"Invalid {label} UUID") from exc
 
 
+IDEMPOTENCY_CONFLICT = "Idempotency-Key reused with a different payload or target"
+
+
+def _idempotent_replay(
+    owner_id: str,
+    scope: str,
+    idempotency_key: Optional[str],
+    request_hash: bytes,
+    target_id: str,
+    response: Response,
+):
+    """
+    Si la Idempotency-Key ya se usó, devuelve (resource_id, created_at) del
+    recurso original sin volver a insertar. Se llama tras autorizar: la
+    clave queda ligada a su conversación (message) o mensaje (attachment)
+    y contra otro target responde 409.
+    """
+    if idempotency_key is None:
+        return None
+    if not idempotency_key.strip() or len(idempotency_key) > 255:
+        raise HTTPException(status_code=400, detail="Invalid Idempotency-Key")
+    existing = db.get_idempotent_result(owner_id, scope, idempotency_key)
+    if not existing:
+        return None
+    if (
+        bytes(existing["request_hash"]) != request_hash
+        or str(existing["target_id"]).lower() != target_id.lower()
+    ):
+        raise HTTPException(status_code=409, detail=IDEMPOTENCY_CONFLICT)
+    if existing["resource_created_at"] is None:
+        # Reservada pero sin insertar: insert_* termina el mismo recurso
+        return None
+    response.headers["Idempotent-Replayed"] = "true"
+    return existing["resource_id"], existing["resource_created_at"]
+
+
+# Cabeceras HTTP de caché: mensajes y adjuntos son inmutables (trigger
+# no_message_update_or_delete); claves y páginas abiertas se revalidan.
+CACHE_IMMUTABLE = "public, max-age=31536000, immutable"
+CACHE_REVALIDATE = "no-cache"
+# Antigüedad mínima del último mensaje para dar una página llena por cerrada
+PAGE_SETTLE_SECONDS = int(os.getenv("VAULT_PAGE_SETTLE_SECONDS", 30))
+
+
+def _etag(*parts) -> str:
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(bytes(part) if isinstance(part, (bytes, memoryview)) else str(part).encode())
+        digest.update(b"\x1f")
+    return f'"{digest.hexdigest()[:32]}"'
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Match usa comparación débil: W/"x" equivale a "x"
+    return any(c.strip().removeprefix("W/") == etag for c in if_none_match.split(","))
+
+
+def _not_modified(etag: str, cache_control: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": cache_control})
+
+
+def _page_etag(conversation_id: str, after: Optional[str], limit: int, tail) -> str:
+    if not tail:
+        return _etag("page", conversation_id, after or "", limit, 0)
+    return _etag(
+        "page", conversation_id, after or "", limit,
+        tail["row_count"], tail["message_id"], tail["content_hash"],
+    )
+
+
+def _require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not x_admin_token or not hmac.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+
 # ======== RUTAS ========
 
 @app.get("/")
@@ -85,6 +256,33 @@ def root():
     }
 
 
+@app.get("/metrics")
+def get_metrics():
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+@app.get("/admin/slow-queries", dependencies=[Depends(_require_admin)])
+def list_slow_queries(limit: int = Query(20, ge=1, le=200)):
+    return {
+        "threshold_ms": slowlog.SLOW_QUERY_MS,
+        "enabled": slowlog.ENABLED,
+        "queries": slowlog.top(limit),
+    }
+
+
+@app.get("/admin/profiles", dependencies=[Depends(_require_admin)])
+def list_profiles():
+    return profiling.list_profiles()
+
+
+@app.get("/admin/profiles/{profile_id}", dependencies=[Depends(_require_admin)])
+def get_profile(profile_id: str):
+    path = profiling.profile_path(profile_id)
+    if not path:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return FileResponse(path, media_type="application/octet-stream", filename=path.name)
+
+
 @app.post("/users")
 def create_user(data: UserIn):
     fingerprint_bytes = _b64_to_bytes(data.fingerprint)
@@ -139,23 +337,73 @@ def add_user_key(user_id: str, data: UserKeyIn):
     return {"key_id": key_id}
 
 
+def _key_out(k) -> dict:
+    return {
+        "key_id": k["key_id"],
+        "public_key": k["public_key"],
+        "fingerprint": _bytes_to_b64(k["fingerprint"]),
+        "is_primary": k["is_primary"],
+        "created_at": k["created_at"],
+        "revoked_at": k["revoked_at"],
+    }
+
+
 @app.get("/users/{user_id}/keys")
-def list_user_keys(user_id: str):
+def list_user_keys(
+    user_id: str,
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
+):
     _require_uuid(user_id, "user_id")
     if not db.get_user_by_id(user_id):
         raise HTTPException(status_code=404, detail="User not found")
-    keys = db.list_user_keys(user_id)
-    return [
-        {
-            "key_id": k["key_id"],
-            "public_key": k["public_key"],
-            "fingerprint": _bytes_to_b64(k["fingerprint"]),
-            "is_primary": k["is_primary"],
-            "created_at": k["created_at"],
-            "revoked_at": k["revoked_at"],
-        }
+    keys = [_key_out(k) for k in db.list_user_keys(user_id)]
+    # Las claves cambian (rotación, revocación): validador sin max-age
+    etag = _etag("keys", user_id, *(
+        f"{k['key_id']}|{k['fingerprint']}|{k['is_primary']}|{k['revoked_at']}" for k in keys
+    ))
+    if _etag_matches(if_none_match, etag):
+        return _not_modified(etag, CACHE_REVALIDATE)
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = CACHE_REVALIDATE
+    return keys
+
+
+# Tope de (user_id, key_id) + user_ids por consulta de directorio
+MAX_KEY_LOOKUP = int(os.getenv("VAULT_MAX_KEY_LOOKUP", 1000))
+
+
+@app.post("/keys:lookup")
+def lookup_keys(
+    data: KeyLookupIn,
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
+):
+    if len(data.keys) + len(data.user_ids) > MAX_KEY_LOOKUP:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_KEY_LOOKUP} lookups per request")
+    for ref in data.keys:
+        _require_uuid(ref.user_id, "user_id")
+    for user_id in data.user_ids:
+        _require_uuid(user_id, "user_id")
+
+    rows = db.lookup_keys(
+        [(ref.user_id, ref.key_id) for ref in data.keys], data.user_ids, data.since
+    )
+    keys = [{"user_id": str(k["user_id"]), **_key_out(k)} for k in rows]
+
+    # `as_of` = siguiente `since` para un refresco incremental
+    stamps = [k[c] for k in rows for c in ("created_at", "revoked_at") if k[c] is not None]
+    as_of = max(stamps) if stamps else data.since
+
+    etag = _etag("keys:lookup", *(
+        f"{k['user_id']}|{k['key_id']}|{k['fingerprint']}|{k['is_primary']}|{k['revoked_at']}"
         for k in keys
-    ]
+    ))
+    if _etag_matches(if_none_match, etag):
+        return _not_modified(etag, CACHE_REVALIDATE)
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = CACHE_REVALIDATE
+    return {"keys": keys, "as_of": as_of}
 
 
 @app.post("/users/{user_id}/keys/{key_id}/revoke")
@@ -180,9 +428,32 @@ def set_primary_key(user_id: str, key_id: str):
     return {"primary": True}
 
 
+# Tope de user_ids por petición de alta en bloque
+MAX_BATCH_PARTICIPANTS = int(os.getenv("VAULT_MAX_BATCH_PARTICIPANTS", 1000))
+
+
+def _require_user_ids(user_ids: List[str]):
+    if len(user_ids) > MAX_BATCH_PARTICIPANTS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {MAX_BATCH_PARTICIPANTS} user_ids per request",
+        )
+    for user_id in user_ids:
+        _require_uuid(user_id, "user_id")
+
+
 @app.post("/conversations")
-def create_conversation():
-    conversation_id = db.create_conversation()
+def create_conversation(data: Optional[ConversationIn] = None):
+    participants = data.participants if data else None
+    if participants:
+        _require_user_ids(participants)
+    try:
+        conversation_id = db.create_conversation(participants)
+    except db.UnknownUsers as exc:
+        raise HTTPException(
+            status_code=404,
+            detail={"message": "User not found", "unknown": exc.user_ids},
+        ) from exc
     return {"conversation_id": conversation_id}
 
 
@@ -198,6 +469,16 @@ def add_participant(conversation_id: str, data: ParticipantIn):
     return {"added": True}
 
 
+@app.post("/conversations/{conversation_id}/participants:batch")
+def add_participants_batch(conversation_id: str, data: ParticipantsIn):
+    _require_uuid(conversation_id, "conversation_id")
+    _require_user_ids(data.user_ids)
+    result = db.add_participants(conversation_id, data.user_ids)
+    if result is None:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    return result
+
+
 @app.get("/users/{user_id}/conversations")
 def list_conversations(user_id: str):
     _require_uuid(user_id, "user_id")
@@ -207,29 +488,71 @@ def list_conversations(user_id: str):
 
 
 @app.post("/conversations/{conversation_id}/messages")
-def create_message(conversation_id: str, data: MessageIn):
+def create_message(
+    conversation_id: str,
+    data: MessageIn,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None),
+):
+    with admission.admit("write", user=data.sender_id, conversation=conversation_id):
+        return _create_message(conversation_id, data, response, idempotency_key)
+
+
+def _create_message(
+    conversation_id: str,
+    data: MessageIn,
+    response: Response,
+    idempotency_key: Optional[str],
+):
     _require_uuid(conversation_id, "conversation_id")
     _require_uuid(data.sender_id, "sender_id")
+    content_hash = _b64_to_bytes(data.content_hash)
+
     if not db.conversation_exists(conversation_id):
         raise HTTPException(status_code=404, detail="Conversation not found")
     if not db.is_participant(conversation_id, data.sender_id):
         raise HTTPException(status_code=403, detail="Sender is not a participant")
 
+    replayed = _idempotent_replay(
+        data.sender_id, "message", idempotency_key, content_hash, conversation_id, response
+    )
+    if replayed:
+        return {"message_id": replayed[0], "created_at": replayed[1]}
+
     key_id = data.key_id or "primary"
     key = db.get_active_key(data.sender_id, key_id)
     if not key:
         raise HTTPException(status_code=400, detail="Invalid or revoked key_id")
 
-    message_id, created_at = db.insert_message(
-        conversation_id=conversation_id,
-        sender_id=data.sender_id,
-        ciphertext=_b64_to_bytes(data.ciphertext),
-        content_hash=_b64_to_bytes(data.content_hash),
-        prev_hash=_b64_to_bytes(data.prev_hash),
-        signature=_b64_to_bytes(data.signature),
-        client_timestamp=data.client_timestamp,
-        key_id=key_id,
-    )
+    signature = _b64_to_bytes(data.signature)
+    if signatures.VERIFY_SIGNATURES:
+        started = time.perf_counter()
+        valid = signatures.verify(key["public_key"], content_hash, signature)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        response.headers["Server-Timing"] = f"verify;dur={elapsed_ms:.3f}"
+        if not valid:
+            raise HTTPException(status_code=400, detail="Invalid signature")
+
+    ciphertext = _b64_to_bytes(data.ciphertext)
+    metrics.PAYLOAD_SIZE.observe(len(ciphertext), "message_ciphertext")
+
+    row = {
+        "conversation_id": conversation_id,
+        "sender_id": data.sender_id,
+        "ciphertext": ciphertext,
+        "content_hash": content_hash,
+        "prev_hash": _b64_to_bytes(data.prev_hash),
+        "signature": signature,
+        "client_timestamp": data.client_timestamp,
+        "key_id": key_id,
+    }
+    if coalescer.ENABLED and not idempotency_key:
+        message_id, created_at = coalescer.insert_message(**row)
+    else:
+        try:
+            message_id, created_at = db.insert_message(**row, idempotency_key=idempotency_key)
+        except db.IdempotencyKeyReused as exc:
+            raise HTTPException(status_code=409, detail=IDEMPOTENCY_CONFLICT) from exc
 
     return {
         "message_id": message_id,
@@ -237,38 +560,242 @@ def create_message(conversation_id: str, data: MessageIn):
     }
 
 
+def _message_out(r) -> dict:
+    return {
+        "message_id": r["message_id"],
+        "sender_id": r["sender_id"],
+        "ciphertext": _bytes_to_b64(r["ciphertext"]),
+        "content_hash": _bytes_to_b64(r["content_hash"]),
+        "prev_hash": _bytes_to_b64(r["prev_hash"]),
+        "signature": _bytes_to_b64(r["signature"]),
+        "client_timestamp": r["client_timestamp"],
+        "key_id": r["key_id"],
+        "created_at": r["created_at"],
+    }
+
+
+INCLUDE_OPTIONS = ("attachments", "status")
+# Tope de bytes embebidos por página con include=
+MAX_EXPANSION_BYTES = int(os.getenv("VAULT_MAX_EXPANSION_BYTES", 1024 * 1024))
+
+
+def _parse_include(include: Optional[str]) -> frozenset:
+    if not include:
+        return frozenset()
+    names = frozenset(part.strip() for part in include.split(",") if part.strip())
+    unknown = names.difference(INCLUDE_OPTIONS)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown include: {', '.join(sorted(unknown))}")
+    return names
+
+
+def _embed_expansions(messages: list, include: frozenset, response: Response):
+    """
+    Una sola consulta para toda la página. Si se supera el tope, los mensajes
+    desde el primero que no cabe quedan sin expandir y se indica en
+    X-Vault-Include-Truncated (el cliente pide esos por separado).
+    """
+    expansions = db.get_message_expansions([m["message_id"] for m in messages], include)
+    budget = MAX_EXPANSION_BYTES
+    for message in messages:
+        message_id = str(message["message_id"])
+        extra = expansions.get(message_id, {})
+        if "status" in extra:
+            extra["status"] = receipts.merge_pending(message_id, extra["status"])
+        size = len(json.dumps(extra, default=str))
+        if size > budget:
+            response.headers["X-Vault-Include-Truncated"] = message_id
+            return
+        budget -= size
+        message.update(extra)
+
+
 @app.get("/conversations/{conversation_id}/messages")
 def list_messages(
+    request: Request,
+    response: Response,
     conversation_id: str,
     after: Optional[str] = None,
-    limit: int = Query(50, ge=1, le=200),
+    limit: int = Query(50, ge=0, le=200),
+    around: Optional[datetime] = None,
+    before: int = Query(0, ge=0, le=200),
+    include: Optional[str] = None,
+    if_none_match: Optional[str] = Header(None),
+):
+    client = request.client.host if request.client else None
+    with admission.admit("read", user=client, conversation=conversation_id):
+        if around is not None:
+            return _list_messages_around(
+                conversation_id, around, before, limit, after, response, include
+            )
+        if before or not limit:
+            raise HTTPException(status_code=400, detail="'before' and limit=0 require 'around'")
+        return _list_messages(
+            conversation_id, after, limit, response, if_none_match, _parse_include(include)
+        )
+
+
+def _page_link(conversation_id: str, rel: str, include: Optional[str], **params) -> str:
+    if include:
+        params["include"] = include
+    return f'</conversations/{conversation_id}/messages?{urlencode(params)}>; rel="{rel}"'
+
+
+def _list_messages_around(
+    conversation_id: str,
+    around: datetime,
+    before: int,
+    limit: int,
+    after: Optional[str],
+    response: Response,
+    include: Optional[str] = None,
 ):
+    """
+    Modo `around`: `before` mensajes anteriores al instante y `limit` desde
+    él. Los cursores van en la cabecera Link: rel="prev" sigue hacia atrás
+    con otro `around`, rel="next" continúa con `after=<message_id>`.
+    """
     _require_uuid(conversation_id, "conversation_id")
+    expansions = _parse_include(include)
+    if after:
+        raise HTTPException(status_code=400, detail="'after' and 'around' are mutually exclusive")
+    if not before and not limit:
+        raise HTTPException(status_code=400, detail="'before' or 'limit' must be positive")
     if not db.conversation_exists(conversation_id):
         raise HTTPException(status_code=404, detail="Conversation not found")
+    if around.tzinfo is not None:
+        # created_at se guarda como TIMESTAMP en UTC
+        around = around.astimezone(timezone.utc).replace(tzinfo=None)
+
+    # Una fila de más por lado indica si quedan mensajes fuera de la ventana
+    rows = db.get_messages_around(conversation_id, around, before + 1, limit + 1)
+    older = [r for r in rows if r["created_at"] < around]
+    newer = rows[len(older):]
+    window = older[len(older) - before:] + newer[:limit]
+
+    links = []
+    if len(older) > before:
+        links.append(_page_link(
+            conversation_id, "prev", include,
+            around=(window[0]["created_at"] if window else around).isoformat(),
+            before=before or limit, limit=0,
+        ))
+    if len(newer) > limit:
+        cursor = {"after": window[-1]["message_id"]} if window else {"around": around.isoformat()}
+        links.append(_page_link(conversation_id, "next", include, **cursor, limit=limit or before))
+    if links:
+        response.headers["Link"] = ", ".join(links)
+
+    messages = [_message_out(r) for r in window]
+    if expansions:
+        _embed_expansions(messages, expansions, response)
+    # La ventana depende de lo que llegue después: siempre se revalida
+    response.headers["Cache-Control"] = CACHE_REVALIDATE
+    return messages
+
+
+def _list_messages(
+    conversation_id: str,
+    after: Optional[str],
+    limit: int,
+    response: Response,
+    if_none_match: Optional[str] = None,
+    include: frozenset = frozenset(),
+):
+    _require_uuid(conversation_id, "conversation_id")
     if after:
         _require_uuid(after, "message_id")
-        if not db.message_exists(conversation_id, after):
-            raise HTTPException(status_code=400, detail="Invalid 'after' message_id")
+
+    read_token = None
+    if not include:
+        # Cola caliente en memoria: sin tocar la DB, ni siquiera para validar
+        cached = tailcache.page(conversation_id, after, limit)
+        if cached is not None:
+            body, tail = cached
+            etag = _page_etag(conversation_id, after, limit, tail)
+            if _etag_matches(if_none_match, etag):
+                return _not_modified(etag, CACHE_REVALIDATE)
+            return Response(
+                content=body,
+                media_type="application/json",
+                headers={"ETag": etag, "Cache-Control": CACHE_REVALIDATE},
+            )
+        read_token = tailcache.token()
+
+    if not db.conversation_exists(conversation_id):
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    if after and not db.message_exists(conversation_id, after):
+        raise HTTPException(status_code=400, detail="Invalid 'after' message_id")
+
+    if include:
+        # Adjuntos y recibos cambian: sin ETag, siempre se revalida
+        messages = [_message_out(r) for r in db.get_messages(
+            conversation_id=conversation_id,
+            after_message_id=after,
+            limit=limit,
+        )]
+        _embed_expansions(messages, include, response)
+        response.headers["Cache-Control"] = CACHE_REVALIDATE
+        return messages
+
+    # Una página llena cuyo último mensaje ya se asentó no cambia nunca
+    tail = None
+    if if_none_match:
+        tail = db.get_message_page_tail(conversation_id, after, limit, PAGE_SETTLE_SECONDS)
+        etag = _page_etag(conversation_id, after, limit, tail)
+        closed = bool(tail) and tail["row_count"] == limit and tail["settled"]
+        if _etag_matches(if_none_match, etag):
+            return _not_modified(etag, CACHE_IMMUTABLE if closed else CACHE_REVALIDATE)
+
     rows = db.get_messages(
         conversation_id=conversation_id,
         after_message_id=after,
         limit=limit,
     )
-    return [
-        {
-            "message_id": r["message_id"],
-            "sender_id": r["sender_id"],
-            "ciphertext": _bytes_to_b64(r["ciphertext"]),
-            "content_hash": _bytes_to_b64(r["content_hash"]),
-            "prev_hash": _bytes_to_b64(r["prev_hash"]),
-            "signature": _bytes_to_b64(r["signature"]),
-            "client_timestamp": r["client_timestamp"],
-            "key_id": r["key_id"],
-            "created_at": r["created_at"],
-        }
-        for r in rows
-    ]
+    if len(rows) < limit:
+        # Página abierta: llega al final, es la cola de la conversación
+        tailcache.fill(conversation_id, after, rows, read_token)
+        # El validador sale de las propias filas
+        tail = {
+            "row_count": len(rows),
+            "message_id": rows[-1]["message_id"],
+            "content_hash": rows[-1]["content_hash"],
+            "settled": False,
+        } if rows else None
+    elif tail is None:
+        tail = db.get_message_page_tail(conversation_id, after, limit, PAGE_SETTLE_SECONDS)
+    closed = bool(tail) and tail["row_count"] == limit and tail["settled"]
+    response.headers["ETag"] = _page_etag(conversation_id, after, limit, tail)
+    response.headers["Cache-Control"] = CACHE_IMMUTABLE if closed else CACHE_REVALIDATE
+
+    return [_message_out(r) for r in rows]
+
+
+# Tope de ids por petición de messages:batchGet
+MAX_BATCH_GET = int(os.getenv("VAULT_MAX_BATCH_GET", 100))
+
+
+@app.post("/messages:batchGet")
+def batch_get_messages(data: BatchGetIn):
+    _require_uuid(data.user_id, "user_id")
+    if len(data.message_ids) > MAX_BATCH_GET:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_GET} message_ids per request")
+    for message_id in data.message_ids:
+        _require_uuid(message_id, "message_id")
+
+    with admission.admit("read", user=data.user_id):
+        rows = db.get_messages_by_ids(data.message_ids, data.user_id)
+
+    messages, missing, forbidden = [], [], []
+    for r in rows:
+        if not r["found"]:
+            missing.append(r["requested_id"])
+        elif not r["allowed"]:
+            forbidden.append(r["requested_id"])
+        else:
+            # Ids de varias conversaciones: el hash de la cadena la incluye
+            messages.append({**_message_out(r), "conversation_id": r["conversation_id"]})
+    return {"messages": messages, "missing": missing, "forbidden": forbidden}
 
 
 @app.get("/conversations/{conversation_id}/messages/last-hash")
@@ -280,8 +807,202 @@ def get_last_hash(conversation_id: str):
     return {"content_hash": _bytes_to_b64(last_hash)}
 
 
+# Árbol de Merkle por conversación: cabeceras firmadas y pruebas (server/merkle.py)
+
+def _require_conversation(conversation_id: str):
+    _require_uuid(conversation_id, "conversation_id")
+    if not db.conversation_exists(conversation_id):
+        raise HTTPException(status_code=404, detail="Conversation not found")
+
+
+@app.get("/log/public-key")
+def get_log_public_key():
+    # Los clientes la fijan la primera vez y verifican con ella cada cabecera
+    return {"algorithm": "Ed25519", "public_key": merkle.public_key_pem()}
+
+
+@app.get("/conversations/{conversation_id}/tree-head")
+def get_tree_head(conversation_id: str):
+    _require_conversation(conversation_id)
+    head = merkle.tree_head(conversation_id)
+    return {
+        "conversation_id": conversation_id,
+        "tree_size": head["tree_size"],
+        "root_hash": _bytes_to_b64(head["root_hash"]),
+        "timestamp": head["timestamp"],
+        "signature": _bytes_to_b64(head["signature"]),
+    }
+
+
+@app.get("/conversations/{conversation_id}/proofs/inclusion")
+def get_inclusion_proof(
+    conversation_id: str,
+    message_id: str = Query(...),
+    tree_size: Optional[int] = Query(None, ge=1),
+):
+    _require_conversation(conversation_id)
+    _require_uuid(message_id, "message_id")
+    if not db.message_exists(conversation_id, message_id):
+        raise HTTPException(status_code=404, detail="Message not found")
+    try:
+        proof = merkle.inclusion_proof(conversation_id, message_id, tree_size)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+    if proof is None:
+        # Recién llegado y la secuenciación se cortó en el tope por petición
+        raise HTTPException(
+            status_code=409, detail="Message not in the tree yet, retry shortly",
+        )
+    return {
+        "message_id": message_id,
+        "leaf_index": proof["leaf_index"],
+        "tree_size": proof["tree_size"],
+        "inclusion_path": [_bytes_to_b64(h) for h in proof["inclusion_path"]],
+    }
+
+
+@app.get("/conversations/{conversation_id}/proofs/consistency")
+def get_consistency_proof(
+    conversation_id: str,
+    first: int = Query(..., ge=0),
+    second: Optional[int] = Query(None, ge=0),
+):
+    _require_conversation(conversation_id)
+    try:
+        proof = merkle.consistency_proof(conversation_id, first, second)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+    return {
+        "first": proof["first"],
+        "second": proof["second"],
+        "consistency_path": [_bytes_to_b64(h) for h in proof["consistency_path"]],
+    }
+
+
+EXPORT_ATTACHMENT_MODES = ("ref", "full")
+
+
+@app.get("/conversations/{conversation_id}/export")
+def export_conversation(
+    conversation_id: str,
+    user_id: str = Query(...),
+    fmt: str = Query("ndjson", alias="format"),
+    after: Optional[str] = None,
+    attachments: str = Query("ref"),
+):
+    _require_uuid(conversation_id, "conversation_id")
+    _require_uuid(user_id, "user_id")
+    if fmt not in transfer.FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(transfer.FORMATS)}")
+    if attachments not in EXPORT_ATTACHMENT_MODES:
+        raise HTTPException(status_code=400, detail="attachments must be 'ref' or 'full'")
+    if not db.conversation_exists(conversation_id):
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    if not db.is_participant(conversation_id, user_id):
+        raise HTTPException(status_code=403, detail="User is not a participant")
+    if after:
+        _require_uuid(after, "message_id")
+        if not db.message_exists(conversation_id, after):
+            raise HTTPException(status_code=400, detail="Invalid 'after' message_id")
+
+    # Sin admisión: el stream ocupa una conexión lo que tarde el cliente en leer
+    return StreamingResponse(
+        transfer.export_stream(conversation_id, fmt, after, attachments == "full"),
+        media_type=transfer.MEDIA_TYPES[fmt],
+        headers={"Cache-Control": "no-store"},
+    )
+
+
+@app.post("/conversations/{conversation_id}/import", dependencies=[Depends(_require_admin)])
+async def import_conversation(conversation_id: str, request: Request):
+    _require_uuid(conversation_id, "conversation_id")
+    importer = transfer.Importer(str(uuid.UUID(conversation_id)))
+    try:
+        # Parseo, verificación y COPY fuera del event loop, trozo a trozo
+        async for chunk in request.stream():
+            await run_in_threadpool(importer.feed, chunk)
+        return await run_in_threadpool(importer.finish)
+    except transfer.ImportRejected as exc:
+        raise HTTPException(
+            status_code=400, detail={"message": str(exc), "imported": importer.summary},
+        ) from exc
+    except db.ImportConflict as exc:
+        raise HTTPException(
+            status_code=409,
+            detail={"message": f"Message {exc} already exists with different content",
+                    "imported": importer.summary},
+        ) from exc
+    except db.ImportBeforeTail as exc:
+        raise HTTPException(
+            status_code=409,
+            detail={"message": f"Message {exc} is not newer than the conversation's latest "
+                               "message; import into a new or empty conversation",
+                    "imported": importer.summary},
+        ) from exc
+    except db.UnknownUsers as exc:
+        raise HTTPException(
+            status_code=404,
+            detail={"message": "User not found", "unknown": exc.user_ids,
+                    "imported": importer.summary},
+        ) from exc
+
+
+# Señales efímeras (escribiendo, presencia, viendo): solo memoria, ver server/signals.py
+
+@app.get("/conversations/{conversation_id}/events")
+async def stream_signals(conversation_id: str, user_id: str = Query(...)):
+    _require_uuid(conversation_id, "conversation_id")
+    _require_uuid(user_id, "user_id")
+    conversation_id, user_id = str(uuid.UUID(conversation_id)), str(uuid.UUID(user_id))
+    if not await run_in_threadpool(signals.is_participant, conversation_id, user_id):
+        raise HTTPException(status_code=403, detail="User is not a participant")
+
+    subscriber = signals.subscribe(conversation_id, user_id)
+    return StreamingResponse(
+        signals.events(subscriber),
+        media_type="text/event-stream",
+        # Sin buffering en proxies (nginx) ni cachés
+        headers={"Cache-Control": "no-store", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.post("/conversations/{conversation_id}/signals", status_code=202)
+def publish_signal(conversation_id: str, data: SignalIn):
+    _require_uuid(conversation_id, "conversation_id")
+    _require_uuid(data.user_id, "user_id")
+    if data.type not in signals.SIGNAL_TYPES:
+        raise HTTPException(
+            status_code=400, detail=f"type must be one of {', '.join(signals.SIGNAL_TYPES)}"
+        )
+    if data.state is not None and len(data.state) > signals.MAX_STATE_LENGTH:
+        raise HTTPException(
+            status_code=400, detail=f"state is limited to {signals.MAX_STATE_LENGTH} characters"
+        )
+    ttl_s = signals.DEFAULT_TTL_S if data.ttl_s is None else data.ttl_s
+    if not 0 < ttl_s <= signals.MAX_TTL_S:
+        raise HTTPException(status_code=400, detail=f"ttl_s must be in (0, {signals.MAX_TTL_S:g}]")
+
+    conversation_id, user_id = str(uuid.UUID(conversation_id)), str(uuid.UUID(data.user_id))
+    if not signals.is_participant(conversation_id, user_id):
+        raise HTTPException(status_code=403, detail="User is not a participant")
+    delivered = signals.publish(conversation_id, user_id, data.type, data.state, ttl_s)
+    return {"coalesced": delivered is None, "delivered": delivered or 0}
+
+
+def _mark_receipt(message_id: str, user_id: str, read: bool, durable: bool):
+    try:
+        receipts.mark(message_id, user_id, read=read, durable=durable)
+    except receipts.ReceiptNotConfirmed as exc:
+        # Tiempo agotado o volcado fallido: el recibo sigue en cola
+        raise HTTPException(
+            status_code=503,
+            detail="Receipt not confirmed",
+            headers={"Retry-After": str(receipts.retry_after())},
+        ) from exc
+
+
 @app.post("/messages/{message_id}/delivered")
-def mark_delivered(message_id: str, data: StatusIn):
+def mark_delivered(message_id: str, data: StatusIn, durable: bool = Query(False)):
     _require_uuid(message_id, "message_id")
     _require_uuid(data.user_id, "user_id")
     conversation_id = db.get_message_conversation_id(message_id)
@@ -289,12 +1010,12 @@ def mark_delivered(message_id: str, data: StatusIn):
         raise HTTPException(status_code=404, detail="Message not found")
     if not db.is_participant(conversation_id, data.user_id):
         raise HTTPException(status_code=403, detail="User is not a participant")
-    db.mark_message_delivered(message_id, data.user_id)
+    _mark_receipt(message_id, data.user_id, read=False, durable=durable)
     return {"delivered": True}
 
 
 @app.post("/messages/{message_id}/read")
-def mark_read(message_id: str, data: StatusIn):
+def mark_read(message_id: str, data: StatusIn, durable: bool = Query(False)):
     _require_uuid(message_id, "message_id")
     _require_uuid(data.user_id, "user_id")
     conversation_id = db.get_message_conversation_id(message_id)
@@ -302,7 +1023,7 @@ def mark_read(message_id: str, data: StatusIn):
         raise HTTPException(status_code=404, detail="Message not found")
     if not db.is_participant(conversation_id, data.user_id):
         raise HTTPException(status_code=403, detail="User is not a participant")
-    db.mark_message_read(message_id, data.user_id)
+    _mark_receipt(message_id, data.user_id, read=True, durable=durable)
     return {"read": True}
 
 
@@ -312,7 +1033,7 @@ def get_status(message_id: str):
     conversation_id = db.get_message_conversation_id(message_id)
     if not conversation_id:
         raise HTTPException(status_code=404, detail="Message not found")
-    statuses = db.get_message_status(message_id)
+    statuses = receipts.merge_pending(message_id, db.get_message_status(message_id))
     return [
         {
             "user_id": s["user_id"],
@@ -324,25 +1045,45 @@ def get_status(message_id: str):
 
 
 @app.post("/messages/{message_id}/attachments")
-def add_attachment(message_id: str, data: AttachmentIn):
+def add_attachment(
+    message_id: str,
+    data: AttachmentIn,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None),
+):
     _require_uuid(message_id, "message_id")
     _require_uuid(data.uploader_id, "uploader_id")
+    content_hash = _b64_to_bytes(data.content_hash)
+
     conversation_id = db.get_message_conversation_id(message_id)
     if not conversation_id:
         raise HTTPException(status_code=404, detail="Message not found")
     if not db.is_participant(conversation_id, data.uploader_id):
         raise HTTPException(status_code=403, detail="Uploader is not a participant")
 
-    attachment_id, created_at = db.insert_attachment(
-        message_id=message_id,
-        uploader_id=data.uploader_id,
-        ciphertext=_b64_to_bytes(data.ciphertext),
-        content_hash=_b64_to_bytes(data.content_hash),
-        signature=_b64_to_bytes(data.signature),
-        meta_ciphertext=_b64_to_bytes(data.meta_ciphertext),
-        meta_hash=_b64_to_bytes(data.meta_hash),
-        meta_signature=_b64_to_bytes(data.meta_signature),
+    replayed = _idempotent_replay(
+        data.uploader_id, "attachment", idempotency_key, content_hash, message_id, response
     )
+    if replayed:
+        return {"attachment_id": replayed[0], "created_at": replayed[1]}
+
+    ciphertext = _b64_to_bytes(data.ciphertext)
+    metrics.PAYLOAD_SIZE.observe(len(ciphertext), "attachment_ciphertext")
+
+    try:
+        attachment_id, created_at = db.insert_attachment(
+            message_id=message_id,
+            uploader_id=data.uploader_id,
+            ciphertext=ciphertext,
+            content_hash=content_hash,
+            signature=_b64_to_bytes(data.signature),
+            meta_ciphertext=_b64_to_bytes(data.meta_ciphertext),
+            meta_hash=_b64_to_bytes(data.meta_hash),
+            meta_signature=_b64_to_bytes(data.meta_signature),
+            idempotency_key=idempotency_key,
+        )
+    except db.IdempotencyKeyReused as exc:
+        raise HTTPException(status_code=409, detail=IDEMPOTENCY_CONFLICT) from exc
     return {"attachment_id": attachment_id, "created_at": created_at}
 
 
@@ -370,19 +1111,40 @@ def list_attachments(message_id: str, user_id: str = Query(...)):
     ]
 
 
+def _require_attachment_reader(message_id: str, user_id: str):
+    conversation_id = db.get_message_conversation_id(message_id)
+    if not conversation_id:
+        raise HTTPException(status_code=404, detail="Message not found")
+    if not db.is_participant(conversation_id, user_id):
+        raise HTTPException(status_code=403, detail="User is not a participant")
+
+
 @app.get("/attachments/{attachment_id}")
-def get_attachment(attachment_id: str, user_id: str = Query(...)):
+def get_attachment(
+    attachment_id: str,
+    response: Response,
+    user_id: str = Query(...),
+    if_none_match: Optional[str] = Header(None),
+):
     _require_uuid(attachment_id, "attachment_id")
     _require_uuid(user_id, "user_id")
+
+    # Revalidación sin leer el ciphertext: el content_hash es el ETag
+    if if_none_match:
+        validator = db.get_attachment_validator(attachment_id)
+        if validator:
+            etag = f'"{bytes(validator["content_hash"]).hex()}"'
+            if _etag_matches(if_none_match, etag):
+                _require_attachment_reader(validator["message_id"], user_id)
+                return _not_modified(etag, CACHE_IMMUTABLE)
+
     attachment = db.get_attachment(attachment_id)
     if not attachment:
         raise HTTPException(status_code=404, detail="Attachment not found")
-    conversation_id = db.get_message_conversation_id(attachment["message_id"])
-    if not conversation_id:
-        raise HTTPException(status_code=404, detail="Message not found")
-    if not db.is_participant(conversation_id, user_id):
-        raise HTTPException(status_code=403, detail="User is not a participant")
+    _require_attachment_reader(attachment["message_id"], user_id)
 
+    response.headers["ETag"] = f'"{bytes(attachment["content_hash"]).hex()}"'
+    response.headers["Cache-Control"] = CACHE_IMMUTABLE
     return {
         "attachment_id": attachment["attachment_id"],
         "message_id": attachment["message_id"],
@@ -0,0 +1,182 @@
+import argparse
+import os
+from datetime import datetime, timedelta
+from typing import Optional
+
+from server import db, metrics, migrate, segments, storage
+
+
+# ============================================================
+# CONFIG
+# ============================================================
+
+# Antigüedad a partir de la cual el ciphertext pasa a un segmento
+ARCHIVE_AFTER_DAYS = int(os.getenv("VAULT_ARCHIVE_AFTER_DAYS", 90))
+# Mensajes por segmento (y por transacción de stub)
+ARCHIVE_MAX_MESSAGES = int(os.getenv("VAULT_ARCHIVE_MAX_MESSAGES", 10_000))
+# Login propio del archivador (miembro de vault_archiver): los triggers de
+# messages solo le dejan a él vaciar el ciphertext. Vacío = DB_USER
+ARCHIVE_USER = os.getenv("VAULT_ARCHIVE_DB_USER")
+ARCHIVE_PASSWORD = os.getenv("VAULT_ARCHIVE_DB_PASSWORD", "")
+ARCHIVER_ROLE = "vault_archiver"
+
+ARCHIVED = metrics.Counter(
+    "vault_archived_messages_total",
+    "Messages whose ciphertext was moved to a cold-storage segment.",
+)
+
+
+# ============================================================
+# ARCHIVADOR
+# ============================================================
+
+class ArchiveAborted(Exception):
+    """
+    El login del archivador no puede dejar mensajes como stub: no se
+    escribe ningún segmento.
+    """
+
+
+def _login() -> Optional[dict]:
+    return {"user": ARCHIVE_USER, "password": ARCHIVE_PASSWORD} if ARCHIVE_USER else None
+
+
+def _can_archive(conn) -> bool:
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_has_role(current_user, %s, 'MEMBER');", (ARCHIVER_ROLE,))
+        allowed = cur.fetchone()[0]
+    conn.commit()
+    return allowed
+
+
+def check_archiver() -> None:
+    """
+    Antes de escribir segmentos: sin el rol, cada UPDATE de stub fallaría
+    después de escribir su fichero.
+    """
+    if storage.ENGINE != "postgres":
+        return
+    for shard, config in db.SHARDS.items():
+        conn = migrate.connect({**config, **(_login() or {})})
+        try:
+            allowed = _can_archive(conn)
+        finally:
+            conn.close()
+        if not allowed:
+            raise ArchiveAborted(
+                f"el usuario del archivador no es miembro de {ARCHIVER_ROLE} en {shard} "
+                "(VAULT_ARCHIVE_DB_USER)"
+            )
+
+
+def archive_conversation(conversation_id: str, older_than: datetime, max_messages: int) -> list:
+    """
+    Archiva por lotes los mensajes de la conversación anteriores a
+    `older_than`. Cada segmento se escribe y verifica en disco antes de
+    dejar las filas como stub; si la transacción falla se borra el fichero.
+    """
+    written = []
+    while True:
+        rows = db.get_archivable_messages(conversation_id, older_than, max_messages)
+        if not rows:
+            return written
+
+        segment_id = db.new_uuid()
+        path = segments.segment_path(conversation_id, segment_id)
+        info = segments.write_segment(path, conversation_id, rows)
+        try:
+            reader = segments.SegmentReader(path)
+            try:
+                if reader.verify() != info["sha256"]:
+                    raise segments.SegmentError(f"sha256 inesperado en {path}")
+            finally:
+                reader.close()
+            db.record_segment(segment_id, conversation_id, rows, info, login=_login())
+        except Exception:
+            path.unlink(missing_ok=True)
+            raise
+
+        ARCHIVED.inc(amount=len(rows))
+        written.append({"segment_id": segment_id, "count": len(rows), "bytes": info["bytes"]})
+        if len(rows) < max_messages:
+            return written
+
+
+def run(older_than_days: int = ARCHIVE_AFTER_DAYS,
+        max_messages: int = ARCHIVE_MAX_MESSAGES,
+        dry_run: bool = False,
+        vacuum: bool = False) -> None:
+    older_than = datetime.utcnow() - timedelta(days=older_than_days)
+    candidates = db.list_archivable_conversations(older_than)
+    total = sum(c["messages"] for c in candidates)
+    print(f"{total} mensajes anteriores a {older_than:%Y-%m-%d} en {len(candidates)} conversaciones")
+    if dry_run or not candidates:
+        return
+    check_archiver()
+
+    for c in candidates:
+        conversation_id = str(c["conversation_id"])
+        for s in archive_conversation(conversation_id, older_than, max_messages):
+            print(f"  {conversation_id}  {s['segment_id']}  {s['count']} mensajes  {s['bytes']} B")
+
+    if vacuum:
+        # El espacio TOAST del ciphertext se libera con VACUUM (autovacuum lo
+        # hará igualmente, esto solo lo adelanta)
+        for name, config in migrate.databases():
+            conn = migrate.connect(config)
+            try:
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute("VACUUM (ANALYZE) messages;")
+            finally:
+                conn.close()
+            print(f"VACUUM (ANALYZE) messages completado ({name})")
+
+
+def verify(conversation_id: Optional[str] = None) -> int:
+    """
+    Comprueba cada segmento registrado contra su sha256 y nº de mensajes;
+    devuelve el número de segmentos con error.
+    """
+    failures = 0
+    for s in db.list_segments(conversation_id):
+        path = segments.segment_path(s["conversation_id"], s["segment_id"])
+        try:
+            reader = segments.SegmentReader(path)
+            try:
+                digest = reader.verify()
+                count = reader.count
+            finally:
+                reader.close()
+            if digest != bytes(s["sha256"]) or count != s["message_count"]:
+                raise segments.SegmentError("no coincide con message_segments")
+        except segments.SegmentError as exc:
+            failures += 1
+            print(f"ERROR {path}: {exc}")
+    return failures
+
+
+def main(argv: Optional[list] = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m server.archive")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p_run = sub.add_parser("run")
+    p_run.add_argument("--older-than-days", type=int, default=ARCHIVE_AFTER_DAYS)
+    p_run.add_argument("--max-messages", type=int, default=ARCHIVE_MAX_MESSAGES)
+    p_run.add_argument("--dry-run", action="store_true")
+    p_run.add_argument("--vacuum", action="store_true")
+
+    p_verify = sub.add_parser("verify")
+    p_verify.add_argument("--conversation")
+
+    args = parser.parse_args(argv)
+    if args.cmd == "run":
+        run(args.older_than_days, args.max_messages, args.dry_run, args.vacuum)
+    elif args.cmd == "verify":
+        failures = verify(args.conversation)
+        print("OK" if not failures else f"{failures} segmentos con error")
+        raise SystemExit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+import os
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Optional
+
+from server import db, metrics
+
+
+# ============================================================
+# CONFIG
+# ============================================================
+
+# 0 = desactivado: cada insert_message hace su propio commit
+WINDOW_MS = float(os.getenv("VAULT_COALESCE_WINDOW_MS", 0))
+MAX_BATCH = int(os.getenv("VAULT_COALESCE_MAX_BATCH", 64))
+
+ENABLED = WINDOW_MS > 0
+
+BATCH_SIZE = metrics.Histogram(
+    "vault_coalesced_batch_rows",
+    "Rows per group-commit INSERT.",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256),
+)
+BATCH_LATENCY = metrics.Histogram(
+    "vault_coalesced_batch_seconds",
+    "Duration of a group-commit flush.",
+)
+
+
+# ============================================================
+# WRITE COALESCER
+# ============================================================
+
+class WriteCoalescer:
+    """
+    Agrupa inserts concurrentes: el primero abre una ventana de `window_ms`
+    y se vacía al cerrarla o al llegar a `max_batch` filas. Cada llamante
+    espera su propio resultado.
+    """
+
+    def __init__(
+        self,
+        flush: Callable[[list], list],
+        window_ms: float = WINDOW_MS,
+        max_batch: int = MAX_BATCH,
+    ):
+        self.flush = flush
+        self.window = window_ms / 1000
+        self.max_batch = max(1, max_batch)
+        self._pending: list = []
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="vault-coalescer", daemon=True)
+        self._thread.start()
+
+    def submit(self, row: dict) -> Future:
+        future: Future = Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("WriteCoalescer cerrado")
+            self._pending.append((row, future))
+            self._cond.notify()
+        return future
+
+    def _take_batch(self) -> list:
+        with self._cond:
+            while not self._pending and not self._closed:
+                self._cond.wait()
+            if not self._pending:
+                return []
+            deadline = time.monotonic() + self.window
+            while len(self._pending) < self.max_batch and not self._closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch = self._pending[:self.max_batch]
+            del self._pending[:self.max_batch]
+            return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._take_batch()
+            if not batch:
+                return
+            self._flush(batch)
+
+    def _flush(self, batch: list) -> None:
+        started = time.perf_counter()
+        try:
+            results = self.flush([row for row, _ in batch])
+        except Exception as exc:
+            results = [exc] * len(batch)
+        BATCH_SIZE.observe(len(batch))
+        BATCH_LATENCY.observe(time.perf_counter() - started)
+        for (_, future), result in zip(batch, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(tuple(result))
+
+    def close(self) -> None:
+        """
+        Vacía lo pendiente y detiene el hilo.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+
+_coalescer: Optional[WriteCoalescer] = None
+_lock = threading.Lock()
+
+
+def _get() -> WriteCoalescer:
+    global _coalescer
+    with _lock:
+        if _coalescer is None:
+            _coalescer = WriteCoalescer(db.insert_messages_batch)
+        return _coalescer
+
+
+def insert_message(**row):
+    """
+    Misma firma y retorno que db.insert_message (sin idempotency_key).
+    """
+    return _get().submit(row).result()
+
+
+def shutdown() -> None:
+    global _coalescer
+    with _lock:
+        coalescer, _coalescer = _coalescer, None
+    if coalescer is not None:
+        coalescer.close()
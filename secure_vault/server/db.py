@@ -1,8 +1,18 @@
+import bisect
+import hashlib
+import io
 import os
+import sys
+import threading
+import time
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from psycopg2.extras import RealDictCursor, execute_values
 from contextlib import contextmanager
-from typing import Optional
+from typing import Callable, Optional
+
+from server import metrics, segments, slowlog, storage, tailcache
 
 
 # ============================================================
@@ -17,10 +27,20 @@ DB_CONFIG = {
     "password": os.getenv("DB_PASSWORD", "vaultpass"),
 }
 
+# Instrumentación de cursores solo si VAULT_SLOW_QUERY_MS > 0
+_CONNECT_OPTIONS = {"connection_factory": slowlog.TimedConnection} if slowlog.ENABLED else {}
+
 
 @contextmanager
-def get_connection():
-    conn = psycopg2.connect(**DB_CONFIG)
+def get_connection(shard: Optional[str] = None, login: Optional[dict] = None):
+    """
+    Sin `shard`: DB_CONFIG (el directorio global cuando hay sharding).
+    `login` ({"user", "password"}) sustituye al usuario de la API.
+    """
+    config = SHARDS[shard] if shard else DB_CONFIG
+    conn = psycopg2.connect(**{**config, **(login or {})}, **_CONNECT_OPTIONS)
+    metrics.DB_CONNECTIONS.inc()
+    metrics.DB_CONNECTIONS_OPEN.inc()
     try:
         yield conn
         conn.commit()
@@ -29,12 +49,233 @@ def get_connection():
         raise
     finally:
         conn.close()
+        metrics.DB_CONNECTIONS_OPEN.dec()
+
+
+# ============================================================
+# SHARDING
+#
+#   VAULT_SHARDS="s1=host1:5432/vault,s2=host2:5432/vault"
+#
+# Todo lo que cuelga de una conversación (participantes, mensajes,
+# recibos, adjuntos, segmentos) vive en el shard de su conversation_id,
+# elegido por hashing consistente. DB_CONFIG queda como directorio global:
+# users, user_keys y conversation_placements (conversaciones movidas por
+# server/rebalance.py fuera de su shard natural). Cada shard guarda una
+# copia de `users` para sus FK. Sin VAULT_SHARDS todo va a DB_CONFIG.
+# ============================================================
+
+SHARDED = bool(os.getenv("VAULT_SHARDS"))
+DEFAULT_SHARD = "default"
+# Puntos por shard en el anillo (más = reparto más uniforme)
+SHARD_VNODES = int(os.getenv("VAULT_SHARD_VNODES", 64))
+# Cada cuánto se relee conversation_placements
+PLACEMENT_TTL_S = float(os.getenv("VAULT_PLACEMENT_TTL_S", 5))
+# message_id -> conversation_id recordados (evita el scatter en recibos)
+MESSAGE_ROUTE_CACHE = int(os.getenv("VAULT_MESSAGE_ROUTE_CACHE", 100_000))
+SCATTER_WORKERS = int(os.getenv("VAULT_SHARD_SCATTER_WORKERS", 16))
+
+SCATTER_QUERIES = metrics.Counter(
+    "vault_shard_scatter_total",
+    "Queries fanned out to every shard.",
+    labels=("function",),
+)
+
+
+def parse_shards(spec: str) -> dict:
+    """
+    "nombre=host:puerto/db,..." -> {nombre: config}; usuario y contraseña
+    salen de DB_CONFIG.
+    """
+    shards = {}
+    for entry in filter(None, (e.strip() for e in spec.split(","))):
+        name, sep, target = entry.partition("=")
+        if not sep or not name or not target:
+            raise ValueError(f"VAULT_SHARDS: se esperaba nombre=host:puerto/db, no {entry!r}")
+        address, _, dbname = target.partition("/")
+        host, _, port = address.partition(":")
+        shards[name.strip()] = {
+            **DB_CONFIG,
+            "host": host or DB_CONFIG["host"],
+            "port": int(port or DB_CONFIG["port"]),
+            "dbname": dbname or DB_CONFIG["dbname"],
+        }
+    return shards
+
+
+SHARDS = parse_shards(os.getenv("VAULT_SHARDS", "")) or {DEFAULT_SHARD: DB_CONFIG}
+
+# Los mensajes viven en los shards: ahí escucha la caché de colas
+tailcache.listen_configs = list(SHARDS.values())
+
+
+class ConversationMoving(Exception):
+    """
+    La conversación se está moviendo de shard: escrituras en pausa.
+    """
+
+
+class ReceiptsDeferred(Exception):
+    """
+    apply_receipts escribió `written` recibos, pero no los de conversaciones
+    en traslado (`receipts`), que hay que reintentar más tarde.
+    """
+
+    def __init__(self, written: int, receipts: list):
+        super().__init__(f"{len(receipts)} recibos aplazados")
+        self.written = written
+        self.receipts = receipts
+
+
+def _hash64(key: str) -> int:
+    return int.from_bytes(hashlib.sha256(key.encode()).digest()[:8], "big")
+
+
+class ShardRing:
+    """
+    Anillo de hashing consistente: añadir un shard solo mueve ~1/N de las
+    conversaciones.
+    """
+
+    def __init__(self, names, vnodes: int = SHARD_VNODES):
+        points = sorted((_hash64(f"{name}#{i}"), name) for name in names for i in range(vnodes))
+        self._keys = [p[0] for p in points]
+        self._names = [p[1] for p in points]
+
+    def lookup(self, key: str) -> str:
+        i = bisect.bisect(self._keys, _hash64(key)) % len(self._keys)
+        return self._names[i]
+
+
+RING = ShardRing(SHARDS)
+
+_placements: dict = {}
+_placements_loaded = 0.0
+_placements_lock = threading.Lock()
+
+_message_routes: OrderedDict = OrderedDict()
+_message_routes_lock = threading.Lock()
+
+_scatter_pool: Optional[ThreadPoolExecutor] = None
+
+
+def _load_placements() -> dict:
+    global _placements, _placements_loaded
+    with _placements_lock:
+        if time.monotonic() - _placements_loaded < PLACEMENT_TTL_S:
+            return _placements
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT conversation_id::text, shard, state FROM conversation_placements;")
+                _placements = {r[0]: (r[1], r[2]) for r in cur.fetchall()}
+        _placements_loaded = time.monotonic()
+        return _placements
+
+
+def shard_for(conversation_id, write: bool = False) -> str:
+    """
+    Shard de una conversación: excepción del directorio o el anillo.
+    Con write=True lanza ConversationMoving durante un traslado.
+    """
+    if not SHARDED:
+        return DEFAULT_SHARD
+    key = str(conversation_id).lower()
+    placement = _load_placements().get(key)
+    if placement is None:
+        return RING.lookup(key)
+    shard, state = placement
+    if write and state == "moving":
+        raise ConversationMoving(key)
+    return shard
+
+
+def scatter(fn: Callable, label: str, shards=None) -> list:
+    """
+    fn(shard) en paralelo sobre todos los shards; resultados en orden.
+    """
+    global _scatter_pool
+    names = list(shards or SHARDS)
+    if len(names) == 1:
+        return [fn(names[0])]
+    SCATTER_QUERIES.inc(label)
+    if _scatter_pool is None:
+        _scatter_pool = ThreadPoolExecutor(SCATTER_WORKERS, thread_name_prefix="vault-shard")
+    return list(_scatter_pool.map(fn, names))
+
+
+@metrics.track_query
+def new_uuid() -> str:
+    """
+    UUID generado por PostgreSQL (directorio) para recursos cuyo id hace
+    falta antes del INSERT: conversaciones con sharding, segmentos.
+    """
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT gen_random_uuid();")
+            return str(cur.fetchone()[0])
+
+
+def remember_messages(rows) -> None:
+    if not SHARDED:
+        return
+    with _message_routes_lock:
+        for r in rows:
+            if r.get("message_id") and r.get("conversation_id"):
+                _message_routes[str(r["message_id"])] = str(r["conversation_id"])
+                _message_routes.move_to_end(str(r["message_id"]))
+        while len(_message_routes) > MESSAGE_ROUTE_CACHE:
+            _message_routes.popitem(last=False)
+
+
+def _message_shard(message_id: str, write: bool = False) -> str:
+    if not SHARDED:
+        return DEFAULT_SHARD
+    conversation_id = get_message_conversation_id(message_id)
+    # Mensaje inexistente: cualquier shard da el mismo error de FK / vacío
+    return shard_for(conversation_id, write) if conversation_id else next(iter(SHARDS))
+
+
+def _message_conversations(message_ids) -> dict:
+    """
+    message_id -> conversation_id de varios mensajes: la caché de rutas y,
+    para el resto, una consulta por shard con todos los ids. Los que no
+    existen no aparecen.
+    """
+    ids = {str(m).lower() for m in message_ids}
+    with _message_routes_lock:
+        found = {m: _message_routes[m] for m in ids if m in _message_routes}
+    missing = list(ids - found.keys())
+    if not missing:
+        return found
+
+    def fetch(shard: str) -> list:
+        with get_connection(shard) as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    SELECT message_id::text, conversation_id::text
+                    FROM messages
+                    WHERE message_id = ANY(%s::uuid[]);
+                    """,
+                    (missing,),
+                )
+                return cur.fetchall()
+
+    rows = [
+        {"message_id": m, "conversation_id": c}
+        for part in scatter(fetch, "message_conversations")
+        for m, c in part
+    ]
+    remember_messages(rows)
+    found.update((r["message_id"], r["conversation_id"]) for r in rows)
+    return found
 
 
 # ============================================================
 # USERS (Cryptographic identities only)
 # ============================================================
 
+@metrics.track_query
 def create_user(public_key: str, fingerprint: bytes) -> Optional[str]:
     """
     fingerprint = hash(public_key) generado en el cliente
@@ -86,10 +327,30 @@ def create_user(public_key: str, fingerprint: bytes) -> Optional[str]:
                     psycopg2.Binary(fingerprint),
                 )
             )
-            return user_id
-            
+
+    if SHARDED:
+        _replicate_user(user_id, public_key, fingerprint)
+    return user_id
 
 
+def _replicate_user(user_id: str, public_key: str, fingerprint: bytes) -> None:
+    # Copia en cada shard para las FK de participantes, mensajes y recibos
+    def replicate(shard: str) -> None:
+        with get_connection(shard) as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    INSERT INTO users (user_id, public_key, fingerprint)
+                    VALUES (%s, %s, %s)
+                    ON CONFLICT DO NOTHING;
+                    """,
+                    (user_id, public_key, psycopg2.Binary(fingerprint)),
+                )
+
+    scatter(replicate, "replicate_user")
+
+
+@metrics.track_query
 def get_user_by_fingerprint(fingerprint: bytes):
     query = """
         SELECT user_id, public_key, created_at
@@ -103,6 +364,7 @@ def get_user_by_fingerprint(fingerprint: bytes):
             return cur.fetchone()
 
 
+@metrics.track_query
 def get_user_by_id(user_id: str):
     query = """
         SELECT user_id, public_key, created_at
@@ -116,6 +378,7 @@ def get_user_by_id(user_id: str):
             return cur.fetchone()
 
 
+@metrics.track_query
 def add_user_key(
     user_id: str,
     key_id: str,
@@ -146,6 +409,7 @@ def add_user_key(
             return row[0] if row else None
 
 
+@metrics.track_query
 def list_user_keys(user_id: str):
     query = """
         SELECT key_id, public_key, fingerprint, is_primary, created_at, revoked_at
@@ -160,6 +424,7 @@ def list_user_keys(user_id: str):
             return cur.fetchall()
 
 
+@metrics.track_query
 def revoke_user_key(user_id: str, key_id: str) -> bool:
     query = """
         UPDATE user_keys
@@ -176,6 +441,7 @@ def revoke_user_key(user_id: str, key_id: str) -> bool:
             return cur.rowcount > 0
 
 
+@metrics.track_query
 def set_primary_key(user_id: str, key_id: str) -> bool:
     with get_connection() as conn:
         with conn.cursor() as cur:
@@ -200,6 +466,48 @@ def set_primary_key(user_id: str, key_id: str) -> bool:
             return cur.rowcount > 0
 
 
+@metrics.track_query
+def lookup_keys(pairs: list, user_ids: list, since=None):
+    """
+    Claves de varios usuarios en una sola consulta (índice de la PK):
+    `pairs` = [(user_id, key_id)] exactos, `user_ids` = todas las claves del
+    usuario, o solo las creadas/revocadas después de `since`. Incluye
+    revocadas para que el cliente pueda verificar mensajes antiguos.
+    """
+    query = """
+        SELECT user_id, key_id, public_key, fingerprint, is_primary, created_at, revoked_at
+        FROM user_keys
+        WHERE (user_id, key_id) IN (
+                SELECT * FROM unnest(%s::uuid[], %s::text[])
+            )
+           OR (
+                user_id = ANY(%s::uuid[])
+                AND (
+                    %s::timestamptz IS NULL
+                    OR created_at > %s::timestamptz
+                    OR revoked_at > %s::timestamptz
+                )
+            )
+        ORDER BY user_id, created_at ASC;
+    """
+
+    with get_connection() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(
+                query,
+                (
+                    [p[0] for p in pairs],
+                    [p[1] for p in pairs],
+                    list(user_ids),
+                    since,
+                    since,
+                    since,
+                ),
+            )
+            return cur.fetchall()
+
+
+@metrics.track_query
 def get_active_key(user_id: str, key_id: str):
     query = """
         SELECT key_id, public_key, fingerprint, is_primary, revoked_at
@@ -219,23 +527,83 @@ def get_active_key(user_id: str, key_id: str):
 # CONVERSATIONS
 # ============================================================
 
-def create_conversation() -> str:
+class UnknownUsers(Exception):
+    """
+    Algún user_id de la lista de participantes no existe.
+    """
+
+    def __init__(self, user_ids: list):
+        super().__init__(", ".join(user_ids))
+        self.user_ids = user_ids
+
+
+def _add_participants(cur, conversation_id: str, user_ids: list) -> dict:
+    """
+    Valida e inserta en bloque (unnest) dentro de la transacción de `cur`.
+    """
+    cur.execute(
+        """
+        WITH requested AS (
+            SELECT DISTINCT user_id
+            FROM unnest(%s::uuid[]) AS t(user_id)
+        ),
+        inserted AS (
+            INSERT INTO conversation_participants (conversation_id, user_id)
+            SELECT %s, r.user_id
+            FROM requested r
+            JOIN users u ON u.user_id = r.user_id
+            ON CONFLICT DO NOTHING
+            RETURNING user_id
+        )
+        SELECT
+            r.user_id::text,
+            u.user_id IS NOT NULL AS known,
+            i.user_id IS NOT NULL AS added
+        FROM requested r
+        LEFT JOIN users u ON u.user_id = r.user_id
+        LEFT JOIN inserted i ON i.user_id = r.user_id;
+        """,
+        (list(user_ids), conversation_id),
+    )
+    result = {"added": [], "already_participants": [], "unknown": []}
+    for user_id, known, added in cur.fetchall():
+        if not known:
+            result["unknown"].append(user_id)
+        elif added:
+            result["added"].append(user_id)
+        else:
+            result["already_participants"].append(user_id)
+    return result
+
+
+@metrics.track_query
+def create_conversation(participant_ids: Optional[list] = None) -> str:
     """
-    UUID generado EXCLUSIVAMENTE por PostgreSQL
+    UUID generado EXCLUSIVAMENTE por PostgreSQL. Con `participant_ids` la
+    conversación y sus participantes se crean en la misma transacción; si
+    alguno no existe se lanza UnknownUsers y no se crea nada. Con sharding
+    el id se pide antes al directorio porque decide el shard.
     """
 
     query = """
-        INSERT INTO conversations
-        DEFAULT VALUES
+        INSERT INTO conversations (conversation_id)
+        VALUES (COALESCE(%s::uuid, gen_random_uuid()))
         RETURNING conversation_id;
     """
+    conversation_id = new_uuid() if SHARDED else None
 
-    with get_connection() as conn:
+    with get_connection(shard_for(conversation_id, write=True)) as conn:
         with conn.cursor() as cur:
-            cur.execute(query)
-            return cur.fetchone()[0]
+            cur.execute(query, (conversation_id,))
+            conversation_id = cur.fetchone()[0]
+            if participant_ids:
+                result = _add_participants(cur, conversation_id, participant_ids)
+                if result["unknown"]:
+                    raise UnknownUsers(result["unknown"])
+            return conversation_id
 
 
+@metrics.track_query
 def conversation_exists(conversation_id: str) -> bool:
     query = """
         SELECT 1
@@ -244,12 +612,13 @@ def conversation_exists(conversation_id: str) -> bool:
         LIMIT 1;
     """
 
-    with get_connection() as conn:
+    with get_connection(shard_for(conversation_id)) as conn:
         with conn.cursor() as cur:
             cur.execute(query, (conversation_id,))
             return cur.fetchone() is not None
 
 
+@metrics.track_query
 def add_participant(conversation_id: str, user_id: str):
     query = """
         INSERT INTO conversation_participants (conversation_id, user_id)
@@ -257,11 +626,30 @@ def add_participant(conversation_id: str, user_id: str):
         ON CONFLICT DO NOTHING;
     """
 
-    with get_connection() as conn:
+    with get_connection(shard_for(conversation_id, write=True)) as conn:
         with conn.cursor() as cur:
             cur.execute(query, (conversation_id, user_id))
 
 
+@metrics.track_query
+def add_participants(conversation_id: str, user_ids: list) -> Optional[dict]:
+    """
+    Alta en bloque: {"added", "already_participants", "unknown"}.
+    None si la conversación no existe.
+    """
+
+    with get_connection(shard_for(conversation_id, write=True)) as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT 1 FROM conversations WHERE conversation_id = %s;",
+                (conversation_id,),
+            )
+            if cur.fetchone() is None:
+                return None
+            return _add_participants(cur, conversation_id, user_ids)
+
+
+@metrics.track_query
 def list_conversations_for_user(user_id: str):
     query = """
         SELECT c.conversation_id, c.created_at
@@ -272,12 +660,19 @@ def list_conversations_for_user(user_id: str):
         ORDER BY c.created_at DESC;
     """
 
-    with get_connection() as conn:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute(query, (user_id,))
-            return cur.fetchall()
+    def fetch(shard: str) -> list:
+        with get_connection(shard) as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(query, (user_id,))
+                # Durante un traslado la conversación está en dos shards
+                return [r for r in cur.fetchall() if shard_for(r["conversation_id"]) == shard]
 
+    rows = [r for part in scatter(fetch, "list_conversations_for_user") for r in part]
+    rows.sort(key=lambda r: r["created_at"], reverse=True)
+    return rows
 
+
+@metrics.track_query
 def is_participant(conversation_id: str, user_id: str) -> bool:
     query = """
         SELECT 1
@@ -286,16 +681,139 @@ def is_participant(conversation_id: str, user_id: str) -> bool:
         LIMIT 1;
     """
 
-    with get_connection() as conn:
+    with get_connection(shard_for(conversation_id)) as conn:
         with conn.cursor() as cur:
             cur.execute(query, (conversation_id, user_id))
             return cur.fetchone() is not None
 
 
+# ============================================================
+# IDEMPOTENCY KEYS (reintentos seguros de escrituras append-only)
+#
+# Viven en el directorio: la clave es única aunque el mismo dueño
+# escriba en conversaciones de shards distintos.
+# ============================================================
+
+IDEMPOTENCY_TTL_HOURS = int(os.getenv("VAULT_IDEMPOTENCY_TTL_HOURS", 24))
+
+
+class IdempotencyKeyReused(Exception):
+    """
+    La misma Idempotency-Key se envió con un contenido distinto o contra
+    otra conversación / otro mensaje.
+    """
+
+@metrics.track_query
+def get_idempotent_result(owner_id: str, scope: str, idempotency_key: str):
+    """
+    Una sola búsqueda por PK en el directorio. scope = "message" | "attachment".
+    resource_created_at es NULL mientras el recurso no se ha insertado;
+    target_id es la conversación (message) o el mensaje (attachment).
+    """
+    with get_connection() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(
+                """
+                SELECT resource_id, resource_created_at, request_hash, target_id
+                FROM idempotency_keys
+                WHERE owner_id = %s
+                  AND scope = %s
+                  AND idempotency_key = %s
+                  AND expires_at > CURRENT_TIMESTAMP;
+                """,
+                (owner_id, scope, idempotency_key)
+            )
+            return cur.fetchone()
+
+
+def _claim_idempotency_key(owner_id, scope, idempotency_key, request_hash, target_id):
+    """
+    Reserva la clave en el directorio (única entre shards) y le asigna ya el
+    id del recurso. Devuelve (resource_id, resource_created_at): con
+    created_at el recurso existe; sin él, el llamador lo inserta con ese id
+    (ON CONFLICT DO NOTHING), así que un reintento tras un fallo a medias
+    acaba el mismo recurso. Las claves expiradas se reutilizan; otro
+    contenido u otro target_id lanza IdempotencyKeyReused.
+    """
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO idempotency_keys (
+                    owner_id, scope, idempotency_key, request_hash, target_id,
+                    resource_id, expires_at
+                )
+                VALUES (
+                    %s, %s, %s, %s, %s, gen_random_uuid(),
+                    CURRENT_TIMESTAMP + make_interval(hours => %s)
+                )
+                ON CONFLICT (owner_id, scope, idempotency_key) DO UPDATE
+                    SET request_hash = EXCLUDED.request_hash,
+                        target_id = EXCLUDED.target_id,
+                        resource_id = EXCLUDED.resource_id,
+                        resource_created_at = NULL,
+                        created_at = CURRENT_TIMESTAMP,
+                        expires_at = EXCLUDED.expires_at
+                    WHERE idempotency_keys.expires_at <= CURRENT_TIMESTAMP
+                RETURNING resource_id, resource_created_at;
+                """,
+                (
+                    owner_id,
+                    scope,
+                    idempotency_key,
+                    psycopg2.Binary(request_hash),
+                    target_id,
+                    IDEMPOTENCY_TTL_HOURS,
+                )
+            )
+            claimed = cur.fetchone()
+            if claimed:
+                return claimed
+
+            cur.execute(
+                """
+                SELECT resource_id, resource_created_at, request_hash, target_id
+                FROM idempotency_keys
+                WHERE owner_id = %s AND scope = %s AND idempotency_key = %s;
+                """,
+                (owner_id, scope, idempotency_key)
+            )
+            resource_id, resource_created_at, stored_hash, stored_target = cur.fetchone()
+    # Sin target_id (clave anterior a la columna) tampoco coincide
+    if bytes(stored_hash) != request_hash or str(stored_target).lower() != str(target_id).lower():
+        raise IdempotencyKeyReused(idempotency_key)
+    return resource_id, resource_created_at
+
+
+def _complete_idempotency_key(owner_id, scope, idempotency_key, row):
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                UPDATE idempotency_keys
+                SET resource_created_at = %s
+                WHERE owner_id = %s AND scope = %s AND idempotency_key = %s
+                  AND resource_id = %s;
+                """,
+                (row[1], owner_id, scope, idempotency_key, row[0])
+            )
+
+
+@metrics.track_query
+def purge_expired_idempotency_keys() -> int:
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "DELETE FROM idempotency_keys WHERE expires_at <= CURRENT_TIMESTAMP;"
+            )
+            return cur.rowcount
+
+
 # ============================================================
 # MESSAGES (Append-only / E2EE)
 # ============================================================
 
+@metrics.track_query
 def insert_message(
     conversation_id: str,
     sender_id: str,
@@ -305,14 +823,19 @@ def insert_message(
     prev_hash: Optional[bytes] = None,
     client_timestamp: Optional[str] = None,
     key_id: Optional[str] = None,
+    idempotency_key: Optional[str] = None,
 ):
     """
     content_hash = hash(ciphertext + sender_id + conversation_id + prev_hash)
     signature    = firma(content_hash)
+
+    Con idempotency_key, el message_id sale de la clave reservada en el
+    directorio; un reintento devuelve el (message_id, created_at) original.
     """
 
     query = """
         INSERT INTO messages (
+            message_id,
             conversation_id,
             sender_id,
             ciphertext,
@@ -322,15 +845,27 @@ def insert_message(
             client_timestamp,
             key_id
         )
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-        RETURNING message_id, created_at;
+        VALUES (COALESCE(%s::uuid, gen_random_uuid()), %s, %s, %s, %s, %s, %s, %s, %s)
+        ON CONFLICT (message_id) DO NOTHING
+        RETURNING message_id, created_at, client_timestamp;
     """
 
-    with get_connection() as conn:
+    shard = shard_for(conversation_id, write=True)
+    message_id = None
+    if idempotency_key:
+        message_id, created_at = _claim_idempotency_key(
+            sender_id, "message", idempotency_key, content_hash, conversation_id
+        )
+        if created_at:
+            return message_id, created_at
+
+    events = []
+    with get_connection(shard) as conn:
         with conn.cursor() as cur:
             cur.execute(
                 query,
                 (
+                    message_id,
                     conversation_id,
                     sender_id,
                     psycopg2.Binary(ciphertext),
@@ -341,9 +876,155 @@ def insert_message(
                     key_id,
                 )
             )
-            return cur.fetchone()
+            inserted = cur.fetchone()
+            if inserted is None:
+                # Un intento anterior con la misma clave llegó a insertarlo
+                cur.execute(
+                    "SELECT message_id, created_at FROM messages WHERE message_id = %s;",
+                    (message_id,)
+                )
+                row = cur.fetchone()
+            else:
+                message_id, created_at, stored_timestamp = inserted
+                row = (message_id, created_at)
+                events = tailcache.publish(cur, [{
+                    "message_id": message_id,
+                    "conversation_id": conversation_id,
+                    "sender_id": sender_id,
+                    "ciphertext": ciphertext,
+                    "content_hash": content_hash,
+                    "prev_hash": prev_hash,
+                    "signature": signature,
+                    "client_timestamp": stored_timestamp,
+                    "key_id": key_id,
+                    "created_at": created_at,
+                }])
+
+    if idempotency_key:
+        _complete_idempotency_key(sender_id, "message", idempotency_key, row)
+    tailcache.apply(events)
+    remember_messages([{"message_id": row[0], "conversation_id": conversation_id}])
+    return row
+
+
+@metrics.track_query
+def insert_messages_batch(rows: list) -> list:
+    """
+    Inserta varios mensajes en una sola transacción por shard (group
+    commit). `rows` son dicts con los argumentos de insert_message (sin
+    idempotency_key). Devuelve, en el mismo orden, (message_id, created_at)
+    o la excepción de esa fila: una fila inválida no hace fallar al resto.
+    """
+    results: list = [None] * len(rows)
+    groups: dict = {}
+    for i, r in enumerate(rows):
+        try:
+            groups.setdefault(shard_for(r["conversation_id"], write=True), []).append(i)
+        except ConversationMoving as exc:
+            results[i] = exc
+
+    def insert(shard: str) -> None:
+        indexes = groups[shard]
+        try:
+            inserted = _insert_messages_batch(shard, [rows[i] for i in indexes])
+        except Exception as exc:
+            # Solo fallan las filas de este shard: las de los demás ya
+            # confirmaron y no deben reintentarse (duplicados)
+            inserted = [exc] * len(indexes)
+        for i, result in zip(indexes, inserted):
+            results[i] = result
+
+    scatter(insert, "insert_messages_batch", groups)
+    remember_messages(
+        {"message_id": res[0], "conversation_id": r["conversation_id"]}
+        for r, res in zip(rows, results)
+        if not isinstance(res, Exception)
+    )
+    return results
+
+
+def _insert_messages_batch(shard: str, rows: list) -> list:
+    """
+    created_at usa clock_timestamp() para conservar el orden entre filas de
+    la misma transacción (CURRENT_TIMESTAMP sería idéntico para todas).
+    """
+
+    columns = """
+        conversation_id,
+        sender_id,
+        ciphertext,
+        content_hash,
+        prev_hash,
+        signature,
+        client_timestamp,
+        key_id,
+        created_at
+    """
+    template = "(%s, %s, %s, %s, %s, %s, %s, %s, clock_timestamp())"
+
+    values = [
+        (
+            r["conversation_id"],
+            r["sender_id"],
+            psycopg2.Binary(r["ciphertext"]),
+            psycopg2.Binary(r["content_hash"]),
+            psycopg2.Binary(r["prev_hash"]) if r.get("prev_hash") else None,
+            psycopg2.Binary(r["signature"]),
+            r.get("client_timestamp"),
+            r.get("key_id"),
+        )
+        for r in rows
+    ]
 
+    returning = "RETURNING message_id, created_at, client_timestamp"
 
+    with get_connection(shard) as conn:
+        with conn.cursor() as cur:
+            try:
+                inserted = execute_values(
+                    cur,
+                    f"INSERT INTO messages ({columns}) VALUES %s {returning};",
+                    values,
+                    template=template,
+                    page_size=len(values),
+                    fetch=True,
+                )
+            except psycopg2.Error:
+                conn.rollback()
+
+                # Aislamiento por fila: misma transacción, un SAVEPOINT por fila
+                inserted = []
+                for value in values:
+                    cur.execute("SAVEPOINT coalesced_row;")
+                    try:
+                        cur.execute(
+                            f"INSERT INTO messages ({columns}) VALUES {template} {returning};",
+                            value,
+                        )
+                        inserted.append(cur.fetchone())
+                        cur.execute("RELEASE SAVEPOINT coalesced_row;")
+                    except psycopg2.Error as exc:
+                        cur.execute("ROLLBACK TO SAVEPOINT coalesced_row;")
+                        inserted.append(exc)
+
+            events = tailcache.publish(cur, [
+                {
+                    **r,
+                    "prev_hash": r.get("prev_hash"),
+                    "key_id": r.get("key_id"),
+                    "message_id": result[0],
+                    "created_at": result[1],
+                    "client_timestamp": result[2],
+                }
+                for r, result in zip(rows, inserted)
+                if not isinstance(result, Exception)
+            ])
+
+    tailcache.apply(events)
+    return [result if isinstance(result, Exception) else tuple(result[:2]) for result in inserted]
+
+
+@metrics.track_query
 def get_messages(
     conversation_id: str,
     after_message_id: Optional[str] = None,
@@ -351,13 +1032,15 @@ def get_messages(
 ):
     """
     Devuelve mensajes en orden cronológico
-    (la verificación criptográfica se hace en el cliente)
+    (la verificación criptográfica se hace en el cliente). El ciphertext de
+    los mensajes archivados se lee de su segmento.
     """
 
     if after_message_id:
         query = """
             SELECT
                 message_id,
+                conversation_id,
                 sender_id,
                 ciphertext,
                 content_hash,
@@ -365,7 +1048,8 @@ def get_messages(
                 signature,
                 client_timestamp,
                 key_id,
-                created_at
+                created_at,
+                segment_id
             FROM messages
             WHERE conversation_id = %s
               AND created_at > (
@@ -381,6 +1065,7 @@ def get_messages(
         query = """
             SELECT
                 message_id,
+                conversation_id,
                 sender_id,
                 ciphertext,
                 content_hash,
@@ -388,7 +1073,8 @@ def get_messages(
                 signature,
                 client_timestamp,
                 key_id,
-                created_at
+                created_at,
+                segment_id
             FROM messages
             WHERE conversation_id = %s
             ORDER BY created_at ASC
@@ -396,12 +1082,177 @@ def get_messages(
         """
         params = (conversation_id, limit)
 
-    with get_connection() as conn:
+    with get_connection(shard_for(conversation_id)) as conn:
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
             cur.execute(query, params)
-            return cur.fetchall()
+            rows = cur.fetchall()
+    remember_messages(rows)
+    return segments.hydrate(rows)
+
+
+@metrics.track_query
+def get_message_page_tail(
+    conversation_id: str,
+    after_message_id: Optional[str] = None,
+    limit: int = 50,
+    settle_seconds: int = 30,
+):
+    """
+    Validador de una página de get_messages sin leer columnas BYTEA grandes:
+    número de filas y último mensaje (id + content_hash). `settled` indica
+    que el último mensaje es más antiguo que `settle_seconds`, de modo que
+    ya no pueden aparecer commits concurrentes con un created_at anterior.
+    """
+
+    after_filter = ""
+    params = [settle_seconds, conversation_id]
+    if after_message_id:
+        after_filter = """
+              AND created_at > (
+                  SELECT created_at
+                  FROM messages
+                  WHERE message_id = %s
+              )
+        """
+        params.append(after_message_id)
+    params.append(limit)
+
+    query = f"""
+        SELECT
+            count(*) OVER () AS row_count,
+            message_id,
+            content_hash,
+            created_at < CURRENT_TIMESTAMP - make_interval(secs => %s) AS settled
+        FROM (
+            SELECT message_id, content_hash, created_at
+            FROM messages
+            WHERE conversation_id = %s
+              {after_filter}
+            ORDER BY created_at ASC
+            LIMIT %s
+        ) page
+        ORDER BY created_at DESC
+        LIMIT 1;
+    """
+
+    with get_connection(shard_for(conversation_id)) as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(query, params)
+            return cur.fetchone()
+
+
+@metrics.track_query
+def get_messages_around(
+    conversation_id: str,
+    around,
+    before: int = 25,
+    after: int = 50,
+):
+    """
+    Ventana alrededor de un instante, en orden cronológico: hasta `before`
+    mensajes anteriores a `around` y hasta `after` desde `around` en
+    adelante. Cada mitad es un salto directo sobre
+    idx_messages_conversation_created (la anterior, recorrida hacia atrás),
+    sin paginar desde el principio.
+    """
+    query = """
+        SELECT *
+        FROM (
+            (
+                SELECT message_id, conversation_id, sender_id, ciphertext, content_hash,
+                       prev_hash, signature, client_timestamp, key_id, created_at, segment_id
+                FROM messages
+                WHERE conversation_id = %s
+                  AND created_at < %s
+                ORDER BY created_at DESC
+                LIMIT %s
+            )
+            UNION ALL
+            (
+                SELECT message_id, conversation_id, sender_id, ciphertext, content_hash,
+                       prev_hash, signature, client_timestamp, key_id, created_at, segment_id
+                FROM messages
+                WHERE conversation_id = %s
+                  AND created_at >= %s
+                ORDER BY created_at ASC
+                LIMIT %s
+            )
+        ) window_rows
+        ORDER BY created_at ASC;
+    """
+    params = (conversation_id, around, before, conversation_id, around, after)
+
+    with get_connection(shard_for(conversation_id)) as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(query, params)
+            rows = cur.fetchall()
+    remember_messages(rows)
+    return segments.hydrate(rows)
+
+
+@metrics.track_query
+def get_messages_by_ids(message_ids: list, user_id: str):
+    """
+    Mensajes por id con la autorización resuelta en la misma consulta: una
+    fila por id pedido con `found` y `allowed`. El ciphertext solo se lee si
+    el usuario participa en la conversación.
+    """
+    query = """
+        WITH requested AS (
+            SELECT DISTINCT message_id
+            FROM unnest(%s::uuid[]) AS t(message_id)
+        )
+        SELECT
+            r.message_id::text AS requested_id,
+            m.message_id IS NOT NULL AS found,
+            cp.user_id IS NOT NULL AS allowed,
+            m.message_id,
+            m.conversation_id,
+            m.sender_id,
+            CASE WHEN cp.user_id IS NOT NULL THEN m.ciphertext END AS ciphertext,
+            m.content_hash,
+            m.prev_hash,
+            m.signature,
+            m.client_timestamp,
+            m.key_id,
+            m.created_at,
+            m.segment_id
+        FROM requested r
+        LEFT JOIN messages m
+            ON m.message_id = r.message_id
+        LEFT JOIN conversation_participants cp
+            ON cp.conversation_id = m.conversation_id
+           AND cp.user_id = %s
+        ORDER BY m.created_at ASC NULLS LAST;
+    """
 
+    def fetch(shard: str) -> list:
+        with get_connection(shard) as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(query, (list(message_ids), user_id))
+                return cur.fetchall()
 
+    parts = scatter(fetch, "get_messages_by_ids")
+    if len(parts) == 1:
+        rows = parts[0]
+    else:
+        # Cada shard responde por todos los ids: vale la fila del shard dueño
+        by_id: dict = {}
+        for shard, part in zip(SHARDS, parts):
+            for r in part:
+                current = by_id.get(r["requested_id"])
+                owned = r["found"] and shard_for(r["conversation_id"]) == shard
+                if current is None or owned:
+                    by_id[r["requested_id"]] = r
+        rows = sorted(
+            by_id.values(),
+            key=lambda r: (r["created_at"] is None, r["created_at"] or 0),
+        )
+    remember_messages(r for r in rows if r["found"])
+    return segments.hydrate(rows)
+
+
+@metrics.track_query
 def message_exists(conversation_id: str, message_id: str) -> bool:
     query = """
         SELECT 1
@@ -410,26 +1261,43 @@ def message_exists(conversation_id: str, message_id: str) -> bool:
         LIMIT 1;
     """
 
-    with get_connection() as conn:
+    with get_connection(shard_for(conversation_id)) as conn:
         with conn.cursor() as cur:
             cur.execute(query, (conversation_id, message_id))
             return cur.fetchone() is not None
 
 
+@metrics.track_query
 def get_message_conversation_id(message_id: str) -> Optional[str]:
+    """
+    Con sharding se consulta primero la caché de rutas y, si no está, todos
+    los shards en paralelo.
+    """
     query = """
         SELECT conversation_id
         FROM messages
         WHERE message_id = %s;
     """
-
-    with get_connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute(query, (message_id,))
-            row = cur.fetchone()
-            return row[0] if row else None
-
-
+    if SHARDED:
+        with _message_routes_lock:
+            cached = _message_routes.get(str(message_id))
+        if cached:
+            return cached
+
+    def fetch(shard: str) -> Optional[str]:
+        with get_connection(shard) as conn:
+            with conn.cursor() as cur:
+                cur.execute(query, (message_id,))
+                row = cur.fetchone()
+                return row[0] if row else None
+
+    conversation_id = next((c for c in scatter(fetch, "get_message_conversation_id") if c), None)
+    if conversation_id:
+        remember_messages([{"message_id": message_id, "conversation_id": conversation_id}])
+    return conversation_id
+
+
+@metrics.track_query
 def get_last_message_hash(conversation_id: str) -> Optional[bytes]:
     """
     Útil para encadenar prev_hash
@@ -443,13 +1311,14 @@ def get_last_message_hash(conversation_id: str) -> Optional[bytes]:
         LIMIT 1;
     """
 
-    with get_connection() as conn:
+    with get_connection(shard_for(conversation_id)) as conn:
         with conn.cursor() as cur:
             cur.execute(query, (conversation_id,))
             row = cur.fetchone()
             return row[0] if row else None
 
 
+@metrics.track_query
 def mark_message_delivered(message_id: str, user_id: str) -> bool:
     query = """
         INSERT INTO message_status (message_id, user_id, delivered_at)
@@ -458,12 +1327,13 @@ def mark_message_delivered(message_id: str, user_id: str) -> bool:
         DO UPDATE SET delivered_at = COALESCE(message_status.delivered_at, CURRENT_TIMESTAMP);
     """
 
-    with get_connection() as conn:
+    with get_connection(_message_shard(message_id, write=True)) as conn:
         with conn.cursor() as cur:
             cur.execute(query, (message_id, user_id))
             return True
 
 
+@metrics.track_query
 def mark_message_read(message_id: str, user_id: str) -> bool:
     query = """
         INSERT INTO message_status (message_id, user_id, delivered_at, read_at)
@@ -474,12 +1344,91 @@ def mark_message_read(message_id: str, user_id: str) -> bool:
             read_at = COALESCE(message_status.read_at, CURRENT_TIMESTAMP);
     """
 
-    with get_connection() as conn:
+    with get_connection(_message_shard(message_id, write=True)) as conn:
         with conn.cursor() as cur:
             cur.execute(query, (message_id, user_id))
             return True
 
 
+@metrics.track_query
+def apply_receipts(receipts: list) -> int:
+    """
+    Aplica un lote de recibos (message_id, user_id, delivered_at, read_at)
+    con un COPY a una tabla temporal y un único upsert. Se conserva siempre
+    el primer timestamp (LEAST ignora NULL). Recibos de mensajes que ya no
+    existen se descartan en lugar de romper el lote por la FK.
+
+    Con sharding los shards se resuelven para todo el lote de una vez; los
+    recibos de conversaciones en traslado no se aplican y se devuelven en
+    ReceiptsDeferred (tras escribir el resto) para reintentarlos.
+    """
+    if not receipts:
+        return 0
+    if not SHARDED:
+        return _apply_receipts(DEFAULT_SHARD, receipts)
+
+    conversations = _message_conversations(r[0] for r in receipts)
+    groups: dict = {}
+    deferred = []
+    for r in receipts:
+        conversation_id = conversations.get(str(r[0]).lower())
+        if conversation_id is None:
+            continue
+        try:
+            groups.setdefault(shard_for(conversation_id, write=True), []).append(r)
+        except ConversationMoving:
+            deferred.append(r)
+
+    written = sum(
+        scatter(lambda shard: _apply_receipts(shard, groups[shard]), "apply_receipts", groups)
+    ) if groups else 0
+    if deferred:
+        raise ReceiptsDeferred(written, deferred)
+    return written
+
+
+def _apply_receipts(shard: str, receipts: list) -> int:
+    def copy_value(value) -> str:
+        return value.isoformat() if value else "\\N"
+
+    buffer = io.StringIO()
+    for message_id, user_id, delivered_at, read_at in receipts:
+        buffer.write(
+            f"{message_id}\t{user_id}\t{copy_value(delivered_at)}\t{copy_value(read_at)}\n"
+        )
+    buffer.seek(0)
+
+    with get_connection(shard) as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                CREATE TEMP TABLE receipt_staging (
+                    message_id UUID NOT NULL,
+                    user_id UUID NOT NULL,
+                    delivered_at TIMESTAMPTZ,
+                    read_at TIMESTAMPTZ
+                ) ON COMMIT DROP;
+            """)
+            cur.copy_expert(
+                "COPY receipt_staging (message_id, user_id, delivered_at, read_at) FROM STDIN",
+                buffer,
+            )
+            # TIMESTAMPTZ -> TIMESTAMP usa la zona de la sesión, igual que CURRENT_TIMESTAMP
+            cur.execute("""
+                INSERT INTO message_status (message_id, user_id, delivered_at, read_at)
+                SELECT s.message_id, s.user_id, MIN(s.delivered_at), MIN(s.read_at)
+                FROM receipt_staging s
+                JOIN messages m ON m.message_id = s.message_id
+                JOIN users u ON u.user_id = s.user_id
+                GROUP BY s.message_id, s.user_id
+                ON CONFLICT (message_id, user_id)
+                DO UPDATE SET
+                    delivered_at = LEAST(message_status.delivered_at, EXCLUDED.delivered_at),
+                    read_at = LEAST(message_status.read_at, EXCLUDED.read_at);
+            """)
+            return cur.rowcount
+
+
+@metrics.track_query
 def get_message_status(message_id: str):
     query = """
         SELECT user_id, delivered_at, read_at
@@ -488,12 +1437,73 @@ def get_message_status(message_id: str):
         ORDER BY delivered_at ASC NULLS LAST;
     """
 
-    with get_connection() as conn:
+    with get_connection(_message_shard(message_id)) as conn:
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
             cur.execute(query, (message_id,))
             return cur.fetchall()
 
 
+_EXPANSIONS = {
+    "attachments": """
+        COALESCE((
+            SELECT json_agg(json_build_object(
+                'attachment_id', a.attachment_id,
+                'uploader_id', a.uploader_id,
+                'meta_ciphertext', translate(encode(a.meta_ciphertext, 'base64'), E'\\n', ''),
+                'meta_hash', translate(encode(a.meta_hash, 'base64'), E'\\n', ''),
+                'meta_signature', translate(encode(a.meta_signature, 'base64'), E'\\n', ''),
+                'created_at', a.created_at
+            ) ORDER BY a.created_at)
+            FROM attachments a
+            WHERE a.message_id = p.message_id
+        ), '[]'::json) AS attachments
+    """,
+    "status": """
+        COALESCE((
+            SELECT json_agg(json_build_object(
+                'user_id', s.user_id,
+                'delivered_at', s.delivered_at,
+                'read_at', s.read_at
+            ) ORDER BY s.delivered_at ASC NULLS LAST)
+            FROM message_status s
+            WHERE s.message_id = p.message_id
+        ), '[]'::json) AS status
+    """,
+}
+
+
+@metrics.track_query
+def get_message_expansions(message_ids: list, include: set) -> dict:
+    """
+    Adjuntos (solo metadatos, nunca el ciphertext) y/o recibos de toda una
+    página en una sola consulta. message_id -> {"attachments": [...], "status": [...]}.
+    """
+    columns = [_EXPANSIONS[name] for name in ("attachments", "status") if name in include]
+    if not message_ids or not columns:
+        return {}
+
+    query = f"""
+        SELECT p.message_id::text AS message_id, {", ".join(columns)}
+        FROM unnest(%s::uuid[]) AS p(message_id);
+    """
+
+    groups: dict = {}
+    for m in message_ids:
+        groups.setdefault(_message_shard(m), []).append(str(m))
+
+    def fetch(shard: str) -> dict:
+        with get_connection(shard) as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(query, (groups[shard],))
+                return {row.pop("message_id"): row for row in cur.fetchall()}
+
+    expansions: dict = {}
+    for part in scatter(fetch, "get_message_expansions", groups):
+        expansions.update(part)
+    return expansions
+
+
+@metrics.track_query
 def insert_attachment(
     message_id: str,
     uploader_id: str,
@@ -503,9 +1513,11 @@ def insert_attachment(
     meta_ciphertext: Optional[bytes] = None,
     meta_hash: Optional[bytes] = None,
     meta_signature: Optional[bytes] = None,
+    idempotency_key: Optional[str] = None,
 ):
     query = """
         INSERT INTO attachments (
+            attachment_id,
             message_id,
             uploader_id,
             ciphertext,
@@ -515,15 +1527,26 @@ def insert_attachment(
             meta_hash,
             meta_signature
         )
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        VALUES (COALESCE(%s::uuid, gen_random_uuid()), %s, %s, %s, %s, %s, %s, %s, %s)
+        ON CONFLICT (attachment_id) DO NOTHING
         RETURNING attachment_id, created_at;
     """
 
-    with get_connection() as conn:
+    shard = _message_shard(message_id, write=True)
+    attachment_id = None
+    if idempotency_key:
+        attachment_id, created_at = _claim_idempotency_key(
+            uploader_id, "attachment", idempotency_key, content_hash, message_id
+        )
+        if created_at:
+            return attachment_id, created_at
+
+    with get_connection(shard) as conn:
         with conn.cursor() as cur:
             cur.execute(
                 query,
                 (
+                    attachment_id,
                     message_id,
                     uploader_id,
                     psycopg2.Binary(ciphertext),
@@ -534,9 +1557,21 @@ def insert_attachment(
                     psycopg2.Binary(meta_signature) if meta_signature else None,
                 )
             )
-            return cur.fetchone()
+            row = cur.fetchone()
+            if row is None:
+                # Un intento anterior con la misma clave llegó a insertarlo
+                cur.execute(
+                    "SELECT attachment_id, created_at FROM attachments WHERE attachment_id = %s;",
+                    (attachment_id,)
+                )
+                row = cur.fetchone()
+
+    if idempotency_key:
+        _complete_idempotency_key(uploader_id, "attachment", idempotency_key, row)
+    return row
 
 
+@metrics.track_query
 def list_attachments(message_id: str):
     query = """
         SELECT attachment_id, uploader_id, meta_ciphertext, meta_hash, meta_signature, created_at
@@ -545,12 +1580,33 @@ def list_attachments(message_id: str):
         ORDER BY created_at ASC;
     """
 
-    with get_connection() as conn:
+    with get_connection(_message_shard(message_id)) as conn:
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
             cur.execute(query, (message_id,))
             return cur.fetchall()
 
 
+@metrics.track_query
+def get_attachment_validator(attachment_id: str):
+    """
+    message_id + content_hash sin cargar el ciphertext (para If-None-Match).
+    """
+    query = """
+        SELECT message_id, content_hash
+        FROM attachments
+        WHERE attachment_id = %s;
+    """
+
+    def fetch(shard: str):
+        with get_connection(shard) as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(query, (attachment_id,))
+                return cur.fetchone()
+
+    return next((row for row in scatter(fetch, "get_attachment_validator") if row), None)
+
+
+@metrics.track_query
 def get_attachment(attachment_id: str):
     query = """
         SELECT attachment_id, message_id, uploader_id,
@@ -561,7 +1617,650 @@ def get_attachment(attachment_id: str):
         WHERE attachment_id = %s;
     """
 
-    with get_connection() as conn:
+    def fetch(shard: str):
+        with get_connection(shard) as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(query, (attachment_id,))
+                return cur.fetchone()
+
+    return next((row for row in scatter(fetch, "get_attachment") if row), None)
+
+
+# ============================================================
+# ARCHIVE (segmentos de almacenamiento frío)
+# ============================================================
+
+@metrics.track_query
+def list_archivable_conversations(older_than) -> list:
+    query = """
+        SELECT conversation_id, count(*) AS messages
+        FROM messages
+        WHERE created_at < %s
+          AND segment_id IS NULL
+        GROUP BY conversation_id
+        ORDER BY conversation_id;
+    """
+
+    def fetch(shard: str) -> list:
+        with get_connection(shard) as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(query, (older_than,))
+                # Copias a medio mover: solo cuenta el shard dueño
+                return [r for r in cur.fetchall() if shard_for(r["conversation_id"]) == shard]
+
+    return [r for part in scatter(fetch, "list_archivable_conversations") for r in part]
+
+
+@metrics.track_query
+def get_archivable_messages(conversation_id: str, older_than, limit: int):
+    """
+    Los mensajes más antiguos aún sin archivar, en orden cronológico.
+    """
+    query = """
+        SELECT message_id, sender_id, ciphertext, content_hash, prev_hash,
+               signature, client_timestamp, key_id, created_at
+        FROM messages
+        WHERE conversation_id = %s
+          AND created_at < %s
+          AND segment_id IS NULL
+        ORDER BY created_at ASC
+        LIMIT %s;
+    """
+
+    with get_connection(shard_for(conversation_id)) as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(query, (conversation_id, older_than, limit))
+            return cur.fetchall()
+
+
+@metrics.track_query
+def record_segment(segment_id: str, conversation_id: str, messages: list, info: dict,
+                   login: Optional[dict] = None) -> int:
+    """
+    Registra el segmento y deja como stub (ciphertext vacío) sus mensajes en
+    una sola transacción. Si otro archivador se adelantó con alguno de ellos
+    se aborta todo. `login`: el del archivador (server.archive), miembro de
+    vault_archiver, el único al que los triggers dejan hacer el UPDATE.
+    """
+    message_ids = [str(m["message_id"]) for m in messages]
+
+    with get_connection(shard_for(conversation_id, write=True), login) as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO message_segments (
+                    segment_id, conversation_id, first_created_at,
+                    last_created_at, message_count, bytes, sha256
+                )
+                VALUES (%s, %s, %s, %s, %s, %s, %s);
+                """,
+                (
+                    segment_id,
+                    conversation_id,
+                    messages[0]["created_at"],
+                    messages[-1]["created_at"],
+                    len(messages),
+                    info["bytes"],
+                    psycopg2.Binary(info["sha256"]),
+                ),
+            )
+            cur.execute(
+                """
+                UPDATE messages
+                SET ciphertext = ''::bytea, segment_id = %s
+                WHERE message_id = ANY(%s::uuid[])
+                  AND segment_id IS NULL;
+                """,
+                (segment_id, message_ids),
+            )
+            if cur.rowcount != len(message_ids):
+                raise RuntimeError(
+                    f"segmento {segment_id}: {cur.rowcount}/{len(message_ids)} mensajes archivados"
+                )
+            return cur.rowcount
+
+
+@metrics.track_query
+def list_segments(conversation_id: Optional[str] = None):
+    query = """
+        SELECT segment_id, conversation_id, message_count, bytes, sha256
+        FROM message_segments
+        WHERE %s::uuid IS NULL OR conversation_id = %s::uuid
+        ORDER BY conversation_id, first_created_at;
+    """
+
+    def fetch(shard: str) -> list:
+        with get_connection(shard) as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(query, (conversation_id, conversation_id))
+                return [r for r in cur.fetchall() if shard_for(r["conversation_id"]) == shard]
+
+    shards = [shard_for(conversation_id)] if conversation_id else None
+    return [r for part in scatter(fetch, "list_segments", shards) for r in part]
+
+
+# ============================================================
+# EXPORT / IMPORT (copia completa de una conversación)
+# ============================================================
+
+# Filas por viaje del cursor con nombre de la exportación
+EXPORT_FETCH_SIZE = int(os.getenv("VAULT_EXPORT_FETCH_SIZE", 1000))
+
+_B64 = "translate(encode({}, 'base64'), E'\\n', '')"
+
+
+class ImportConflict(Exception):
+    """
+    Un message_id importado ya existe con otro contenido o en otra conversación.
+    """
+
+
+class ImportBeforeTail(Exception):
+    """
+    Un mensaje importado no es posterior al último de la conversación:
+    entraría en páginas ya servidas como inmutables (ETag y caché de un
+    año). Solo se importa en conversaciones nuevas o vacías, o detrás de
+    su cola (reanudar una importación).
+    """
+
+
+@metrics.track_query
+def get_conversation_export_header(conversation_id: str) -> Optional[dict]:
+    query = """
+        SELECT
+            c.conversation_id,
+            c.created_at,
+            ARRAY(
+                SELECT cp.user_id::text
+                FROM conversation_participants cp
+                WHERE cp.conversation_id = c.conversation_id
+                ORDER BY cp.joined_at, cp.user_id
+            ) AS participants
+        FROM conversations c
+        WHERE c.conversation_id = %s;
+    """
+
+    with get_connection(shard_for(conversation_id)) as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(query, (conversation_id,))
+            return cur.fetchone()
+
+
+def stream_conversation_export(
+    conversation_id: str,
+    after_message_id: Optional[str] = None,
+    attachment_data: bool = False,
+):
+    """
+    Generador de mensajes (en orden created_at, message_id) con sus adjuntos
+    y recibos agregados. Cursor con nombre: la memoria no depende del tamaño
+    de la conversación. REPEATABLE READ da una instantánea coherente durante
+    todo el stream. Sin track_query: la duración es la del cliente leyendo.
+    """
+    attachment_ciphertext = _B64.format("a.ciphertext") if attachment_data else "NULL"
+    after = """
+          AND (m.created_at, m.message_id) > (
+              SELECT created_at, message_id
+              FROM messages
+              WHERE message_id = %(after)s
+          )
+    """ if after_message_id else ""
+    query = f"""
+        SELECT
+            m.message_id,
+            m.conversation_id,
+            m.sender_id,
+            m.ciphertext,
+            m.content_hash,
+            m.prev_hash,
+            m.signature,
+            m.client_timestamp,
+            m.key_id,
+            m.created_at,
+            m.segment_id,
+            COALESCE((
+                SELECT json_agg(json_build_object(
+                    'attachment_id', a.attachment_id,
+                    'uploader_id', a.uploader_id,
+                    'ciphertext', {attachment_ciphertext},
+                    'content_hash', {_B64.format("a.content_hash")},
+                    'signature', {_B64.format("a.signature")},
+                    'meta_ciphertext', {_B64.format("a.meta_ciphertext")},
+                    'meta_hash', {_B64.format("a.meta_hash")},
+                    'meta_signature', {_B64.format("a.meta_signature")},
+                    'created_at', a.created_at
+                ) ORDER BY a.created_at, a.attachment_id)
+                FROM attachments a
+                WHERE a.message_id = m.message_id
+            ), '[]'::json) AS attachments,
+            COALESCE((
+                SELECT json_agg(json_build_object(
+                    'user_id', s.user_id,
+                    'delivered_at', s.delivered_at,
+                    'read_at', s.read_at
+                ) ORDER BY s.user_id)
+                FROM message_status s
+                WHERE s.message_id = m.message_id
+            ), '[]'::json) AS receipts
+        FROM messages m
+        WHERE m.conversation_id = %(conversation_id)s
+        {after}
+        ORDER BY m.created_at ASC, m.message_id ASC;
+    """
+    params = {"conversation_id": conversation_id, "after": after_message_id}
+
+    with get_connection(shard_for(conversation_id)) as conn:
+        conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
+        with conn.cursor(name="vault_export", cursor_factory=RealDictCursor) as cur:
+            cur.itersize = EXPORT_FETCH_SIZE
+            cur.execute(query, params)
+            for row in cur:
+                yield segments.hydrate([row])[0]
+
+
+@metrics.track_query
+def prepare_import(conversation_id: str, participants: list, created_at=None) -> bool:
+    """
+    Crea la conversación con su id original (el hash de cada mensaje lo
+    incluye) y sus participantes. True si la conversación no existía.
+    """
+    with get_connection(shard_for(conversation_id, write=True)) as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO conversations (conversation_id, created_at)
+                VALUES (%s, COALESCE(%s, CURRENT_TIMESTAMP))
+                ON CONFLICT DO NOTHING;
+                """,
+                (conversation_id, created_at),
+            )
+            created = cur.rowcount == 1
+            result = _add_participants(cur, conversation_id, participants)
+            if result["unknown"]:
+                raise UnknownUsers(result["unknown"])
+            return created
+
+
+@metrics.track_query
+def get_recent_message_hashes(conversation_id: str, limit: int) -> list:
+    """
+    content_hash de los últimos `limit` mensajes, del más antiguo al más nuevo.
+    """
+    query = """
+        SELECT content_hash
+        FROM (
+            SELECT content_hash, created_at
+            FROM messages
+            WHERE conversation_id = %s
+            ORDER BY created_at DESC
+            LIMIT %s
+        ) recent
+        ORDER BY created_at ASC;
+    """
+
+    with get_connection(shard_for(conversation_id)) as conn:
+        with conn.cursor() as cur:
+            cur.execute(query, (conversation_id, limit))
+            return [bytes(r[0]) for r in cur.fetchall()]
+
+
+def _copy_field(value) -> str:
+    # Formato texto de COPY: \N es NULL y bytea va en hex (\\x...)
+    if value is None:
+        return "\\N"
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return "\\\\x" + bytes(value).hex()
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def _copy_rows(cur, table: str, columns: tuple, rows: list) -> None:
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join(_copy_field(row[c]) for c in columns) + "\n")
+    buffer.seek(0)
+    cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buffer)
+
+
+_IMPORT_MESSAGE_COLUMNS = (
+    "message_id", "sender_id", "ciphertext", "content_hash", "prev_hash",
+    "signature", "client_timestamp", "key_id", "created_at",
+)
+_IMPORT_ATTACHMENT_COLUMNS = (
+    "attachment_id", "message_id", "uploader_id", "ciphertext", "content_hash",
+    "signature", "meta_ciphertext", "meta_hash", "meta_signature", "created_at",
+)
+_IMPORT_RECEIPT_COLUMNS = ("message_id", "user_id", "delivered_at", "read_at")
+
+
+@metrics.track_query
+def import_messages_batch(conversation_id: str, messages: list) -> dict:
+    """
+    Carga un lote ya verificado: COPY a tablas temporales y un INSERT ...
+    SELECT por tabla destino, en una transacción. Los ids ya presentes con
+    el mismo contenido se saltan (reanudar o repetir una importación no
+    duplica). Adjuntos solo si traen ciphertext.
+    """
+    attachments = [
+        dict(a, message_id=m["message_id"])
+        for m in messages
+        for a in m["attachments"]
+        if a.get("ciphertext") is not None
+    ]
+    receipts = [dict(r, message_id=m["message_id"]) for m in messages for r in m["receipts"]]
+
+    with get_connection(shard_for(conversation_id, write=True)) as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                CREATE TEMP TABLE import_messages (
+                    message_id UUID NOT NULL,
+                    sender_id UUID NOT NULL,
+                    ciphertext BYTEA NOT NULL,
+                    content_hash BYTEA NOT NULL,
+                    prev_hash BYTEA,
+                    signature BYTEA NOT NULL,
+                    client_timestamp TIMESTAMP,
+                    key_id TEXT,
+                    created_at TIMESTAMP NOT NULL
+                ) ON COMMIT DROP;
+
+                CREATE TEMP TABLE import_attachments (
+                    attachment_id UUID NOT NULL,
+                    message_id UUID NOT NULL,
+                    uploader_id UUID NOT NULL,
+                    ciphertext BYTEA NOT NULL,
+                    content_hash BYTEA NOT NULL,
+                    signature BYTEA NOT NULL,
+                    meta_ciphertext BYTEA,
+                    meta_hash BYTEA,
+                    meta_signature BYTEA,
+                    created_at TIMESTAMP NOT NULL
+                ) ON COMMIT DROP;
+
+                CREATE TEMP TABLE import_receipts (
+                    message_id UUID NOT NULL,
+                    user_id UUID NOT NULL,
+                    delivered_at TIMESTAMP,
+                    read_at TIMESTAMP
+                ) ON COMMIT DROP;
+            """)
+            _copy_rows(cur, "import_messages", _IMPORT_MESSAGE_COLUMNS, messages)
+            _copy_rows(cur, "import_attachments", _IMPORT_ATTACHMENT_COLUMNS, attachments)
+            _copy_rows(cur, "import_receipts", _IMPORT_RECEIPT_COLUMNS, receipts)
+
+            cur.execute("""
+                SELECT DISTINCT u.user_id::text
+                FROM (
+                    SELECT sender_id AS user_id FROM import_messages
+                    UNION
+                    SELECT uploader_id FROM import_attachments
+                ) u
+                WHERE NOT EXISTS (SELECT 1 FROM users WHERE users.user_id = u.user_id);
+            """)
+            unknown = [r[0] for r in cur.fetchall()]
+            if unknown:
+                raise UnknownUsers(unknown)
+
+            cur.execute(
+                """
+                SELECT i.message_id::text
+                FROM import_messages i
+                JOIN messages m ON m.message_id = i.message_id
+                WHERE m.conversation_id <> %s
+                   OR m.content_hash <> i.content_hash
+                LIMIT 1;
+                """,
+                (conversation_id,),
+            )
+            conflict = cur.fetchone()
+            if conflict:
+                raise ImportConflict(conflict[0])
+
+            cur.execute(
+                """
+                SELECT i.message_id::text
+                FROM import_messages i
+                WHERE NOT EXISTS (SELECT 1 FROM messages m WHERE m.message_id = i.message_id)
+                  AND i.created_at <= (
+                      SELECT max(created_at) FROM messages WHERE conversation_id = %s
+                  )
+                LIMIT 1;
+                """,
+                (conversation_id,),
+            )
+            behind = cur.fetchone()
+            if behind:
+                raise ImportBeforeTail(behind[0])
+
+            cur.execute(
+                """
+                INSERT INTO messages (
+                    message_id, conversation_id, sender_id, ciphertext, content_hash,
+                    prev_hash, signature, client_timestamp, key_id, created_at
+                )
+                SELECT
+                    message_id, %s, sender_id, ciphertext, content_hash,
+                    prev_hash, signature, client_timestamp, key_id, created_at
+                FROM import_messages
+                ON CONFLICT (message_id) DO NOTHING;
+                """,
+                (conversation_id,),
+            )
+            inserted = cur.rowcount
+
+            cur.execute("""
+                INSERT INTO attachments (
+                    attachment_id, message_id, uploader_id, ciphertext, content_hash,
+                    signature, meta_ciphertext, meta_hash, meta_signature, created_at
+                )
+                SELECT
+                    attachment_id, message_id, uploader_id, ciphertext, content_hash,
+                    signature, meta_ciphertext, meta_hash, meta_signature, created_at
+                FROM import_attachments
+                ON CONFLICT (attachment_id) DO NOTHING;
+            """)
+            attachments_inserted = cur.rowcount
+
+            # Mismo criterio que apply_receipts: gana el primer timestamp
+            cur.execute("""
+                INSERT INTO message_status (message_id, user_id, delivered_at, read_at)
+                SELECT r.message_id, r.user_id, MIN(r.delivered_at), MIN(r.read_at)
+                FROM import_receipts r
+                JOIN users u ON u.user_id = r.user_id
+                GROUP BY r.message_id, r.user_id
+                ON CONFLICT (message_id, user_id)
+                DO UPDATE SET
+                    delivered_at = LEAST(message_status.delivered_at, EXCLUDED.delivered_at),
+                    read_at = LEAST(message_status.read_at, EXCLUDED.read_at);
+            """)
+            result = {
+                "messages": inserted,
+                "attachments": attachments_inserted,
+                "receipts": cur.rowcount,
+            }
+            # Filas con created_at antiguo: la cola cacheada se descarta y el
+            # árbol de Merkle vuelve a buscar hojas desde el principio
+            events = tailcache.publish_invalidation(cur, conversation_id) if inserted else []
+            if inserted:
+                cur.execute(
+                    "UPDATE merkle_heads SET sequenced_until = NULL WHERE conversation_id = %s;",
+                    (conversation_id,),
+                )
+
+    tailcache.apply(events)
+    return result
+
+
+# ============================================================
+# MERKLE (registro de transparencia por conversación, server/merkle.py)
+# ============================================================
+
+@metrics.track_query
+def get_merkle_head(conversation_id: str) -> Optional[dict]:
+    query = """
+        SELECT tree_size, root_hash, sequenced_until
+        FROM merkle_heads
+        WHERE conversation_id = %s;
+    """
+
+    with get_connection(shard_for(conversation_id)) as conn:
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute(query, (attachment_id,))
+            cur.execute(query, (conversation_id,))
             return cur.fetchone()
+
+
+@metrics.track_query
+def get_unsequenced_messages(conversation_id: str, limit: int) -> list:
+    """
+    Mensajes sin hoja en el árbol, en orden de llegada. Anti-join sobre
+    toda la conversación, sin cota de tiempo: created_at es el de
+    clock_timestamp() y una transacción puede confirmar mucho después,
+    detrás de lo ya secuenciado. Con l.conversation_id el plan puede ser un
+    anti-join de dos rangos de índice de la conversación.
+    """
+    query = """
+        SELECT m.message_id, m.content_hash, m.created_at
+        FROM messages m
+        WHERE m.conversation_id = %s
+          AND NOT EXISTS (
+              SELECT 1
+              FROM merkle_leaves l
+              WHERE l.conversation_id = m.conversation_id
+                AND l.message_id = m.message_id
+          )
+        ORDER BY m.created_at ASC, m.message_id ASC
+        LIMIT %s;
+    """
+
+    with get_connection(shard_for(conversation_id)) as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(query, (conversation_id, limit))
+            return cur.fetchall()
+
+
+@metrics.track_query
+def append_merkle_leaves(
+    conversation_id: str,
+    expected: Optional[dict],
+    head: dict,
+    leaves: list,
+    nodes: list,
+) -> bool:
+    """
+    Avanza la cabecera de `expected` a `head` y guarda las hojas
+    (leaf_index, message_id, hash) y nodos internos (level, node_index,
+    hash) nuevos. False, sin escribir nada, si la cabecera ya no es
+    `expected` (otro integrador se adelantó o una importación la reinició).
+    """
+    with get_connection(shard_for(conversation_id, write=True)) as conn:
+        with conn.cursor() as cur:
+            if expected is None:
+                cur.execute(
+                    """
+                    INSERT INTO merkle_heads (conversation_id, tree_size, root_hash, sequenced_until)
+                    VALUES (%s, %s, %s, %s)
+                    ON CONFLICT (conversation_id) DO NOTHING
+                    RETURNING 1;
+                    """,
+                    (conversation_id, head["tree_size"], psycopg2.Binary(head["root_hash"]),
+                     head["sequenced_until"]),
+                )
+            else:
+                cur.execute(
+                    """
+                    UPDATE merkle_heads
+                    SET tree_size = %s, root_hash = %s, sequenced_until = %s,
+                        updated_at = CURRENT_TIMESTAMP
+                    WHERE conversation_id = %s
+                      AND tree_size = %s
+                      AND sequenced_until IS NOT DISTINCT FROM %s
+                    RETURNING 1;
+                    """,
+                    (head["tree_size"], psycopg2.Binary(head["root_hash"]), head["sequenced_until"],
+                     conversation_id, expected["tree_size"], expected["sequenced_until"]),
+                )
+            if cur.fetchone() is None:
+                return False
+
+            execute_values(
+                cur,
+                "INSERT INTO merkle_leaves (conversation_id, leaf_index, message_id, hash) VALUES %s;",
+                [(conversation_id, i, m, psycopg2.Binary(h)) for i, m, h in leaves],
+                page_size=1000,
+            )
+            if nodes:
+                execute_values(
+                    cur,
+                    "INSERT INTO merkle_nodes (conversation_id, level, node_index, hash) VALUES %s;",
+                    [(conversation_id, l, i, psycopg2.Binary(h)) for l, i, h in nodes],
+                    page_size=1000,
+                )
+            return True
+
+
+@metrics.track_query
+def get_merkle_nodes(conversation_id: str, nodes: list) -> dict:
+    """
+    Hashes de los subárboles perfectos (level, node_index) pedidos; el
+    nivel 0 son las hojas. Una consulta para toda una prueba.
+    """
+    if not nodes:
+        return {}
+    query = """
+        SELECT n.level, n.node_index, n.hash
+        FROM merkle_nodes n
+        JOIN unnest(%s::int[], %s::bigint[]) AS w(level, node_index)
+          ON n.level = w.level AND n.node_index = w.node_index
+        WHERE n.conversation_id = %s
+        UNION ALL
+        SELECT 0, l.leaf_index, l.hash
+        FROM merkle_leaves l
+        WHERE l.conversation_id = %s
+          AND l.leaf_index = ANY(%s::bigint[]);
+    """
+    inner = [(l, i) for l, i in nodes if l > 0]
+    leaves = [i for l, i in nodes if l == 0]
+
+    with get_connection(shard_for(conversation_id)) as conn:
+        with conn.cursor() as cur:
+            cur.execute(query, (
+                [l for l, _ in inner], [i for _, i in inner], conversation_id,
+                conversation_id, leaves,
+            ))
+            return {(level, index): bytes(h) for level, index, h in cur.fetchall()}
+
+
+@metrics.track_query
+def get_merkle_leaf_index(conversation_id: str, message_id: str) -> Optional[int]:
+    query = """
+        SELECT leaf_index
+        FROM merkle_leaves
+        WHERE message_id = %s
+          AND conversation_id = %s;
+    """
+
+    with get_connection(shard_for(conversation_id)) as conn:
+        with conn.cursor() as cur:
+            cur.execute(query, (message_id, conversation_id))
+            row = cur.fetchone()
+            return row[0] if row else None
+
+
+# ============================================================
+# MOTOR DE ALMACENAMIENTO (VAULT_STORAGE)
+#
+# Al final del módulo: el motor alternativo importa server.db para sus
+# excepciones y la configuración compartida.
+# ============================================================
+
+if storage.ENGINE == "sqlite":
+    from server import sqlite_db
+
+    storage.install(sys.modules[__name__], sqlite_db)
@@ -0,0 +1,384 @@
+import argparse
+import hashlib
+import os
+import struct
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Optional
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+
+from server import db, metrics
+
+
+# ============================================================
+# CONFIG
+#
+# Registro de transparencia por conversación (RFC 6962 / RFC 9162): un
+# árbol de Merkle append-only sobre los content_hash de sus mensajes.
+# Los clientes piden cabeceras firmadas (tamaño + raíz), pruebas de
+# inclusión de un mensaje y pruebas de consistencia entre dos tamaños,
+# todas de O(log n) hashes.
+#
+# Los mensajes entran al árbol de forma perezosa, al pedir una cabecera o
+# una prueba: el índice de hoja es el orden de secuenciación, no el de
+# created_at (un mensaje que confirma tarde entra detrás de los ya
+# secuenciados).
+# ============================================================
+
+# Clave Ed25519 con la que el servidor firma las cabeceras. Los clientes
+# fijan su pública (GET /log/public-key), así que todas las instancias deben
+# usar la misma: solo la crea `python -m server.merkle init-key` y la API no
+# arranca sin ella. Por defecto, relativa al paquete (no al directorio actual).
+SIGNING_KEY_FILE = Path(
+    os.getenv("VAULT_TREE_HEAD_KEY_FILE")
+    or Path(__file__).resolve().parent.parent / "keys" / "tree_head_ed25519.pem"
+)
+# Hojas por transacción y tope por petición (el resto entra en la siguiente)
+INTEGRATE_BATCH = int(os.getenv("VAULT_MERKLE_BATCH", 5000))
+INTEGRATE_MAX = int(os.getenv("VAULT_MERKLE_MAX_PER_REQUEST", 50_000))
+CAS_RETRIES = 3
+
+# Dominio de la firma: conversation_id (16) | tree_size (8) | timestamp ms (8) | raíz (32)
+TREE_HEAD_CONTEXT = b"secure-vault/tree-head/v1\x00"
+
+LEAVES = metrics.Counter(
+    "vault_merkle_leaves_total",
+    "Messages appended to conversation Merkle trees.",
+)
+CONFLICTS = metrics.Counter(
+    "vault_merkle_conflicts_total",
+    "Tree head updates lost to a concurrent integrator.",
+)
+
+_key: Optional[Ed25519PrivateKey] = None
+_key_lock = threading.Lock()
+
+
+class MissingSigningKey(Exception):
+    """
+    No hay clave de firma de cabeceras en SIGNING_KEY_FILE.
+    """
+
+
+# ============================================================
+# HASHES (RFC 6962 §2.1)
+# ============================================================
+
+EMPTY_ROOT = hashlib.sha256(b"").digest()
+
+
+def leaf_hash(content_hash: bytes) -> bytes:
+    return hashlib.sha256(b"\x00" + bytes(content_hash)).digest()
+
+
+def node_hash(left: bytes, right: bytes) -> bytes:
+    return hashlib.sha256(b"\x01" + bytes(left) + bytes(right)).digest()
+
+
+# ============================================================
+# FORMA DEL ÁRBOL
+#
+# Solo se guardan subárboles perfectos: (nivel, índice) cubre las hojas
+# [índice << nivel, (índice + 1) << nivel). El hash de cualquier rango que
+# usan las pruebas se compone con a lo sumo log2(n) de ellos.
+# ============================================================
+
+def _split(n: int) -> int:
+    # Mayor potencia de 2 estrictamente menor que n (n > 1)
+    return 1 << ((n - 1).bit_length() - 1)
+
+
+def perfect_nodes(lo: int, hi: int) -> list:
+    """
+    Subárboles perfectos que componen [lo, hi), de mayor a menor: la
+    descomposición binaria de hi - lo. Vale para cualquier rango que sea
+    un nodo del árbol (lo está alineado a su tamaño).
+    """
+    nodes = []
+    for level in range((hi - lo).bit_length() - 1, -1, -1):
+        if (hi - lo) >> level & 1:
+            nodes.append((level, lo >> level))
+            lo += 1 << level
+    return nodes
+
+
+def _fold(hashes: list) -> bytes:
+    # MTH de rangos consecutivos de mayor a menor: se pliegan por la derecha
+    root = hashes[-1]
+    for h in reversed(hashes[:-1]):
+        root = node_hash(h, root)
+    return root
+
+
+def range_hash(lo: int, hi: int, stored: dict) -> bytes:
+    if lo == hi:
+        return EMPTY_ROOT
+    return _fold([stored[n] for n in perfect_nodes(lo, hi)])
+
+
+def inclusion_ranges(index: int, size: int) -> list:
+    """
+    PATH(m, D[n]) como rangos de hojas, de la hoja hacia la raíz.
+    """
+    path, lo, hi = [], 0, size
+    while hi - lo > 1:
+        k = _split(hi - lo)
+        if index < lo + k:
+            path.append((lo + k, hi))
+            hi = lo + k
+        else:
+            path.append((lo, lo + k))
+            lo += k
+    return path[::-1]
+
+
+def consistency_ranges(first: int, second: int) -> list:
+    """
+    PROOF(m, D[n]) (SUBPROOF con b = true) como rangos de hojas, de abajo
+    arriba. 0 < first < second.
+    """
+    proof, lo, hi, m, complete = [], 0, second, first, True
+    while m != hi - lo:
+        k = _split(hi - lo)
+        if m <= k:
+            proof.append((lo + k, hi))
+            hi = lo + k
+        else:
+            proof.append((lo, lo + k))
+            lo += k
+            m -= k
+            complete = False
+    if not complete:
+        proof.append((lo, hi))
+    return proof[::-1]
+
+
+def _ranges_hashes(conversation_id: str, ranges: list) -> list:
+    wanted = sorted({n for lo, hi in ranges for n in perfect_nodes(lo, hi)})
+    stored = db.get_merkle_nodes(conversation_id, wanted)
+    return [range_hash(lo, hi, stored) for lo, hi in ranges]
+
+
+# ============================================================
+# SECUENCIACIÓN
+# ============================================================
+
+def integrate(conversation_id: str) -> Optional[dict]:
+    """
+    Añade al árbol los mensajes aún sin hoja y devuelve la cabecera
+    (tree_size, root_hash) o None si la conversación no tiene ninguno.
+
+    Solo hace falta la frontera derecha (un subárbol perfecto por bit de
+    tree_size) para seguir: cada hoja nueva se apila y se funde con la
+    anterior mientras tengan la misma altura. La cabecera avanza con una
+    comparación (tamaño y marca de agua esperados); si otro integrador se
+    adelantó se relee y se reintenta. Durante un traslado de shard se sirve
+    la última cabecera sin integrar.
+    """
+    head = db.get_merkle_head(conversation_id)
+    appended = conflicts = 0
+    while appended < INTEGRATE_MAX:
+        size = head["tree_size"] if head else 0
+        watermark = head["sequenced_until"] if head else None
+        pending = db.get_unsequenced_messages(conversation_id, INTEGRATE_BATCH)
+        if not pending:
+            break
+
+        frontier = perfect_nodes(0, size)
+        stored = db.get_merkle_nodes(conversation_id, frontier)
+        stack = [(level, stored[(level, index)]) for level, index in frontier]
+        leaves, nodes = [], []
+        for index, message in enumerate(pending, start=size):
+            h = leaf_hash(message["content_hash"])
+            leaves.append((index, message["message_id"], h))
+            stack.append((0, h))
+            while len(stack) > 1 and stack[-1][0] == stack[-2][0]:
+                level, right = stack.pop()
+                _, left = stack.pop()
+                h = node_hash(left, right)
+                nodes.append((level + 1, index >> (level + 1), h))
+                stack.append((level + 1, h))
+
+        latest = max(m["created_at"] for m in pending)
+        new_head = {
+            "tree_size": size + len(pending),
+            "root_hash": _fold([h for _, h in stack]),
+            "sequenced_until": max(latest, watermark) if watermark else latest,
+        }
+        try:
+            won = db.append_merkle_leaves(conversation_id, head, new_head, leaves, nodes)
+        except db.ConversationMoving:
+            break
+        if not won:
+            CONFLICTS.inc()
+            conflicts += 1
+            if conflicts > CAS_RETRIES:
+                break
+            head = db.get_merkle_head(conversation_id)
+            continue
+
+        head = new_head
+        appended += len(pending)
+        LEAVES.inc(amount=len(pending))
+        if len(pending) < INTEGRATE_BATCH:
+            break
+    return head
+
+
+# ============================================================
+# CABECERAS FIRMADAS
+# ============================================================
+
+def signing_key() -> Ed25519PrivateKey:
+    """
+    La API la carga al arrancar: sin fichero falla en vez de generar una
+    clave distinta por host (los clientes fijan la primera que ven).
+    """
+    global _key
+    with _key_lock:
+        if _key is None:
+            try:
+                pem = SIGNING_KEY_FILE.read_bytes()
+            except FileNotFoundError as exc:
+                raise MissingSigningKey(
+                    f"falta la clave de firma {SIGNING_KEY_FILE}: créala una vez con "
+                    "`python -m server.merkle init-key` y comparte el fichero entre "
+                    "instancias (VAULT_TREE_HEAD_KEY_FILE)"
+                ) from exc
+            _key = serialization.load_pem_private_key(pem, password=None)
+        return _key
+
+
+def create_key(path: Path) -> Ed25519PrivateKey:
+    """
+    Genera la clave en `path`; nunca sobrescribe una existente (rotarla
+    rompe a todos los clientes que fijaron la anterior).
+    """
+    key = Ed25519PrivateKey.generate()
+    pem = key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    )
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(pem)
+    return key
+
+
+def public_key_pem() -> str:
+    return signing_key().public_key().public_bytes(
+        serialization.Encoding.PEM,
+        serialization.PublicFormat.SubjectPublicKeyInfo,
+    ).decode()
+
+
+def tree_head_message(conversation_id: str, tree_size: int, timestamp: int, root_hash: bytes) -> bytes:
+    return (
+        TREE_HEAD_CONTEXT
+        + uuid.UUID(str(conversation_id)).bytes
+        + struct.pack(">QQ", tree_size, timestamp)
+        + bytes(root_hash)
+    )
+
+
+def tree_head(conversation_id: str) -> dict:
+    head = integrate(conversation_id)
+    size = head["tree_size"] if head else 0
+    root = bytes(head["root_hash"]) if head else EMPTY_ROOT
+    timestamp = int(time.time() * 1000)
+    return {
+        "tree_size": size,
+        "root_hash": root,
+        "timestamp": timestamp,
+        "signature": signing_key().sign(tree_head_message(conversation_id, size, timestamp, root)),
+    }
+
+
+# ============================================================
+# PRUEBAS
+# ============================================================
+
+def _current_size(conversation_id: str, at_least: int = 0) -> int:
+    # Solo se integra si lo guardado no llega
+    head = db.get_merkle_head(conversation_id)
+    if not head or head["tree_size"] < at_least:
+        head = integrate(conversation_id)
+    return head["tree_size"] if head else 0
+
+
+def inclusion_proof(conversation_id: str, message_id: str, tree_size: Optional[int] = None) -> Optional[dict]:
+    """
+    Ruta de auditoría de un mensaje en el árbol de `tree_size` hojas (por
+    defecto, el actual). None si el mensaje no está en el árbol; ValueError
+    si el tamaño pedido no existe o no lo contiene.
+    """
+    index = db.get_merkle_leaf_index(conversation_id, message_id)
+    if index is None:
+        integrate(conversation_id)
+        index = db.get_merkle_leaf_index(conversation_id, message_id)
+        if index is None:
+            return None
+    current = _current_size(conversation_id, tree_size or index + 1)
+    size = current if tree_size is None else tree_size
+    if size > current:
+        raise ValueError(f"tree_size {size} is larger than the tree ({current})")
+    if index >= size:
+        raise ValueError(f"Message is leaf {index}, not in a tree of size {size}")
+
+    ranges = inclusion_ranges(index, size)
+    return {
+        "leaf_index": index,
+        "tree_size": size,
+        "inclusion_path": _ranges_hashes(conversation_id, ranges),
+    }
+
+
+def consistency_proof(conversation_id: str, first: int, second: Optional[int] = None) -> dict:
+    """
+    Prueba de que el árbol de `first` hojas es prefijo del de `second` (por
+    defecto, el actual). ValueError si los tamaños no valen.
+    """
+    current = _current_size(conversation_id, second or 0)
+    second = current if second is None else second
+    if second > current:
+        raise ValueError(f"second {second} is larger than the tree ({current})")
+    if first > second:
+        raise ValueError("first must not be larger than second")
+
+    # Árbol vacío o el mismo tamaño: basta con comparar raíces
+    ranges = consistency_ranges(first, second) if 0 < first < second else []
+    return {
+        "first": first,
+        "second": second,
+        "consistency_path": _ranges_hashes(conversation_id, ranges),
+    }
+
+
+# ============================================================
+# CLI
+# ============================================================
+
+def main(argv: Optional[list] = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m server.merkle")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("init-key")
+    sub.add_parser("public-key")
+
+    args = parser.parse_args(argv)
+    if args.cmd == "init-key":
+        try:
+            create_key(SIGNING_KEY_FILE)
+        except FileExistsError:
+            raise SystemExit(f"{SIGNING_KEY_FILE} ya existe: no se sobrescribe")
+        print(f"clave creada en {SIGNING_KEY_FILE}")
+    print(public_key_pem(), end="")
+
+
+if __name__ == "__main__":
+    main()
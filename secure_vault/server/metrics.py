@@ -0,0 +1,259 @@
+import threading
+import time
+from bisect import bisect_left
+from functools import wraps
+from typing import Dict, Iterable, Tuple
+
+
+# ============================================================
+# METRIC TYPES (Prometheus text exposition format 0.0.4)
+# ============================================================
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+ROW_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 200, 500, 1000, 5000)
+SIZE_BUCKETS = tuple(64 * 4 ** i for i in range(11))  # 64 B .. 64 MiB
+
+_REGISTRY = []
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        _REGISTRY.append(self)
+
+    def _header(self) -> list:
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, documentation, labels=()):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1.0) -> None:
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0.0) + amount
+
+    def value(self, *label_values: str) -> float:
+        return self._values.get(label_values, 0.0)
+
+    def render(self) -> list:
+        lines = self._header()
+        with self._lock:
+            items = list(self._values.items())
+        for values, total in items:
+            lines.append(f"{self.name}{_format_labels(self.labels, values)} {_format_value(total)}")
+        return lines
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *label_values: str, amount: float = 1.0) -> None:
+        self.inc(*label_values, amount=-amount)
+
+    def set(self, *label_values: str, value: float) -> None:
+        with self._lock:
+            self._values[label_values] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        # label_values -> [counts por bucket (no acumulados) + overflow, sum]
+        self._series: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, *label_values: str) -> None:
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = [[0] * (len(self.buckets) + 1), 0.0]
+                self._series[label_values] = series
+            series[0][index] += 1
+            series[1] += value
+
+    def count(self, *label_values: str) -> int:
+        series = self._series.get(label_values)
+        return sum(series[0]) if series else 0
+
+    def render(self) -> list:
+        lines = self._header()
+        with self._lock:
+            items = [(k, list(v[0]), v[1]) for k, v in self._series.items()]
+        for values, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(self.labels, values, le)} {cumulative}"
+                )
+            labels = _format_labels(self.labels, values)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+def render() -> str:
+    lines = []
+    for metric in _REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# ============================================================
+# VAULT METRICS
+# ============================================================
+
+HTTP_REQUESTS = Counter(
+    "vault_http_requests_total",
+    "HTTP requests by method, route template and status.",
+    ("method", "route", "status"),
+)
+HTTP_LATENCY = Histogram(
+    "vault_http_request_duration_seconds",
+    "HTTP request latency by method and route template.",
+    ("method", "route"),
+)
+HTTP_IN_FLIGHT = Gauge(
+    "vault_http_requests_in_flight",
+    "HTTP requests currently being served.",
+)
+
+DB_QUERY_LATENCY = Histogram(
+    "vault_db_query_duration_seconds",
+    "Latency of server.db functions (connection + query + commit).",
+    ("function",),
+)
+DB_QUERY_ROWS = Histogram(
+    "vault_db_query_rows",
+    "Rows returned by server.db functions.",
+    ("function",),
+    buckets=ROW_BUCKETS,
+)
+DB_QUERY_ERRORS = Counter(
+    "vault_db_query_errors_total",
+    "server.db functions that raised.",
+    ("function",),
+)
+DB_CONNECTIONS_OPEN = Gauge(
+    "vault_db_connections_open",
+    "PostgreSQL connections currently open by this worker.",
+)
+DB_CONNECTIONS = Counter(
+    "vault_db_connections_total",
+    "PostgreSQL connections opened by this worker.",
+)
+
+PAYLOAD_SIZE = Histogram(
+    "vault_payload_bytes",
+    "Size of stored E2EE payloads.",
+    ("kind",),
+    buckets=SIZE_BUCKETS,
+)
+
+
+# ============================================================
+# INSTRUMENTATION
+# ============================================================
+
+def _row_count(result) -> int:
+    if result is None or result is False:
+        return 0
+    if isinstance(result, list):
+        return len(result)
+    return 1
+
+
+def track_query(fn):
+    """
+    Decorador para las funciones de server.db: latencia y filas devueltas.
+    """
+    label = fn.__name__
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            DB_QUERY_ERRORS.inc(label)
+            raise
+        finally:
+            DB_QUERY_LATENCY.observe(time.perf_counter() - started, label)
+        DB_QUERY_ROWS.observe(_row_count(result), label)
+        return result
+
+    return wrapper
+
+
+class MetricsMiddleware:
+    """
+    Middleware ASGI puro (sin BaseHTTPMiddleware) para no añadir una tarea
+    ni copiar el body en el camino caliente.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        HTTP_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            HTTP_IN_FLIGHT.dec()
+            route = scope.get("route")
+            template = getattr(route, "path", None) or "unmatched"
+            method = scope["method"]
+            HTTP_LATENCY.observe(time.perf_counter() - started, method, template)
+            HTTP_REQUESTS.inc(method, template, str(status["code"]))
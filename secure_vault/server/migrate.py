@@ -0,0 +1,588 @@
+import argparse
+import hashlib
+import inspect
+import json
+import os
+import re
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Optional
+
+import psycopg2
+import psycopg2.errors
+
+from server import db
+
+
+# ============================================================
+# CONFIG
+# ============================================================
+
+ROOT = Path(__file__).resolve().parent.parent
+SCRIPTS_DIR = ROOT / "scripts"
+# Esquema con el que nació el manifiesto, congelado: schema.sql sigue
+# cambiando con cada migración y su checksum ya no coincidiría con el
+# registrado. No se edita nunca; los cambios van en migraciones nuevas.
+BASELINE_FILE = SCRIPTS_DIR / "migrate_0000_baseline.sql"
+
+# Las migraciones transaccionales esperan como mucho esto por un lock y
+# reintentan, en lugar de quedarse en cola bloqueando a las tablas calientes
+LOCK_TIMEOUT_MS = int(os.getenv("VAULT_MIGRATE_LOCK_TIMEOUT_MS", 5000))
+LOCK_RETRIES = int(os.getenv("VAULT_MIGRATE_LOCK_RETRIES", 5))
+BATCH_SIZE = int(os.getenv("VAULT_MIGRATE_BATCH_SIZE", 1000))
+BATCH_PAUSE_MS = float(os.getenv("VAULT_MIGRATE_BATCH_PAUSE_MS", 50))
+
+# Primera línea de un .sql que debe ir fuera de transacción (CONCURRENTLY)
+NO_TRANSACTION = "-- migrate: no-transaction"
+ADVISORY_LOCK_KEY = "secure_vault.migrate"
+
+_STATEMENT_END = re.compile(r";[ \t]*(?:--[^\n]*)?(?:\n|$)")
+_CONCURRENT_INDEX = re.compile(
+    r"CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)",
+    re.IGNORECASE,
+)
+
+
+# ============================================================
+# BACKFILLS (por lotes, con pausa y progreso)
+# ============================================================
+
+_BACKFILL_PRIMARY_USER_KEYS = """
+    WITH batch AS (
+        SELECT user_id, public_key, fingerprint
+        FROM users
+        WHERE user_id > %s
+        ORDER BY user_id
+        LIMIT %s
+    ),
+    inserted AS (
+        INSERT INTO user_keys (user_id, key_id, public_key, fingerprint, is_primary)
+        SELECT b.user_id, 'primary', b.public_key, b.fingerprint, TRUE
+        FROM batch b
+        WHERE NOT EXISTS (
+            SELECT 1
+            FROM user_keys k
+            WHERE k.user_id = b.user_id
+              AND k.key_id = 'primary'
+        )
+        ON CONFLICT DO NOTHING
+        RETURNING 1
+    )
+    SELECT
+        (SELECT user_id FROM batch ORDER BY user_id DESC LIMIT 1),
+        (SELECT count(*) FROM batch),
+        (SELECT count(*) FROM inserted);
+"""
+
+
+def backfill_primary_user_keys(conn, batch_size: int, pause: float, progress: Callable) -> None:
+    """
+    Equivalente por lotes de scripts/migrate_user_keys.sql: cada lote es una
+    transacción corta sobre un rango de user_id.
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT count(*) FROM users;")
+        total = cur.fetchone()[0]
+    conn.commit()
+
+    last = "00000000-0000-0000-0000-000000000000"
+    done = inserted = 0
+    while True:
+        with conn.cursor() as cur:
+            cur.execute(_BACKFILL_PRIMARY_USER_KEYS, (last, batch_size))
+            last_id, processed, added = cur.fetchone()
+        conn.commit()
+        if not processed:
+            return
+        last = last_id
+        done += processed
+        inserted += added
+        progress(done, total, inserted)
+        time.sleep(pause)
+
+
+# ============================================================
+# MANIFEST
+# ============================================================
+
+class Migration:
+    def __init__(
+        self,
+        version: str,
+        name: str,
+        path: Optional[Path] = None,
+        backfill: Optional[Callable] = None,
+        baseline: bool = False,
+    ):
+        self.version = version
+        self.name = name
+        self.path = path
+        self.backfill = backfill
+        # baseline: solo se ejecuta en una base vacía; si ya hay esquema se registra
+        self.baseline = baseline
+
+    def sql(self) -> str:
+        return self.path.read_text(encoding="utf-8") if self.path else ""
+
+    @property
+    def no_transaction(self) -> bool:
+        return self.sql().lstrip().startswith(NO_TRANSACTION)
+
+    def checksum(self) -> str:
+        source = self.sql() if self.path else inspect.getsource(self.backfill)
+        return hashlib.sha256(source.encode()).hexdigest()[:16]
+
+
+MIGRATIONS = [
+    Migration("0000", "baseline schema", BASELINE_FILE, baseline=True),
+    Migration("0001", "user_keys table", SCRIPTS_DIR / "migrate_user_keys_table.sql"),
+    Migration("0002", "backfill primary user_keys", backfill=backfill_primary_user_keys),
+    Migration("0003", "message_status table", SCRIPTS_DIR / "migrate_message_status_table.sql"),
+    Migration("0004", "attachments table", SCRIPTS_DIR / "migrate_attachments_table.sql"),
+    Migration("0005", "idempotency_keys table", SCRIPTS_DIR / "migrate_idempotency_keys_table.sql"),
+    Migration("0006", "drop redundant indexes", SCRIPTS_DIR / "migrate_drop_redundant_indexes.sql"),
+    Migration("0007", "message segments", SCRIPTS_DIR / "migrate_message_segments.sql"),
+    Migration("0008", "conversation placements", SCRIPTS_DIR / "migrate_conversation_placements.sql"),
+    Migration("0009", "BRIN index on messages.created_at", SCRIPTS_DIR / "migrate_messages_created_at_brin.sql"),
+    Migration("0010", "merkle trees", SCRIPTS_DIR / "migrate_merkle_trees.sql"),
+    Migration("0011", "idempotency key targets", SCRIPTS_DIR / "migrate_idempotency_key_targets.sql"),
+]
+
+
+# ============================================================
+# RUNNER
+# ============================================================
+
+def split_statements(sql: str) -> list:
+    """
+    Separa por `;` al final de línea. Solo para ficheros no-transaction
+    (sin cuerpos $$ ... $$).
+    """
+    statements = []
+    for chunk in _STATEMENT_END.split(sql):
+        lines = [l for l in chunk.splitlines() if l.strip() and not l.strip().startswith("--")]
+        if lines:
+            statements.append("\n".join(lines))
+    return statements
+
+
+def connect(config: Optional[dict] = None):
+    return psycopg2.connect(**(config or db.DB_CONFIG))
+
+
+def databases() -> list:
+    """
+    (nombre, config) de cada base a migrar: el directorio y, con
+    VAULT_SHARDS, cada shard. Todas llevan el esquema completo.
+    """
+    targets = [("directory", db.DB_CONFIG)]
+    for name, config in db.SHARDS.items():
+        if config != db.DB_CONFIG:
+            targets.append((name, config))
+    return targets
+
+
+def _ensure_version_table(conn) -> None:
+    with conn.cursor() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                checksum TEXT NOT NULL,
+                applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                duration_ms INTEGER NOT NULL
+            );
+        """)
+    conn.commit()
+
+
+def applied_versions(conn) -> dict:
+    with conn.cursor() as cur:
+        cur.execute("SELECT version, name, checksum, applied_at FROM schema_migrations;")
+        rows = cur.fetchall()
+    conn.commit()
+    return {r[0]: {"name": r[1], "checksum": r[2], "applied_at": r[3]} for r in rows}
+
+
+def _record(cur, migration: Migration, started: float) -> None:
+    cur.execute(
+        """
+        INSERT INTO schema_migrations (version, name, checksum, duration_ms)
+        VALUES (%s, %s, %s, %s)
+        ON CONFLICT (version) DO NOTHING;
+        """,
+        (migration.version, migration.name, migration.checksum(),
+         int((time.perf_counter() - started) * 1000)),
+    )
+
+
+def _schema_exists(conn) -> bool:
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass('public.users') IS NOT NULL;")
+        exists = cur.fetchone()[0]
+    conn.commit()
+    return exists
+
+
+def _run_transactional(conn, migration: Migration, sql: str, started: float) -> None:
+    for attempt in range(LOCK_RETRIES + 1):
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SET LOCAL lock_timeout = %s;", (f"{LOCK_TIMEOUT_MS}ms",))
+                if sql:
+                    cur.execute(sql)
+                _record(cur, migration, started)
+            conn.commit()
+            return
+        except psycopg2.errors.LockNotAvailable:
+            conn.rollback()
+            if attempt == LOCK_RETRIES:
+                raise
+            wait = min(2 ** attempt, 30)
+            print(f"    lock ocupado, reintento en {wait}s ({attempt + 1}/{LOCK_RETRIES})")
+            time.sleep(wait)
+
+
+def _drop_invalid_index(cur, name: str) -> None:
+    # Un CREATE INDEX CONCURRENTLY interrumpido deja el índice INVALID
+    cur.execute(
+        """
+        SELECT NOT i.indisvalid
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = %s;
+        """,
+        (name,),
+    )
+    row = cur.fetchone()
+    if row and row[0]:
+        print(f"    {name} quedó INVALID en un intento anterior: se recrea")
+        cur.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}";')
+
+
+def _run_no_transaction(conn, migration: Migration, sql: str, started: float) -> None:
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SET lock_timeout = %s;", (f"{LOCK_TIMEOUT_MS}ms",))
+            for statement in split_statements(sql):
+                match = _CONCURRENT_INDEX.search(statement)
+                if match:
+                    _drop_invalid_index(cur, match.group(1))
+                print(f"    {statement.splitlines()[0].strip()}")
+                cur.execute(statement)
+            cur.execute("RESET lock_timeout;")
+            _record(cur, migration, started)
+    finally:
+        conn.autocommit = False
+
+
+def apply(conn, migration: Migration, batch_size: int, pause: float) -> None:
+    started = time.perf_counter()
+    if migration.backfill:
+        def progress(done, total, inserted):
+            pct = f"{done * 100 / total:.0f}%" if total else "-"
+            print(f"    {done}/{total} ({pct}) insertadas={inserted}")
+
+        migration.backfill(conn, batch_size, pause, progress)
+        _run_transactional(conn, migration, "", started)
+    elif migration.baseline and _schema_exists(conn):
+        print("    esquema ya presente: se registra sin ejecutar")
+        _run_transactional(conn, migration, "", started)
+    elif migration.no_transaction:
+        _run_no_transaction(conn, migration, migration.sql(), started)
+    else:
+        _run_transactional(conn, migration, migration.sql(), started)
+
+
+def up(batch_size: int = BATCH_SIZE, pause_ms: float = BATCH_PAUSE_MS,
+       target: Optional[str] = None) -> int:
+    targets = databases()
+    count = 0
+    for name, config in targets:
+        if len(targets) > 1:
+            print(f"== {name}")
+        count += _up(connect(config), batch_size, pause_ms, target)
+    return count
+
+
+def _up(conn, batch_size: int, pause_ms: float, target: Optional[str]) -> int:
+    try:
+        _ensure_version_table(conn)
+        with conn.cursor() as cur:
+            # Un solo runner a la vez (lock de sesión)
+            cur.execute("SELECT pg_advisory_lock(hashtext(%s));", (ADVISORY_LOCK_KEY,))
+        conn.commit()
+
+        done = applied_versions(conn)
+        count = 0
+        for migration in MIGRATIONS:
+            if target and migration.version > target:
+                break
+            if migration.version in done:
+                continue
+            print(f"[*] {migration.version} {migration.name}")
+            started = time.perf_counter()
+            apply(conn, migration, batch_size, pause_ms / 1000)
+            print(f"[+] {migration.version} aplicada en {(time.perf_counter() - started) * 1000:.0f} ms")
+            count += 1
+        if not count:
+            print("[+] sin migraciones pendientes")
+        return count
+    finally:
+        conn.close()
+
+
+def status(config: Optional[dict] = None) -> list:
+    conn = connect(config)
+    try:
+        _ensure_version_table(conn)
+        done = applied_versions(conn)
+    finally:
+        conn.close()
+
+    report = []
+    for migration in MIGRATIONS:
+        row = done.get(migration.version)
+        state = "pending"
+        if row:
+            state = "applied" if row["checksum"] == migration.checksum() else "changed"
+        report.append({
+            "version": migration.version,
+            "name": migration.name,
+            "state": state,
+            "applied_at": row["applied_at"] if row else None,
+        })
+    return report
+
+
+# ============================================================
+# INDEX AUDIT
+# ============================================================
+
+# Consultas calientes de server.db: (función, tabla, columnas de igualdad,
+# columna de orden, columnas leídas). None = lee columnas anchas (BYTEA),
+# un índice que las cubra no compensa.
+HOT_QUERIES = [
+    ("get_messages", "messages", ("conversation_id",), "created_at", None),
+    ("get_messages_around", "messages", ("conversation_id",), "created_at", None),
+    ("get_message_page_tail", "messages", ("conversation_id",), "created_at",
+     ("message_id", "content_hash")),
+    ("get_last_message_hash", "messages", ("conversation_id",), "created_at", ("content_hash",)),
+    ("message_exists", "messages", ("conversation_id", "message_id"), None, ()),
+    ("get_message_conversation_id", "messages", ("message_id",), None, ("conversation_id",)),
+    ("is_participant", "conversation_participants", ("conversation_id", "user_id"), None, ()),
+    ("list_conversations_for_user", "conversation_participants", ("user_id",), None,
+     ("conversation_id",)),
+    ("get_message_status", "message_status", ("message_id",), None,
+     ("user_id", "delivered_at", "read_at")),
+    ("list_user_keys", "user_keys", ("user_id",), "created_at", None),
+    ("list_attachments", "attachments", ("message_id",), "created_at", None),
+    ("get_merkle_leaf_index", "merkle_leaves", ("message_id",), None, ("leaf_index",)),
+]
+
+
+def load_indexes(conn) -> list:
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT
+                t.relname AS table_name,
+                c.relname AS index_name,
+                am.amname AS method,
+                i.indisunique,
+                i.indisprimary,
+                i.indisvalid,
+                i.indpred IS NOT NULL AS partial,
+                i.indnkeyatts,
+                ARRAY(
+                    SELECT COALESCE(a.attname, '(expr)')
+                    FROM unnest(i.indkey) WITH ORDINALITY AS k(attnum, ord)
+                    LEFT JOIN pg_attribute a
+                        ON a.attrelid = i.indrelid AND a.attnum = k.attnum
+                    ORDER BY k.ord
+                ) AS columns,
+                pg_relation_size(i.indexrelid) AS bytes,
+                COALESCE(s.idx_scan, 0) AS scans
+            FROM pg_index i
+            JOIN pg_class c ON c.oid = i.indexrelid
+            JOIN pg_class t ON t.oid = i.indrelid
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            JOIN pg_am am ON am.oid = c.relam
+            LEFT JOIN pg_stat_user_indexes s ON s.indexrelid = i.indexrelid
+            WHERE n.nspname = 'public'
+            ORDER BY t.relname, c.relname;
+        """)
+        rows = cur.fetchall()
+    conn.commit()
+    return [
+        {
+            "table": r[0],
+            "name": r[1],
+            "method": r[2],
+            "unique": r[3],
+            "primary": r[4],
+            "valid": r[5],
+            "partial": r[6],
+            "keys": list(r[8][:r[7]]),
+            "include": list(r[8][r[7]:]),
+            "bytes": r[9],
+            "scans": r[10],
+        }
+        for r in rows
+    ]
+
+
+def find_redundant(indexes: list) -> list:
+    """
+    Índices btree no únicos cuyas columnas clave son prefijo de otro índice
+    de la misma tabla (el otro ya sirve las mismas búsquedas).
+    """
+    redundant = []
+    for a in indexes:
+        if a["method"] != "btree" or a["unique"] or a["partial"]:
+            continue
+        for b in indexes:
+            if b is a or b["table"] != a["table"] or b["method"] != "btree" or b["partial"]:
+                continue
+            n = len(a["keys"])
+            if b["keys"][:n] != a["keys"]:
+                continue
+            if len(b["keys"]) == n and not (b["unique"] or b["name"] < a["name"]):
+                continue
+            if not set(a["include"]) <= set(b["keys"] + b["include"]):
+                continue
+            redundant.append({
+                "table": a["table"],
+                "index": a["name"],
+                "covered_by": b["name"],
+                "bytes": a["bytes"],
+                "drop": f"DROP INDEX CONCURRENTLY IF EXISTS {a['name']};",
+            })
+            break
+    return redundant
+
+
+def _serves(index: dict, equality: tuple, order: Optional[str]) -> bool:
+    keys = index["keys"]
+    n = len(equality)
+    if set(keys[:n]) == set(equality):
+        return order is None or keys[n:n + 1] == [order]
+    # Búsqueda por clave única contenida en el filtro (p. ej. la PK)
+    return index["unique"] and not index["partial"] and set(keys) <= set(equality)
+
+
+def covering_candidates(indexes: list, hot_queries: list = HOT_QUERIES) -> list:
+    candidates = []
+    for function, table, equality, order, reads in hot_queries:
+        usable = [
+            i for i in indexes
+            if i["table"] == table and i["valid"] and not i["partial"] and _serves(i, equality, order)
+        ]
+        key_columns = list(equality) + ([order] if order else [])
+        if not usable:
+            candidates.append({
+                "query": function,
+                "issue": "sin índice para el filtro/orden",
+                "create": f"CREATE INDEX CONCURRENTLY ON {table} ({', '.join(key_columns)});",
+            })
+            continue
+        if reads is None:
+            continue
+        if any(set(reads) <= set(i["keys"] + i["include"]) for i in usable):
+            continue
+        best = min(usable, key=lambda i: len(i["keys"]))
+        missing = [c for c in reads if c not in best["keys"] + best["include"]]
+        candidates.append({
+            "query": function,
+            "issue": f"{best['name']} no cubre {', '.join(missing)} (sin index-only scan)",
+            "create": (
+                f"CREATE INDEX CONCURRENTLY ON {table} ({', '.join(best['keys'])}) "
+                f"INCLUDE ({', '.join(missing)});"
+            ),
+        })
+    return candidates
+
+
+def audit(indexes: Optional[list] = None) -> dict:
+    if indexes is None:
+        conn = connect()
+        try:
+            indexes = load_indexes(conn)
+        finally:
+            conn.close()
+    return {
+        "invalid": [i["name"] for i in indexes if not i["valid"]],
+        "unused": [
+            {"index": i["name"], "bytes": i["bytes"]}
+            for i in indexes
+            if i["scans"] == 0 and not (i["unique"] or i["primary"])
+        ],
+        "redundant": find_redundant(indexes),
+        "covering_candidates": covering_candidates(indexes),
+    }
+
+
+# ============================================================
+# CLI
+# ============================================================
+
+def _print_audit(report: dict) -> None:
+    print("Índices INVALID:", ", ".join(report["invalid"]) or "ninguno")
+
+    print("\nÍndices redundantes (prefijo de otro):")
+    for r in report["redundant"]:
+        print(f"  {r['table']}.{r['index']} ⊂ {r['covered_by']} ({r['bytes']} B)")
+        print(f"    {r['drop']}")
+    if not report["redundant"]:
+        print("  ninguno")
+
+    print("\nSin escaneos desde el último reset de estadísticas:")
+    for r in report["unused"]:
+        print(f"  {r['index']} ({r['bytes']} B)")
+    if not report["unused"]:
+        print("  ninguno")
+
+    print("\nCandidatos para consultas calientes de server/db.py:")
+    for c in report["covering_candidates"]:
+        print(f"  {c['query']}: {c['issue']}")
+        print(f"    {c['create']}")
+    if not report["covering_candidates"]:
+        print("  ninguno")
+
+
+def main(argv: Optional[list] = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m server.migrate")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p_up = sub.add_parser("up")
+    p_up.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    p_up.add_argument("--pause-ms", type=float, default=BATCH_PAUSE_MS)
+    p_up.add_argument("--target", help="aplicar hasta esta versión (incluida)")
+
+    sub.add_parser("status")
+
+    p_audit = sub.add_parser("audit")
+    p_audit.add_argument("--json", action="store_true")
+
+    args = parser.parse_args(argv)
+    if args.cmd == "up":
+        up(args.batch_size, args.pause_ms, args.target)
+    elif args.cmd == "status":
+        targets = databases()
+        for name, config in targets:
+            if len(targets) > 1:
+                print(f"== {name}")
+            for row in status(config):
+                print(f"{row['version']}  {row['state']:<8} {row['name']}  {row['applied_at'] or ''}")
+    elif args.cmd == "audit":
+        report = audit()
+        if args.json:
+            json.dump(report, sys.stdout, indent=2, default=str)
+            print()
+        else:
+            _print_audit(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+import cProfile
+import hmac
+import inspect
+import json
+import os
+import pstats
+import re
+import time
+import uuid
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from functools import wraps
+from pathlib import Path
+from typing import Callable, Optional
+
+from fastapi.routing import APIRoute
+
+
+# ============================================================
+# CONFIG
+# ============================================================
+
+PROFILE_HEADER = b"x-vault-profile"
+TOKEN_HEADER = b"x-admin-token"
+PROFILE_DIR = Path(os.getenv("VAULT_PROFILE_DIR", "logs/profiles"))
+PROFILE_MAX_FILES = int(os.getenv("VAULT_PROFILE_MAX_FILES", 50))
+
+# Perfil activo de la petición en curso (None = sin perfilar)
+_current: ContextVar[Optional["ProfileSession"]] = ContextVar("vault_profile", default=None)
+
+
+class ProfileSession:
+    def __init__(self, profile_id: str, method: str, path: str):
+        self.profile_id = profile_id
+        self.method = method
+        self.path = path
+        self.profiler = cProfile.Profile()
+        self.endpoint_seconds = 0.0
+
+
+# ============================================================
+# ROUTE WRAPPER
+# ============================================================
+
+def _wrap_endpoint(endpoint: Callable) -> Callable:
+    # Los endpoints síncronos corren en el threadpool de FastAPI: cProfile
+    # tiene que activarse en ese mismo hilo, por eso se envuelve la ruta y
+    # no solo el middleware. Sin sesión activa solo cuesta un ContextVar.get.
+    @wraps(endpoint)
+    def wrapper(*args, **kwargs):
+        session = _current.get()
+        if session is None:
+            return endpoint(*args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return session.profiler.runcall(endpoint, *args, **kwargs)
+        finally:
+            session.endpoint_seconds += time.perf_counter() - started
+
+    return wrapper
+
+
+class ProfiledRoute(APIRoute):
+    def __init__(self, path: str, endpoint: Callable, **kwargs):
+        if not inspect.iscoroutinefunction(endpoint):
+            endpoint = _wrap_endpoint(endpoint)
+        super().__init__(path, endpoint, **kwargs)
+
+
+# ============================================================
+# BREAKDOWN
+# ============================================================
+
+def _category(filename: str, funcname: str) -> str:
+    path = filename.replace("\\", "/")
+    if path.endswith("server/db.py") or "psycopg2" in path or "psycopg2" in funcname:
+        return "db"
+    if (
+        path.endswith("/base64.py")
+        or "/json/" in path
+        or "pydantic" in path
+        or path.endswith("fastapi/encoders.py")
+        or "binascii" in funcname
+    ):
+        return "serialization"
+    if any(p in path for p in ("/fastapi/", "/starlette/", "/anyio/")):
+        return "framework"
+    return "app"
+
+
+def breakdown(stats: pstats.Stats) -> dict:
+    """
+    Tiempo propio (tottime) agregado por categoría, en ms.
+    """
+    totals = {"db": 0.0, "serialization": 0.0, "framework": 0.0, "app": 0.0}
+    for (filename, _, funcname), (_, _, tottime, _, _) in stats.stats.items():
+        totals[_category(filename, funcname)] += tottime
+    return {k: round(v * 1000, 3) for k, v in totals.items()}
+
+
+# ============================================================
+# STORAGE
+# ============================================================
+
+def _safe(text: str) -> str:
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", text).strip("_")[:80]
+
+
+def _prune() -> None:
+    profiles = sorted(PROFILE_DIR.glob("*.prof"), key=lambda p: p.stat().st_mtime)
+    for old in profiles[:-PROFILE_MAX_FILES] if PROFILE_MAX_FILES > 0 else profiles:
+        old.unlink(missing_ok=True)
+        old.with_suffix(".json").unlink(missing_ok=True)
+
+
+def save(session: ProfileSession, status: int, wall_seconds: float) -> dict:
+    PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+    name = session.profile_id
+    stats = pstats.Stats(session.profiler)
+
+    # .prof = formato pstats (snakeviz, flameprof, gprof2dot)
+    stats.dump_stats(str(PROFILE_DIR / f"{name}.prof"))
+
+    by_category = breakdown(stats)
+    by_category["framework"] = round(
+        by_category["framework"]
+        + max(wall_seconds - session.endpoint_seconds, 0.0) * 1000,
+        3,
+    )
+    summary = {
+        "profile_id": name,
+        "at": datetime.now(timezone.utc).isoformat(),
+        "method": session.method,
+        "path": session.path,
+        "status": status,
+        "wall_ms": round(wall_seconds * 1000, 3),
+        "endpoint_ms": round(session.endpoint_seconds * 1000, 3),
+        "breakdown_ms": by_category,
+    }
+    (PROFILE_DIR / f"{name}.json").write_text(json.dumps(summary), encoding="utf-8")
+    _prune()
+    return summary
+
+
+def list_profiles() -> list:
+    if not PROFILE_DIR.exists():
+        return []
+    summaries = []
+    for path in sorted(PROFILE_DIR.glob("*.json"), key=lambda p: p.stat().st_mtime, reverse=True):
+        try:
+            summaries.append(json.loads(path.read_text(encoding="utf-8")))
+        except (OSError, ValueError):
+            continue
+    return summaries
+
+
+def profile_path(profile_id: str) -> Optional[Path]:
+    if _safe(profile_id) != profile_id:
+        return None
+    path = PROFILE_DIR / f"{profile_id}.prof"
+    return path if path.exists() else None
+
+
+# ============================================================
+# MIDDLEWARE
+# ============================================================
+
+class ProfilingMiddleware:
+    """
+    Perfila una petición si trae `X-Vault-Profile` y un `X-Admin-Token`
+    válido. Sin la cabecera la petición pasa tal cual.
+    """
+
+    def __init__(self, app, token: Callable[[], Optional[str]]):
+        self.app = app
+        self.token = token
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope["headers"])
+        if PROFILE_HEADER not in headers:
+            await self.app(scope, receive, send)
+            return
+
+        expected = self.token()
+        provided = headers.get(TOKEN_HEADER, b"").decode(errors="replace")
+        if not expected or not hmac.compare_digest(provided, expected):
+            await _reject(send)
+            return
+
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S")
+        profile_id = _safe(f"{stamp}-{uuid.uuid4().hex[:8]}-{scope['method']}-{scope['path']}")
+        session = ProfileSession(profile_id, scope["method"], scope["path"])
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"x-vault-profile-id", profile_id.encode())
+                ]
+            await send(message)
+
+        token = _current.set(session)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current.reset(token)
+            save(session, status["code"], time.perf_counter() - started)
+
+
+async def _reject(send) -> None:
+    body = b'{"detail":"Invalid admin token"}'
+    await send({
+        "type": "http.response.start",
+        "status": 403,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
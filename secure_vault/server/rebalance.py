@@ -0,0 +1,431 @@
+import argparse
+import os
+import time
+from datetime import timedelta
+from typing import Optional
+
+from psycopg2.extras import RealDictCursor, execute_values
+
+from server import db, metrics, migrate
+
+
+# ============================================================
+# CONFIG
+#
+# Alta de un shard:
+#   1. crear la base y `python -m server.migrate up` (con el nuevo VAULT_SHARDS)
+#   2. `python -m server.rebalance sync-users`
+#   3. `python -m server.rebalance pin`: fija en conversation_placements las
+#      conversaciones que el nuevo anillo movería, en su shard actual
+#   4. reiniciar la API con el nuevo VAULT_SHARDS y repetir `pin`
+#   5. `python -m server.rebalance run`: las mueve a su shard del anillo
+# ============================================================
+
+# Filas por lote de copia
+COPY_BATCH = int(os.getenv("VAULT_REBALANCE_BATCH", 5000))
+# Margen sobre PLACEMENT_TTL_S para que todos los workers vean el cambio
+PROPAGATION_MARGIN_S = float(os.getenv("VAULT_REBALANCE_MARGIN_S", 2))
+# El delta relee los mensajes desde la última copia menos este margen
+# (transacciones que empezaron antes y confirmaron después)
+DELTA_OVERLAP_S = float(os.getenv("VAULT_REBALANCE_DELTA_OVERLAP_S", 60))
+# Login con el que se borra en el origen: debe ser miembro de
+# vault_rebalancer, el único rol al que los triggers dejan borrar mensajes.
+# Vacío = las credenciales de DB_* (solo vale si ese usuario es miembro).
+PURGE_USER = os.getenv("VAULT_REBALANCE_DB_USER")
+PURGE_PASSWORD = os.getenv("VAULT_REBALANCE_DB_PASSWORD", "")
+REBALANCER_ROLE = "vault_rebalancer"
+
+MOVED = metrics.Counter(
+    "vault_rebalanced_conversations_total",
+    "Conversations moved between shards.",
+)
+
+
+class MoveAborted(Exception):
+    """
+    El traslado no puede completarse (el destino no tiene lo mismo que el
+    origen, o no se podría borrar en el origen): no se borra nada.
+    """
+
+
+# ============================================================
+# COPIA
+# ============================================================
+
+def _copy(src, dst, table: str, where: str, params: tuple, conflict: str = "DO NOTHING") -> int:
+    """
+    Copia por lotes las filas de `table` que cumplen `where` (sobre el alias
+    t). Idempotente: las ya copiadas no cambian salvo por `conflict`.
+    """
+    copied = 0
+    with src.cursor(name=f"rebalance_{table}") as read:
+        read.itersize = COPY_BATCH
+        read.execute(f"SELECT t.* FROM {table} t WHERE {where};", params)
+        while True:
+            rows = read.fetchmany(COPY_BATCH)
+            if not rows:
+                break
+            columns = ", ".join(c.name for c in read.description)
+            with dst.cursor() as write:
+                execute_values(
+                    write,
+                    f"INSERT INTO {table} ({columns}) VALUES %s ON CONFLICT {conflict};",
+                    rows,
+                    page_size=COPY_BATCH,
+                )
+            dst.commit()
+            copied += len(rows)
+    src.commit()
+    return copied
+
+
+_STATUS_MERGE = """
+    (message_id, user_id) DO UPDATE SET
+        delivered_at = LEAST(message_status.delivered_at, EXCLUDED.delivered_at),
+        read_at = LEAST(message_status.read_at, EXCLUDED.read_at)
+"""
+
+_HEAD_REPLACE = """
+    (conversation_id) DO UPDATE SET
+        tree_size = EXCLUDED.tree_size,
+        root_hash = EXCLUDED.root_hash,
+        sequenced_until = EXCLUDED.sequenced_until,
+        updated_at = EXCLUDED.updated_at
+"""
+
+_OF_CONVERSATION = "t.message_id IN (SELECT message_id FROM messages WHERE conversation_id = %s)"
+
+
+def copy_conversation(src, dst, conversation_id: str, since=None) -> dict:
+    """
+    Copia la conversación (o, con `since`, lo creado desde entonces). Orden
+    de las FK: conversación, participantes, segmentos, mensajes y lo que
+    cuelga de ellos. Participantes, segmentos, recibos y la cabecera del
+    árbol de Merkle se releen enteros (son pocos o pueden cambiar);
+    mensajes, adjuntos y nodos del árbol son append-only.
+    """
+    cid = (conversation_id,)
+    counts = {
+        "conversations": _copy(src, dst, "conversations", "t.conversation_id = %s", cid),
+        "participants": _copy(src, dst, "conversation_participants", "t.conversation_id = %s", cid),
+        "segments": _copy(src, dst, "message_segments", "t.conversation_id = %s", cid),
+    }
+    if since is None:
+        counts["messages"] = _copy(src, dst, "messages", "t.conversation_id = %s", cid)
+        counts["attachments"] = _copy(src, dst, "attachments", _OF_CONVERSATION, cid)
+        counts["merkle_leaves"] = _copy(src, dst, "merkle_leaves", "t.conversation_id = %s", cid)
+        counts["merkle_nodes"] = _copy(src, dst, "merkle_nodes", "t.conversation_id = %s", cid)
+    else:
+        recent = ("t.conversation_id = %s AND t.created_at >= %s", (conversation_id, since))
+        counts["messages"] = _copy(src, dst, "messages", *recent)
+        counts["attachments"] = _copy(
+            src, dst, "attachments", f"{_OF_CONVERSATION} AND t.created_at >= %s",
+            (conversation_id, since),
+        )
+        counts["merkle_leaves"] = _copy(src, dst, "merkle_leaves", *recent)
+        counts["merkle_nodes"] = _copy(src, dst, "merkle_nodes", *recent)
+    counts["status"] = _copy(src, dst, "message_status", _OF_CONVERSATION, cid, _STATUS_MERGE)
+    counts["merkle_heads"] = _copy(
+        src, dst, "merkle_heads", "t.conversation_id = %s", cid, _HEAD_REPLACE,
+    )
+    return counts
+
+
+def _high_watermark(conn, conversation_id: str):
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT max(created_at) FROM messages WHERE conversation_id = %s;",
+            (conversation_id,),
+        )
+        value = cur.fetchone()[0]
+    conn.commit()
+    return value
+
+
+def _fingerprint(conn, conversation_id: str) -> tuple:
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT
+                (SELECT count(*) FROM messages WHERE conversation_id = %(c)s),
+                (SELECT count(*) FROM conversation_participants WHERE conversation_id = %(c)s),
+                (SELECT count(*) FROM message_segments WHERE conversation_id = %(c)s),
+                (SELECT count(*) FROM attachments a
+                 JOIN messages m ON m.message_id = a.message_id
+                 WHERE m.conversation_id = %(c)s),
+                (SELECT content_hash FROM messages WHERE conversation_id = %(c)s
+                 ORDER BY created_at DESC, message_id DESC LIMIT 1),
+                (SELECT count(*) FROM merkle_leaves WHERE conversation_id = %(c)s),
+                (SELECT root_hash FROM merkle_heads WHERE conversation_id = %(c)s);
+            """,
+            {"c": conversation_id},
+        )
+        row = cur.fetchone()
+    conn.commit()
+    return tuple(bytes(v) if isinstance(v, memoryview) else v for v in row)
+
+
+def _purge_connection(shard: str):
+    config = db.SHARDS[shard]
+    if PURGE_USER:
+        config = {**config, "user": PURGE_USER, "password": PURGE_PASSWORD}
+    return migrate.connect(config)
+
+
+def _can_purge(conn) -> bool:
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_has_role(current_user, %s, 'MEMBER');", (REBALANCER_ROLE,))
+        allowed = cur.fetchone()[0]
+    conn.commit()
+    return allowed
+
+
+def _delete_conversation(conn, conversation_id: str) -> None:
+    # `conn` de _purge_connection: los triggers solo dejan borrar a vault_rebalancer
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM merkle_heads WHERE conversation_id = %s;", (conversation_id,))
+        cur.execute("DELETE FROM merkle_nodes WHERE conversation_id = %s;", (conversation_id,))
+        cur.execute("DELETE FROM merkle_leaves WHERE conversation_id = %s;", (conversation_id,))
+        cur.execute("DELETE FROM messages WHERE conversation_id = %s;", (conversation_id,))
+        cur.execute("DELETE FROM message_segments WHERE conversation_id = %s;", (conversation_id,))
+        cur.execute("DELETE FROM conversations WHERE conversation_id = %s;", (conversation_id,))
+    conn.commit()
+
+
+# ============================================================
+# DIRECTORIO
+# ============================================================
+
+def _set_placement(conversation_id: str, shard: Optional[str], state: str = "active") -> None:
+    """
+    shard=None borra la excepción (la conversación vuelve al anillo).
+    """
+    with db.get_connection() as conn:
+        with conn.cursor() as cur:
+            if shard is None:
+                cur.execute(
+                    "DELETE FROM conversation_placements WHERE conversation_id = %s;",
+                    (conversation_id,),
+                )
+                return
+            cur.execute(
+                """
+                INSERT INTO conversation_placements (conversation_id, shard, state)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (conversation_id)
+                DO UPDATE SET shard = EXCLUDED.shard, state = EXCLUDED.state,
+                              updated_at = CURRENT_TIMESTAMP;
+                """,
+                (conversation_id, shard, state),
+            )
+
+
+def _wait_propagation() -> None:
+    time.sleep(db.PLACEMENT_TTL_S + PROPAGATION_MARGIN_S)
+
+
+def _locate(conversation_id: str) -> Optional[str]:
+    # Shard donde está físicamente (puede no ser el del anillo)
+    def has(shard: str) -> bool:
+        with db.get_connection(shard) as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1 FROM conversations WHERE conversation_id = %s;", (conversation_id,))
+                return cur.fetchone() is not None
+
+    found = [s for s, ok in zip(db.SHARDS, db.scatter(has, "rebalance_locate")) if ok]
+    routed = db.shard_for(conversation_id)
+    return routed if routed in found else (found[0] if found else None)
+
+
+# ============================================================
+# OPERACIONES
+# ============================================================
+
+def move(conversation_id: str, target: str) -> dict:
+    """
+    Traslado en línea: copia masiva con la conversación abierta, pausa de
+    escrituras (placement 'moving', la API responde 503 + Retry-After)
+    mientras se copia el delta, cambio de ruta y borrado en el origen.
+    """
+    if target not in db.SHARDS:
+        raise ValueError(f"shard desconocido: {target}")
+    source = _locate(conversation_id)
+    if source is None:
+        raise LookupError(f"conversación {conversation_id} no encontrada")
+    if source == target:
+        return {"conversation_id": conversation_id, "source": source, "target": target, "moved": False}
+
+    home = db.RING.lookup(conversation_id.lower())
+    src = migrate.connect(db.SHARDS[source])
+    dst = migrate.connect(db.SHARDS[target])
+    purge = _purge_connection(source)
+    try:
+        # Antes de copiar nada: sin permiso de borrado quedarían dos copias
+        if not _can_purge(purge):
+            raise MoveAborted(
+                f"el usuario de borrado no es miembro de {REBALANCER_ROLE} en {source} "
+                "(VAULT_REBALANCE_DB_USER)"
+            )
+
+        # Fija la ruta actual antes de tocar nada (por si el anillo ya apunta al destino)
+        _set_placement(conversation_id, source)
+        _wait_propagation()
+
+        started = time.monotonic()
+        watermark = _high_watermark(src, conversation_id)
+        bulk = copy_conversation(src, dst, conversation_id)
+
+        _set_placement(conversation_id, source, "moving")
+        _wait_propagation()
+        paused = time.monotonic()
+        since = watermark - timedelta(seconds=DELTA_OVERLAP_S) if watermark else None
+        delta = copy_conversation(src, dst, conversation_id, since)
+
+        if _fingerprint(src, conversation_id) != _fingerprint(dst, conversation_id):
+            _set_placement(conversation_id, source)
+            raise MoveAborted(f"{conversation_id}: el destino {target} no coincide con {source}")
+
+        _set_placement(conversation_id, None if target == home else target)
+        paused = time.monotonic() - paused
+        # Lecturas en vuelo contra el origen terminan antes del borrado
+        _wait_propagation()
+        _delete_conversation(purge, conversation_id)
+    finally:
+        src.close()
+        dst.close()
+        purge.close()
+
+    MOVED.inc()
+    return {
+        "conversation_id": conversation_id,
+        "source": source,
+        "target": target,
+        "moved": True,
+        "messages": bulk["messages"],
+        "delta_messages": delta["messages"],
+        "write_pause_s": round(paused, 1),
+        "total_s": round(time.monotonic() - started, 1),
+    }
+
+
+def _conversations(shard: str) -> list:
+    with db.get_connection(shard) as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute("""
+                SELECT c.conversation_id::text AS conversation_id,
+                       (SELECT count(*) FROM messages m
+                        WHERE m.conversation_id = c.conversation_id) AS messages
+                FROM conversations c
+                ORDER BY c.conversation_id;
+            """)
+            return cur.fetchall()
+
+
+def pin() -> int:
+    """
+    Registra en su shard actual cada conversación que el anillo (con el
+    VAULT_SHARDS de este proceso) mandaría a otro. Idempotente.
+    """
+    placements = db._load_placements()
+    pinned = 0
+    for shard, rows in zip(db.SHARDS, db.scatter(_conversations, "rebalance_pin")):
+        for r in rows:
+            cid = r["conversation_id"]
+            if cid in placements or db.RING.lookup(cid) == shard:
+                continue
+            _set_placement(cid, shard)
+            pinned += 1
+    return pinned
+
+
+def plan() -> list:
+    """
+    Conversaciones fuera de su shard del anillo, de menor a mayor.
+    """
+    placements = db._load_placements()
+    moves = []
+    for shard, rows in zip(db.SHARDS, db.scatter(_conversations, "rebalance_plan")):
+        for r in rows:
+            cid = r["conversation_id"]
+            placed = placements.get(cid)
+            home = db.RING.lookup(cid)
+            if placed and placed[0] == shard and home != shard:
+                moves.append({"conversation_id": cid, "source": shard, "target": home,
+                              "messages": r["messages"]})
+    return sorted(moves, key=lambda m: m["messages"])
+
+
+def status() -> dict:
+    placements = db._load_placements()
+    report = {}
+    for shard, rows in zip(db.SHARDS, db.scatter(_conversations, "rebalance_status")):
+        report[shard] = {
+            "conversations": len(rows),
+            "messages": sum(r["messages"] for r in rows),
+            "placed": sum(1 for r in rows if r["conversation_id"] in placements),
+        }
+    return report
+
+
+def sync_users() -> dict:
+    """
+    Copia `users` del directorio a cada shard (shards nuevos o restaurados).
+    """
+    directory = migrate.connect()
+    copied = {}
+    try:
+        for name, config in db.SHARDS.items():
+            if config == db.DB_CONFIG:
+                continue
+            conn = migrate.connect(config)
+            try:
+                copied[name] = _copy(directory, conn, "users", "TRUE", ())
+            finally:
+                conn.close()
+    finally:
+        directory.close()
+    return copied
+
+
+# ============================================================
+# CLI
+# ============================================================
+
+def main(argv: Optional[list] = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m server.rebalance")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    sub.add_parser("status")
+    sub.add_parser("sync-users")
+    sub.add_parser("pin")
+    sub.add_parser("plan")
+
+    p_move = sub.add_parser("move")
+    p_move.add_argument("conversation_id")
+    p_move.add_argument("shard")
+
+    p_run = sub.add_parser("run")
+    p_run.add_argument("--limit", type=int, help="máximo de conversaciones a mover")
+
+    args = parser.parse_args(argv)
+    if args.cmd == "status":
+        for shard, s in status().items():
+            print(f"{shard:<12} {s['conversations']:>8} conversaciones  "
+                  f"{s['messages']:>10} mensajes  {s['placed']:>6} fijadas")
+    elif args.cmd == "sync-users":
+        for shard, count in sync_users().items():
+            print(f"{shard}: {count} usuarios copiados")
+    elif args.cmd == "pin":
+        print(f"{pin()} conversaciones fijadas en su shard actual")
+    elif args.cmd == "plan":
+        for m in plan():
+            print(f"{m['conversation_id']}  {m['source']} -> {m['target']}  {m['messages']} mensajes")
+    elif args.cmd == "move":
+        print(move(args.conversation_id, args.shard))
+    elif args.cmd == "run":
+        for m in plan()[:args.limit]:
+            print(move(m["conversation_id"], m["target"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+import math
+import os
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime, timezone
+from typing import Callable, Optional
+
+from server import db, metrics
+
+
+# ============================================================
+# CONFIG
+# ============================================================
+
+# 0 = desactivado: cada recibo hace su propio upsert + commit
+FLUSH_MS = float(os.getenv("VAULT_RECEIPTS_FLUSH_MS", 0))
+# Al llegar a este número de recibos pendientes se vacía sin esperar
+MAX_PENDING = int(os.getenv("VAULT_RECEIPTS_MAX_PENDING", 10_000))
+# Espera máxima de una petición con durable=true
+DURABLE_TIMEOUT_S = float(os.getenv("VAULT_RECEIPTS_DURABLE_TIMEOUT_S", 5))
+# Volcados fallidos seguidos tras los que un recibo se descarta
+MAX_RETRIES = int(os.getenv("VAULT_RECEIPTS_MAX_RETRIES", 5))
+
+ENABLED = FLUSH_MS > 0
+
+FLUSH_ROWS = metrics.Histogram(
+    "vault_receipts_flush_rows",
+    "Receipts written per buffered flush.",
+    buckets=metrics.ROW_BUCKETS,
+)
+FLUSH_LATENCY = metrics.Histogram(
+    "vault_receipts_flush_seconds",
+    "Duration of a buffered receipts flush.",
+)
+PENDING = metrics.Gauge(
+    "vault_receipts_pending",
+    "Receipts buffered in memory waiting for a flush.",
+)
+DROPPED = metrics.Counter(
+    "vault_receipts_dropped_total",
+    "Receipts discarded after a failed flush (buffer full or out of retries).",
+    labels=("reason",),
+)
+
+
+class ReceiptNotConfirmed(Exception):
+    """
+    durable=True: el lote del recibo no llegó a la DB a tiempo o falló. El
+    recibo sigue en la cola y puede escribirse más tarde.
+    """
+
+
+# ============================================================
+# RECEIPT BUFFER
+# ============================================================
+
+class ReceiptBuffer:
+    """
+    Buffer write-behind de recibos por (message_id, user_id). Read implica
+    delivered y solo cuenta el primer timestamp de cada uno. Se vacía cada
+    `flush_ms` con `apply(list)`; el Future devuelto por record() se resuelve
+    cuando el lote que contiene ese recibo está en la DB.
+    """
+
+    def __init__(
+        self,
+        apply: Callable[[list], int],
+        flush_ms: float = FLUSH_MS,
+        max_pending: int = MAX_PENDING,
+    ):
+        self.apply = apply
+        self.interval = flush_ms / 1000
+        self.max_pending = max(1, max_pending)
+        self._pending: dict = {}
+        # (message_id, user_id) -> volcados fallidos seguidos
+        self._failures: dict = {}
+        self._done: Future = Future()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="vault-receipts", daemon=True)
+        self._thread.start()
+
+    def record(self, message_id: str, user_id: str, read: bool = False,
+               now: Optional[datetime] = None) -> Future:
+        now = now or datetime.now(timezone.utc)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("ReceiptBuffer cerrado")
+            entry = self._pending.get((message_id, user_id))
+            if entry is None:
+                entry = [now, None]
+                self._pending[(message_id, user_id)] = entry
+            if read and entry[1] is None:
+                entry[1] = now
+            PENDING.set(value=len(self._pending))
+            if len(self._pending) >= self.max_pending:
+                self._cond.notify()
+            return self._done
+
+    def pending_for(self, message_id: str) -> dict:
+        """
+        user_id -> (delivered_at, read_at) aún no escritos por este worker.
+        """
+        with self._cond:
+            return {
+                user_id: tuple(entry)
+                for (mid, user_id), entry in self._pending.items()
+                if mid == message_id
+            }
+
+    def _take(self):
+        with self._cond:
+            if not self._closed and len(self._pending) < self.max_pending:
+                self._cond.wait(self.interval)
+            pending, done = self._pending, self._done
+            self._pending, self._done = {}, Future()
+            PENDING.set(value=0)
+            return pending, done, self._closed
+
+    def _run(self) -> None:
+        while True:
+            pending, done, closed = self._take()
+            self._flush(pending, done)
+            if closed:
+                return
+
+    def _flush(self, pending: dict, done: Future) -> None:
+        if not pending:
+            done.set_result(0)
+            return
+        started = time.perf_counter()
+        deferred = ()
+        try:
+            written = self.apply([(m, u, d, r) for (m, u), (d, r) in pending.items()])
+        except db.ReceiptsDeferred as exc:
+            written, deferred = exc.written, exc.receipts
+        except Exception as exc:
+            self._requeue(pending, failed=True)
+            done.set_exception(exc)
+            return
+        finally:
+            FLUSH_LATENCY.observe(time.perf_counter() - started)
+        if self._failures:
+            with self._cond:
+                for key in pending:
+                    self._failures.pop(key, None)
+        FLUSH_ROWS.observe(len(pending) - len(deferred))
+        if not deferred:
+            done.set_result(written)
+            return
+
+        # Conversaciones en traslado: solo sus recibos vuelven a la cola, y
+        # quien espera este lote espera también al siguiente
+        retry = self._requeue({(m, u): (d, r) for m, u, d, r in deferred})
+        retry.add_done_callback(lambda f: _settle(done, f, written))
+
+    def _requeue(self, pending: dict, failed: bool = False) -> Future:
+        """
+        Se reintenta en el siguiente ciclo conservando el primer timestamp.
+        Tras un volcado fallido (`failed`), un recibo que ya falló
+        MAX_RETRIES veces seguidas se descarta en vez de reintentarse
+        siempre. Devuelve el Future de ese ciclo.
+        """
+        with self._cond:
+            for key, (delivered_at, read_at) in pending.items():
+                if failed:
+                    self._failures[key] = self._failures.get(key, 0) + 1
+                    if self._failures[key] >= MAX_RETRIES:
+                        del self._failures[key]
+                        DROPPED.inc("retries")
+                        continue
+                entry = self._pending.get(key)
+                if entry is None:
+                    if len(self._pending) >= self.max_pending:
+                        self._failures.pop(key, None)
+                        DROPPED.inc("full")
+                        continue
+                    self._pending[key] = [delivered_at, read_at]
+                    continue
+                entry[0] = min(entry[0], delivered_at)
+                if read_at is not None:
+                    entry[1] = read_at if entry[1] is None else min(entry[1], read_at)
+            PENDING.set(value=len(self._pending))
+            return self._done
+
+    def close(self) -> None:
+        """
+        Vacía lo pendiente y detiene el hilo.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+
+def _settle(done: Future, retry: Future, written: int) -> None:
+    if retry.exception() is not None:
+        done.set_exception(retry.exception())
+    else:
+        done.set_result(written + retry.result())
+
+
+_buffer: Optional[ReceiptBuffer] = None
+_lock = threading.Lock()
+
+
+def _get() -> ReceiptBuffer:
+    global _buffer
+    with _lock:
+        if _buffer is None:
+            _buffer = ReceiptBuffer(db.apply_receipts)
+        return _buffer
+
+
+def mark(message_id: str, user_id: str, read: bool = False, durable: bool = False) -> None:
+    """
+    durable=True espera al commit del lote (o escribe directo si el buffer
+    está desactivado); si no, el recibo queda en memoria hasta el flush.
+    """
+    if not ENABLED:
+        if read:
+            db.mark_message_read(message_id, user_id)
+        else:
+            db.mark_message_delivered(message_id, user_id)
+        return
+    done = _get().record(message_id, user_id, read=read)
+    if durable:
+        try:
+            done.result(timeout=DURABLE_TIMEOUT_S)
+        except Exception as exc:
+            raise ReceiptNotConfirmed(f"{message_id}/{user_id}") from exc
+
+
+def retry_after() -> int:
+    """
+    Segundos hasta el próximo volcado (cabecera Retry-After).
+    """
+    return max(1, math.ceil(FLUSH_MS / 1000))
+
+
+def _naive(value: Optional[datetime]) -> Optional[datetime]:
+    # Como message_status (TIMESTAMP en una sesión UTC): UTC sin zona
+    if value is not None and value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def merge_pending(message_id: str, statuses: list) -> list:
+    """
+    Completa el estado leído de la DB con los recibos aún en memoria, con
+    sus timestamps en el mismo formato que las filas de la DB.
+    """
+    if _buffer is None:
+        return statuses
+    pending = {
+        user_id: (_naive(delivered_at), _naive(read_at))
+        for user_id, (delivered_at, read_at) in _buffer.pending_for(message_id).items()
+    }
+    if not pending:
+        return statuses
+
+    # Lo ya escrito es anterior a lo pendiente: el valor de la DB manda
+    merged = []
+    for s in statuses:
+        delivered_at, read_at = pending.pop(str(s["user_id"]), (None, None))
+        merged.append({
+            "user_id": s["user_id"],
+            "delivered_at": s["delivered_at"] or delivered_at,
+            "read_at": s["read_at"] or read_at,
+        })
+    for user_id, (delivered_at, read_at) in pending.items():
+        merged.append({"user_id": user_id, "delivered_at": delivered_at, "read_at": read_at})
+    return merged
+
+
+def shutdown() -> None:
+    global _buffer
+    with _lock:
+        buffer, _buffer = _buffer, None
+    if buffer is not None:
+        buffer.close()
@@ -0,0 +1,296 @@
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import uuid
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Optional
+
+
+# ============================================================
+# CONFIG
+# ============================================================
+
+ARCHIVE_DIR = Path(os.getenv("VAULT_ARCHIVE_DIR", "archive"))
+# Segmentos abiertos (mmap) a la vez por worker
+SEGMENT_CACHE_SIZE = int(os.getenv("VAULT_SEGMENT_CACHE", 64))
+
+# ============================================================
+# FORMATO
+#
+#   header | registros | índice (ordenado por created_at) | footer
+#
+#   header : magic, versión, conversation_id, nº registros, rango
+#            created_at (µs), offset del índice
+#   índice : created_at µs, message_id, offset, longitud, crc32 (40 B)
+#   footer : sha256(registros + índice + header) + magic de cierre
+#
+# Cada registro es un byte de flag (0 = raw, 1 = zlib) + el mensaje
+# serializado; se comprime solo si reduce tamaño (el ciphertext E2EE no
+# comprime, los metadatos sí).
+# ============================================================
+
+MAGIC = b"SVSEG\x00\x01\n"
+END_MAGIC = b"SVSEGEND"
+VERSION = 1
+
+_HEADER = struct.Struct("<8sH16sIqqQ")
+_INDEX = struct.Struct("<q16sQII")
+_FOOTER = struct.Struct("<32s8s")
+_RECORD = struct.Struct("<16sqHHHHI")
+
+_EPOCH = datetime(1970, 1, 1)
+_NONE_TS = -(2 ** 63)
+_NONE_LEN = 0xFFFF
+
+FLAG_RAW = 0
+FLAG_ZLIB = 1
+
+
+class SegmentError(Exception):
+    """
+    Segmento ausente, truncado o con checksum incorrecto.
+    """
+
+
+def _to_us(value: Optional[datetime]) -> int:
+    if value is None:
+        return _NONE_TS
+    return (value.replace(tzinfo=None) - _EPOCH) // timedelta(microseconds=1)
+
+
+def _from_us(value: int) -> Optional[datetime]:
+    if value == _NONE_TS:
+        return None
+    return _EPOCH + timedelta(microseconds=value)
+
+
+def _uuid_bytes(value) -> bytes:
+    return uuid.UUID(str(value)).bytes
+
+
+def segment_path(conversation_id, segment_id) -> Path:
+    return ARCHIVE_DIR / str(conversation_id) / f"{segment_id}.seg"
+
+
+# ============================================================
+# ESCRITURA
+# ============================================================
+
+def _encode_record(m: dict) -> bytes:
+    key_id = m["key_id"].encode() if m.get("key_id") is not None else b""
+    prev_hash = bytes(m["prev_hash"]) if m.get("prev_hash") is not None else b""
+    content_hash = bytes(m["content_hash"])
+    signature = bytes(m["signature"])
+    ciphertext = bytes(m["ciphertext"])
+    body = _RECORD.pack(
+        _uuid_bytes(m["sender_id"]),
+        _to_us(m.get("client_timestamp")),
+        len(key_id) if m.get("key_id") is not None else _NONE_LEN,
+        len(content_hash),
+        len(prev_hash) if m.get("prev_hash") is not None else _NONE_LEN,
+        len(signature),
+        len(ciphertext),
+    ) + key_id + content_hash + prev_hash + signature + ciphertext
+
+    compressed = zlib.compress(body, 6)
+    if len(compressed) < len(body):
+        return bytes([FLAG_ZLIB]) + compressed
+    return bytes([FLAG_RAW]) + body
+
+
+def write_segment(path: Path, conversation_id, messages: list) -> dict:
+    """
+    Escribe un segmento con `messages` (filas de messages ordenadas por
+    created_at). Escritura atómica: fichero temporal + fsync + rename.
+    Devuelve {"sha256", "bytes", "count"}.
+    """
+    if not messages:
+        raise ValueError("segmento vacío")
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    digest = hashlib.sha256()
+    index = []
+
+    with open(tmp, "wb") as fh:
+        def write(data: bytes) -> None:
+            fh.write(data)
+            digest.update(data)
+
+        # El offset del índice se conoce al final: header provisional
+        fh.write(b"\x00" * _HEADER.size)
+        offset = _HEADER.size
+        for m in messages:
+            record = _encode_record(m)
+            write(record)
+            index.append((_to_us(m["created_at"]), _uuid_bytes(m["message_id"]),
+                          offset, len(record), zlib.crc32(record)))
+            offset += len(record)
+
+        index_offset = offset
+        for entry in index:
+            write(_INDEX.pack(*entry))
+
+        header = _HEADER.pack(
+            MAGIC, VERSION, _uuid_bytes(conversation_id), len(index),
+            index[0][0], index[-1][0], index_offset,
+        )
+        fh.seek(0)
+        fh.write(header)
+        fh.seek(0, os.SEEK_END)
+
+        # sha256 de registros + índice + header (el header se conoce al final)
+        digest.update(header)
+        fh.write(_FOOTER.pack(digest.digest(), END_MAGIC))
+        fh.flush()
+        os.fsync(fh.fileno())
+
+    os.replace(tmp, path)
+    return {"sha256": digest.digest(), "bytes": path.stat().st_size, "count": len(index)}
+
+
+# ============================================================
+# LECTURA (mmap)
+# ============================================================
+
+class SegmentReader:
+    def __init__(self, path: Path):
+        self.path = path
+        try:
+            self._file = open(path, "rb")
+        except OSError as exc:
+            raise SegmentError(f"segmento no disponible: {path}") from exc
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError as exc:
+            self._file.close()
+            raise SegmentError(f"segmento vacío: {path}") from exc
+
+        if len(self._map) < _HEADER.size + _FOOTER.size:
+            self.close()
+            raise SegmentError(f"segmento truncado: {path}")
+        (magic, version, conversation, count,
+         self.first_us, self.last_us, index_offset) = _HEADER.unpack_from(self._map, 0)
+        _, end_magic = _FOOTER.unpack_from(self._map, len(self._map) - _FOOTER.size)
+        if magic != MAGIC or end_magic != END_MAGIC or version != VERSION:
+            self.close()
+            raise SegmentError(f"formato de segmento desconocido: {path}")
+
+        self.conversation_id = str(uuid.UUID(bytes=conversation))
+        self.count = count
+        self._index_offset = index_offset
+        self._positions: Optional[dict] = None
+
+    def _entry(self, i: int) -> tuple:
+        return _INDEX.unpack_from(self._map, self._index_offset + i * _INDEX.size)
+
+    def _position(self, message_id) -> Optional[int]:
+        if self._positions is None:
+            self._positions = {self._entry(i)[1]: i for i in range(self.count)}
+        return self._positions.get(_uuid_bytes(message_id))
+
+    def _read(self, i: int) -> dict:
+        created_us, message_id, offset, length, crc = self._entry(i)
+        record = self._map[offset:offset + length]
+        if zlib.crc32(record) != crc:
+            raise SegmentError(f"crc incorrecto en {self.path} (registro {i})")
+        body = zlib.decompress(record[1:]) if record[0] == FLAG_ZLIB else record[1:]
+
+        (sender, client_us, key_len, hash_len, prev_len,
+         sig_len, ct_len) = _RECORD.unpack_from(body, 0)
+        pos = _RECORD.size
+
+        def take(n: int) -> Optional[bytes]:
+            nonlocal pos
+            if n == _NONE_LEN:
+                return None
+            chunk = body[pos:pos + n]
+            pos += n
+            return chunk
+
+        key_id = take(key_len)
+        content_hash = take(hash_len)
+        prev_hash = take(prev_len)
+        signature = take(sig_len)
+        ciphertext = body[pos:pos + ct_len]
+        return {
+            "message_id": str(uuid.UUID(bytes=message_id)),
+            "conversation_id": self.conversation_id,
+            "sender_id": str(uuid.UUID(bytes=sender)),
+            "ciphertext": ciphertext,
+            "content_hash": content_hash,
+            "prev_hash": prev_hash,
+            "signature": signature,
+            "client_timestamp": _from_us(client_us),
+            "key_id": key_id.decode() if key_id is not None else None,
+            "created_at": _from_us(created_us),
+        }
+
+    def get(self, message_id) -> Optional[dict]:
+        i = self._position(message_id)
+        return self._read(i) if i is not None else None
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self._read(i)
+
+    def verify(self) -> bytes:
+        """
+        Recalcula el sha256 completo; devuelve el digest si coincide.
+        """
+        end = len(self._map) - _FOOTER.size
+        stored, _ = _FOOTER.unpack_from(self._map, end)
+        digest = hashlib.sha256(self._map[_HEADER.size:end])
+        digest.update(self._map[:_HEADER.size])
+        actual = digest.digest()
+        if actual != stored:
+            raise SegmentError(f"sha256 incorrecto en {self.path}")
+        for i in range(self.count):
+            self._read(i)
+        return actual
+
+    def close(self) -> None:
+        if getattr(self, "_map", None) is not None:
+            self._map.close()
+        self._file.close()
+
+
+_readers: OrderedDict = OrderedDict()
+_readers_lock = threading.Lock()
+
+
+def open_segment(conversation_id, segment_id) -> SegmentReader:
+    key = str(segment_id)
+    with _readers_lock:
+        reader = _readers.get(key)
+        if reader is not None:
+            _readers.move_to_end(key)
+            return reader
+        reader = SegmentReader(segment_path(conversation_id, segment_id))
+        _readers[key] = reader
+        # Los lectores desalojados se cierran con el GC (puede haber un
+        # hilo leyendo todavía del mmap)
+        while len(_readers) > SEGMENT_CACHE_SIZE:
+            _readers.popitem(last=False)
+        return reader
+
+
+def hydrate(rows: list) -> list:
+    """
+    Completa el ciphertext de las filas stub (segment_id no nulo) desde su
+    segmento; las filas deben traer conversation_id y message_id.
+    """
+    for row in rows:
+        segment_id = row.get("segment_id")
+        if not segment_id or row.get("ciphertext") is None:
+            continue
+        archived = open_segment(row["conversation_id"], segment_id).get(row["message_id"])
+        if archived is None:
+            raise SegmentError(f"mensaje {row['message_id']} no está en el segmento {segment_id}")
+        row["ciphertext"] = archived["ciphertext"]
+    return rows
@@ -0,0 +1,338 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from server import db, metrics
+
+
+# ============================================================
+# CONFIG
+#
+# Señales efímeras por conversación (escribiendo, presencia, viendo): un
+# bus pub/sub en memoria que nunca toca la DB salvo para autorizar
+# (is_participant, cacheado). Cada señal caduca a los pocos segundos, las
+# repetidas se funden y cada suscriptor tiene una cola acotada: al
+# llenarse se le desconecta (vuelve a suscribirse), no se acumula.
+#
+# El bus es de cada proceso: con varios workers, la suscripción y las
+# publicaciones de una conversación deben ir al mismo (enrutado por
+# conversation_id en el proxy); si no, solo se ven entre peticiones que
+# caen en el mismo worker.
+# ============================================================
+
+SIGNAL_TYPES = ("typing", "presence", "viewing")
+MAX_STATE_LENGTH = 32
+
+DEFAULT_TTL_S = float(os.getenv("VAULT_SIGNAL_TTL_S", 3))
+MAX_TTL_S = float(os.getenv("VAULT_SIGNAL_MAX_TTL_S", 30))
+# Señales pendientes (una por usuario y tipo) antes de soltar al suscriptor
+QUEUE_SIZE = int(os.getenv("VAULT_SIGNAL_QUEUE", 32))
+# Comentario SSE para que proxies y clientes no den la conexión por muerta
+HEARTBEAT_S = float(os.getenv("VAULT_SIGNAL_HEARTBEAT_S", 15))
+# Solo se cachean los positivos (no hay baja de participantes)
+AUTH_TTL_S = float(os.getenv("VAULT_SIGNAL_AUTH_TTL_S", 60))
+AUTH_CACHE_SIZE = int(os.getenv("VAULT_SIGNAL_AUTH_CACHE", 100_000))
+
+PUBLISHED = metrics.Counter(
+    "vault_signals_published_total",
+    "Ephemeral signals received, by outcome.",
+    ("outcome",),
+)
+DELIVERED = metrics.Counter(
+    "vault_signals_delivered_total",
+    "Ephemeral signals written to subscriber streams.",
+)
+EXPIRED = metrics.Counter(
+    "vault_signals_expired_total",
+    "Queued signals discarded because their TTL ran out before delivery.",
+)
+DROPPED = metrics.Counter(
+    "vault_signal_subscribers_dropped_total",
+    "Subscribers disconnected because their queue was full.",
+)
+SUBSCRIBERS = metrics.Gauge(
+    "vault_signal_subscribers",
+    "Open signal streams in this worker.",
+)
+
+
+# ============================================================
+# SEÑALES Y SUSCRIPTORES
+# ============================================================
+
+class Signal:
+    __slots__ = ("user_id", "type", "state", "expires_at")
+
+    def __init__(self, user_id: str, type: str, state: Optional[str], ttl_s: float, now: float):
+        self.user_id = user_id
+        self.type = type
+        self.state = state
+        self.expires_at = now + ttl_s
+
+    @property
+    def key(self) -> tuple:
+        return self.user_id, self.type
+
+    def event(self, now: float) -> str:
+        """
+        Evento SSE; el cliente retira el indicador pasado expires_in_ms.
+        """
+        data = {
+            "user_id": self.user_id,
+            "type": self.type,
+            "state": self.state,
+            "expires_in_ms": max(0, round((self.expires_at - now) * 1000)),
+        }
+        return f"event: {self.type}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+
+class Subscriber:
+    """
+    Una conexión abierta. Las señales pendientes van por (usuario, tipo):
+    una nueva del mismo par sustituye a la que aún no se ha enviado.
+    """
+
+    def __init__(self, conversation_id: str, user_id: str, loop, max_pending: int):
+        self.conversation_id = conversation_id
+        self.user_id = user_id
+        self.max_pending = max_pending
+        self.dropped = False
+        self._pending: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._loop = loop
+        self._wake = asyncio.Event()
+
+    def offer(self, signal: Signal) -> bool:
+        """
+        False si la cola está llena: el suscriptor queda soltado.
+        """
+        with self._lock:
+            if self.dropped:
+                return False
+            if signal.key not in self._pending and len(self._pending) >= self.max_pending:
+                self.dropped = True
+            else:
+                self._pending[signal.key] = signal
+        self._notify()
+        return not self.dropped
+
+    def close(self) -> None:
+        with self._lock:
+            self.dropped = True
+        self._notify()
+
+    def _notify(self) -> None:
+        try:
+            self._loop.call_soon_threadsafe(self._wake.set)
+        except RuntimeError:
+            pass  # loop cerrado: el stream ya terminó
+
+    async def next_batch(self, timeout: float) -> Optional[list]:
+        """
+        Señales vigentes pendientes ([] si pasa `timeout` sin ninguna),
+        None si el suscriptor fue soltado.
+        """
+        try:
+            await asyncio.wait_for(self._wake.wait(), timeout)
+        except asyncio.TimeoutError:
+            return []
+        self._wake.clear()
+        with self._lock:
+            if self.dropped:
+                return None
+            batch = list(self._pending.values())
+            self._pending.clear()
+        now = time.monotonic()
+        live = [s for s in batch if s.expires_at > now]
+        if len(live) < len(batch):
+            EXPIRED.inc(amount=len(batch) - len(live))
+        return live
+
+
+# ============================================================
+# BUS
+# ============================================================
+
+class SignalBus:
+    """
+    Suscriptores y última señal vigente de cada (usuario, tipo) por
+    conversación. La última señal sirve para fundir repeticiones y para
+    que quien se suscribe vea al momento quién está escribiendo.
+    """
+
+    def __init__(self, max_pending: int = QUEUE_SIZE):
+        self.max_pending = max_pending
+        self._subscribers: dict = {}
+        self._live: dict = {}
+        self._lock = threading.Lock()
+        self._swept = time.monotonic()
+
+    def subscribe(self, conversation_id: str, user_id: str, loop) -> Subscriber:
+        subscriber = Subscriber(conversation_id, user_id, loop, self.max_pending)
+        now = time.monotonic()
+        with self._lock:
+            self._subscribers.setdefault(conversation_id, set()).add(subscriber)
+            live = self._live.get(conversation_id, {})
+            current = [s for s in live.values() if s.expires_at > now and s.user_id != user_id]
+            SUBSCRIBERS.set(value=sum(len(s) for s in self._subscribers.values()))
+        for signal in current[:self.max_pending]:
+            subscriber.offer(signal)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        with self._lock:
+            subscribers = self._subscribers.get(subscriber.conversation_id)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self._subscribers[subscriber.conversation_id]
+            SUBSCRIBERS.set(value=sum(len(s) for s in self._subscribers.values()))
+
+    def publish(
+        self,
+        conversation_id: str,
+        user_id: str,
+        type: str,
+        state: Optional[str] = None,
+        ttl_s: float = DEFAULT_TTL_S,
+    ) -> Optional[int]:
+        """
+        Reparte la señal a los demás suscriptores de la conversación y
+        devuelve a cuántos. None si se funde con la anterior: mismo estado y
+        aún le queda al menos la mitad del TTL pedido (un cliente que repite
+        "typing" cada segundo genera un evento cada TTL/2, no uno por
+        petición).
+        """
+        now = time.monotonic()
+        signal = Signal(user_id, type, state, ttl_s, now)
+        with self._lock:
+            if now - self._swept > MAX_TTL_S:
+                self._sweep(now)
+            live = self._live.setdefault(conversation_id, {})
+            previous = live.get(signal.key)
+            if (
+                previous is not None
+                and previous.state == state
+                and previous.expires_at - now >= ttl_s / 2
+            ):
+                PUBLISHED.inc("coalesced")
+                return None
+            live[signal.key] = signal
+            targets = [
+                s for s in self._subscribers.get(conversation_id, ()) if s.user_id != user_id
+            ]
+
+        dropped = [s for s in targets if not s.offer(signal)]
+        for subscriber in dropped:
+            DROPPED.inc()
+            self.unsubscribe(subscriber)
+        PUBLISHED.inc("relayed")
+        return len(targets) - len(dropped)
+
+    def _sweep(self, now: float) -> None:
+        # Sin esto las conversaciones que ya no publican dejarían su última señal
+        for conversation_id in list(self._live):
+            live = self._live[conversation_id]
+            for key in [k for k, s in live.items() if s.expires_at <= now]:
+                del live[key]
+            if not live:
+                del self._live[conversation_id]
+        self._swept = now
+
+    def close(self) -> None:
+        with self._lock:
+            subscribers = [s for group in self._subscribers.values() for s in group]
+            self._subscribers.clear()
+            self._live.clear()
+            SUBSCRIBERS.set(value=0)
+        for subscriber in subscribers:
+            subscriber.close()
+
+
+async def stream(bus: SignalBus, subscriber: Subscriber, heartbeat_s: float = HEARTBEAT_S):
+    """
+    Cuerpo text/event-stream de una suscripción. Termina si el suscriptor
+    es soltado o el cliente se desconecta.
+    """
+    try:
+        # El navegador reintenta con EventSource tras este intervalo
+        yield "retry: 2000\n\n"
+        while True:
+            batch = await subscriber.next_batch(heartbeat_s)
+            if batch is None:
+                return
+            if not batch:
+                yield ": keep-alive\n\n"
+                continue
+            now = time.monotonic()
+            DELIVERED.inc(amount=len(batch))
+            yield "".join(s.event(now) for s in batch)
+    finally:
+        bus.unsubscribe(subscriber)
+
+
+# ============================================================
+# AUTORIZACIÓN (is_participant cacheado)
+# ============================================================
+
+_participants: OrderedDict = OrderedDict()
+_participants_lock = threading.Lock()
+
+
+def is_participant(conversation_id: str, user_id: str) -> bool:
+    key = (conversation_id.lower(), user_id.lower())
+    now = time.monotonic()
+    with _participants_lock:
+        expires = _participants.get(key)
+        if expires is not None and expires > now:
+            _participants.move_to_end(key)
+            return True
+    if not db.is_participant(conversation_id, user_id):
+        return False
+    with _participants_lock:
+        _participants[key] = now + AUTH_TTL_S
+        _participants.move_to_end(key)
+        while len(_participants) > AUTH_CACHE_SIZE:
+            _participants.popitem(last=False)
+    return True
+
+
+# ============================================================
+# INSTANCIA DEL PROCESO
+# ============================================================
+
+_bus: Optional[SignalBus] = None
+_lock = threading.Lock()
+
+
+def _get() -> SignalBus:
+    global _bus
+    with _lock:
+        if _bus is None:
+            _bus = SignalBus()
+        return _bus
+
+
+def subscribe(conversation_id: str, user_id: str) -> Subscriber:
+    # Desde el event loop que va a servir el stream
+    return _get().subscribe(conversation_id, user_id, asyncio.get_running_loop())
+
+
+def publish(conversation_id: str, user_id: str, type: str, state: Optional[str], ttl_s: float):
+    return _get().publish(conversation_id, user_id, type, state, ttl_s)
+
+
+def events(subscriber: Subscriber):
+    return stream(_get(), subscriber)
+
+
+def shutdown() -> None:
+    global _bus
+    with _lock:
+        bus, _bus = _bus, None
+    if bus is not None:
+        bus.close()
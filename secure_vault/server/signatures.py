@@ -0,0 +1,56 @@
+import base64
+import os
+from functools import lru_cache
+from typing import Optional
+
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PublicKey
+
+
+# ============================================================
+# CONFIG
+# ============================================================
+
+# Opt-in: el servidor sigue sin descifrar nada, solo comprueba la firma
+# Ed25519 de content_hash contra user_keys.public_key antes de insertar.
+VERIFY_SIGNATURES = os.getenv("VAULT_VERIFY_SIGNATURES", "0") == "1"
+
+PUBLIC_KEY_CACHE_SIZE = int(os.getenv("VAULT_PUBLIC_KEY_CACHE_SIZE", 4096))
+
+
+# ============================================================
+# PUBLIC KEYS
+# ============================================================
+
+@lru_cache(maxsize=PUBLIC_KEY_CACHE_SIZE)
+def parse_public_key(public_key: str) -> Optional[Ed25519PublicKey]:
+    """
+    user_keys.public_key es PEM o Base64 (32 bytes crudos).
+    Devuelve None si no es una clave Ed25519 válida.
+    """
+    try:
+        if public_key.lstrip().startswith("-----BEGIN"):
+            key = serialization.load_pem_public_key(public_key.encode())
+        else:
+            key = Ed25519PublicKey.from_public_bytes(
+                base64.b64decode(public_key, validate=True)
+            )
+    except Exception:
+        return None
+    return key if isinstance(key, Ed25519PublicKey) else None
+
+
+# ============================================================
+# VERIFICATION
+# ============================================================
+
+def verify(public_key: str, content_hash: bytes, signature: bytes) -> bool:
+    key = parse_public_key(public_key)
+    if key is None:
+        return False
+    try:
+        key.verify(signature, content_hash)
+        return True
+    except InvalidSignature:
+        return False
@@ -0,0 +1,280 @@
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from datetime import datetime, timezone
+from logging.handlers import RotatingFileHandler
+from typing import Optional
+
+import psycopg2
+import psycopg2.extensions
+
+
+# ============================================================
+# CONFIG
+# ============================================================
+
+# 0 = desactivado (no se instrumenta el cursor)
+SLOW_QUERY_MS = float(os.getenv("VAULT_SLOW_QUERY_MS", 0))
+EXPLAIN_SAMPLE_RATE = float(os.getenv("VAULT_SLOW_QUERY_EXPLAIN_RATE", 0.1))
+EXPLAIN_TIMEOUT_MS = int(os.getenv("VAULT_SLOW_QUERY_EXPLAIN_TIMEOUT_MS", 5000))
+LOG_FILE = os.getenv("VAULT_SLOW_QUERY_LOG", "logs/slow_queries.jsonl")
+LOG_MAX_BYTES = int(os.getenv("VAULT_SLOW_QUERY_LOG_MAX_BYTES", 10 * 1024 * 1024))
+LOG_BACKUPS = int(os.getenv("VAULT_SLOW_QUERY_LOG_BACKUPS", 5))
+MAX_FINGERPRINTS = 500
+
+ENABLED = SLOW_QUERY_MS > 0
+
+_stats: dict = {}
+_stats_lock = threading.Lock()
+_explain_busy = threading.Lock()
+_logger: Optional[logging.Logger] = None
+_logger_lock = threading.Lock()
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+# ============================================================
+# NORMALIZATION
+# ============================================================
+
+def normalize(sql) -> str:
+    if isinstance(sql, bytes):
+        sql = sql.decode(errors="replace")
+    return _WHITESPACE.sub(" ", str(sql)).strip().rstrip(";").strip()
+
+
+def fingerprint(normalized: str) -> str:
+    return hashlib.sha1(normalized.encode()).hexdigest()[:16]
+
+
+def _shape(value) -> str:
+    if value is None:
+        return "null"
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return f"bytes[{len(value)}]"
+    if isinstance(value, psycopg2.extensions.Binary):
+        return f"bytes[{len(value.adapted)}]"
+    if isinstance(value, (list, tuple)):
+        return f"{type(value).__name__}[{len(value)}]"
+    return type(value).__name__
+
+
+def param_shapes(params) -> list:
+    """
+    Solo tipos y tamaños: nunca se registran valores (ciphertext, ids).
+    """
+    if params is None:
+        return []
+    if isinstance(params, dict):
+        return [f"{k}:{_shape(v)}" for k, v in params.items()]
+    return [_shape(v) for v in params]
+
+
+# ============================================================
+# LOG + STATS
+# ============================================================
+
+def _get_logger() -> logging.Logger:
+    global _logger
+    with _logger_lock:
+        if _logger is None:
+            directory = os.path.dirname(LOG_FILE)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            handler = RotatingFileHandler(
+                LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS
+            )
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            logger = logging.getLogger("vault.slow_queries")
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+            logger.addHandler(handler)
+            _logger = logger
+    return _logger
+
+
+def _write(entry: dict) -> None:
+    _get_logger().info(json.dumps(entry, default=str))
+
+
+def _update_stats(fp: str, normalized: str, duration_ms: float) -> None:
+    with _stats_lock:
+        stat = _stats.get(fp)
+        if stat is None:
+            if len(_stats) >= MAX_FINGERPRINTS:
+                fastest = min(_stats, key=lambda k: _stats[k]["max_ms"])
+                del _stats[fastest]
+            stat = {
+                "fingerprint": fp,
+                "sql": normalized,
+                "count": 0,
+                "total_ms": 0.0,
+                "max_ms": 0.0,
+                "last_seen": None,
+                "last_plan": None,
+            }
+            _stats[fp] = stat
+        stat["count"] += 1
+        stat["total_ms"] += duration_ms
+        stat["max_ms"] = max(stat["max_ms"], duration_ms)
+        stat["last_seen"] = datetime.now(timezone.utc).isoformat()
+
+
+def observe(sql, params, seconds: float, dsn: Optional[str] = None) -> None:
+    """
+    dsn: el de la conexión que ejecutó la sentencia (con sharding, la de su
+    shard); sin él no se muestrea EXPLAIN.
+    """
+    duration_ms = seconds * 1000
+    if duration_ms < SLOW_QUERY_MS:
+        return
+
+    normalized = normalize(sql)
+    fp = fingerprint(normalized)
+    _update_stats(fp, normalized, duration_ms)
+    _write({
+        "type": "slow_query",
+        "at": datetime.now(timezone.utc).isoformat(),
+        "fingerprint": fp,
+        "duration_ms": round(duration_ms, 3),
+        "sql": normalized,
+        "params": param_shapes(params),
+    })
+
+    if (
+        dsn
+        and random.random() < EXPLAIN_SAMPLE_RATE
+        and normalized.upper().startswith("SELECT")
+    ):
+        threading.Thread(
+            target=_explain, args=(fp, sql, params, dsn), daemon=True
+        ).start()
+
+
+def top(limit: int = 20) -> list:
+    with _stats_lock:
+        stats = [dict(s) for s in _stats.values()]
+    stats.sort(key=lambda s: s["max_ms"], reverse=True)
+    for s in stats:
+        s["mean_ms"] = round(s["total_ms"] / s["count"], 3)
+        s["total_ms"] = round(s["total_ms"], 3)
+        s["max_ms"] = round(s["max_ms"], 3)
+    return stats[:limit]
+
+
+def reset() -> None:
+    with _stats_lock:
+        _stats.clear()
+
+
+# ============================================================
+# EXPLAIN (ANALYZE, BUFFERS) en conexión aparte
+# ============================================================
+
+def _plan_summary(plan: dict) -> dict:
+    """
+    Resumen comparable entre muestras para detectar cambios de plan.
+    """
+    nodes = []
+
+    def walk(node):
+        label = node.get("Node Type", "?")
+        if node.get("Index Name"):
+            label += f" using {node['Index Name']}"
+        nodes.append(label)
+        for child in node.get("Plans", []):
+            walk(child)
+
+    root = plan.get("Plan", {})
+    walk(root)
+    return {
+        "nodes": nodes,
+        "execution_ms": plan.get("Execution Time"),
+        "shared_hit_blocks": root.get("Shared Hit Blocks"),
+        "shared_read_blocks": root.get("Shared Read Blocks"),
+    }
+
+
+def _explain(fp: str, sql, params, dsn: str) -> None:
+    # Solo SELECT: ANALYZE ejecuta la sentencia. Un EXPLAIN a la vez.
+    if not _explain_busy.acquire(blocking=False):
+        return
+    try:
+        conn = psycopg2.connect(dsn)
+        try:
+            conn.autocommit = False
+            with conn.cursor() as cur:
+                cur.execute("SET LOCAL statement_timeout = %s", (EXPLAIN_TIMEOUT_MS,))
+                statement = sql.decode() if isinstance(sql, bytes) else sql
+                cur.execute(
+                    "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + statement,
+                    params,
+                )
+                plan = cur.fetchone()[0][0]
+            conn.rollback()
+        finally:
+            conn.close()
+    except Exception as exc:
+        _write({"type": "explain_error", "fingerprint": fp, "error": str(exc)})
+        return
+    finally:
+        _explain_busy.release()
+
+    summary = _plan_summary(plan)
+    with _stats_lock:
+        if fp in _stats:
+            _stats[fp]["last_plan"] = summary
+    _write({
+        "type": "explain",
+        "at": datetime.now(timezone.utc).isoformat(),
+        "fingerprint": fp,
+        "summary": summary,
+        "plan": plan,
+    })
+
+
+# ============================================================
+# CURSOR INSTRUMENTATION
+# ============================================================
+
+class _TimedCursorMixin:
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            observe(query, vars, time.perf_counter() - started, self.connection.explain_dsn)
+
+
+_timed_cursor_classes: dict = {}
+
+
+def _timed_cursor_class(base):
+    cls = _timed_cursor_classes.get(base)
+    if cls is None:
+        cls = type("Timed" + base.__name__, (_TimedCursorMixin, base), {})
+        _timed_cursor_classes[base] = cls
+    return cls
+
+
+class TimedConnection(psycopg2.extensions.connection):
+    """
+    connection_factory para psycopg2: cada cursor (incluido RealDictCursor)
+    mide sus execute() y pasa las lentas a observe(). Guarda el dsn con el
+    que se abrió (`dsn` enmascara la contraseña) para que EXPLAIN vaya a
+    la misma base.
+    """
+
+    def __init__(self, dsn, *args, **kwargs):
+        super().__init__(dsn, *args, **kwargs)
+        self.explain_dsn = dsn
+
+    def cursor(self, *args, **kwargs):
+        base = kwargs.get("cursor_factory") or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs["cursor_factory"] = _timed_cursor_class(base)
+        return super().cursor(*args, **kwargs)
@@ -0,0 +1,1414 @@
+import base64
+import os
+import sqlite3
+import threading
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Optional
+
+from server import db, metrics, segments
+
+
+# ============================================================
+# CONFIG
+#
+# Motor embebido (VAULT_STORAGE=sqlite) con las mismas funciones y la misma
+# semántica que server/db.py: mensajes append-only (triggers), una sola
+# clave primaria por usuario, claves de idempotencia y recibos con el
+# primer timestamp. Pensado para despliegues pequeños de un solo nodo y
+# para tests de pila completa; sin sharding ni herramientas de migración.
+# ============================================================
+
+SQLITE_PATH = os.getenv("VAULT_SQLITE_PATH", "vault.sqlite3")
+# NORMAL en WAL: un corte de luz puede perder las últimas transacciones,
+# nunca corromper la base. FULL para durabilidad por commit.
+SQLITE_SYNCHRONOUS = os.getenv("VAULT_SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("VAULT_SQLITE_BUSY_TIMEOUT_MS", 5000))
+
+SCHEMA_FILE = Path(__file__).resolve().parent.parent / " db" / "schema.sqlite.sql"
+SCHEMA_VERSION = 3
+# Las sentencias tras esta línea son de esa versión (las de antes, de la 1):
+# una base existente solo aplica las de versiones posteriores a la suya
+SCHEMA_VERSION_MARKER = "-- schema-version:"
+
+
+def _adapt_datetime(value: datetime) -> str:
+    # Mismo criterio que las columnas TIMESTAMP de PostgreSQL: UTC sin zona
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value.strftime("%Y-%m-%d %H:%M:%S.%f")
+
+
+sqlite3.register_adapter(datetime, _adapt_datetime)
+sqlite3.register_converter("TIMESTAMP", lambda raw: datetime.fromisoformat(raw.decode()))
+sqlite3.register_converter("BOOLEAN", lambda raw: raw not in (b"0", b""))
+
+_local = threading.local()
+_schema_lock = threading.Lock()
+_clock_lock = threading.Lock()
+_last_now = datetime.min
+
+
+def _now() -> datetime:
+    """
+    UTC estrictamente creciente dentro del proceso: created_at ordena los
+    mensajes como clock_timestamp() en PostgreSQL.
+    """
+    global _last_now
+    with _clock_lock:
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        if now <= _last_now:
+            now = _last_now + timedelta(microseconds=1)
+        _last_now = now
+        return now
+
+
+def _new_id() -> str:
+    return str(uuid.uuid4())
+
+
+def _id(value) -> str:
+    # UUID canónico: TEXT compara por bytes, PostgreSQL por valor
+    return str(uuid.UUID(str(value)))
+
+
+def _timestamp(value):
+    # Texto: como el cast a TIMESTAMP, se ignora la zona. datetime con
+    # zona: como TIMESTAMPTZ -> TIMESTAMP en una sesión UTC.
+    if isinstance(value, str):
+        return datetime.fromisoformat(value).replace(tzinfo=None)
+    if isinstance(value, datetime) and value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _dict_row(cursor, row) -> dict:
+    return {d[0]: value for d, value in zip(cursor.description, row)}
+
+
+def _open(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(
+        path,
+        timeout=SQLITE_BUSY_TIMEOUT_MS / 1000,
+        isolation_level=None,
+        detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
+        check_same_thread=False,
+    )
+    conn.row_factory = _dict_row
+    conn.execute("PRAGMA journal_mode = WAL;")
+    conn.execute("PRAGMA foreign_keys = ON;")
+    conn.execute(f"PRAGMA synchronous = {SQLITE_SYNCHRONOUS};")
+    if _schema_version(conn) < SCHEMA_VERSION:
+        with _schema_lock:
+            # Otro proceso puede estar creándolo: se comprueba con el lock de escritor
+            conn.execute("BEGIN IMMEDIATE;")
+            try:
+                current = _schema_version(conn)
+                if current < SCHEMA_VERSION:
+                    for version, statement in _statements(SCHEMA_FILE.read_text(encoding="utf-8")):
+                        if version > current:
+                            conn.execute(statement)
+                    conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION};")
+                conn.execute("COMMIT;")
+            except BaseException:
+                conn.execute("ROLLBACK;")
+                raise
+    return conn
+
+
+def _schema_version(conn) -> int:
+    return conn.execute("PRAGMA user_version;").fetchone()["user_version"]
+
+
+def _statements(script: str):
+    # executescript() confirma la transacción abierta antes de empezar
+    version, statement = 1, ""
+    for line in script.splitlines(keepends=True):
+        if line.startswith(SCHEMA_VERSION_MARKER):
+            version = int(line[len(SCHEMA_VERSION_MARKER):])
+            continue
+        statement += line
+        if sqlite3.complete_statement(statement):
+            yield version, statement
+            statement = ""
+
+
+def connect() -> sqlite3.Connection:
+    """
+    Una conexión por hilo y fichero (abrir una conexión SQLite es barato,
+    pero los PRAGMA y la caché de sentencias no).
+    """
+    conns = _local.__dict__.setdefault("conns", {})
+    conn = conns.get(SQLITE_PATH)
+    if conn is None:
+        conn = conns[SQLITE_PATH] = _open(SQLITE_PATH)
+        metrics.DB_CONNECTIONS.inc()
+    return conn
+
+
+@contextmanager
+def transaction():
+    """
+    Transacción de escritura. BEGIN IMMEDIATE toma el lock de escritor al
+    empezar: sin él, dos lectores que pasan a escribir se bloquean entre sí.
+    """
+    conn = connect()
+    conn.execute("BEGIN IMMEDIATE;")
+    try:
+        yield conn
+        conn.execute("COMMIT;")
+    except BaseException:
+        conn.execute("ROLLBACK;")
+        raise
+
+
+def _placeholders(values) -> str:
+    return ", ".join("?" * len(values))
+
+
+def _b64(value) -> Optional[str]:
+    return base64.b64encode(bytes(value)).decode() if value is not None else None
+
+
+def _iso(value: Optional[datetime]) -> Optional[str]:
+    # Mismo formato que los timestamps dentro de json_build_object
+    return value.isoformat() if value is not None else None
+
+
+def _earliest(a, b):
+    # LEAST de PostgreSQL ignora NULL
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a, b)
+
+
+# ============================================================
+# USERS
+# ============================================================
+
+@metrics.track_query
+def create_user(public_key: str, fingerprint: bytes) -> Optional[str]:
+    with transaction() as conn:
+        row = conn.execute(
+            "SELECT user_id FROM users WHERE fingerprint = ?;", (fingerprint,)
+        ).fetchone()
+        if row:
+            user_id = row["user_id"]
+        else:
+            user_id = _new_id()
+            conn.execute(
+                "INSERT INTO users (user_id, public_key, fingerprint, created_at) VALUES (?, ?, ?, ?);",
+                (user_id, public_key, fingerprint, _now()),
+            )
+        conn.execute(
+            """
+            INSERT INTO user_keys (user_id, key_id, public_key, fingerprint, is_primary, created_at)
+            VALUES (?, 'primary', ?, ?, 1, ?)
+            ON CONFLICT (user_id, key_id) DO NOTHING;
+            """,
+            (user_id, public_key, fingerprint, _now()),
+        )
+        return user_id
+
+
+@metrics.track_query
+def get_user_by_fingerprint(fingerprint: bytes):
+    return connect().execute(
+        "SELECT user_id, public_key, created_at FROM users WHERE fingerprint = ?;",
+        (fingerprint,),
+    ).fetchone()
+
+
+@metrics.track_query
+def get_user_by_id(user_id: str):
+    return connect().execute(
+        "SELECT user_id, public_key, created_at FROM users WHERE user_id = ?;",
+        (_id(user_id),),
+    ).fetchone()
+
+
+@metrics.track_query
+def add_user_key(
+    user_id: str,
+    key_id: str,
+    public_key: str,
+    fingerprint: bytes,
+    is_primary: bool = False,
+):
+    with transaction() as conn:
+        row = conn.execute(
+            """
+            INSERT INTO user_keys (user_id, key_id, public_key, fingerprint, is_primary, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (user_id, key_id) DO NOTHING
+            RETURNING key_id;
+            """,
+            (_id(user_id), key_id, public_key, fingerprint, bool(is_primary), _now()),
+        ).fetchone()
+        return row["key_id"] if row else None
+
+
+@metrics.track_query
+def list_user_keys(user_id: str):
+    return connect().execute(
+        """
+        SELECT key_id, public_key, fingerprint, is_primary, created_at, revoked_at
+        FROM user_keys
+        WHERE user_id = ?
+        ORDER BY created_at ASC;
+        """,
+        (_id(user_id),),
+    ).fetchall()
+
+
+@metrics.track_query
+def revoke_user_key(user_id: str, key_id: str) -> bool:
+    with transaction() as conn:
+        cur = conn.execute(
+            """
+            UPDATE user_keys
+            SET revoked_at = ?, is_primary = 0
+            WHERE user_id = ? AND key_id = ? AND revoked_at IS NULL;
+            """,
+            (_now(), _id(user_id), key_id),
+        )
+        return cur.rowcount > 0
+
+
+@metrics.track_query
+def set_primary_key(user_id: str, key_id: str) -> bool:
+    with transaction() as conn:
+        conn.execute("UPDATE user_keys SET is_primary = 0 WHERE user_id = ?;", (_id(user_id),))
+        cur = conn.execute(
+            """
+            UPDATE user_keys
+            SET is_primary = 1
+            WHERE user_id = ? AND key_id = ? AND revoked_at IS NULL;
+            """,
+            (_id(user_id), key_id),
+        )
+        return cur.rowcount > 0
+
+
+@metrics.track_query
+def lookup_keys(pairs: list, user_ids: list, since=None):
+    conditions, params = [], []
+    if pairs:
+        conditions.append(
+            f"(user_id, key_id) IN (VALUES {', '.join(['(?, ?)'] * len(pairs))})"
+        )
+        for user_id, key_id in pairs:
+            params += [_id(user_id), key_id]
+    if user_ids:
+        condition = f"user_id IN ({_placeholders(user_ids)})"
+        params += [_id(u) for u in user_ids]
+        if since is not None:
+            condition += " AND (created_at > ? OR revoked_at > ?)"
+            params += [since, since]
+        conditions.append(f"({condition})")
+    if not conditions:
+        return []
+
+    return connect().execute(
+        f"""
+        SELECT user_id, key_id, public_key, fingerprint, is_primary, created_at, revoked_at
+        FROM user_keys
+        WHERE {" OR ".join(conditions)}
+        ORDER BY user_id, created_at ASC;
+        """,
+        params,
+    ).fetchall()
+
+
+@metrics.track_query
+def get_active_key(user_id: str, key_id: str):
+    return connect().execute(
+        """
+        SELECT key_id, public_key, fingerprint, is_primary, revoked_at
+        FROM user_keys
+        WHERE user_id = ? AND key_id = ? AND revoked_at IS NULL;
+        """,
+        (_id(user_id), key_id),
+    ).fetchone()
+
+
+# ============================================================
+# CONVERSATIONS
+# ============================================================
+
+def _add_participants(conn, conversation_id: str, user_ids: list) -> dict:
+    requested = list(dict.fromkeys(_id(u) for u in user_ids))
+    known = {
+        r["user_id"]
+        for r in conn.execute(
+            f"SELECT user_id FROM users WHERE user_id IN ({_placeholders(requested)});",
+            requested,
+        )
+    } if requested else set()
+
+    result = {"added": [], "already_participants": [], "unknown": []}
+    joined_at = _now()
+    for user_id in requested:
+        if user_id not in known:
+            result["unknown"].append(user_id)
+            continue
+        cur = conn.execute(
+            """
+            INSERT INTO conversation_participants (conversation_id, user_id, joined_at)
+            VALUES (?, ?, ?)
+            ON CONFLICT DO NOTHING;
+            """,
+            (conversation_id, user_id, joined_at),
+        )
+        result["added" if cur.rowcount else "already_participants"].append(user_id)
+    return result
+
+
+@metrics.track_query
+def create_conversation(participant_ids: Optional[list] = None) -> str:
+    conversation_id = _new_id()
+    with transaction() as conn:
+        conn.execute(
+            "INSERT INTO conversations (conversation_id, created_at) VALUES (?, ?);",
+            (conversation_id, _now()),
+        )
+        if participant_ids:
+            result = _add_participants(conn, conversation_id, participant_ids)
+            if result["unknown"]:
+                raise db.UnknownUsers(result["unknown"])
+    return conversation_id
+
+
+@metrics.track_query
+def conversation_exists(conversation_id: str) -> bool:
+    return connect().execute(
+        "SELECT 1 FROM conversations WHERE conversation_id = ?;", (_id(conversation_id),)
+    ).fetchone() is not None
+
+
+@metrics.track_query
+def add_participant(conversation_id: str, user_id: str):
+    with transaction() as conn:
+        conn.execute(
+            """
+            INSERT INTO conversation_participants (conversation_id, user_id, joined_at)
+            VALUES (?, ?, ?)
+            ON CONFLICT DO NOTHING;
+            """,
+            (_id(conversation_id), _id(user_id), _now()),
+        )
+
+
+@metrics.track_query
+def add_participants(conversation_id: str, user_ids: list) -> Optional[dict]:
+    conversation_id = _id(conversation_id)
+    with transaction() as conn:
+        if conn.execute(
+            "SELECT 1 FROM conversations WHERE conversation_id = ?;", (conversation_id,)
+        ).fetchone() is None:
+            return None
+        return _add_participants(conn, conversation_id, user_ids)
+
+
+@metrics.track_query
+def list_conversations_for_user(user_id: str):
+    return connect().execute(
+        """
+        SELECT c.conversation_id, c.created_at
+        FROM conversations c
+        JOIN conversation_participants cp ON cp.conversation_id = c.conversation_id
+        WHERE cp.user_id = ?
+        ORDER BY c.created_at DESC;
+        """,
+        (_id(user_id),),
+    ).fetchall()
+
+
+@metrics.track_query
+def is_participant(conversation_id: str, user_id: str) -> bool:
+    return connect().execute(
+        "SELECT 1 FROM conversation_participants WHERE conversation_id = ? AND user_id = ?;",
+        (_id(conversation_id), _id(user_id)),
+    ).fetchone() is not None
+
+
+# ============================================================
+# IDEMPOTENCY KEYS
+# ============================================================
+
+@metrics.track_query
+def get_idempotent_result(owner_id: str, scope: str, idempotency_key: str):
+    return connect().execute(
+        """
+        SELECT resource_id, resource_created_at, request_hash, target_id
+        FROM idempotency_keys
+        WHERE owner_id = ? AND scope = ? AND idempotency_key = ? AND expires_at > ?;
+        """,
+        (_id(owner_id), scope, idempotency_key, _now()),
+    ).fetchone()
+
+
+def _claim_idempotency_key(conn, owner_id, scope, idempotency_key, request_hash, target_id):
+    now = _now()
+    claimed = conn.execute(
+        """
+        INSERT INTO idempotency_keys (
+            owner_id, scope, idempotency_key, request_hash, target_id, created_at, expires_at
+        )
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (owner_id, scope, idempotency_key) DO UPDATE
+            SET request_hash = excluded.request_hash,
+                target_id = excluded.target_id,
+                resource_id = NULL,
+                resource_created_at = NULL,
+                created_at = excluded.created_at,
+                expires_at = excluded.expires_at
+            WHERE idempotency_keys.expires_at <= excluded.created_at
+        RETURNING 1;
+        """,
+        (owner_id, scope, idempotency_key, request_hash, _id(target_id), now,
+         now + timedelta(hours=db.IDEMPOTENCY_TTL_HOURS)),
+    ).fetchone()
+    if claimed:
+        return None
+
+    row = conn.execute(
+        """
+        SELECT resource_id, resource_created_at, request_hash, target_id
+        FROM idempotency_keys
+        WHERE owner_id = ? AND scope = ? AND idempotency_key = ?;
+        """,
+        (owner_id, scope, idempotency_key),
+    ).fetchone()
+    # Sin target_id (clave anterior a la columna) tampoco coincide
+    if bytes(row["request_hash"]) != request_hash or row["target_id"] != _id(target_id):
+        raise db.IdempotencyKeyReused(idempotency_key)
+    return row["resource_id"], row["resource_created_at"]
+
+
+def _complete_idempotency_key(conn, owner_id, scope, idempotency_key, row):
+    conn.execute(
+        """
+        UPDATE idempotency_keys
+        SET resource_id = ?, resource_created_at = ?
+        WHERE owner_id = ? AND scope = ? AND idempotency_key = ?;
+        """,
+        (row[0], row[1], owner_id, scope, idempotency_key),
+    )
+
+
+@metrics.track_query
+def purge_expired_idempotency_keys() -> int:
+    with transaction() as conn:
+        return conn.execute(
+            "DELETE FROM idempotency_keys WHERE expires_at <= ?;", (_now(),)
+        ).rowcount
+
+
+# ============================================================
+# MESSAGES (Append-only / E2EE)
+# ============================================================
+
+_MESSAGE_COLUMNS = """
+    message_id, conversation_id, sender_id, ciphertext, content_hash, prev_hash,
+    signature, client_timestamp, key_id, created_at, segment_id
+"""
+
+
+def _insert_message(conn, conversation_id, sender_id, ciphertext, content_hash, signature,
+                    prev_hash=None, client_timestamp=None, key_id=None) -> tuple:
+    row = (_new_id(), _now())
+    conn.execute(
+        """
+        INSERT INTO messages (
+            message_id, conversation_id, sender_id, ciphertext, content_hash,
+            prev_hash, signature, client_timestamp, key_id, created_at
+        )
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
+        """,
+        (
+            row[0], _id(conversation_id), _id(sender_id), ciphertext, content_hash,
+            prev_hash or None, signature, _timestamp(client_timestamp), key_id, row[1],
+        ),
+    )
+    return row
+
+
+@metrics.track_query
+def insert_message(
+    conversation_id: str,
+    sender_id: str,
+    ciphertext: bytes,
+    content_hash: bytes,
+    signature: bytes,
+    prev_hash: Optional[bytes] = None,
+    client_timestamp: Optional[str] = None,
+    key_id: Optional[str] = None,
+    idempotency_key: Optional[str] = None,
+):
+    with transaction() as conn:
+        if idempotency_key:
+            existing = _claim_idempotency_key(
+                conn, _id(sender_id), "message", idempotency_key, content_hash,
+                conversation_id,
+            )
+            if existing:
+                return existing
+
+        row = _insert_message(conn, conversation_id, sender_id, ciphertext, content_hash,
+                              signature, prev_hash, client_timestamp, key_id)
+        if idempotency_key:
+            _complete_idempotency_key(conn, _id(sender_id), "message", idempotency_key, row)
+        return row
+
+
+@metrics.track_query
+def insert_messages_batch(rows: list) -> list:
+    """
+    Una transacción para todo el lote y un SAVEPOINT por fila: una fila
+    inválida no hace fallar al resto.
+    """
+    results = []
+    with transaction() as conn:
+        for r in rows:
+            conn.execute("SAVEPOINT coalesced_row;")
+            try:
+                results.append(_insert_message(conn, **r))
+                conn.execute("RELEASE SAVEPOINT coalesced_row;")
+            except (sqlite3.Error, ValueError) as exc:
+                conn.execute("ROLLBACK TO SAVEPOINT coalesced_row;")
+                conn.execute("RELEASE SAVEPOINT coalesced_row;")
+                results.append(exc)
+    return results
+
+
+def _after_clause(after_message_id: Optional[str]) -> tuple:
+    if not after_message_id:
+        return "", ()
+    return (
+        "AND created_at > (SELECT created_at FROM messages WHERE message_id = ?)",
+        (_id(after_message_id),),
+    )
+
+
+@metrics.track_query
+def get_messages(
+    conversation_id: str,
+    after_message_id: Optional[str] = None,
+    limit: int = 50,
+):
+    after, params = _after_clause(after_message_id)
+    rows = connect().execute(
+        f"""
+        SELECT {_MESSAGE_COLUMNS}
+        FROM messages
+        WHERE conversation_id = ? {after}
+        ORDER BY created_at ASC
+        LIMIT ?;
+        """,
+        (_id(conversation_id), *params, limit),
+    ).fetchall()
+    return segments.hydrate(rows)
+
+
+@metrics.track_query
+def get_message_page_tail(
+    conversation_id: str,
+    after_message_id: Optional[str] = None,
+    limit: int = 50,
+    settle_seconds: int = 30,
+):
+    after, params = _after_clause(after_message_id)
+    page = connect().execute(
+        f"""
+        SELECT message_id, content_hash, created_at
+        FROM messages
+        WHERE conversation_id = ? {after}
+        ORDER BY created_at ASC
+        LIMIT ?;
+        """,
+        (_id(conversation_id), *params, limit),
+    ).fetchall()
+    if not page:
+        return None
+    last = page[-1]
+    return {
+        "row_count": len(page),
+        "message_id": last["message_id"],
+        "content_hash": last["content_hash"],
+        "settled": last["created_at"] < _now() - timedelta(seconds=settle_seconds),
+    }
+
+
+@metrics.track_query
+def get_messages_around(
+    conversation_id: str,
+    around,
+    before: int = 25,
+    after: int = 50,
+):
+    conn, cid, at = connect(), _id(conversation_id), _timestamp(around)
+    older = conn.execute(
+        f"""
+        SELECT {_MESSAGE_COLUMNS}
+        FROM messages
+        WHERE conversation_id = ? AND created_at < ?
+        ORDER BY created_at DESC
+        LIMIT ?;
+        """,
+        (cid, at, before),
+    ).fetchall()
+    newer = conn.execute(
+        f"""
+        SELECT {_MESSAGE_COLUMNS}
+        FROM messages
+        WHERE conversation_id = ? AND created_at >= ?
+        ORDER BY created_at ASC
+        LIMIT ?;
+        """,
+        (cid, at, after),
+    ).fetchall()
+    return segments.hydrate(older[::-1] + newer)
+
+
+@metrics.track_query
+def get_messages_by_ids(message_ids: list, user_id: str):
+    requested = list(dict.fromkeys(_id(m) for m in message_ids))
+    if not requested:
+        return []
+    found = {
+        r["message_id"]: r
+        for r in connect().execute(
+            f"""
+            SELECT {_MESSAGE_COLUMNS},
+                   EXISTS (
+                       SELECT 1 FROM conversation_participants cp
+                       WHERE cp.conversation_id = messages.conversation_id
+                         AND cp.user_id = ?
+                   ) AS "allowed [BOOLEAN]"
+            FROM messages
+            WHERE message_id IN ({_placeholders(requested)});
+            """,
+            (_id(user_id), *requested),
+        )
+    }
+
+    rows = []
+    for message_id in requested:
+        row = found.get(message_id)
+        if row is None:
+            row = dict.fromkeys(_MESSAGE_COLUMNS.replace(",", " ").split())
+            row["allowed"] = False
+        elif not row["allowed"]:
+            row["ciphertext"] = None
+        rows.append({"requested_id": message_id, "found": message_id in found, **row})
+    rows.sort(key=lambda r: (r["created_at"] is None, r["created_at"] or datetime.min))
+    return segments.hydrate(rows)
+
+
+@metrics.track_query
+def message_exists(conversation_id: str, message_id: str) -> bool:
+    return connect().execute(
+        "SELECT 1 FROM messages WHERE conversation_id = ? AND message_id = ?;",
+        (_id(conversation_id), _id(message_id)),
+    ).fetchone() is not None
+
+
+@metrics.track_query
+def get_message_conversation_id(message_id: str) -> Optional[str]:
+    row = connect().execute(
+        "SELECT conversation_id FROM messages WHERE message_id = ?;", (_id(message_id),)
+    ).fetchone()
+    return row["conversation_id"] if row else None
+
+
+@metrics.track_query
+def get_last_message_hash(conversation_id: str) -> Optional[bytes]:
+    row = connect().execute(
+        """
+        SELECT content_hash
+        FROM messages
+        WHERE conversation_id = ?
+        ORDER BY created_at DESC
+        LIMIT 1;
+        """,
+        (_id(conversation_id),),
+    ).fetchone()
+    return row["content_hash"] if row else None
+
+
+# ============================================================
+# MESSAGE STATUS
+# ============================================================
+
+@metrics.track_query
+def mark_message_delivered(message_id: str, user_id: str) -> bool:
+    now = _now()
+    with transaction() as conn:
+        conn.execute(
+            """
+            INSERT INTO message_status (message_id, user_id, delivered_at)
+            VALUES (?, ?, ?)
+            ON CONFLICT (message_id, user_id)
+            DO UPDATE SET delivered_at = COALESCE(message_status.delivered_at, excluded.delivered_at);
+            """,
+            (_id(message_id), _id(user_id), now),
+        )
+    return True
+
+
+@metrics.track_query
+def mark_message_read(message_id: str, user_id: str) -> bool:
+    now = _now()
+    with transaction() as conn:
+        conn.execute(
+            """
+            INSERT INTO message_status (message_id, user_id, delivered_at, read_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (message_id, user_id)
+            DO UPDATE SET
+                delivered_at = COALESCE(message_status.delivered_at, excluded.delivered_at),
+                read_at = COALESCE(message_status.read_at, excluded.read_at);
+            """,
+            (_id(message_id), _id(user_id), now, now),
+        )
+    return True
+
+
+def _upsert_receipts(conn, receipts: dict) -> int:
+    """
+    receipts: (message_id, user_id) -> (delivered_at, read_at). Gana
+    siempre el primer timestamp; usuarios desconocidos se descartan.
+    """
+    stored = 0
+    for (message_id, user_id), (delivered_at, read_at) in receipts.items():
+        current = conn.execute(
+            "SELECT delivered_at, read_at FROM message_status WHERE message_id = ? AND user_id = ?;",
+            (message_id, user_id),
+        ).fetchone()
+        if current:
+            delivered_at = _earliest(current["delivered_at"], delivered_at)
+            read_at = _earliest(current["read_at"], read_at)
+        stored += conn.execute(
+            """
+            INSERT INTO message_status (message_id, user_id, delivered_at, read_at)
+            SELECT ?, ?, ?, ?
+            WHERE EXISTS (SELECT 1 FROM users WHERE user_id = ?)
+            ON CONFLICT (message_id, user_id)
+            DO UPDATE SET delivered_at = excluded.delivered_at, read_at = excluded.read_at;
+            """,
+            (message_id, user_id, delivered_at, read_at, user_id),
+        ).rowcount
+    return stored
+
+
+@metrics.track_query
+def apply_receipts(receipts: list) -> int:
+    if not receipts:
+        return 0
+
+    merged: dict = {}
+    for message_id, user_id, delivered_at, read_at in receipts:
+        key = (_id(message_id), _id(user_id))
+        previous = merged.get(key, (None, None))
+        merged[key] = (
+            _earliest(previous[0], _timestamp(delivered_at)),
+            _earliest(previous[1], _timestamp(read_at)),
+        )
+
+    with transaction() as conn:
+        # Recibos de mensajes que ya no existen se descartan (como el JOIN en db.py)
+        message_ids = list({m for m, _ in merged})
+        existing = {
+            r["message_id"]
+            for r in conn.execute(
+                f"SELECT message_id FROM messages WHERE message_id IN ({_placeholders(message_ids)});",
+                message_ids,
+            )
+        }
+        return _upsert_receipts(conn, {k: v for k, v in merged.items() if k[0] in existing})
+
+
+@metrics.track_query
+def get_message_status(message_id: str):
+    return connect().execute(
+        """
+        SELECT user_id, delivered_at, read_at
+        FROM message_status
+        WHERE message_id = ?
+        ORDER BY delivered_at ASC NULLS LAST;
+        """,
+        (_id(message_id),),
+    ).fetchall()
+
+
+@metrics.track_query
+def get_message_expansions(message_ids: list, include: set) -> dict:
+    requested = [_id(m) for m in message_ids]
+    wanted = [name for name in ("attachments", "status") if name in include]
+    if not requested or not wanted:
+        return {}
+
+    conn = connect()
+    expansions = {m: {name: [] for name in wanted} for m in requested}
+    marks = _placeholders(requested)
+    if "attachments" in wanted:
+        for a in conn.execute(
+            f"""
+            SELECT message_id, attachment_id, uploader_id, meta_ciphertext, meta_hash,
+                   meta_signature, created_at
+            FROM attachments
+            WHERE message_id IN ({marks})
+            ORDER BY created_at;
+            """,
+            requested,
+        ):
+            expansions[a["message_id"]]["attachments"].append({
+                "attachment_id": a["attachment_id"],
+                "uploader_id": a["uploader_id"],
+                "meta_ciphertext": _b64(a["meta_ciphertext"]),
+                "meta_hash": _b64(a["meta_hash"]),
+                "meta_signature": _b64(a["meta_signature"]),
+                "created_at": _iso(a["created_at"]),
+            })
+    if "status" in wanted:
+        for s in conn.execute(
+            f"""
+            SELECT message_id, user_id, delivered_at, read_at
+            FROM message_status
+            WHERE message_id IN ({marks})
+            ORDER BY delivered_at ASC NULLS LAST;
+            """,
+            requested,
+        ):
+            expansions[s["message_id"]]["status"].append({
+                "user_id": s["user_id"],
+                "delivered_at": _iso(s["delivered_at"]),
+                "read_at": _iso(s["read_at"]),
+            })
+    return expansions
+
+
+# ============================================================
+# ATTACHMENTS (E2EE)
+# ============================================================
+
+@metrics.track_query
+def insert_attachment(
+    message_id: str,
+    uploader_id: str,
+    ciphertext: bytes,
+    content_hash: bytes,
+    signature: bytes,
+    meta_ciphertext: Optional[bytes] = None,
+    meta_hash: Optional[bytes] = None,
+    meta_signature: Optional[bytes] = None,
+    idempotency_key: Optional[str] = None,
+):
+    uploader_id = _id(uploader_id)
+    with transaction() as conn:
+        if idempotency_key:
+            existing = _claim_idempotency_key(
+                conn, uploader_id, "attachment", idempotency_key, content_hash, message_id
+            )
+            if existing:
+                return existing
+
+        row = (_new_id(), _now())
+        conn.execute(
+            """
+            INSERT INTO attachments (
+                attachment_id, message_id, uploader_id, ciphertext, content_hash,
+                signature, meta_ciphertext, meta_hash, meta_signature, created_at
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
+            """,
+            (
+                row[0], _id(message_id), uploader_id, ciphertext, content_hash, signature,
+                meta_ciphertext or None, meta_hash or None, meta_signature or None, row[1],
+            ),
+        )
+        if idempotency_key:
+            _complete_idempotency_key(conn, uploader_id, "attachment", idempotency_key, row)
+        return row
+
+
+@metrics.track_query
+def list_attachments(message_id: str):
+    return connect().execute(
+        """
+        SELECT attachment_id, uploader_id, meta_ciphertext, meta_hash, meta_signature, created_at
+        FROM attachments
+        WHERE message_id = ?
+        ORDER BY created_at ASC;
+        """,
+        (_id(message_id),),
+    ).fetchall()
+
+
+@metrics.track_query
+def get_attachment_validator(attachment_id: str):
+    return connect().execute(
+        "SELECT message_id, content_hash FROM attachments WHERE attachment_id = ?;",
+        (_id(attachment_id),),
+    ).fetchone()
+
+
+@metrics.track_query
+def get_attachment(attachment_id: str):
+    return connect().execute(
+        """
+        SELECT attachment_id, message_id, uploader_id,
+               ciphertext, content_hash, signature,
+               meta_ciphertext, meta_hash, meta_signature,
+               created_at
+        FROM attachments
+        WHERE attachment_id = ?;
+        """,
+        (_id(attachment_id),),
+    ).fetchone()
+
+
+# ============================================================
+# ARCHIVE (segmentos de almacenamiento frío)
+# ============================================================
+
+@metrics.track_query
+def new_uuid() -> str:
+    return _new_id()
+
+
+@metrics.track_query
+def list_archivable_conversations(older_than) -> list:
+    return connect().execute(
+        """
+        SELECT conversation_id, count(*) AS messages
+        FROM messages
+        WHERE created_at < ? AND segment_id IS NULL
+        GROUP BY conversation_id
+        ORDER BY conversation_id;
+        """,
+        (older_than,),
+    ).fetchall()
+
+
+@metrics.track_query
+def get_archivable_messages(conversation_id: str, older_than, limit: int):
+    return connect().execute(
+        """
+        SELECT message_id, sender_id, ciphertext, content_hash, prev_hash,
+               signature, client_timestamp, key_id, created_at
+        FROM messages
+        WHERE conversation_id = ? AND created_at < ? AND segment_id IS NULL
+        ORDER BY created_at ASC
+        LIMIT ?;
+        """,
+        (_id(conversation_id), older_than, limit),
+    ).fetchall()
+
+
+@metrics.track_query
+def record_segment(segment_id: str, conversation_id: str, messages: list, info: dict,
+                   login: Optional[dict] = None) -> int:
+    # SQLite no tiene roles: `login` no se usa
+    message_ids = [_id(m["message_id"]) for m in messages]
+    with transaction() as conn:
+        conn.execute(
+            """
+            INSERT INTO message_segments (
+                segment_id, conversation_id, first_created_at, last_created_at,
+                message_count, bytes, sha256, created_at
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?);
+            """,
+            (
+                _id(segment_id), _id(conversation_id), messages[0]["created_at"],
+                messages[-1]["created_at"], len(messages), info["bytes"], info["sha256"], _now(),
+            ),
+        )
+        # Única vía de UPDATE que aceptan los triggers de messages
+        conn.execute("INSERT INTO vault_flags (flag) VALUES ('archiving');")
+        cur = conn.execute(
+            f"""
+            UPDATE messages
+            SET ciphertext = X'', segment_id = ?
+            WHERE message_id IN ({_placeholders(message_ids)}) AND segment_id IS NULL;
+            """,
+            (_id(segment_id), *message_ids),
+        )
+        conn.execute("DELETE FROM vault_flags WHERE flag = 'archiving';")
+        if cur.rowcount != len(message_ids):
+            raise RuntimeError(
+                f"segmento {segment_id}: {cur.rowcount}/{len(message_ids)} mensajes archivados"
+            )
+        return cur.rowcount
+
+
+@metrics.track_query
+def list_segments(conversation_id: Optional[str] = None):
+    return connect().execute(
+        """
+        SELECT segment_id, conversation_id, message_count, bytes, sha256
+        FROM message_segments
+        WHERE ? IS NULL OR conversation_id = ?
+        ORDER BY conversation_id, first_created_at;
+        """,
+        (conversation_id and _id(conversation_id),) * 2,
+    ).fetchall()
+
+
+# ============================================================
+# EXPORT / IMPORT
+# ============================================================
+
+@metrics.track_query
+def get_conversation_export_header(conversation_id: str) -> Optional[dict]:
+    conn = connect()
+    header = conn.execute(
+        "SELECT conversation_id, created_at FROM conversations WHERE conversation_id = ?;",
+        (_id(conversation_id),),
+    ).fetchone()
+    if header is None:
+        return None
+    header["participants"] = [
+        r["user_id"]
+        for r in conn.execute(
+            """
+            SELECT user_id FROM conversation_participants
+            WHERE conversation_id = ?
+            ORDER BY joined_at, user_id;
+            """,
+            (header["conversation_id"],),
+        )
+    ]
+    return header
+
+
+def stream_conversation_export(
+    conversation_id: str,
+    after_message_id: Optional[str] = None,
+    attachment_data: bool = False,
+):
+    """
+    Conexión propia (el generador avanza desde hilos distintos) y una
+    transacción de lectura: en WAL ve una instantánea fija todo el stream.
+    """
+    conversation_id = _id(conversation_id)
+    after = ""
+    params: tuple = (conversation_id,)
+    if after_message_id:
+        after = """
+            AND (created_at, message_id) > (
+                SELECT created_at, message_id FROM messages WHERE message_id = ?
+            )
+        """
+        params += (_id(after_message_id),)
+
+    conn = _open(SQLITE_PATH)
+    try:
+        conn.execute("BEGIN;")
+        messages = conn.execute(
+            f"""
+            SELECT {_MESSAGE_COLUMNS}
+            FROM messages
+            WHERE conversation_id = ? {after}
+            ORDER BY created_at ASC, message_id ASC;
+            """,
+            params,
+        )
+        for row in messages:
+            row["attachments"] = [
+                {
+                    "attachment_id": a["attachment_id"],
+                    "uploader_id": a["uploader_id"],
+                    "ciphertext": _b64(a["ciphertext"]) if attachment_data else None,
+                    "content_hash": _b64(a["content_hash"]),
+                    "signature": _b64(a["signature"]),
+                    "meta_ciphertext": _b64(a["meta_ciphertext"]),
+                    "meta_hash": _b64(a["meta_hash"]),
+                    "meta_signature": _b64(a["meta_signature"]),
+                    "created_at": _iso(a["created_at"]),
+                }
+                for a in conn.execute(
+                    """
+                    SELECT * FROM attachments
+                    WHERE message_id = ?
+                    ORDER BY created_at, attachment_id;
+                    """,
+                    (row["message_id"],),
+                )
+            ]
+            row["receipts"] = [
+                {
+                    "user_id": s["user_id"],
+                    "delivered_at": _iso(s["delivered_at"]),
+                    "read_at": _iso(s["read_at"]),
+                }
+                for s in conn.execute(
+                    """
+                    SELECT user_id, delivered_at, read_at FROM message_status
+                    WHERE message_id = ?
+                    ORDER BY user_id;
+                    """,
+                    (row["message_id"],),
+                )
+            ]
+            yield segments.hydrate([row])[0]
+        conn.execute("COMMIT;")
+    finally:
+        conn.close()
+
+
+@metrics.track_query
+def prepare_import(conversation_id: str, participants: list, created_at=None) -> bool:
+    conversation_id = _id(conversation_id)
+    with transaction() as conn:
+        created = conn.execute(
+            """
+            INSERT INTO conversations (conversation_id, created_at)
+            VALUES (?, ?)
+            ON CONFLICT DO NOTHING;
+            """,
+            (conversation_id, created_at or _now()),
+        ).rowcount == 1
+        result = _add_participants(conn, conversation_id, participants)
+        if result["unknown"]:
+            raise db.UnknownUsers(result["unknown"])
+        return created
+
+
+@metrics.track_query
+def get_recent_message_hashes(conversation_id: str, limit: int) -> list:
+    rows = connect().execute(
+        """
+        SELECT content_hash
+        FROM messages
+        WHERE conversation_id = ?
+        ORDER BY created_at DESC
+        LIMIT ?;
+        """,
+        (_id(conversation_id), limit),
+    ).fetchall()
+    return [bytes(r["content_hash"]) for r in reversed(rows)]
+
+
+@metrics.track_query
+def import_messages_batch(conversation_id: str, messages: list) -> dict:
+    """
+    Mismas reglas que en db.py: usuarios desconocidos, message_id con otro
+    contenido y mensajes nuevos no posteriores a la cola abortan el lote;
+    los ya presentes se saltan.
+    """
+    conversation_id = _id(conversation_id)
+    attachments = [
+        dict(a, message_id=m["message_id"])
+        for m in messages
+        for a in m["attachments"]
+        if a.get("ciphertext") is not None
+    ]
+    receipts: dict = defaultdict(lambda: (None, None))
+    for m in messages:
+        for r in m["receipts"]:
+            key = (_id(m["message_id"]), _id(r["user_id"]))
+            delivered_at, read_at = receipts[key]
+            receipts[key] = (
+                _earliest(delivered_at, _timestamp(r.get("delivered_at"))),
+                _earliest(read_at, _timestamp(r.get("read_at"))),
+            )
+
+    with transaction() as conn:
+        users = list({_id(m["sender_id"]) for m in messages} | {_id(a["uploader_id"]) for a in attachments})
+        known = {
+            r["user_id"]
+            for r in conn.execute(
+                f"SELECT user_id FROM users WHERE user_id IN ({_placeholders(users)});", users
+            )
+        } if users else set()
+        unknown = [u for u in users if u not in known]
+        if unknown:
+            raise db.UnknownUsers(unknown)
+
+        new = []
+        for m in messages:
+            existing = conn.execute(
+                "SELECT conversation_id, content_hash FROM messages WHERE message_id = ?;",
+                (_id(m["message_id"]),),
+            ).fetchone()
+            if existing and (existing["conversation_id"] != conversation_id
+                             or bytes(existing["content_hash"]) != bytes(m["content_hash"])):
+                raise db.ImportConflict(_id(m["message_id"]))
+            if existing is None:
+                new.append(m)
+
+        tail = conn.execute(
+            "SELECT created_at FROM messages WHERE conversation_id = ? ORDER BY created_at DESC LIMIT 1;",
+            (conversation_id,),
+        ).fetchone()
+        for m in new:
+            if tail and _timestamp(m["created_at"]) <= tail["created_at"]:
+                raise db.ImportBeforeTail(_id(m["message_id"]))
+
+        inserted = 0
+        for m in messages:
+            inserted += conn.execute(
+                """
+                INSERT INTO messages (
+                    message_id, conversation_id, sender_id, ciphertext, content_hash,
+                    prev_hash, signature, client_timestamp, key_id, created_at
+                )
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (message_id) DO NOTHING;
+                """,
+                (
+                    _id(m["message_id"]), conversation_id, _id(m["sender_id"]), m["ciphertext"],
+                    m["content_hash"], m["prev_hash"], m["signature"], m["client_timestamp"],
+                    m["key_id"], m["created_at"],
+                ),
+            ).rowcount
+
+        attachments_inserted = 0
+        for a in attachments:
+            attachments_inserted += conn.execute(
+                """
+                INSERT INTO attachments (
+                    attachment_id, message_id, uploader_id, ciphertext, content_hash,
+                    signature, meta_ciphertext, meta_hash, meta_signature, created_at
+                )
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (attachment_id) DO NOTHING;
+                """,
+                (
+                    _id(a["attachment_id"]), _id(a["message_id"]), _id(a["uploader_id"]),
+                    a["ciphertext"], a["content_hash"], a["signature"], a["meta_ciphertext"],
+                    a["meta_hash"], a["meta_signature"], a["created_at"],
+                ),
+            ).rowcount
+
+        if inserted:
+            # Filas con created_at antiguo: el árbol vuelve a buscar desde el principio
+            conn.execute(
+                "UPDATE merkle_heads SET sequenced_until = NULL WHERE conversation_id = ?;",
+                (conversation_id,),
+            )
+        return {
+            "messages": inserted,
+            "attachments": attachments_inserted,
+            "receipts": _upsert_receipts(conn, receipts),
+        }
+
+
+# ============================================================
+# MERKLE (registro de transparencia por conversación, server/merkle.py)
+# ============================================================
+
+@metrics.track_query
+def get_merkle_head(conversation_id: str) -> Optional[dict]:
+    return connect().execute(
+        "SELECT tree_size, root_hash, sequenced_until FROM merkle_heads WHERE conversation_id = ?;",
+        (_id(conversation_id),),
+    ).fetchone()
+
+
+@metrics.track_query
+def get_unsequenced_messages(conversation_id: str, limit: int) -> list:
+    return connect().execute(
+        """
+        SELECT m.message_id, m.content_hash, m.created_at
+        FROM messages m
+        WHERE m.conversation_id = ?
+          AND NOT EXISTS (SELECT 1 FROM merkle_leaves l WHERE l.message_id = m.message_id)
+        ORDER BY m.created_at ASC, m.message_id ASC
+        LIMIT ?;
+        """,
+        (_id(conversation_id), limit),
+    ).fetchall()
+
+
+@metrics.track_query
+def append_merkle_leaves(
+    conversation_id: str,
+    expected: Optional[dict],
+    head: dict,
+    leaves: list,
+    nodes: list,
+) -> bool:
+    cid = _id(conversation_id)
+    with transaction() as conn:
+        if expected is None:
+            cur = conn.execute(
+                """
+                INSERT INTO merkle_heads (
+                    conversation_id, tree_size, root_hash, sequenced_until, updated_at
+                )
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (conversation_id) DO NOTHING;
+                """,
+                (cid, head["tree_size"], head["root_hash"], head["sequenced_until"], _now()),
+            )
+        else:
+            cur = conn.execute(
+                """
+                UPDATE merkle_heads
+                SET tree_size = ?, root_hash = ?, sequenced_until = ?, updated_at = ?
+                WHERE conversation_id = ? AND tree_size = ? AND sequenced_until IS ?;
+                """,
+                (head["tree_size"], head["root_hash"], head["sequenced_until"], _now(),
+                 cid, expected["tree_size"], expected["sequenced_until"]),
+            )
+        if cur.rowcount != 1:
+            return False
+        conn.executemany(
+            "INSERT INTO merkle_leaves (conversation_id, leaf_index, message_id, hash) "
+            "VALUES (?, ?, ?, ?);",
+            [(cid, i, _id(m), h) for i, m, h in leaves],
+        )
+        conn.executemany(
+            "INSERT INTO merkle_nodes (conversation_id, level, node_index, hash) VALUES (?, ?, ?, ?);",
+            [(cid, l, i, h) for l, i, h in nodes],
+        )
+        return True
+
+
+@metrics.track_query
+def get_merkle_nodes(conversation_id: str, nodes: list) -> dict:
+    if not nodes:
+        return {}
+    cid = _id(conversation_id)
+    inner = [(l, i) for l, i in nodes if l > 0]
+    leaves = [i for l, i in nodes if l == 0]
+    rows = []
+    if inner:
+        rows += connect().execute(
+            f"""
+            WITH wanted(level, node_index) AS (VALUES {", ".join(["(?, ?)"] * len(inner))})
+            SELECT n.level, n.node_index, n.hash
+            FROM merkle_nodes n
+            JOIN wanted w ON n.level = w.level AND n.node_index = w.node_index
+            WHERE n.conversation_id = ?;
+            """,
+            (*(v for pair in inner for v in pair), cid),
+        ).fetchall()
+    if leaves:
+        rows += connect().execute(
+            f"""
+            SELECT 0 AS level, leaf_index AS node_index, hash
+            FROM merkle_leaves
+            WHERE conversation_id = ? AND leaf_index IN ({_placeholders(leaves)});
+            """,
+            (cid, *leaves),
+        ).fetchall()
+    return {(r["level"], r["node_index"]): bytes(r["hash"]) for r in rows}
+
+
+@metrics.track_query
+def get_merkle_leaf_index(conversation_id: str, message_id: str) -> Optional[int]:
+    row = connect().execute(
+        "SELECT leaf_index FROM merkle_leaves WHERE message_id = ? AND conversation_id = ?;",
+        (_id(message_id), _id(conversation_id)),
+    ).fetchone()
+    return row["leaf_index"] if row else None
@@ -0,0 +1,115 @@
+import inspect
+import os
+from typing import Callable
+
+
+# ============================================================
+# MOTORES DE ALMACENAMIENTO
+#
+#   VAULT_STORAGE=postgres (default) | sqlite
+#
+# El resto del servidor solo llama a `db.<función>`. server/db.py es el
+# motor PostgreSQL; otro motor es un módulo con las funciones de INTERFACE
+# (misma firma y semántica) que se instala sobre server.db al importarlo.
+# Las excepciones (UnknownUsers, IdempotencyKeyReused, ImportConflict...)
+# son siempre las de server.db.
+# ============================================================
+
+ENGINES = ("postgres", "sqlite")
+ENGINE = os.getenv("VAULT_STORAGE", "postgres").strip().lower()
+
+if ENGINE not in ENGINES:
+    raise ValueError(f"VAULT_STORAGE: se esperaba {' | '.join(ENGINES)}, no {ENGINE!r}")
+
+INTERFACE = (
+    # users / keys
+    "create_user",
+    "get_user_by_fingerprint",
+    "get_user_by_id",
+    "add_user_key",
+    "list_user_keys",
+    "revoke_user_key",
+    "set_primary_key",
+    "lookup_keys",
+    "get_active_key",
+    # conversations
+    "create_conversation",
+    "conversation_exists",
+    "add_participant",
+    "add_participants",
+    "list_conversations_for_user",
+    "is_participant",
+    # idempotency keys
+    "get_idempotent_result",
+    "purge_expired_idempotency_keys",
+    # messages
+    "insert_message",
+    "insert_messages_batch",
+    "get_messages",
+    "get_message_page_tail",
+    "get_messages_around",
+    "get_messages_by_ids",
+    "message_exists",
+    "get_message_conversation_id",
+    "get_last_message_hash",
+    # receipts
+    "mark_message_delivered",
+    "mark_message_read",
+    "apply_receipts",
+    "get_message_status",
+    "get_message_expansions",
+    # attachments
+    "insert_attachment",
+    "list_attachments",
+    "get_attachment_validator",
+    "get_attachment",
+    # archive
+    "new_uuid",
+    "list_archivable_conversations",
+    "get_archivable_messages",
+    "record_segment",
+    "list_segments",
+    # export / import
+    "get_conversation_export_header",
+    "stream_conversation_export",
+    "prepare_import",
+    "get_recent_message_hashes",
+    "import_messages_batch",
+    # merkle
+    "get_merkle_head",
+    "get_unsequenced_messages",
+    "append_merkle_leaves",
+    "get_merkle_nodes",
+    "get_merkle_leaf_index",
+)
+
+
+def mismatches(reference, engine) -> list:
+    """
+    Funciones de INTERFACE que faltan en `engine` o cuyos parámetros no
+    coinciden con los de `reference`.
+    """
+    problems = []
+    for name in INTERFACE:
+        if not hasattr(engine, name):
+            problems.append(f"{name}: no implementada")
+            continue
+        expected = inspect.signature(getattr(reference, name)).parameters
+        actual = inspect.signature(getattr(engine, name)).parameters
+        if [(p.name, p.default) for p in expected.values()] != [
+            (p.name, p.default) for p in actual.values()
+        ]:
+            problems.append(f"{name}: parámetros distintos")
+    return problems
+
+
+def install(target, engine, setter: Callable = setattr) -> None:
+    """
+    Sustituye las funciones de INTERFACE de `target` (server.db) por las de
+    `engine`. `setter` permite hacerlo con monkeypatch.setattr en los tests.
+    """
+    problems = mismatches(target, engine)
+    if problems:
+        raise TypeError(f"{engine.__name__} no cumple la interfaz: {'; '.join(problems)}")
+    for name in INTERFACE:
+        setter(target, name, getattr(engine, name))
@@ -0,0 +1,463 @@
+import base64
+import json
+import logging
+import os
+import select
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Optional
+
+import psycopg2
+import psycopg2.extensions
+
+from server import metrics, storage
+
+
+# ============================================================
+# CONFIG
+# ============================================================
+
+# 0 = desactivado. Presupuesto de memoria de la caché en cada worker
+MAX_BYTES = int(os.getenv("VAULT_TAIL_CACHE_BYTES", 0))
+# Últimos mensajes guardados por conversación
+TAIL_MESSAGES = int(os.getenv("VAULT_TAIL_CACHE_MESSAGES", 200))
+CHANNEL = "vault_messages"
+
+# Necesita LISTEN/NOTIFY entre workers: solo con el motor PostgreSQL
+ENABLED = MAX_BYTES > 0 and TAIL_MESSAGES > 0 and storage.ENGINE == "postgres"
+
+# Una NOTIFY admite menos de 8000 bytes: si la fila no cabe se invalida
+MAX_PAYLOAD = 7900
+# Coste aproximado de los objetos Python que acompañan a cada fila / cola
+ROW_OVERHEAD = 160
+TAIL_OVERHEAD = 240
+# Conversaciones con eventos recientes recordadas para descartar lecturas
+# que compitieron con una escritura (ver token())
+EVENT_HISTORY = 4096
+RECONNECT_S = 1.0
+
+# Bases a escuchar (el directorio o cada shard); server.db las fija al importarse
+listen_configs: list = []
+
+LOOKUPS = metrics.Counter(
+    "vault_tail_cache_lookups_total",
+    "Message list requests checked against the tail cache, by result (hit | miss).",
+    labels=("result",),
+)
+EVICTIONS = metrics.Counter(
+    "vault_tail_cache_evictions_total",
+    "Conversations evicted from the tail cache to stay within the memory budget.",
+)
+EVENTS = metrics.Counter(
+    "vault_tail_cache_events_total",
+    "Message notifications applied to the tail cache, by action (extend | invalidate).",
+    labels=("action",),
+)
+CACHED_BYTES = metrics.Gauge(
+    "vault_tail_cache_bytes",
+    "Estimated memory used by the tail cache.",
+)
+CACHED_CONVERSATIONS = metrics.Gauge(
+    "vault_tail_cache_conversations",
+    "Conversations whose tail is cached.",
+)
+
+logger = logging.getLogger("vault.tailcache")
+
+
+# ============================================================
+# FILAS PRECODIFICADAS
+#
+# Cada mensaje se guarda una vez ya serializado como lo devuelve
+# GET /conversations/{id}/messages; una página servida desde la caché es
+# concatenar bytes.
+# ============================================================
+
+def _b64(value) -> Optional[str]:
+    return base64.b64encode(bytes(value)).decode() if value is not None else None
+
+
+def _iso(value) -> Optional[str]:
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def encode(row: dict) -> bytes:
+    return json.dumps(
+        {
+            "message_id": str(row["message_id"]),
+            "sender_id": str(row["sender_id"]),
+            "ciphertext": _b64(row["ciphertext"]),
+            "content_hash": _b64(row["content_hash"]),
+            "prev_hash": _b64(row["prev_hash"]),
+            "signature": _b64(row["signature"]),
+            "client_timestamp": _iso(row["client_timestamp"]),
+            "key_id": row["key_id"],
+            "created_at": _iso(row["created_at"]),
+        },
+        ensure_ascii=False,
+        separators=(",", ":"),
+    ).encode()
+
+
+class _Entry:
+    __slots__ = ("message_id", "created_at", "content_hash", "body")
+
+    def __init__(self, message_id: str, created_at: datetime, content_hash: bytes, body: bytes):
+        self.message_id = message_id
+        self.created_at = created_at
+        self.content_hash = content_hash
+        self.body = body
+
+    @classmethod
+    def from_row(cls, row: dict) -> "_Entry":
+        return cls(str(row["message_id"]), row["created_at"], bytes(row["content_hash"]), encode(row))
+
+    @classmethod
+    def from_body(cls, body: bytes) -> "_Entry":
+        fields = json.loads(body)
+        return cls(
+            fields["message_id"],
+            datetime.fromisoformat(fields["created_at"]),
+            base64.b64decode(fields["content_hash"]),
+            body,
+        )
+
+    @property
+    def size(self) -> int:
+        return len(self.body) + ROW_OVERHEAD
+
+
+# ============================================================
+# TAIL CACHE
+# ============================================================
+
+# anchor: mensaje inmediatamente anterior a rows[0]; START si rows empieza
+# en el primer mensaje de la conversación, None si no se conoce
+START = ""
+
+
+class _Tail:
+    __slots__ = ("anchor", "rows", "size")
+
+    def __init__(self, anchor: Optional[str], rows: list):
+        self.anchor = anchor
+        self.rows = rows
+        self.size = TAIL_OVERHEAD + sum(e.size for e in rows)
+
+    def position(self, after: Optional[str]) -> Optional[int]:
+        """
+        Índice de la primera fila posterior a `after`, o None si la caché no
+        sabe dónde está ese mensaje. Los lectores suelen pedir el final.
+        """
+        if after is None:
+            return 0 if self.anchor == START else None
+        if after == self.anchor:
+            return 0
+        for i in range(len(self.rows) - 1, -1, -1):
+            if self.rows[i].message_id == after:
+                return i + 1
+        return None
+
+    def add(self, entry: _Entry, keep: int) -> bool:
+        """
+        Inserta en orden de created_at. False si la fila podría caer antes
+        del ancla (commit tardío o importación): la cola ya no es fiable.
+        """
+        if any(e.message_id == entry.message_id for e in self.rows):
+            return True
+        i = len(self.rows)
+        while i and self.rows[i - 1].created_at > entry.created_at:
+            i -= 1
+        if i == 0 and self.rows and self.anchor not in (None, START):
+            return False
+        self.rows.insert(i, entry)
+        self.size += entry.size
+        self.trim(keep)
+        return True
+
+    def trim(self, keep: int) -> None:
+        while len(self.rows) > keep:
+            dropped = self.rows.pop(0)
+            self.anchor = dropped.message_id
+            self.size -= dropped.size
+
+
+class TailCache:
+    """
+    Últimos `tail_messages` mensajes por conversación, con LRU por
+    conversación y un presupuesto de `max_bytes`. Se rellena en la primera
+    lectura que llega al final de la conversación y crece con cada insert
+    (local o notificado por otro worker). Solo responde si el rango pedido
+    cae entero dentro de la cola.
+    """
+
+    def __init__(self, max_bytes: int = MAX_BYTES, tail_messages: int = TAIL_MESSAGES):
+        self.max_bytes = max_bytes
+        self.tail_messages = tail_messages
+        self._tails: OrderedDict = OrderedDict()
+        self._bytes = 0
+        # Reloj de eventos: último evento por conversación reciente y, para
+        # las olvidadas, el mayor reloj descartado
+        self._clock = 0
+        self._events: OrderedDict = OrderedDict()
+        self._floor = 0
+        self._lock = threading.Lock()
+
+    def page(self, conversation_id: str, after: Optional[str], limit: int) -> Optional[tuple]:
+        """
+        (cuerpo JSON, validador de página como get_message_page_tail) o None
+        si el rango no está entero en la caché.
+        """
+        with self._lock:
+            tail = self._tails.get(conversation_id)
+            start = tail.position(after) if tail is not None else None
+            if start is None:
+                LOOKUPS.inc("miss")
+                return None
+            self._tails.move_to_end(conversation_id)
+            rows = tail.rows[start:start + limit]
+        LOOKUPS.inc("hit")
+
+        body = b"[" + b",".join(e.body for e in rows) + b"]"
+        if not rows:
+            return body, None
+        # Sin reloj de la DB no se sabe si la página se asentó: se revalida
+        return body, {
+            "row_count": len(rows),
+            "message_id": rows[-1].message_id,
+            "content_hash": rows[-1].content_hash,
+            "settled": False,
+        }
+
+    def token(self) -> int:
+        """
+        Se toma antes de leer de la DB y se pasa a fill(): si hubo algún
+        evento de la conversación en medio, la lectura no se cachea.
+        """
+        with self._lock:
+            return self._clock
+
+    def fill(self, conversation_id: str, after: Optional[str], rows: list, token: int) -> None:
+        """
+        `rows`: página de get_messages que llega al final de la conversación
+        (menos filas que el límite pedido).
+        """
+        entries = [_Entry.from_row(r) for r in rows]
+        with self._lock:
+            if self._events.get(conversation_id, self._floor) > token:
+                return
+            current = self._tails.get(conversation_id)
+            if current is not None and len(current.rows) > len(entries):
+                return
+            tail = _Tail(START if after is None else after, entries)
+            tail.trim(self.tail_messages)
+            self._store(conversation_id, tail, current.size if current is not None else 0)
+
+    def apply(self, events: list) -> None:
+        """
+        events: (conversation_id, _Entry | None); None invalida la cola.
+        """
+        with self._lock:
+            for conversation_id, entry in events:
+                self._clock += 1
+                self._events[conversation_id] = self._clock
+                self._events.move_to_end(conversation_id)
+                while len(self._events) > EVENT_HISTORY:
+                    _, forgotten = self._events.popitem(last=False)
+                    self._floor = max(self._floor, forgotten)
+
+                tail = self._tails.get(conversation_id)
+                before = tail.size if tail is not None else 0
+                if entry is None or (tail is not None and not tail.add(entry, self.tail_messages)):
+                    EVENTS.inc("invalidate")
+                    self._drop(conversation_id)
+                    continue
+                EVENTS.inc("extend")
+                if tail is None:
+                    # Conversación fría: la cola empieza en este mensaje
+                    tail = _Tail(None, [entry])
+                self._store(conversation_id, tail, before)
+
+    def clear(self) -> None:
+        """
+        Tras perder la conexión LISTEN pudo haber eventos sin ver.
+        """
+        with self._lock:
+            self._clock += 1
+            self._floor = self._clock
+            self._events.clear()
+            self._tails.clear()
+            self._bytes = 0
+            self._report()
+
+    def _store(self, conversation_id: str, tail: _Tail, replaced_size: int) -> None:
+        """
+        replaced_size: tamaño que ocupaba antes esta conversación (la misma
+        cola antes de crecer o la que se sustituye).
+        """
+        self._tails[conversation_id] = tail
+        self._tails.move_to_end(conversation_id)
+        self._bytes += tail.size - replaced_size
+        while self._bytes > self.max_bytes and self._tails:
+            _, evicted = self._tails.popitem(last=False)
+            self._bytes -= evicted.size
+            EVICTIONS.inc()
+        self._report()
+
+    def _drop(self, conversation_id: str) -> None:
+        tail = self._tails.pop(conversation_id, None)
+        if tail is not None:
+            self._bytes -= tail.size
+            self._report()
+
+    def _report(self) -> None:
+        CACHED_BYTES.set(value=self._bytes)
+        CACHED_CONVERSATIONS.set(value=len(self._tails))
+
+
+# ============================================================
+# NOTIFY (escritura) / LISTEN (un hilo por worker)
+# ============================================================
+
+def publish(cur, rows: list) -> list:
+    """
+    Dentro de la transacción del INSERT: una NOTIFY por mensaje con la fila
+    precodificada (se entrega al hacer commit). `rows` son dicts con las
+    columnas de messages. Devuelve los eventos para apply() tras el commit.
+    """
+    if not ENABLED or not rows:
+        return []
+    events, payloads = [], []
+    for row in rows:
+        conversation_id = str(row["conversation_id"])
+        entry = _Entry.from_row(row)
+        payload = f"{conversation_id} {entry.body.decode()}"
+        if len(payload.encode()) > MAX_PAYLOAD:
+            entry, payload = None, f"{conversation_id} -"
+        events.append((conversation_id, entry))
+        payloads.append(payload)
+    cur.execute("SELECT pg_notify(%s, payload) FROM unnest(%s::text[]) AS payload;", (CHANNEL, payloads))
+    return events
+
+
+def publish_invalidation(cur, conversation_id: str) -> list:
+    """
+    Para escrituras masivas (importación): se invalida la cola entera.
+    """
+    if not ENABLED:
+        return []
+    cur.execute("SELECT pg_notify(%s, %s);", (CHANNEL, f"{conversation_id} -"))
+    return [(str(conversation_id), None)]
+
+
+def _parse(payload: str) -> tuple:
+    conversation_id, _, body = payload.partition(" ")
+    if body == "-":
+        return conversation_id, None
+    return conversation_id, _Entry.from_body(body.encode())
+
+
+class _Listener:
+    def __init__(self, cache: TailCache, configs: list):
+        self.cache = cache
+        self.configs = configs
+        self.ready = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="vault-tailcache", daemon=True)
+        self._thread.start()
+
+    def _connect(self) -> list:
+        conns = []
+        try:
+            for config in self.configs:
+                conn = psycopg2.connect(**config)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with conn.cursor() as cur:
+                    cur.execute(f"LISTEN {CHANNEL};")
+                conns.append(conn)
+        except psycopg2.Error:
+            for conn in conns:
+                conn.close()
+            raise
+        return conns
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            conns = []
+            try:
+                conns = self._connect()
+                # Lo cacheado antes de escuchar pudo perder eventos
+                self.cache.clear()
+                self.ready.set()
+                while not self._stop.is_set():
+                    readable, _, _ = select.select(conns, [], [], 1.0)
+                    for conn in readable:
+                        conn.poll()
+                        events = [_parse(n.payload) for n in conn.notifies]
+                        conn.notifies.clear()
+                        self.cache.apply(events)
+            except (psycopg2.Error, OSError, ValueError) as exc:
+                logger.warning("tail cache LISTEN perdido: %s", exc)
+            finally:
+                self.ready.clear()
+                self.cache.clear()
+                for conn in conns:
+                    conn.close()
+            self._stop.wait(RECONNECT_S)
+
+    def close(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+
+_cache: Optional[TailCache] = None
+_listener: Optional[_Listener] = None
+_lock = threading.Lock()
+
+
+def _get() -> Optional[TailCache]:
+    """
+    La caché solo se usa mientras el hilo LISTEN está conectado.
+    """
+    global _cache, _listener
+    if not ENABLED:
+        return None
+    with _lock:
+        if _cache is None:
+            _cache = TailCache()
+            _listener = _Listener(_cache, listen_configs)
+        listening = _listener.ready.is_set()
+    return _cache if listening else None
+
+
+def page(conversation_id: str, after: Optional[str], limit: int) -> Optional[tuple]:
+    cache = _get()
+    return cache.page(conversation_id, after, limit) if cache else None
+
+
+def token() -> Optional[int]:
+    cache = _get()
+    return cache.token() if cache else None
+
+
+def fill(conversation_id: str, after: Optional[str], rows: list, read_token: Optional[int]) -> None:
+    cache = _get()
+    if cache is not None and read_token is not None:
+        cache.fill(conversation_id, after, rows, read_token)
+
+
+def apply(events: list) -> None:
+    """
+    Eventos de este worker tras su commit, sin esperar a su propia NOTIFY.
+    """
+    if events and _cache is not None:
+        _cache.apply(events)
+
+
+def shutdown() -> None:
+    global _cache, _listener
+    with _lock:
+        listener, _listener, _cache = _listener, None, None
+    if listener is not None:
+        listener.close()
@@ -0,0 +1,438 @@
+import base64
+import binascii
+import hashlib
+import json
+import os
+import struct
+import uuid
+from collections import deque
+from datetime import datetime
+from typing import Optional
+
+from server import db, metrics, signatures
+
+
+# ============================================================
+# CONFIG
+# ============================================================
+
+# Bytes acumulados antes de entregar un trozo al StreamingResponse
+EXPORT_CHUNK_BYTES = int(os.getenv("VAULT_EXPORT_CHUNK_BYTES", 64 * 1024))
+# Mensajes por transacción de importación (COPY + INSERT ... SELECT)
+IMPORT_BATCH_SIZE = int(os.getenv("VAULT_IMPORT_BATCH_SIZE", 1000))
+# Hashes recientes contra los que puede enlazar prev_hash (envíos
+# concurrentes bifurcan la cadena)
+CHAIN_WINDOW = int(os.getenv("VAULT_IMPORT_CHAIN_WINDOW", 1024))
+# Tope de un registro importado (protege la memoria del worker)
+MAX_RECORD_BYTES = int(os.getenv("VAULT_IMPORT_MAX_RECORD_BYTES", 64 * 1024 * 1024))
+
+EXPORTED = metrics.Counter(
+    "vault_export_messages_total",
+    "Messages streamed by conversation exports.",
+)
+IMPORTED = metrics.Counter(
+    "vault_import_messages_total",
+    "Messages inserted by conversation imports.",
+)
+
+# ============================================================
+# FORMATO
+#
+#   ndjson : un objeto JSON por línea (binarios en base64)
+#   binary : MAGIC + tramas  tipo (1 B) | len JSON (u32) | len blob (u32)
+#            | JSON | blob;  el blob es el ciphertext del mensaje en crudo
+#
+# Registros: header (conversación y participantes, solo sin `after`),
+# un message por mensaje con sus adjuntos y recibos, y end al final.
+# ============================================================
+
+FORMATS = ("ndjson", "binary")
+MEDIA_TYPES = {"ndjson": "application/x-ndjson", "binary": "application/octet-stream"}
+VERSION = 1
+
+MAGIC = b"SVEXP\x00\x01\n"
+_FRAME = struct.Struct(">cII")
+_FRAME_TYPES = {"header": b"H", "message": b"M", "end": b"E"}
+_RECORD_TYPES = {v: k for k, v in _FRAME_TYPES.items()}
+
+
+class ImportRejected(Exception):
+    """
+    Stream de importación mal formado o con la cadena de hashes rota.
+    """
+
+
+def _b64(value) -> Optional[str]:
+    return base64.b64encode(bytes(value)).decode() if value is not None else None
+
+
+def _unb64(value: Optional[str], field: str) -> Optional[bytes]:
+    if value is None:
+        return None
+    try:
+        return base64.b64decode(value, validate=True)
+    except (binascii.Error, TypeError) as exc:
+        raise ImportRejected(f"{field}: base64 inválido") from exc
+
+
+def encode_record(fmt: str, record: dict, blob: bytes = b"") -> bytes:
+    if fmt == "ndjson":
+        if record["type"] == "message":
+            record = {**record, "ciphertext": _b64(blob)}
+        return json.dumps(record, separators=(",", ":"), default=str).encode() + b"\n"
+    body = json.dumps(record, separators=(",", ":"), default=str).encode()
+    return _FRAME.pack(_FRAME_TYPES[record["type"]], len(body), len(blob)) + body + blob
+
+
+def _message_record(row: dict) -> dict:
+    # Sin el ciphertext: va como blob (binary) o se añade en base64 (ndjson)
+    return {
+        "type": "message",
+        "message_id": str(row["message_id"]),
+        "sender_id": str(row["sender_id"]),
+        "content_hash": _b64(row["content_hash"]),
+        "prev_hash": _b64(row["prev_hash"]),
+        "signature": _b64(row["signature"]),
+        "client_timestamp": row["client_timestamp"],
+        "key_id": row["key_id"],
+        "created_at": row["created_at"],
+        "attachments": row["attachments"],
+        "receipts": row["receipts"],
+    }
+
+
+# ============================================================
+# EXPORT
+# ============================================================
+
+def export_stream(
+    conversation_id: str,
+    fmt: str = "ndjson",
+    after_message_id: Optional[str] = None,
+    attachment_data: bool = False,
+):
+    """
+    Generador de bytes para StreamingResponse. Con `after_message_id`
+    continúa una exportación interrumpida (sin header ni MAGIC).
+    """
+    buffer = bytearray()
+    if after_message_id is None:
+        header = db.get_conversation_export_header(conversation_id)
+        if fmt == "binary":
+            buffer += MAGIC
+        buffer += encode_record(fmt, {
+            "type": "header",
+            "version": VERSION,
+            "conversation_id": str(header["conversation_id"]),
+            "created_at": header["created_at"],
+            "participants": header["participants"],
+        })
+
+    count, last = 0, after_message_id
+    for row in db.stream_conversation_export(conversation_id, after_message_id, attachment_data):
+        buffer += encode_record(fmt, _message_record(row), bytes(row["ciphertext"]))
+        count += 1
+        last = str(row["message_id"])
+        if len(buffer) >= EXPORT_CHUNK_BYTES:
+            yield bytes(buffer)
+            buffer.clear()
+            EXPORTED.inc(amount=count)
+            count = 0
+
+    EXPORTED.inc(amount=count)
+    buffer += encode_record(fmt, {"type": "end", "last_message_id": last})
+    yield bytes(buffer)
+
+
+# ============================================================
+# IMPORT
+# ============================================================
+
+class Decoder:
+    """
+    Parser incremental de ambos formatos (se detecta por los primeros
+    bytes). feed() devuelve los registros completos como (record, blob).
+    """
+
+    def __init__(self, max_record_bytes: int = MAX_RECORD_BYTES):
+        self.max_record_bytes = max_record_bytes
+        self.format: Optional[str] = None
+        self._buffer = bytearray()
+
+    def feed(self, chunk: bytes) -> list:
+        self._buffer += chunk
+        if self.format is None:
+            if len(self._buffer) < len(MAGIC) and MAGIC.startswith(bytes(self._buffer)):
+                return []
+            if self._buffer.startswith(MAGIC):
+                self.format = "binary"
+                del self._buffer[:len(MAGIC)]
+            else:
+                self.format = "ndjson"
+        return self._frames() if self.format == "binary" else self._lines()
+
+    def _lines(self) -> list:
+        records = []
+        start = 0
+        while True:
+            end = self._buffer.find(b"\n", start)
+            if end < 0:
+                break
+            line = bytes(self._buffer[start:end]).strip()
+            start = end + 1
+            if not line:
+                continue
+            record = self._parse_json(line)
+            blob = b""
+            if record.get("type") == "message":
+                blob = _unb64(record.pop("ciphertext", None), "ciphertext")
+                if blob is None:
+                    raise ImportRejected("message sin ciphertext")
+            records.append((record, blob))
+        del self._buffer[:start]
+        if len(self._buffer) > self.max_record_bytes:
+            raise ImportRejected("registro demasiado grande")
+        return records
+
+    def _frames(self) -> list:
+        records = []
+        pos = 0
+        while len(self._buffer) - pos >= _FRAME.size:
+            kind, body_len, blob_len = _FRAME.unpack_from(self._buffer, pos)
+            if kind not in _RECORD_TYPES:
+                raise ImportRejected(f"tipo de trama desconocido: {kind!r}")
+            if body_len + blob_len > self.max_record_bytes:
+                raise ImportRejected("registro demasiado grande")
+            end = pos + _FRAME.size + body_len + blob_len
+            if len(self._buffer) < end:
+                break
+            body_start = pos + _FRAME.size
+            record = self._parse_json(bytes(self._buffer[body_start:body_start + body_len]))
+            if record.get("type") != _RECORD_TYPES[kind]:
+                raise ImportRejected("el tipo de la trama no coincide con el registro")
+            records.append((record, bytes(self._buffer[body_start + body_len:end])))
+            pos = end
+        del self._buffer[:pos]
+        return records
+
+    @staticmethod
+    def _parse_json(data: bytes) -> dict:
+        try:
+            record = json.loads(data)
+        except ValueError as exc:
+            raise ImportRejected("JSON inválido") from exc
+        if not isinstance(record, dict):
+            raise ImportRejected("se esperaba un objeto JSON")
+        return record
+
+    def close(self) -> list:
+        if self.format == "ndjson" and self._buffer.strip():
+            # Última línea sin \n
+            self._buffer += b"\n"
+            return self._lines()
+        if self._buffer:
+            raise ImportRejected("stream truncado a mitad de un registro")
+        return []
+
+
+class ChainVerifier:
+    """
+    Recalcula content_hash = SHA-256(ciphertext + sender_id + conversation_id
+    + prev_hash) y exige que prev_hash enlace con alguno de los últimos
+    `window` hashes (del stream o ya en la DB). Solo el primer mensaje del
+    stream puede no tener prev_hash.
+    """
+
+    def __init__(self, conversation_id: str, known_hashes: list = (), window: int = CHAIN_WINDOW):
+        self.conversation_id = conversation_id
+        self._recent = deque(maxlen=max(1, window))
+        self._seen: dict = {}
+        self._first = True
+        for h in known_hashes:
+            self._remember(h)
+
+    def _remember(self, content_hash: bytes) -> None:
+        if len(self._recent) == self._recent.maxlen:
+            oldest = self._recent[0]
+            self._seen[oldest] -= 1
+            if not self._seen[oldest]:
+                del self._seen[oldest]
+        self._recent.append(content_hash)
+        self._seen[content_hash] = self._seen.get(content_hash, 0) + 1
+
+    def check(self, message: dict) -> None:
+        computed = hashlib.sha256(
+            message["ciphertext"]
+            + message["sender_id"].encode()
+            + self.conversation_id.encode()
+            + (message["prev_hash"] or b"")
+        ).digest()
+        if computed != message["content_hash"]:
+            raise ImportRejected(f"content_hash no coincide en {message['message_id']}")
+        prev_hash = message["prev_hash"]
+        if prev_hash is None:
+            if not self._first:
+                raise ImportRejected(f"{message['message_id']} sin prev_hash a mitad de cadena")
+        elif prev_hash not in self._seen:
+            raise ImportRejected(f"prev_hash de {message['message_id']} no enlaza con la cadena")
+        self._first = False
+        self._remember(computed)
+
+
+def _uuid(value, field: str) -> str:
+    try:
+        return str(uuid.UUID(str(value)))
+    except ValueError as exc:
+        raise ImportRejected(f"{field}: UUID inválido") from exc
+
+
+def _timestamp(value, field: str) -> Optional[datetime]:
+    if value is None:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError) as exc:
+        raise ImportRejected(f"{field}: timestamp inválido") from exc
+
+
+def _parse_message(record: dict, blob: bytes) -> dict:
+    try:
+        message = {
+            "message_id": _uuid(record["message_id"], "message_id"),
+            "sender_id": _uuid(record["sender_id"], "sender_id"),
+            "ciphertext": blob,
+            "content_hash": _unb64(record["content_hash"], "content_hash"),
+            "prev_hash": _unb64(record.get("prev_hash"), "prev_hash"),
+            "signature": _unb64(record["signature"], "signature"),
+            "client_timestamp": _timestamp(record.get("client_timestamp"), "client_timestamp"),
+            "key_id": record.get("key_id"),
+            "created_at": _timestamp(record["created_at"], "created_at"),
+            "attachments": [
+                {
+                    "attachment_id": _uuid(a["attachment_id"], "attachment_id"),
+                    "uploader_id": _uuid(a["uploader_id"], "uploader_id"),
+                    "ciphertext": _unb64(a.get("ciphertext"), "attachment ciphertext"),
+                    "content_hash": _unb64(a["content_hash"], "attachment content_hash"),
+                    "signature": _unb64(a["signature"], "attachment signature"),
+                    "meta_ciphertext": _unb64(a.get("meta_ciphertext"), "meta_ciphertext"),
+                    "meta_hash": _unb64(a.get("meta_hash"), "meta_hash"),
+                    "meta_signature": _unb64(a.get("meta_signature"), "meta_signature"),
+                    "created_at": _timestamp(a["created_at"], "attachment created_at"),
+                }
+                for a in record.get("attachments") or []
+            ],
+            "receipts": [
+                {
+                    "user_id": _uuid(r["user_id"], "receipt user_id"),
+                    "delivered_at": _timestamp(r.get("delivered_at"), "delivered_at"),
+                    "read_at": _timestamp(r.get("read_at"), "read_at"),
+                }
+                for r in record.get("receipts") or []
+            ],
+        }
+    except (KeyError, TypeError) as exc:
+        raise ImportRejected(f"campo obligatorio ausente o inválido: {exc}") from exc
+    if message["content_hash"] is None or message["signature"] is None or message["created_at"] is None:
+        raise ImportRejected(f"mensaje incompleto: {message['message_id']}")
+    return message
+
+
+class Importer:
+    """
+    Consume el stream por trozos (feed) y carga lotes verificados de
+    `batch_size` mensajes, cada uno en su propia transacción: si el stream
+    se corta, lo ya cargado queda y el cliente reanuda desde el último hash.
+    """
+
+    def __init__(self, conversation_id: str, batch_size: Optional[int] = None):
+        self.conversation_id = conversation_id
+        self.batch_size = max(1, batch_size or IMPORT_BATCH_SIZE)
+        self.decoder = Decoder()
+        self.verifier: Optional[ChainVerifier] = None
+        self._batch: list = []
+        self.summary = {
+            "conversation_id": conversation_id,
+            "created": False,
+            "received": 0,
+            "messages": 0,
+            "attachments": 0,
+            "receipts": 0,
+            "complete": False,
+        }
+
+    def feed(self, chunk: bytes) -> None:
+        for record, blob in self.decoder.feed(chunk):
+            self._handle(record, blob)
+
+    def _handle(self, record: dict, blob: bytes) -> None:
+        kind = record.get("type")
+        if self.summary["complete"]:
+            raise ImportRejected("registros después de end")
+        if kind == "header":
+            self._start(record)
+        elif kind == "message":
+            if self.verifier is None:
+                raise ImportRejected("el stream debe empezar con un header")
+            message = _parse_message(record, blob)
+            self.verifier.check(message)
+            self._batch.append(message)
+            self.summary["received"] += 1
+            if len(self._batch) >= self.batch_size:
+                self._flush()
+        elif kind == "end":
+            self.summary["complete"] = True
+        else:
+            raise ImportRejected(f"tipo de registro desconocido: {kind!r}")
+
+    def _start(self, header: dict) -> None:
+        if self.verifier is not None:
+            raise ImportRejected("header duplicado")
+        if header.get("version") != VERSION:
+            raise ImportRejected(f"versión de exportación no soportada: {header.get('version')}")
+        if _uuid(header.get("conversation_id"), "conversation_id") != self.conversation_id:
+            raise ImportRejected("conversation_id del header distinto del de la URL")
+        participants = [_uuid(p, "participant") for p in header.get("participants") or []]
+        self.summary["created"] = db.prepare_import(
+            self.conversation_id, participants, _timestamp(header.get("created_at"), "created_at")
+        )
+        self.verifier = ChainVerifier(
+            self.conversation_id,
+            db.get_recent_message_hashes(self.conversation_id, CHAIN_WINDOW),
+        )
+
+    def _verify_signatures(self) -> None:
+        """
+        Con VAULT_VERIFY_SIGNATURES=1, como en la ingesta: firma de cada
+        content_hash contra su user_keys. Una consulta por lote; incluye las
+        claves revocadas porque el historial se firmó antes de revocarlas.
+        """
+        pairs = {(m["sender_id"], m["key_id"] or "primary") for m in self._batch}
+        keys = {
+            (str(k["user_id"]), k["key_id"]): k["public_key"]
+            for k in db.lookup_keys(sorted(pairs), [])
+        }
+        for m in self._batch:
+            public_key = keys.get((m["sender_id"], m["key_id"] or "primary"))
+            if public_key is None or not signatures.verify(
+                public_key, m["content_hash"], m["signature"]
+            ):
+                raise ImportRejected(f"firma inválida en {m['message_id']}")
+
+    def _flush(self) -> None:
+        if not self._batch:
+            return
+        if signatures.VERIFY_SIGNATURES:
+            self._verify_signatures()
+        loaded = db.import_messages_batch(self.conversation_id, self._batch)
+        self._batch = []
+        for key in ("messages", "attachments", "receipts"):
+            self.summary[key] += loaded[key]
+        IMPORTED.inc(amount=loaded["messages"])
+
+    def finish(self) -> dict:
+        for record, blob in self.decoder.close():
+            self._handle(record, blob)
+        if self.verifier is None:
+            raise ImportRejected("el stream debe empezar con un header")
+        self._flush()
+        return self.summary
@@ -1,9 +1,23 @@
+import asyncio
 import base64
+import hashlib
+import json
+import sqlite3
+import time
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
 
 import pytest
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
 from fastapi.testclient import TestClient
 
-from server import api, db
+from client import crypto as client_crypto
+from client import verify
+from server import (
+    admission, api, coalescer, db, merkle, metrics, migrate, profiling, receipts, segments,
+    signals, signatures, slowlog, sqlite_db, storage, tailcache, transfer,
+)
 
 
 def b64(text: str) -> str:
@@ -60,6 +74,37 @@ def test_create_message_invalid_key(monkeypatch, client):
     assert resp.status_code == 400
 
 
+def test_create_message_verifies_signature(monkeypatch, client):
+    private_key = Ed25519PrivateKey.generate()
+    public_pem = private_key.public_key().public_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo,
+    ).decode()
+    content_hash = b"h" * 32
+
+    monkeypatch.setattr(signatures, "VERIFY_SIGNATURES", True)
+    monkeypatch.setattr(db, "conversation_exists", lambda cid: True)
+    monkeypatch.setattr(db, "is_participant", lambda cid, uid: True)
+    monkeypatch.setattr(db, "get_active_key", lambda uid, kid: {"public_key": public_pem})
+    monkeypatch.setattr(db, "insert_message", lambda **kwargs: ("m1", "t0"))
+
+    payload = {
+        "sender_id": "00000000-0000-0000-0000-000000000001",
+        "ciphertext": b64("ct"),
+        "content_hash": base64.b64encode(content_hash).decode(),
+        "signature": base64.b64encode(private_key.sign(content_hash)).decode(),
+    }
+    url = "/conversations/00000000-0000-0000-0000-000000000000/messages"
+
+    resp = client.post(url, json=payload)
+    assert resp.status_code == 200
+    assert resp.headers["server-timing"].startswith("verify;dur=")
+
+    payload["signature"] = base64.b64encode(b"x" * 64).decode()
+    resp = client.post(url, json=payload)
+    assert resp.status_code == 400
+
+
 def test_message_status_flow(monkeypatch, client):
     monkeypatch.setattr(db, "get_message_conversation_id", lambda mid: "c1")
     monkeypatch.setattr(db, "is_participant", lambda cid, uid: True)
@@ -145,3 +190,1230 @@ def test_attachments_flow(monkeypatch, client):
     )
     assert resp.status_code == 200
     assert resp.json()["attachment_id"] == "att-1"
+
+
+def test_metrics_endpoint(monkeypatch, client):
+    monkeypatch.setattr(db, "get_user_by_id", lambda user_id: None)
+    client.get("/users/00000000-0000-0000-0000-000000000000")
+
+    resp = client.get("/metrics")
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("text/plain")
+    assert (
+        'vault_http_requests_total{method="GET",route="/users/{user_id}",status="404"}'
+        in resp.text
+    )
+
+
+def test_track_query_records_latency_and_rows():
+    @metrics.track_query
+    def fake_query():
+        return [{"a": 1}, {"a": 2}]
+
+    before = metrics.DB_QUERY_ROWS.count("fake_query")
+    assert fake_query() == [{"a": 1}, {"a": 2}]
+    assert metrics.DB_QUERY_ROWS.count("fake_query") == before + 1
+    assert metrics.DB_QUERY_LATENCY.count("fake_query") >= 1
+
+
+def test_slow_queries_admin_endpoint(monkeypatch, tmp_path, client):
+    monkeypatch.setattr(slowlog, "LOG_FILE", str(tmp_path / "slow.jsonl"))
+    monkeypatch.setattr(slowlog, "SLOW_QUERY_MS", 10.0)
+    monkeypatch.setattr(slowlog, "EXPLAIN_SAMPLE_RATE", 0.0)
+    slowlog.reset()
+    slowlog.observe(
+        "SELECT *\n  FROM messages WHERE conversation_id = %s;",
+        ("c1",),
+        0.25,
+    )
+    slowlog.observe("SELECT 1", None, 0.001)
+
+    resp = client.get("/admin/slow-queries")
+    assert resp.status_code == 404
+
+    monkeypatch.setattr(api, "ADMIN_TOKEN", "secret")
+    resp = client.get("/admin/slow-queries", headers={"X-Admin-Token": "nope"})
+    assert resp.status_code == 403
+
+    resp = client.get("/admin/slow-queries", headers={"X-Admin-Token": "secret"})
+    assert resp.status_code == 200
+    queries = resp.json()["queries"]
+    assert len(queries) == 1
+    assert queries[0]["sql"] == "SELECT * FROM messages WHERE conversation_id = %s"
+    assert (tmp_path / "slow.jsonl").read_text().count("slow_query") == 1
+
+    # El EXPLAIN muestreado va a la base de la conexión que ejecutó la consulta
+    explained = []
+    monkeypatch.setattr(slowlog, "EXPLAIN_SAMPLE_RATE", 1.0)
+    monkeypatch.setattr(slowlog, "_explain", lambda fp, sql, params, dsn: explained.append(dsn))
+    slowlog.observe("SELECT 2", None, 0.5, dsn="host=s2 dbname=vault")
+    slowlog.observe("SELECT 3", None, 0.5)
+    deadline = time.monotonic() + 2
+    while not explained and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert explained == ["host=s2 dbname=vault"]
+
+
+def test_profile_request_with_admin_header(monkeypatch, tmp_path, client):
+    monkeypatch.setattr(profiling, "PROFILE_DIR", tmp_path)
+    monkeypatch.setattr(api, "ADMIN_TOKEN", "secret")
+    monkeypatch.setattr(db, "get_user_by_id", lambda user_id: None)
+    url = "/users/00000000-0000-0000-0000-000000000000"
+
+    resp = client.get(url)
+    assert "x-vault-profile-id" not in resp.headers
+    assert list(tmp_path.iterdir()) == []
+
+    resp = client.get(url, headers={"X-Vault-Profile": "1", "X-Admin-Token": "nope"})
+    assert resp.status_code == 403
+
+    resp = client.get(url, headers={"X-Vault-Profile": "1", "X-Admin-Token": "secret"})
+    assert resp.status_code == 404
+    profile_id = resp.headers["x-vault-profile-id"]
+
+    resp = client.get("/admin/profiles", headers={"X-Admin-Token": "secret"})
+    summary = resp.json()[0]
+    assert summary["profile_id"] == profile_id
+    assert set(summary["breakdown_ms"]) == {"db", "serialization", "framework", "app"}
+
+    resp = client.get(f"/admin/profiles/{profile_id}", headers={"X-Admin-Token": "secret"})
+    assert resp.status_code == 200
+
+
+def test_admission_rate_limits_writes_per_user(monkeypatch, client):
+    monkeypatch.setattr(admission, "ENABLED", True)
+    monkeypatch.setitem(
+        admission._BUCKETS, ("write", "user"), admission.TokenBuckets(rate=1, burst=2)
+    )
+    monkeypatch.setattr(db, "conversation_exists", lambda cid: True)
+    monkeypatch.setattr(db, "is_participant", lambda cid, uid: True)
+    monkeypatch.setattr(db, "get_active_key", lambda uid, kid: {"public_key": "pk"})
+    monkeypatch.setattr(db, "insert_message", lambda **kwargs: ("m1", "t0"))
+
+    payload = {
+        "sender_id": "00000000-0000-0000-0000-000000000001",
+        "ciphertext": b64("ct"),
+        "content_hash": b64("ch"),
+        "signature": b64("sig"),
+    }
+    url = "/conversations/00000000-0000-0000-0000-000000000000/messages"
+
+    assert client.post(url, json=payload).status_code == 200
+    assert client.post(url, json=payload).status_code == 200
+    resp = client.post(url, json=payload)
+    assert resp.status_code == 429
+    assert resp.headers["retry-after"] == "1"
+
+
+def test_token_bucket_refills():
+    buckets = admission.TokenBuckets(rate=2, burst=1)
+    assert buckets.take("u", now=0.0) == 0
+    assert buckets.take("u", now=0.1) == pytest.approx(0.4)
+    assert buckets.take("u", now=0.6) == 0
+
+
+def test_conversation_rate_limit_does_not_spend_user_token(monkeypatch):
+    monkeypatch.setattr(admission, "ENABLED", True)
+    users = admission.TokenBuckets(rate=0.001, burst=1)
+    conversations = admission.TokenBuckets(rate=0.001, burst=1)
+    monkeypatch.setitem(admission._BUCKETS, ("write", "user"), users)
+    monkeypatch.setitem(admission._BUCKETS, ("write", "conversation"), conversations)
+
+    with admission.admit("write", user="u2", conversation="c1"):
+        pass
+    with pytest.raises(admission.Rejected) as exc:
+        with admission.admit("write", user="u1", conversation="c1"):
+            pass
+    assert exc.value.status_code == 429
+    assert exc.value.reason == "conversation rate limit exceeded"
+    # u1 conserva su token para otra conversación
+    with admission.admit("write", user="u1", conversation="c2"):
+        pass
+
+
+def test_create_message_idempotent_replay(monkeypatch, client):
+    stored = {
+        "resource_id": "m-original",
+        "resource_created_at": "t0",
+        "request_hash": b"ch",
+        "target_id": "00000000-0000-0000-0000-000000000000",
+    }
+    monkeypatch.setattr(
+        db, "get_idempotent_result", lambda owner, scope, key: stored if key == "k1" else None
+    )
+    monkeypatch.setattr(db, "conversation_exists", lambda cid: True)
+    monkeypatch.setattr(db, "is_participant", lambda cid, uid: not uid.endswith("9"))
+
+    def fail_insert(**kwargs):
+        raise AssertionError("retry must not insert")
+
+    monkeypatch.setattr(db, "insert_message", fail_insert)
+
+    payload = {
+        "sender_id": "00000000-0000-0000-0000-000000000001",
+        "ciphertext": b64("ct"),
+        "content_hash": b64("ch"),
+        "signature": b64("sig"),
+    }
+    url = "/conversations/00000000-0000-0000-0000-000000000000/messages"
+
+    resp = client.post(url, json=payload, headers={"Idempotency-Key": "k1"})
+    assert resp.status_code == 200
+    assert resp.json() == {"message_id": "m-original", "created_at": "t0"}
+    assert resp.headers["idempotent-replayed"] == "true"
+
+    # La clave queda ligada a su conversación: contra otra no hay replay
+    other = "/conversations/00000000-0000-0000-0000-0000000000ff/messages"
+    resp = client.post(other, json=payload, headers={"Idempotency-Key": "k1"})
+    assert resp.status_code == 409
+    assert "idempotent-replayed" not in resp.headers
+
+    # Y el replay no se salta la autorización
+    intruder = dict(payload, sender_id="00000000-0000-0000-0000-000000000009")
+    resp = client.post(url, json=intruder, headers={"Idempotency-Key": "k1"})
+    assert resp.status_code == 403
+
+    payload["content_hash"] = b64("otro")
+    resp = client.post(url, json=payload, headers={"Idempotency-Key": "k1"})
+    assert resp.status_code == 409
+
+
+def test_write_coalescer_batches_and_isolates_errors():
+    batches = []
+
+    def flush(rows):
+        batches.append(len(rows))
+        return [
+            ValueError("bad row") if r["n"] == 3 else (f"m{r['n']}", "t0")
+            for r in rows
+        ]
+
+    writer = coalescer.WriteCoalescer(flush, window_ms=50, max_batch=4)
+    futures = [writer.submit({"n": n}) for n in range(6)]
+    writer.close()
+
+    assert futures[0].result() == ("m0", "t0")
+    assert futures[5].result() == ("m5", "t0")
+    with pytest.raises(ValueError):
+        futures[3].result()
+    assert batches == [4, 2]
+
+
+def test_receipt_buffer_dedups_and_keeps_first_timestamp(monkeypatch):
+    applied = []
+    t0 = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+    buffer = receipts.ReceiptBuffer(lambda rows: applied.extend(rows) or len(rows), flush_ms=60_000)
+    buffer.record("m1", "u1", now=t0)
+    buffer.record("m1", "u1", now=t0 + timedelta(seconds=1))
+    buffer.record("m1", "u1", read=True, now=t0 + timedelta(seconds=2))
+    buffer.record("m1", "u1", read=True, now=t0 + timedelta(seconds=3))
+    done = buffer.record("m1", "u2", read=True, now=t0 + timedelta(seconds=4))
+
+    assert buffer.pending_for("m1")["u1"] == (t0, t0 + timedelta(seconds=2))
+
+    # Lo pendiente sale sin zona, como las filas de message_status
+    monkeypatch.setattr(receipts, "_buffer", buffer)
+    merged = receipts.merge_pending("m1", [
+        {"user_id": "u1", "delivered_at": datetime(2025, 12, 31), "read_at": None},
+    ])
+    assert merged == [
+        {"user_id": "u1", "delivered_at": datetime(2025, 12, 31),
+         "read_at": datetime(2026, 1, 1, 0, 0, 2)},
+        {"user_id": "u2", "delivered_at": datetime(2026, 1, 1, 0, 0, 4),
+         "read_at": datetime(2026, 1, 1, 0, 0, 4)},
+    ]
+    buffer.close()
+
+    assert done.result() == 2
+    assert sorted(applied) == [
+        ("m1", "u1", t0, t0 + timedelta(seconds=2)),
+        ("m1", "u2", t0 + timedelta(seconds=4), t0 + timedelta(seconds=4)),
+    ]
+
+    # Recibos de una conversación en traslado: solo esos vuelven a la cola
+    flushes = []
+
+    def apply(rows):
+        flushes.append(sorted(rows))
+        moving = [r for r in rows if r[0] == "m2"]
+        if len(flushes) == 1:
+            raise db.ReceiptsDeferred(len(rows) - len(moving), moving)
+        return len(rows)
+
+    buffer = receipts.ReceiptBuffer(apply, flush_ms=200, max_pending=2)
+    buffer.record("m1", "u1", now=t0)
+    done = buffer.record("m2", "u1", now=t0)
+    assert done.result(timeout=5) == 2
+    buffer.close()
+    assert flushes == [[("m1", "u1", t0, None), ("m2", "u1", t0, None)], [("m2", "u1", t0, None)]]
+
+
+def test_durable_receipt_failed_flush_is_503_and_retries_are_capped(monkeypatch, client):
+    attempts = []
+
+    def apply(rows):
+        attempts.append(sorted(r[:2] for r in rows))
+        raise RuntimeError("db caída")
+
+    monkeypatch.setattr(receipts, "MAX_RETRIES", 2)
+    monkeypatch.setattr(receipts, "ENABLED", True)
+    monkeypatch.setattr(receipts, "_buffer", receipts.ReceiptBuffer(apply, flush_ms=20))
+    monkeypatch.setattr(db, "get_message_conversation_id", lambda mid: "c1")
+    monkeypatch.setattr(db, "is_participant", lambda cid, uid: True)
+    dropped = receipts.DROPPED.value("retries")
+
+    message_id = "00000000-0000-0000-0000-000000000001"
+    user_id = "00000000-0000-0000-0000-000000000002"
+    resp = client.post(f"/messages/{message_id}/delivered", params={"durable": "true"},
+                       json={"user_id": user_id})
+    # La excepción de la DB no llega al cliente como 500
+    assert resp.status_code == 503
+    assert resp.json()["detail"] == "Receipt not confirmed"
+    assert resp.headers["retry-after"] == "1"
+
+    # Tras MAX_RETRIES volcados fallidos el recibo se descarta y se cuenta
+    deadline = time.monotonic() + 2
+    while receipts.DROPPED.value("retries") == dropped and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert receipts.DROPPED.value("retries") == dropped + 1
+    assert receipts._buffer.pending_for(message_id) == {}
+    assert attempts == [[(message_id, user_id)]] * 2
+    receipts._buffer.close()
+
+
+def test_conditional_get_attachment_and_closed_page(monkeypatch, client):
+    monkeypatch.setattr(db, "get_message_conversation_id", lambda mid: "c1")
+    monkeypatch.setattr(db, "is_participant", lambda cid, uid: True)
+    monkeypatch.setattr(db, "conversation_exists", lambda cid: True)
+    monkeypatch.setattr(
+        db, "get_attachment_validator", lambda aid: {"message_id": "m1", "content_hash": b"ch"}
+    )
+
+    def no_bytea(*args, **kwargs):
+        raise AssertionError("304 must not load ciphertext")
+
+    monkeypatch.setattr(db, "get_attachment", no_bytea)
+    resp = client.get(
+        "/attachments/00000000-0000-0000-0000-000000000000",
+        params={"user_id": "00000000-0000-0000-0000-000000000001"},
+        headers={"If-None-Match": f'"{b"ch".hex()}"'},
+    )
+    assert resp.status_code == 304
+    assert "immutable" in resp.headers["Cache-Control"]
+
+    row = {
+        "message_id": "m2",
+        "sender_id": "u1",
+        "ciphertext": b"ct",
+        "content_hash": b"h2",
+        "prev_hash": None,
+        "signature": b"sig",
+        "client_timestamp": None,
+        "key_id": "primary",
+        "created_at": "t0",
+    }
+    tail = {"row_count": 2, "message_id": "m2", "content_hash": b"h2", "settled": True}
+    monkeypatch.setattr(db, "get_messages", lambda **kwargs: [row, row])
+    monkeypatch.setattr(db, "get_message_page_tail", lambda *args: tail)
+
+    url = "/conversations/00000000-0000-0000-0000-000000000000/messages?limit=2"
+    resp = client.get(url)
+    assert resp.status_code == 200
+    assert "immutable" in resp.headers["Cache-Control"]
+    etag = resp.headers["ETag"]
+
+    monkeypatch.setattr(db, "get_messages", no_bytea)
+    resp = client.get(url, headers={"If-None-Match": etag})
+    assert resp.status_code == 304
+
+    # Página incompleta: puede crecer, se revalida siempre
+    monkeypatch.setattr(db, "get_messages", lambda **kwargs: [row])
+    resp = client.get(url.replace("limit=2", "limit=3"))
+    assert resp.headers["Cache-Control"] == "no-cache"
+
+
+def test_bulk_participants(monkeypatch, client):
+    created = {}
+
+    def create_conversation(participants):
+        created["participants"] = participants
+        if "00000000-0000-0000-0000-00000000dead" in (participants or []):
+            raise db.UnknownUsers(["00000000-0000-0000-0000-00000000dead"])
+        return "c1"
+
+    monkeypatch.setattr(db, "create_conversation", create_conversation)
+    users = [f"00000000-0000-0000-0000-{n:012d}" for n in range(1, 4)]
+
+    resp = client.post("/conversations", json={"participants": users})
+    assert resp.status_code == 200
+    assert created["participants"] == users
+
+    resp = client.post("/conversations", json={"participants": users + ["00000000-0000-0000-0000-00000000dead"]})
+    assert resp.status_code == 404
+    assert resp.json()["detail"]["unknown"] == ["00000000-0000-0000-0000-00000000dead"]
+
+    resp = client.post("/conversations")
+    assert resp.status_code == 200
+
+    monkeypatch.setattr(
+        db,
+        "add_participants",
+        lambda cid, uids: {"added": uids[:1], "already_participants": [], "unknown": uids[1:]},
+    )
+    resp = client.post(
+        "/conversations/00000000-0000-0000-0000-000000000000/participants:batch",
+        json={"user_ids": users[:2]},
+    )
+    assert resp.status_code == 200
+    assert resp.json()["unknown"] == [users[1]]
+
+    resp = client.post(
+        "/conversations/00000000-0000-0000-0000-000000000000/participants:batch",
+        json={"user_ids": ["nope"]},
+    )
+    assert resp.status_code == 400
+
+
+def test_key_lookup_batches_and_supports_etag(monkeypatch, client):
+    calls = []
+
+    def lookup_keys(pairs, user_ids, since):
+        calls.append((pairs, user_ids, since))
+        return [
+            {
+                "user_id": "00000000-0000-0000-0000-000000000001",
+                "key_id": "primary",
+                "public_key": "pk",
+                "fingerprint": b"fp",
+                "is_primary": True,
+                "created_at": datetime(2026, 1, 1),
+                "revoked_at": datetime(2026, 2, 1),
+            }
+        ]
+
+    monkeypatch.setattr(db, "lookup_keys", lookup_keys)
+    body = {
+        "keys": [{"user_id": "00000000-0000-0000-0000-000000000001", "key_id": "primary"}],
+        "user_ids": ["00000000-0000-0000-0000-000000000002"],
+    }
+    resp = client.post("/keys:lookup", json=body)
+    assert resp.status_code == 200
+    assert resp.json()["keys"][0]["revoked_at"] == "2026-02-01T00:00:00"
+    assert resp.json()["as_of"] == "2026-02-01T00:00:00"
+    assert calls[0][0] == [("00000000-0000-0000-0000-000000000001", "primary")]
+
+    resp = client.post("/keys:lookup", json=body, headers={"If-None-Match": resp.headers["ETag"]})
+    assert resp.status_code == 304
+
+
+def test_batch_get_messages_splits_missing_and_forbidden(monkeypatch, client):
+    ids = [f"00000000-0000-0000-0000-{n:012d}" for n in range(1, 4)]
+
+    def get_messages_by_ids(message_ids, user_id):
+        base = {
+            "conversation_id": "c1",
+            "sender_id": "u1",
+            "ciphertext": b"ct",
+            "content_hash": b"h",
+            "prev_hash": None,
+            "signature": b"sig",
+            "client_timestamp": None,
+            "key_id": "primary",
+            "created_at": "t0",
+        }
+        return [
+            {**base, "requested_id": ids[0], "message_id": ids[0], "found": True, "allowed": True},
+            {**base, "requested_id": ids[1], "message_id": ids[1], "found": True, "allowed": False,
+             "ciphertext": None},
+            {"requested_id": ids[2], "found": False, "allowed": False},
+        ]
+
+    monkeypatch.setattr(db, "get_messages_by_ids", get_messages_by_ids)
+    resp = client.post(
+        "/messages:batchGet",
+        json={"user_id": "00000000-0000-0000-0000-0000000000aa", "message_ids": ids},
+    )
+    assert resp.status_code == 200
+    body = resp.json()
+    assert [m["message_id"] for m in body["messages"]] == [ids[0]]
+    assert body["messages"][0]["ciphertext"] == b64("ct")
+    assert body["forbidden"] == [ids[1]]
+    assert body["missing"] == [ids[2]]
+
+
+def test_list_messages_include_expansions(monkeypatch, client):
+    monkeypatch.setattr(db, "conversation_exists", lambda cid: True)
+    rows = [
+        {
+            "message_id": f"m{n}",
+            "sender_id": "u1",
+            "ciphertext": b"ct",
+            "content_hash": b"h",
+            "prev_hash": None,
+            "signature": b"sig",
+            "client_timestamp": None,
+            "key_id": "primary",
+            "created_at": "t0",
+        }
+        for n in range(3)
+    ]
+    monkeypatch.setattr(db, "get_messages", lambda **kwargs: rows)
+    calls = []
+
+    def get_message_expansions(message_ids, include):
+        calls.append((list(message_ids), set(include)))
+        return {
+            mid: {
+                "attachments": [{"attachment_id": "a1", "meta_ciphertext": "x" * 40}],
+                "status": [{"user_id": "u2", "delivered_at": "t1", "read_at": None}],
+            }
+            for mid in message_ids
+        }
+
+    monkeypatch.setattr(db, "get_message_expansions", get_message_expansions)
+    url = "/conversations/00000000-0000-0000-0000-000000000000/messages"
+
+    resp = client.get(url, params={"include": "attachments,status"})
+    assert resp.status_code == 200
+    assert calls == [(["m0", "m1", "m2"], {"attachments", "status"})]
+    assert resp.json()[2]["attachments"][0]["attachment_id"] == "a1"
+    assert resp.json()[0]["status"][0]["user_id"] == "u2"
+    assert "ETag" not in resp.headers
+
+    monkeypatch.setattr(api, "MAX_EXPANSION_BYTES", 300)
+    resp = client.get(url, params={"include": "attachments,status"})
+    assert resp.headers["X-Vault-Include-Truncated"] == "m1"
+    assert "attachments" in resp.json()[0] and "attachments" not in resp.json()[1]
+
+    assert client.get(url, params={"include": "ciphertext"}).status_code == 400
+
+
+def test_migration_manifest_and_index_audit():
+    versions = [m.version for m in migrate.MIGRATIONS]
+    assert versions == sorted(versions) and len(set(versions)) == len(versions)
+    for m in migrate.MIGRATIONS:
+        assert m.backfill or m.path.exists()
+    # La base de partida no sigue a schema.sql (cambiaría su checksum)
+    assert migrate.MIGRATIONS[0].path.parent == migrate.SCRIPTS_DIR
+
+    drop = next(m for m in migrate.MIGRATIONS if m.name == "drop redundant indexes")
+    assert drop.no_transaction
+    assert migrate.split_statements(drop.sql())[0] == (
+        "DROP INDEX CONCURRENTLY IF EXISTS idx_messages_conversation"
+    )
+
+    def index(name, table, keys, unique=False, include=()):
+        return {
+            "table": table, "name": name, "method": "btree", "unique": unique,
+            "primary": unique, "valid": True, "partial": False, "keys": list(keys),
+            "include": list(include), "bytes": 8192, "scans": 1,
+        }
+
+    indexes = [
+        index("messages_pkey", "messages", ["message_id"], unique=True),
+        index("idx_messages_conversation", "messages", ["conversation_id"]),
+        index("idx_messages_conversation_created", "messages", ["conversation_id", "created_at"]),
+    ]
+    report = migrate.audit(indexes)
+    assert [r["index"] for r in report["redundant"]] == ["idx_messages_conversation"]
+    candidates = {c["query"]: c for c in report["covering_candidates"]}
+    assert "INCLUDE (message_id, content_hash)" in candidates["get_message_page_tail"]["create"]
+    assert "get_messages" not in candidates
+
+
+def test_archived_segment_roundtrip_and_hydrate(monkeypatch, tmp_path, client):
+    monkeypatch.setattr(segments, "ARCHIVE_DIR", tmp_path)
+    conversation_id = "00000000-0000-0000-0000-0000000000c1"
+    created = datetime(2024, 1, 1)
+    messages = [
+        {
+            "message_id": f"00000000-0000-0000-0000-00000000000{i}",
+            "sender_id": "00000000-0000-0000-0000-0000000000aa",
+            "ciphertext": bytes([i]) * 100,
+            "content_hash": bytes([i]) * 32,
+            "prev_hash": None if i == 0 else bytes([i - 1]) * 32,
+            "signature": b"s" * 64,
+            "client_timestamp": None,
+            "key_id": "primary",
+            "created_at": created + timedelta(seconds=i),
+        }
+        for i in range(3)
+    ]
+    path = segments.segment_path(conversation_id, "seg-1")
+    info = segments.write_segment(path, conversation_id, messages)
+
+    reader = segments.SegmentReader(path)
+    assert reader.verify() == info["sha256"]
+    assert [m["prev_hash"] for m in reader] == [m["prev_hash"] for m in messages]
+    assert reader.get(messages[2]["message_id"])["created_at"] == messages[2]["created_at"]
+    reader.close()
+
+    stubs = [
+        dict(m, ciphertext=b"", conversation_id=conversation_id, segment_id="seg-1")
+        for m in messages
+    ]
+    assert [r["ciphertext"] for r in segments.hydrate(stubs)] == [m["ciphertext"] for m in messages]
+
+    # Segmento corrupto: 503 en lugar de devolver un stub vacío
+    raw = bytearray(path.read_bytes())
+    raw[-40] ^= 0xFF
+    path.write_bytes(bytes(raw))
+    with pytest.raises(segments.SegmentError):
+        segments.SegmentReader(path).verify()
+
+    def get_messages(**kwargs):
+        raise segments.SegmentError("segmento no disponible")
+
+    monkeypatch.setattr(db, "conversation_exists", lambda cid: True)
+    monkeypatch.setattr(db, "get_messages", get_messages)
+    resp = client.get(f"/conversations/{conversation_id}/messages")
+    assert resp.status_code == 503
+
+    # Sin un login miembro de vault_archiver no se escribe ningún segmento
+    from server import archive
+
+    logins = []
+
+    def connect(config):
+        logins.append(config["user"])
+        return SimpleNamespace(close=lambda: None)
+
+    monkeypatch.setattr(storage, "ENGINE", "postgres")
+    monkeypatch.setattr(archive, "ARCHIVE_USER", "vault_archive")
+    monkeypatch.setattr(migrate, "connect", connect)
+    monkeypatch.setattr(archive, "_can_archive", lambda conn: False)
+    monkeypatch.setattr(db, "list_archivable_conversations",
+                        lambda older_than: [{"conversation_id": conversation_id, "messages": 3}])
+
+    def get_archivable_messages(*args):
+        raise AssertionError("no debe leer mensajes sin permiso de stub")
+
+    monkeypatch.setattr(db, "get_archivable_messages", get_archivable_messages)
+    with pytest.raises(archive.ArchiveAborted):
+        archive.run()
+    assert logins == ["vault_archive"]
+
+
+def test_export_import_roundtrip_verifies_chain(monkeypatch, client):
+    import hashlib
+    import io
+
+    from client import transfer as client_transfer
+
+    conversation_id = "00000000-0000-0000-0000-0000000000c2"
+    sender = "00000000-0000-0000-0000-0000000000aa"
+    rows, prev = [], None
+    for i in range(3):
+        ciphertext = bytes([i]) * 50
+        content_hash = hashlib.sha256(
+            ciphertext + sender.encode() + conversation_id.encode() + (prev or b"")
+        ).digest()
+        rows.append({
+            "message_id": f"00000000-0000-0000-0000-00000000010{i}",
+            "sender_id": sender, "ciphertext": ciphertext, "content_hash": content_hash,
+            "prev_hash": prev, "signature": b"s" * 64, "client_timestamp": None,
+            "key_id": "primary", "created_at": datetime(2024, 1, 1, 0, 0, i),
+            "attachments": [], "receipts": [
+                {"user_id": sender, "delivered_at": "2024-01-01T00:01:00", "read_at": None},
+            ],
+        })
+        prev = content_hash
+
+    monkeypatch.setattr(db, "conversation_exists", lambda cid: True)
+    monkeypatch.setattr(db, "is_participant", lambda cid, uid: True)
+    monkeypatch.setattr(db, "get_conversation_export_header", lambda cid: {
+        "conversation_id": cid, "created_at": datetime(2024, 1, 1), "participants": [sender],
+    })
+    monkeypatch.setattr(db, "stream_conversation_export", lambda cid, after, data: iter(rows))
+    monkeypatch.setattr(db, "prepare_import", lambda cid, participants, created_at: True)
+    monkeypatch.setattr(db, "get_recent_message_hashes", lambda cid, limit: [])
+    loaded = []
+
+    def import_messages_batch(cid, messages):
+        loaded.extend(messages)
+        return {"messages": len(messages), "attachments": 0,
+                "receipts": sum(len(m["receipts"]) for m in messages)}
+
+    monkeypatch.setattr(db, "import_messages_batch", import_messages_batch)
+    monkeypatch.setattr(api, "ADMIN_TOKEN", "secret")
+    monkeypatch.setattr(transfer, "IMPORT_BATCH_SIZE", 2)
+
+    for fmt in ("ndjson", "binary"):
+        resp = client.get(f"/conversations/{conversation_id}/export",
+                          params={"user_id": sender, "format": fmt})
+        assert resp.status_code == 200
+        exported = resp.content
+        assert exported.startswith(transfer.MAGIC) == (fmt == "binary")
+
+        loaded.clear()
+        resp = client.post(f"/conversations/{conversation_id}/import", content=exported,
+                           headers={"X-Admin-Token": "secret"})
+        assert resp.status_code == 200
+        assert resp.json()["messages"] == 3 and resp.json()["complete"]
+        assert [m["ciphertext"] for m in loaded] == [r["ciphertext"] for r in rows]
+
+        # Exportación cortada: se reanuda tras el último mensaje completo
+        state = client_transfer.resume_point(io.BytesIO(exported[:-150]))
+        assert not state["complete"]
+        assert state["last_message_id"] == rows[1]["message_id"]
+
+    # Un ciphertext alterado rompe el content_hash
+    tampered = exported.replace(bytes([2]) * 50, bytes([9]) * 50)
+    resp = client.post(f"/conversations/{conversation_id}/import", content=tampered,
+                       headers={"X-Admin-Token": "secret"})
+    assert resp.status_code == 400
+    assert resp.json()["detail"]["imported"]["messages"] == 2
+
+    # Con VAULT_VERIFY_SIGNATURES=1 cada firma se comprueba contra user_keys
+    private_key = Ed25519PrivateKey.generate()
+    public_pem = private_key.public_key().public_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo,
+    ).decode()
+    lookups = []
+
+    def lookup_keys(pairs, user_ids, since=None):
+        lookups.append(pairs)
+        return [{"user_id": sender, "key_id": "primary", "public_key": public_pem}]
+
+    monkeypatch.setattr(db, "lookup_keys", lookup_keys)
+    monkeypatch.setattr(signatures, "VERIFY_SIGNATURES", True)
+    resp = client.post(f"/conversations/{conversation_id}/import", content=exported,
+                       headers={"X-Admin-Token": "secret"})
+    assert resp.status_code == 400
+    assert resp.json()["detail"]["imported"]["messages"] == 0
+
+    for row in rows:
+        row["signature"] = private_key.sign(row["content_hash"])
+    exported = client.get(f"/conversations/{conversation_id}/export",
+                          params={"user_id": sender}).content
+    lookups.clear()
+    resp = client.post(f"/conversations/{conversation_id}/import", content=exported,
+                       headers={"X-Admin-Token": "secret"})
+    assert resp.status_code == 200 and resp.json()["messages"] == 3
+    # Una consulta de claves por lote
+    assert lookups == [[(sender, "primary")]] * 2
+
+
+def test_shard_ring_placements_and_moving_conversation(monkeypatch, client):
+    shards = db.parse_shards("s1=h1:5433/v1, s2=h2/v2")
+    assert shards["s1"]["host"] == "h1" and shards["s1"]["port"] == 5433
+    assert shards["s2"]["port"] == db.DB_CONFIG["port"] and shards["s2"]["dbname"] == "v2"
+    with pytest.raises(ValueError):
+        db.parse_shards("s1")
+
+    keys = [f"00000000-0000-0000-0000-{i:012d}" for i in range(2000)]
+    ring = db.ShardRing(["s1", "s2", "s3"])
+    placed = {k: ring.lookup(k) for k in keys}
+    counts = {s: list(placed.values()).count(s) for s in ("s1", "s2", "s3")}
+    assert min(counts.values()) > 400
+
+    # Con un cuarto shard solo se mueven las que van a él
+    grown = db.ShardRing(["s1", "s2", "s3", "s4"])
+    moved = [k for k in keys if grown.lookup(k) != placed[k]]
+    assert all(grown.lookup(k) == "s4" for k in moved)
+    assert len(moved) < len(keys) / 2
+
+    cid = keys[0]
+    monkeypatch.setattr(db, "SHARDED", True)
+    monkeypatch.setattr(db, "RING", ring)
+    monkeypatch.setattr(db, "_load_placements", lambda: {cid: ("s9", "moving")})
+    assert db.shard_for(keys[1]) == placed[keys[1]]
+    assert db.shard_for(cid.upper()) == "s9"
+    with pytest.raises(db.ConversationMoving):
+        db.shard_for(cid, write=True)
+
+    def moving_insert(**kwargs):
+        db.shard_for(kwargs["conversation_id"], write=True)
+
+    monkeypatch.setattr(db, "conversation_exists", lambda c: True)
+    monkeypatch.setattr(db, "is_participant", lambda c, u: True)
+    monkeypatch.setattr(db, "get_active_key", lambda uid, kid: {"public_key": "pk"})
+    monkeypatch.setattr(db, "insert_message", moving_insert)
+    resp = client.post(f"/conversations/{cid}/messages", json={
+        "sender_id": "00000000-0000-0000-0000-000000000001",
+        "ciphertext": b64("ct"),
+        "content_hash": b64("ch"),
+        "signature": b64("sig"),
+    })
+    assert resp.status_code == 503
+    assert int(resp.headers["retry-after"]) >= 1
+
+    # Un shard caído solo hace fallar sus filas del lote
+    other = next(k for k in keys[1:] if placed[k] == "s1")
+    down = next(k for k in keys[1:] if placed[k] == "s2")
+
+    def shard_insert(shard, rows):
+        if shard == "s2":
+            raise db.psycopg2.OperationalError("s2 down")
+        return [(f"m-{r['conversation_id']}", "t0") for r in rows]
+
+    monkeypatch.setattr(db, "SHARDS", {"s1": {}, "s2": {}, "s3": {}})
+    monkeypatch.setattr(db, "_insert_messages_batch", shard_insert)
+    results = db.insert_messages_batch([
+        {"conversation_id": other}, {"conversation_id": down}, {"conversation_id": cid},
+    ])
+    assert results[0] == (f"m-{other}", "t0")
+    assert isinstance(results[1], db.psycopg2.OperationalError)
+    assert isinstance(results[2], db.ConversationMoving)
+
+    # Recibos: shards resueltos de una vez, los de la conversación en traslado aparte
+    monkeypatch.setattr(db, "_message_routes", db.OrderedDict({"m-a": other, "m-b": cid}))
+    monkeypatch.setattr(db, "get_message_conversation_id", None)
+    monkeypatch.setattr(db, "_apply_receipts", lambda shard, rows: len(rows))
+    with pytest.raises(db.ReceiptsDeferred) as deferred:
+        db.apply_receipts([("m-a", "u", None, None), ("M-B", "u", None, None)])
+    assert deferred.value.written == 1
+    assert deferred.value.receipts == [("M-B", "u", None, None)]
+
+
+@pytest.fixture()
+def sqlite_engine(monkeypatch, tmp_path):
+    monkeypatch.setattr(sqlite_db, "SQLITE_PATH", str(tmp_path / "vault.sqlite3"))
+    storage.install(db, sqlite_db, monkeypatch.setattr)
+    return sqlite_db
+
+
+def test_import_only_appends_behind_the_tail(sqlite_engine):
+    user = db.create_user("pk", b"fp")
+    conversation_id = db.create_conversation([user])
+
+    def record(n, created_at):
+        return {
+            "message_id": f"00000000-0000-0000-0000-00000000020{n}", "sender_id": user,
+            "ciphertext": b"ct", "content_hash": bytes([n]) * 32, "prev_hash": None,
+            "signature": b"sig", "client_timestamp": None, "key_id": "primary",
+            "created_at": created_at, "attachments": [], "receipts": [],
+        }
+
+    first = record(0, datetime(2024, 1, 1))
+    assert db.import_messages_batch(conversation_id, [first])["messages"] == 1
+    # Repetir lo ya cargado se salta y reanudar detrás de la cola vale
+    assert db.import_messages_batch(
+        conversation_id, [first, record(1, datetime(2024, 1, 2))]
+    )["messages"] == 1
+
+    # Con mensajes en vivo, algo anterior cambiaría páginas ya servidas
+    db.insert_message(conversation_id, user, b"live", b"h" * 32, b"sig")
+    with pytest.raises(db.ImportBeforeTail):
+        db.import_messages_batch(conversation_id, [record(2, datetime(2024, 1, 3))])
+
+
+def test_sqlite_engine_matches_postgres_interface():
+    assert storage.mismatches(db, sqlite_db) == []
+
+
+def test_sqlite_engine_full_stack(sqlite_engine, client):
+    alice = client.post("/users", json={"public_key": "pk-a", "fingerprint": b64("fa")}).json()["user_id"]
+    bob = client.post("/users", json={"public_key": "pk-b", "fingerprint": b64("fb")}).json()["user_id"]
+    resp = client.post("/conversations", json={"participants": [alice, bob]})
+    conversation_id = resp.json()["conversation_id"]
+    assert client.get(f"/users/{bob}/conversations").json()[0]["conversation_id"] == conversation_id
+
+    # Rotación: la nueva clave pasa a primaria y la anterior se revoca
+    client.post(f"/users/{alice}/keys", json={"key_id": "k2", "public_key": "pk-a2", "fingerprint": b64("fa2")})
+    assert client.post(f"/users/{alice}/keys/k2/primary").status_code == 200
+    assert client.post(f"/users/{alice}/keys/primary/revoke").status_code == 200
+    keys = {k["key_id"]: k for k in client.get(f"/users/{alice}/keys").json()}
+    assert keys["k2"]["is_primary"] is True and keys["primary"]["revoked_at"]
+
+    url = f"/conversations/{conversation_id}/messages"
+    prev, ids = None, []
+    for text in ("uno", "dos", "tres"):
+        ciphertext = text.encode()
+        content_hash = hashlib.sha256(
+            ciphertext + alice.encode() + conversation_id.encode() + (prev or b"")
+        ).digest()
+        payload = {
+            "sender_id": alice,
+            "ciphertext": base64.b64encode(ciphertext).decode(),
+            "content_hash": base64.b64encode(content_hash).decode(),
+            "prev_hash": base64.b64encode(prev).decode() if prev else None,
+            "signature": b64("sig"),
+            "key_id": "k2",
+        }
+        resp = client.post(url, json=payload, headers={"Idempotency-Key": f"k-{text}"})
+        assert resp.status_code == 200
+        ids.append(resp.json()["message_id"])
+        prev = content_hash
+    replay = client.post(url, json=payload, headers={"Idempotency-Key": "k-tres"})
+    assert replay.json()["message_id"] == ids[-1]
+    other = client.post("/conversations", json={"participants": [alice]}).json()["conversation_id"]
+    reused = client.post(
+        f"/conversations/{other}/messages", json=payload, headers={"Idempotency-Key": "k-tres"}
+    )
+    assert reused.status_code == 409
+    payload["key_id"] = "primary"
+    assert client.post(url, json=payload).status_code == 400
+
+    page = client.get(url, params={"after": ids[0]}).json()
+    assert [m["message_id"] for m in page] == ids[1:]
+    assert client.get(f"{url}/last-hash").json()["content_hash"] == base64.b64encode(prev).decode()
+
+    assert client.post(f"/messages/{ids[0]}/read", json={"user_id": bob}).status_code == 200
+    status = client.get(f"/messages/{ids[0]}/status").json()
+    assert status[0]["user_id"] == bob and status[0]["read_at"]
+
+    resp = client.post(f"/messages/{ids[0]}/attachments", json={
+        "uploader_id": bob, "ciphertext": b64("adjunto"), "content_hash": b64("ah"), "signature": b64("as"),
+    })
+    attachment_id = resp.json()["attachment_id"]
+    assert base64.b64decode(client.get(f"/attachments/{attachment_id}", params={"user_id": alice}).json()["ciphertext"]) == b"adjunto"
+    expanded = client.get(url, params={"include": "attachments,status"}).json()
+    assert expanded[0]["attachments"][0]["attachment_id"] == attachment_id
+
+    other = client.post("/users", json={"public_key": "pk-c", "fingerprint": b64("fc")}).json()["user_id"]
+    batch = client.post("/messages:batchGet", json={"user_id": other, "message_ids": ids[:1]}).json()
+    assert batch["forbidden"] == ids[:1]
+
+    exported = client.get(f"/conversations/{conversation_id}/export", params={"user_id": bob}).content
+    records = [json.loads(line) for line in exported.splitlines()]
+    assert [r["type"] for r in records] == ["header", "message", "message", "message", "end"]
+    assert records[1]["receipts"][0]["user_id"] == bob
+
+
+def test_sqlite_engine_enforces_append_only(sqlite_engine, tmp_path, monkeypatch):
+    user = db.create_user("pk", b"fp")
+    conversation_id = db.create_conversation([user])
+    message_id, _ = db.insert_message(conversation_id, user, b"ct", b"h1", b"sig")
+    conn = sqlite_db.connect()
+    with pytest.raises(sqlite3.IntegrityError):
+        conn.execute("UPDATE messages SET ciphertext = X'00';")
+    with pytest.raises(sqlite3.IntegrityError, match="immutable"):
+        conn.execute("DELETE FROM messages;")
+    with pytest.raises(db.UnknownUsers):
+        db.create_conversation([user, "00000000-0000-0000-0000-000000000009"])
+
+    # El archivador es la única vía de UPDATE, y solo para dejar stubs
+    monkeypatch.setattr(segments, "ARCHIVE_DIR", tmp_path / "archive")
+    rows = db.get_archivable_messages(conversation_id, datetime.utcnow() + timedelta(days=1), 10)
+    segment_id = db.new_uuid()
+    path = segments.segment_path(conversation_id, segment_id)
+    db.record_segment(segment_id, conversation_id, rows, segments.write_segment(path, conversation_id, rows))
+    assert db.get_messages(conversation_id)[0]["ciphertext"] == b"ct"
+    with pytest.raises(RuntimeError):
+        db.record_segment(db.new_uuid(), conversation_id, rows, {"bytes": 1, "sha256": b""})
+    assert db.get_message_conversation_id(message_id) == conversation_id
+
+
+def test_list_messages_around_timestamp(sqlite_engine, client):
+    user = db.create_user("pk", b"fp")
+    conversation_id = db.create_conversation([user])
+    sent = [db.insert_message(conversation_id, user, b"ct", f"h{n}".encode(), b"sig") for n in range(10)]
+    ids = [message_id for message_id, _ in sent]
+    url = f"/conversations/{conversation_id}/messages"
+
+    def page(resp):
+        assert resp.status_code == 200
+        links = dict(
+            (part.split('rel="')[1].rstrip('"'), part.split(">")[0].lstrip(" <"))
+            for part in resp.headers.get("Link", "").split(",") if part
+        )
+        return [m["message_id"] for m in resp.json()], links
+
+    # 2 anteriores al instante del 6.º mensaje + 3 desde él
+    window, links = page(client.get(url, params={"around": sent[5][1].isoformat(), "before": 2, "limit": 3}))
+    assert window == ids[3:8]
+    assert set(links) == {"prev", "next"}
+
+    newer, _ = page(client.get(links["next"]))
+    assert newer == ids[8:]
+    older, links = page(client.get(links["prev"]))
+    assert older == ids[1:3] and "prev" in links
+
+    # Antes del primero y con zona horaria: ventana solo hacia delante
+    start = (sent[0][1] - timedelta(hours=1)).replace(tzinfo=timezone.utc)
+    window, links = page(client.get(url, params={"around": start.isoformat(), "before": 5, "limit": 20}))
+    assert window == ids and links == {}
+
+    assert client.get(url, params={"before": 2}).status_code == 400
+    assert client.get(url, params={"around": start.isoformat(), "after": ids[0]}).status_code == 400
+    assert client.get(url, params={"around": start.isoformat(), "limit": 0}).status_code == 400
+
+
+def _merkle_root(content_hashes: list) -> bytes:
+    # MTH de RFC 6962 por definición, para contrastar lo que guarda el servidor
+    if not content_hashes:
+        return verify.EMPTY_ROOT
+    if len(content_hashes) == 1:
+        return verify.leaf_hash(content_hashes[0])
+    k = 1 << ((len(content_hashes) - 1).bit_length() - 1)
+    return verify.node_hash(_merkle_root(content_hashes[:k]), _merkle_root(content_hashes[k:]))
+
+
+def test_merkle_tree_heads_and_proofs(sqlite_engine, monkeypatch, tmp_path, client):
+    monkeypatch.setattr(merkle, "SIGNING_KEY_FILE", tmp_path / "tree_head.pem")
+    monkeypatch.setattr(merkle, "_key", None)
+    # La clave no se crea sola: solo con init-key, que no sobrescribe
+    with pytest.raises(merkle.MissingSigningKey):
+        merkle.signing_key()
+    merkle.main(["init-key"])
+    with pytest.raises(SystemExit):
+        merkle.main(["init-key"])
+    # Lotes pequeños: la frontera se recarga de la base entre lotes
+    monkeypatch.setattr(merkle, "INTEGRATE_BATCH", 3)
+
+    user = db.create_user("pk", b"fp")
+    conversation_id = db.create_conversation([user])
+    hashes, ids = [], []
+
+    def send(count):
+        for n in range(count):
+            ciphertext = f"ct{len(ids)}".encode()
+            content_hash = client_crypto.calculate_message_hash(
+                ciphertext, user, conversation_id, hashes[-1] if hashes else None
+            )
+            message_id, _ = db.insert_message(
+                conversation_id, user, ciphertext, content_hash, b"sig",
+                prev_hash=hashes[-1] if hashes else None,
+            )
+            hashes.append(content_hash)
+            ids.append(message_id)
+
+    trusted = {"public_key": None, "conversations": {}}
+    empty = verify.check_tree_head(client, conversation_id, trusted)
+    assert empty["tree_size"] == 0
+    assert verify.b64d(empty["root_hash"]) == verify.EMPTY_ROOT
+
+    send(7)
+    report = verify.audit_proofs(client, conversation_id, trusted, ids, user)
+    assert report["tree_size"] == 7
+    assert verify.b64d(report["root_hash"]) == _merkle_root(hashes)
+    assert report["included"] == {message_id: n for n, message_id in enumerate(ids)}
+
+    # Cualquier tamaño anterior: inclusión y consistencia de O(log n) hashes
+    for size in range(1, 8):
+        root = _merkle_root(hashes[:size])
+        for index in range(size):
+            proof = merkle.inclusion_proof(conversation_id, ids[index], size)
+            assert len(proof["inclusion_path"]) <= (size - 1).bit_length()
+            assert verify.verify_inclusion(
+                index, size, verify.leaf_hash(hashes[index]), proof["inclusion_path"], root
+            )
+            assert not verify.verify_inclusion(
+                index, size, verify.leaf_hash(b"forged"), proof["inclusion_path"], root
+            )
+        for first in range(0, size + 1):
+            path = merkle.consistency_proof(conversation_id, first, size)["consistency_path"]
+            first_root = _merkle_root(hashes[:first])
+            assert verify.verify_consistency(first, size, first_root, root, path)
+            if 0 < first < size:
+                assert not verify.verify_consistency(first, size, verify.leaf_hash(b"x"), root, path)
+
+    # El árbol crece: la siguiente cabecera se comprueba contra la guardada
+    send(6)
+    head = verify.check_tree_head(client, conversation_id, trusted)
+    assert head["tree_size"] == 13
+    assert trusted["conversations"][conversation_id] == head
+
+    forged = dict(head, tree_size=14)
+    assert not verify.verify_tree_head(
+        verify.serialization.load_pem_public_key(trusted["public_key"].encode()),
+        conversation_id, forged,
+    )
+    trusted["conversations"][conversation_id] = dict(
+        head, tree_size=5, root_hash=verify.b64e(_merkle_root(hashes[1:6]))
+    )
+    with pytest.raises(verify.VerificationError, match="no extiende"):
+        verify.check_tree_head(client, conversation_id, trusted)
+
+    url = f"/conversations/{conversation_id}/proofs"
+    assert client.get(f"{url}/inclusion", params={"message_id": ids[9], "tree_size": 5}).status_code == 400
+    assert client.get(f"{url}/inclusion", params={"message_id": ids[0], "tree_size": 99}).status_code == 400
+    assert client.get(
+        f"{url}/inclusion", params={"message_id": "00000000-0000-0000-0000-000000000000"}
+    ).status_code == 404
+    assert client.get(f"{url}/consistency", params={"first": 8, "second": 3}).status_code == 400
+
+    # Una transacción que confirma mucho después de su created_at (anterior a
+    # la marca de agua) también recibe hoja, detrás de las ya secuenciadas
+    late = datetime(2000, 1, 1)
+    assert db.get_merkle_head(conversation_id)["sequenced_until"] > late
+    with monkeypatch.context() as m:
+        m.setattr(sqlite_db, "_now", lambda: late)
+        send(1)
+    head = merkle.tree_head(conversation_id)
+    assert head["tree_size"] == 14 and head["root_hash"] == _merkle_root(hashes)
+    proof = merkle.inclusion_proof(conversation_id, ids[-1], 14)
+    assert verify.verify_inclusion(
+        13, 14, verify.leaf_hash(hashes[-1]), proof["inclusion_path"], head["root_hash"]
+    )
+
+    # Las hojas son inmutables
+    with pytest.raises(sqlite3.IntegrityError, match="immutable"):
+        sqlite_db.connect().execute("UPDATE merkle_leaves SET hash = X'00';")
+
+
+def test_tail_cache_serves_hot_tail_and_follows_notifications(monkeypatch, client):
+    conversation_id = "00000000-0000-0000-0000-0000000000c1"
+
+    def message(n, created_at):
+        return {
+            "message_id": f"00000000-0000-0000-0000-{n:012d}",
+            "conversation_id": conversation_id,
+            "sender_id": "00000000-0000-0000-0000-0000000000a1",
+            "ciphertext": f"ct{n}".encode(),
+            "content_hash": f"h{n}".encode(),
+            "prev_hash": f"h{n - 1}".encode() if n > 1 else None,
+            "signature": b"sig",
+            "client_timestamp": None,
+            "key_id": "primary",
+            "created_at": created_at,
+            "segment_id": None,
+        }
+
+    t0 = datetime(2026, 3, 1, 12, 0, 0)
+    rows = [message(n, t0 + timedelta(seconds=n)) for n in range(1, 4)]
+    cache = tailcache.TailCache(max_bytes=1 << 20, tail_messages=3)
+    monkeypatch.setattr(tailcache, "ENABLED", True)
+    monkeypatch.setattr(tailcache, "_get", lambda: cache)
+    monkeypatch.setattr(tailcache, "_cache", cache)
+    monkeypatch.setattr(db, "conversation_exists", lambda cid: True)
+    monkeypatch.setattr(db, "message_exists", lambda cid, mid: True)
+    monkeypatch.setattr(db, "get_messages", lambda **kwargs: [dict(r) for r in rows])
+    hits = tailcache.LOOKUPS.value("hit")
+
+    url = f"/conversations/{conversation_id}/messages"
+    first = client.get(url)
+    assert first.status_code == 200 and len(first.json()) == 3
+
+    # Segunda lectura: mismos bytes y mismo ETag, sin consultas
+    def no_db(*args, **kwargs):
+        raise AssertionError("la cola debería salir de la caché")
+
+    monkeypatch.setattr(db, "conversation_exists", no_db)
+    monkeypatch.setattr(db, "get_messages", no_db)
+    cached = client.get(url)
+    assert cached.content == first.content
+    assert cached.headers["ETag"] == first.headers["ETag"]
+    assert client.get(url, headers={"If-None-Match": first.headers["ETag"]}).status_code == 304
+    assert client.get(url, params={"after": rows[-1]["message_id"]}).json() == []
+    assert tailcache.LOOKUPS.value("hit") == hits + 3
+
+    # Un insert en otro worker llega por NOTIFY con la fila precodificada
+    class Cursor:
+        def execute(self, sql, params):
+            self.params = params
+
+    cur = Cursor()
+    fourth = message(4, t0 + timedelta(seconds=4))
+    events = tailcache.publish(cur, [fourth])
+    assert cur.params[0] == tailcache.CHANNEL
+    cache.apply([tailcache._parse(payload) for payload in cur.params[1]])
+    assert events[0][1].body == cache._tails[conversation_id].rows[-1].body
+    page = client.get(url, params={"after": rows[-1]["message_id"]}).json()
+    assert [m["message_id"] for m in page] == [fourth["message_id"]]
+    # Recortada a 3 filas: el principio ya no está en la caché
+    monkeypatch.setattr(db, "get_messages", lambda **kwargs: [dict(r) for r in rows[:1]])
+    monkeypatch.setattr(db, "conversation_exists", lambda cid: True)
+    monkeypatch.setattr(db, "get_message_page_tail", lambda *args: None)
+    assert len(client.get(url, params={"limit": 1}).json()) == 1
+
+    # Un commit tardío anterior al ancla invalida la cola
+    cache.apply([(conversation_id, tailcache._Entry.from_row(message(9, t0)))])
+    assert conversation_id not in cache._tails
+
+
+def test_tail_cache_budget_and_racing_reads():
+    t0 = datetime(2026, 3, 1)
+
+    def rows(cid, count):
+        return [{
+            "message_id": f"{cid}-{n}", "sender_id": "u", "ciphertext": b"x" * 100,
+            "content_hash": b"h", "prev_hash": None, "signature": b"s",
+            "client_timestamp": None, "key_id": None, "created_at": t0 + timedelta(seconds=n),
+        } for n in range(count)]
+
+    one_tail = tailcache._Tail(tailcache.START, [tailcache._Entry.from_row(r) for r in rows("c1", 5)]).size
+    cache = tailcache.TailCache(max_bytes=2 * one_tail, tail_messages=10)
+    evictions = tailcache.EVICTIONS.value()
+    for cid in ("c1", "c2"):
+        cache.fill(cid, None, rows(cid, 5), cache.token())
+    assert cache.page("c1", None, 50)  # c1 pasa a ser la más reciente
+    cache.fill("c3", None, rows("c3", 5), cache.token())
+    assert list(cache._tails) == ["c1", "c3"]
+    assert tailcache.EVICTIONS.value() == evictions + 1
+    assert cache._bytes == 2 * one_tail
+
+    # Una escritura entre el token y el fill: la lectura no se cachea
+    token = cache.token()
+    cache.apply([("c4", None)])
+    cache.fill("c4", None, rows("c4", 2), token)
+    assert cache.page("c4", None, 50) is None
+    cache.clear()
+    assert cache._bytes == 0 and cache.page("c1", None, 50) is None
+
+
+def test_signal_bus_coalesces_expires_and_drops_slow_subscribers():
+    conversation_id = "00000000-0000-0000-0000-0000000000d1"
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        bus = signals.SignalBus(max_pending=2)
+        bob = bus.subscribe(conversation_id, "bob", loop)
+
+        assert bus.publish(conversation_id, "alice", "typing", "start", ttl_s=3) == 1
+        # Repetición con más de medio TTL por delante: no se reparte
+        assert bus.publish(conversation_id, "alice", "typing", "start", ttl_s=3) is None
+        # Cambio de estado: sustituye a la pendiente del mismo (usuario, tipo)
+        assert bus.publish(conversation_id, "alice", "typing", "stop", ttl_s=3) == 1
+        # Sin eco hacia el propio usuario
+        assert bus.publish(conversation_id, "bob", "typing", "start", ttl_s=3) == 0
+        batch = await bob.next_batch(1)
+        assert [(s.user_id, s.state) for s in batch] == [("alice", "stop")]
+
+        # Caducada antes de entregarse: se descarta
+        bus.publish(conversation_id, "alice", "presence", "online", ttl_s=0.01)
+        await asyncio.sleep(0.05)
+        assert await bob.next_batch(1) == []
+
+        # Quien se suscribe ve las señales aún vigentes de los demás
+        carol = bus.subscribe(conversation_id, "carol", loop)
+        stream = signals.stream(bus, carol, heartbeat_s=0.05)
+        assert await stream.__anext__() == "retry: 2000\n\n"
+        event = await stream.__anext__()
+        assert event.count("event: ") == 2 and '"state":"stop"' in event and '"state":"start"' in event
+        assert await stream.__anext__() == ": keep-alive\n\n"
+        await stream.aclose()
+
+        # Cola llena (dos pares usuario/tipo sin leer): se suelta, no se acumula
+        assert bus.publish(conversation_id, "dave", "viewing", None, ttl_s=3) == 1
+        assert bus.publish(conversation_id, "erin", "viewing", None, ttl_s=3) == 1
+        assert bus.publish(conversation_id, "frank", "viewing", None, ttl_s=3) == 0
+        assert await bob.next_batch(1) is None
+        assert bus.publish(conversation_id, "grace", "viewing", None, ttl_s=3) == 0
+
+    dropped = signals.DROPPED.value()
+    asyncio.run(scenario())
+    assert signals.DROPPED.value() == dropped + 1
+
+
+def test_signal_endpoints_authorize_with_cached_participants(monkeypatch, client):
+    conversation_id = "00000000-0000-0000-0000-0000000000d2"
+    alice = "00000000-0000-0000-0000-0000000000a1"
+    mallory = "00000000-0000-0000-0000-0000000000a9"
+    checks = []
+
+    def is_participant(cid, user_id):
+        checks.append(user_id)
+        return user_id == alice
+
+    monkeypatch.setattr(db, "is_participant", is_participant)
+    monkeypatch.setattr(signals, "_participants", signals.OrderedDict())
+    monkeypatch.setattr(signals, "_bus", signals.SignalBus())
+    url = f"/conversations/{conversation_id}/signals"
+
+    resp = client.post(url, json={"user_id": alice, "type": "typing", "state": "start"})
+    assert resp.status_code == 202
+    assert resp.json() == {"coalesced": False, "delivered": 0}
+    resp = client.post(url, json={"user_id": alice, "type": "typing", "state": "start"})
+    assert resp.json() == {"coalesced": True, "delivered": 0}
+    assert checks == [alice]
+
+    assert client.post(url, json={"user_id": mallory, "type": "typing"}).status_code == 403
+    assert client.post(url, json={"user_id": alice, "type": "shout"}).status_code == 400
+    assert client.post(url, json={"user_id": alice, "type": "presence", "ttl_s": 3600}).status_code == 400
+    assert client.post(url, json={"user_id": alice, "type": "typing", "state": "x" * 33}).status_code == 400
+    resp = client.get(f"/conversations/{conversation_id}/events", params={"user_id": mallory})
+    assert resp.status_code == 403
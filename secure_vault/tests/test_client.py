@@ -0,0 +1,117 @@
+import base64
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from client import crypto, receive
+
+
+CONVERSATION_ID = "00000000-0000-0000-0000-00000000000c"
+SENDER_ID = "00000000-0000-0000-0000-000000000001"
+
+
+def b64(data: bytes) -> str:
+    return base64.b64encode(data).decode()
+
+
+def make_message(private_key, message_id: str, text: bytes, prev_hash=None):
+    encrypted = crypto.encrypt_message(text)
+    content_hash = crypto.calculate_message_hash(
+        encrypted["ciphertext"], SENDER_ID, CONVERSATION_ID, prev_hash
+    )
+    message = {
+        "message_id": message_id,
+        "sender_id": SENDER_ID,
+        "ciphertext": b64(encrypted["ciphertext"]),
+        "content_hash": b64(content_hash),
+        "prev_hash": b64(prev_hash) if prev_hash else None,
+        "signature": b64(private_key.sign(content_hash)),
+        "key_id": "primary",
+    }
+    key = {"key": b64(encrypted["key"]), "nonce": b64(encrypted["nonce"])}
+    return message, key
+
+
+def test_receive_many_statuses():
+    private_key = Ed25519PrivateKey.generate()
+    public_key = private_key.public_key()
+
+    ok, ok_key = make_message(private_key, "m1", b"hola")
+    tampered, _ = make_message(private_key, "m2", b"adios")
+    tampered["ciphertext"] = b64(b"otro")
+    forged, _ = make_message(Ed25519PrivateKey.generate(), "m3", b"falso")
+    unknown, _ = make_message(private_key, "m4", b"rotada")
+    unknown["key_id"] = "device-9"
+
+    calls = []
+
+    def resolve(sender_id, key_id):
+        calls.append((sender_id, key_id))
+        return public_key if key_id == "primary" else None
+
+    results = receive.receive_many(
+        CONVERSATION_ID,
+        [ok, tampered, forged, unknown],
+        resolve,
+        message_keys={"m1": ok_key},
+    )
+
+    assert [r["status"] for r in results] == [
+        receive.STATUS_OK,
+        receive.STATUS_BAD_HASH,
+        receive.STATUS_BAD_SIGNATURE,
+        receive.STATUS_UNKNOWN_KEY,
+    ]
+    assert results[0]["plaintext"] == b"hola"
+    assert sorted(calls) == [(SENDER_ID, "device-9"), (SENDER_ID, "primary")]
+
+
+def test_compressed_envelope_roundtrip():
+    text = b"reunion a las diez, te envio el archivo ahora " * 20
+    encrypted = crypto.encrypt_message(text, compress=True)
+    assert len(encrypted["ciphertext"]) < len(text)
+    assert crypto.decrypt_message(
+        encrypted["ciphertext"], encrypted["nonce"], encrypted["key"]
+    ) == text
+
+    # Mensajes cortos no se comprimen
+    short = crypto.encrypt_message(b"ok", compress=True)
+    assert len(short["ciphertext"]) == 2 + 1 + 16
+
+    # Con diccionario también los cortos, que es para lo que se entrena
+    samples = [f"te veo a las {h} en la reunion {n}, ok?".encode() for h in range(24) for n in range(40)]
+    zstd_dict = crypto.train_dictionary(samples, dict_size=2048)
+    line = b"te veo a las 9 en la reunion 7, ok?"
+    body = crypto.encode_body(line, compress=True, zstd_dict=zstd_dict)
+    assert body[0] == crypto.FLAG_ZSTD_DICT and len(body) < len(line)
+    assert crypto.decode_body(body, zstd_dict) == line
+
+    # Cada hilo usa su propio descompresor (receive_many descifra en paralelo)
+    with ThreadPoolExecutor(4) as pool:
+        theirs = list(pool.map(lambda _: crypto._decompressor(None), range(4)))
+    main = crypto._decompressor(None)
+    assert main is crypto._decompressor(None)
+    assert all(d is not main for d in theirs)
+
+
+def test_decrypt_legacy_message_without_envelope():
+    key = AESGCM.generate_key(bit_length=256)
+    nonce = b"\x00" * 12
+    ciphertext = AESGCM(key).encrypt(nonce, b"legacy", None)
+    assert crypto.decrypt_message(ciphertext, nonce, key) == b"legacy"
+
+
+def test_group_envelope_wraps_key_per_recipient():
+    members = [Ed25519PrivateKey.generate() for _ in range(4)]
+    outsider = Ed25519PrivateKey.generate()
+
+    one = crypto.encrypt_group_message(b"anuncio", [members[0].public_key()])
+    many = crypto.encrypt_group_message(b"anuncio", [m.public_key() for m in members])
+    assert len(many["ciphertext"]) - len(one["ciphertext"]) == 3 * crypto.GROUP_ENTRY_SIZE
+
+    for member in members:
+        assert crypto.decrypt_group_message(many["ciphertext"], member) == b"anuncio"
+    with pytest.raises(ValueError):
+        crypto.decrypt_group_message(many["ciphertext"], outsider)